@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+
+from typing import Dict, Optional
+
+from django.db import connection, transaction
+
+from analytics.models import FillState
+
+from datetime import datetime, timedelta
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+# An hour is only counted once it's this far in the past: a
+# UserActivityInterval reaches 15 minutes past the activity it logs,
+# and the queue worker that writes them can lag.
+FILL_LAG = timedelta(minutes=30)
+
+# How far back the first fill on a server starts, enough for the
+# activity dashboards.
+INITIAL_FILL_DAYS = 15
+
+# How long hourly UserCount rows are kept once their day has been
+# rolled up; the activity dashboards read a week of them (for the
+# at-risk users), and the daily and RealmCount rows are kept forever.
+USER_HOUR_RETENTION_DAYS = 8
+
+# How far a UserActivityInterval reaches past the last activity it
+# logs (see do_update_user_activity_intervals).
+INTERVAL_TAIL = timedelta(minutes=15)
+
+class CountStat(object):
+    def __init__(self, property, user_query, day_aggregate='sum'):
+        # type: (str, str, str) -> None
+        """user_query selects (user_id, realm_id, subgroup, value) rows
+        for the hour from %(start_time)s to %(end_time)s.  A user's
+        count for a day is the day_aggregate ("sum" or "max") of their
+        counts for its hours, and a realm's the sum of its users'."""
+        self.property = property
+        self.user_query = user_query
+        self.day_aggregate = day_aggregate
+
+COUNT_STATS = dict((stat.property, stat) for stat in [
+    # By the id of the client they were sent from.
+    CountStat('messages_sent:client', '''
+        SELECT m.sender_id, up.realm_id, m.sending_client_id::text, count(*)
+        FROM zerver_message m
+        JOIN zerver_userprofile up ON up.id = m.sender_id
+        WHERE m.pub_date >= %(start_time)s AND m.pub_date < %(end_time)s
+        GROUP BY m.sender_id, up.realm_id, m.sending_client_id
+    '''),
+    # 1 for the humans who sent a message in the hour, or were using
+    # the app then, as logged by their UserActivityIntervals.
+    CountStat('active_users', '''
+        SELECT up.id, up.realm_id, '', 1
+        FROM (
+            SELECT m.sender_id
+            FROM zerver_message m
+            WHERE m.pub_date >= %(start_time)s AND m.pub_date < %(end_time)s
+            UNION
+            SELECT uai.user_profile_id
+            FROM zerver_useractivityinterval uai
+            WHERE uai."end" - %(interval_tail)s >= %(start_time)s AND uai.start < %(end_time)s
+        ) AS active (user_id)
+        JOIN zerver_userprofile up ON up.id = active.user_id
+        WHERE NOT up.is_bot
+    ''', day_aggregate='max'),
+    # How much of the hour the user's UserActivityIntervals cover.
+    CountStat('active_seconds', '''
+        SELECT uai.user_profile_id, up.realm_id, '',
+            sum(extract(epoch FROM least(uai."end", %(end_time)s) -
+                                   greatest(uai.start, %(start_time)s)))::bigint
+        FROM zerver_useractivityinterval uai
+        JOIN zerver_userprofile up ON up.id = uai.user_profile_id
+        WHERE uai."end" > %(start_time)s AND uai.start < %(end_time)s
+        GROUP BY uai.user_profile_id, up.realm_id
+    '''),
+]) # type: Dict[str, CountStat]
+
+def floor_to_hour(dt):
+    # type: (datetime) -> datetime
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def floor_to_day(dt):
+    # type: (datetime) -> datetime
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def do_fill_count_stat_at_hour(stat, end_time):
+    # type: (CountStat, datetime) -> None
+    """Counts the hour up to end_time, and if it's the last of a
+    (UTC) day, the day, pruning the hourly UserCount rows that are
+    past USER_HOUR_RETENTION_DAYS; all in one transaction with moving
+    stat's FillState to end_time, so that an interrupted fill starts
+    over with the same hour."""
+    frequencies = ['hour']
+    if end_time == floor_to_day(end_time):
+        frequencies.append('day')
+    params = dict(property=stat.property, start_time=end_time - HOUR, end_time=end_time,
+                  day_start=end_time - DAY,
+                  prune_before=end_time - USER_HOUR_RETENTION_DAYS * DAY,
+                  frequencies=tuple(frequencies),
+                  interval_tail=INTERVAL_TAIL)
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        # Anything there from a fill since forgotten by its FillState.
+        for table in ['analytics_usercount', 'analytics_realmcount']:
+            cursor.execute('''
+                DELETE FROM %s
+                WHERE property = %%(property)s AND frequency IN %%(frequencies)s
+                AND end_time = %%(end_time)s
+            ''' % (table,), params)
+
+        cursor.execute('''
+            INSERT INTO analytics_usercount (user_id, realm_id, property, subgroup, frequency, end_time, value)
+            SELECT user_id, realm_id, %%(property)s, subgroup, 'hour', %%(end_time)s, value
+            FROM (%s) AS counts (user_id, realm_id, subgroup, value)
+        ''' % (stat.user_query,), params)
+        if 'day' in frequencies:
+            cursor.execute('''
+                INSERT INTO analytics_usercount (user_id, realm_id, property, subgroup, frequency, end_time, value)
+                SELECT user_id, realm_id, property, subgroup, 'day', %%(end_time)s, %s(value)
+                FROM analytics_usercount
+                WHERE property = %%(property)s AND frequency = 'hour'
+                AND end_time > %%(day_start)s AND end_time <= %%(end_time)s
+                GROUP BY user_id, realm_id, property, subgroup
+            ''' % (stat.day_aggregate,), params)
+            cursor.execute('''
+                DELETE FROM analytics_usercount
+                WHERE property = %(property)s AND frequency = 'hour'
+                AND end_time <= %(prune_before)s
+            ''', params)
+
+        cursor.execute('''
+            INSERT INTO analytics_realmcount (realm_id, property, subgroup, frequency, end_time, value)
+            SELECT realm_id, property, subgroup, frequency, end_time, sum(value)
+            FROM analytics_usercount
+            WHERE property = %(property)s AND frequency IN %(frequencies)s
+            AND end_time = %(end_time)s
+            GROUP BY realm_id, property, subgroup, frequency, end_time
+        ''', params)
+        cursor.close()
+
+        FillState.objects.update_or_create(property=stat.property,
+                                           defaults={'end_time': end_time})
+
+def process_count_stat(stat, fill_to_time):
+    # type: (CountStat, datetime) -> int
+    """Counts each hour up to fill_to_time (an hour boundary) that
+    stat hasn't been counted for yet, and returns how many."""
+    fill_state = FillState.objects.filter(property=stat.property).first() # type: Optional[FillState]
+    if fill_state is None:
+        end_time = floor_to_day(fill_to_time) - INITIAL_FILL_DAYS * DAY
+    else:
+        end_time = fill_state.end_time
+
+    hours = 0
+    while end_time < fill_to_time:
+        end_time += HOUR
+        do_fill_count_stat_at_hour(stat, end_time)
+        hours += 1
+    return hours
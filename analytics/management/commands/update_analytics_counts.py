@@ -0,0 +1,45 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from typing import Any
+
+from analytics.lib.counts import COUNT_STATS, FILL_LAG, floor_to_hour, process_count_stat
+from zerver.lib.context_managers import lockfile
+from zerver.lib.timestamp import timestamp_to_datetime
+
+class Command(BaseCommand):
+    help = """Fills in the analytics count tables the activity dashboards
+read, for each hour since they were last filled in.
+
+Run as a cron job; hours are counted once they're analytics.lib.counts.FILL_LAG
+in the past."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--time', '-t', dest='time', type=float,
+                            help='Fill up to this UNIX timestamp, rather than now')
+        parser.add_argument('--stat', '-s', dest='stat', type=str,
+                            help='Only fill in this CountStat (e.g. active_users)')
+        parser.add_argument('--verbose', dest='verbose', action='store_true', default=False,
+                            help='Print how many hours of each CountStat were filled in')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if options['time'] is None:
+            fill_to_time = floor_to_hour(timezone.now() - FILL_LAG)
+        else:
+            fill_to_time = floor_to_hour(timestamp_to_datetime(options['time']))
+
+        if options['stat'] is None:
+            stats = list(COUNT_STATS.values())
+        else:
+            stats = [COUNT_STATS[options['stat']]]
+
+        with lockfile("/tmp/zulip_analytics_counts.lockfile"):
+            for stat in stats:
+                hours = process_count_stat(stat, fill_to_time)
+                if options['verbose']:
+                    print("%s: filled in %d hours, through %s" % (stat.property, hours, fill_to_time))
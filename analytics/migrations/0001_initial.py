@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('zerver', '0026_usermessage_flag_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FillState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('property', models.CharField(unique=True, max_length=40)),
+                ('end_time', models.DateTimeField()),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RealmCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('property', models.CharField(max_length=40)),
+                ('subgroup', models.CharField(default='', max_length=16)),
+                ('frequency', models.CharField(max_length=8)),
+                ('end_time', models.DateTimeField()),
+                ('value', models.BigIntegerField()),
+                ('realm', models.ForeignKey(to='zerver.Realm', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('property', models.CharField(max_length=40)),
+                ('subgroup', models.CharField(default='', max_length=16)),
+                ('frequency', models.CharField(max_length=8)),
+                ('end_time', models.DateTimeField()),
+                ('value', models.BigIntegerField()),
+                ('realm', models.ForeignKey(to='zerver.Realm', on_delete=django.db.models.deletion.CASCADE)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL, on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='realmcount',
+            unique_together=set([('realm', 'property', 'subgroup', 'frequency', 'end_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='realmcount',
+            index_together=set([('property', 'frequency', 'end_time')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='usercount',
+            unique_together=set([('user', 'property', 'subgroup', 'frequency', 'end_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='usercount',
+            index_together=set([('property', 'frequency', 'end_time')]),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+
+from django.db import models
+from six import text_type
+
+from zerver.models import Realm, UserProfile
+
+import datetime
+
+class FillState(models.Model):
+    """How far each of analytics.lib.counts' COUNT_STATS has been
+    filled in: every hour up to end_time."""
+    property = models.CharField(max_length=40, unique=True) # type: text_type
+    end_time = models.DateTimeField() # type: datetime.datetime
+    last_modified = models.DateTimeField(auto_now=True) # type: datetime.datetime
+
+    def __unicode__(self):
+        # type: () -> text_type
+        return u"<FillState: %s %s>" % (self.property, self.end_time)
+
+class BaseCount(models.Model):
+    # The CountStat this is a count of, and for some of them, which
+    # part of it (e.g. the sending client's id).
+    property = models.CharField(max_length=40) # type: text_type
+    subgroup = models.CharField(max_length=16, default='') # type: text_type
+    # The count covers the hour or day up to end_time.
+    frequency = models.CharField(max_length=8) # type: text_type
+    end_time = models.DateTimeField() # type: datetime.datetime
+    value = models.BigIntegerField() # type: int
+
+    class Meta(object):
+        abstract = True
+
+class RealmCount(BaseCount):
+    realm = models.ForeignKey(Realm) # type: Realm
+
+    class Meta(object):
+        unique_together = ("realm", "property", "subgroup", "frequency", "end_time")
+        index_together = ["property", "frequency", "end_time"]
+
+class UserCount(BaseCount):
+    user = models.ForeignKey(UserProfile) # type: UserProfile
+    realm = models.ForeignKey(Realm) # type: Realm
+
+    class Meta(object):
+        unique_together = ("user", "property", "subgroup", "frequency", "end_time")
+        index_together = ["property", "frequency", "end_time"]
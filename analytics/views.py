@@ -4,14 +4,16 @@ from six import text_type
 from typing import Any, Dict, List, Tuple, Optional, Sequence, Callable, Union
 
 from django.db import connection
+from django.db.models import Sum
 from django.db.models.query import QuerySet
 from django.template import RequestContext, loader
 from django.core import urlresolvers
 from django.http import HttpResponseNotFound, HttpRequest, HttpResponse
 from jinja2 import Markup as mark_safe
 
+from analytics.models import UserCount
 from zerver.decorator import has_request_variables, REQ, zulip_internal
-from zerver.models import get_realm, UserActivity, UserActivityInterval, Realm
+from zerver.models import get_realm, UserActivity, Realm
 from zerver.lib.timestamp import timestamp_to_datetime
 
 from collections import defaultdict
@@ -56,21 +58,38 @@ def dictfetchall(cursor):
     ]
 
 
+# The usercount rows (as uc) for the days since days_ago days ago:
+# whole days from the daily counts, and today from the hourly ones.
+# (end_time - interval '1 second')::date is the day a row counts.
+def recent_days_condition(days_ago):
+    # type: (int) -> str
+    return '''
+        (
+            (uc.frequency = 'day' and
+             uc.end_time > now()::date - interval '%d day' and
+             uc.end_time <= now()::date)
+        or
+            (uc.frequency = 'hour' and uc.end_time > now()::date)
+        )
+    ''' % (days_ago - 1,)
+
 def get_realm_day_counts():
     # type: () -> Dict[str, Dict[str, str]]
     query = '''
         select
             r.domain,
-            (now()::date - pub_date::date) age,
-            count(*) cnt
-        from zerver_message m
-        join zerver_userprofile up on up.id = m.sender_id
-        join zerver_realm r on r.id = up.realm_id
-        join zerver_client c on c.id = m.sending_client_id
+            (now()::date - (uc.end_time - interval '1 second')::date) age,
+            sum(uc.value) cnt
+        from analytics_usercount uc
+        join zerver_userprofile up on up.id = uc.user_id
+        join zerver_realm r on r.id = uc.realm_id
+        join zerver_client c on c.id = uc.subgroup::integer
         where
+            uc.property = 'messages_sent:client'
+        and
             (not up.is_bot)
         and
-            pub_date > now()::date - interval '8 day'
+            %s
         and
             c.name not in ('zephyr_mirror', 'ZulipMonitoring')
         group by
@@ -79,7 +98,7 @@ def get_realm_day_counts():
         order by
             r.domain,
             age
-    '''
+    ''' % (recent_days_condition(8),)
     cursor = connection.cursor()
     cursor.execute(query)
     rows = dictfetchall(cursor)
@@ -139,23 +158,15 @@ def realm_summary_table(realm_minutes):
         LEFT OUTER JOIN
             (
                 SELECT
-                    up.realm_id realm_id,
-                    count(distinct(ua.user_profile_id)) active_user_count
-                FROM zerver_useractivity ua
-                JOIN zerver_userprofile up
-                    ON up.id = ua.user_profile_id
+                    realm_id,
+                    count(distinct(user_id)) active_user_count
+                FROM analytics_usercount
                 WHERE
-                    query in (
-                        '/json/send_message',
-                        'send_message_backend',
-                        '/api/v1/send_message',
-                        '/json/update_pointer',
-                        '/json/users/me/pointer'
-                    )
+                    property = 'active_users'
                 AND
-                    last_visit > now() - interval '1 day'
+                    frequency = 'hour'
                 AND
-                    not is_bot
+                    end_time > now() - interval '1 day'
                 GROUP BY realm_id
             ) user_counts
             ON user_counts.realm_id = realm.id
@@ -166,48 +177,35 @@ def realm_summary_table(realm_minutes):
                     count(*) at_risk_count
                 FROM (
                     SELECT
-                        realm.id as realm_id,
-                        up.email
-                    FROM zerver_useractivity ua
+                        uc.realm_id,
+                        uc.user_id
+                    FROM analytics_usercount uc
                     JOIN zerver_userprofile up
-                        ON up.id = ua.user_profile_id
-                    JOIN zerver_realm realm
-                        ON realm.id = up.realm_id
+                        ON up.id = uc.user_id
                     WHERE up.is_active
-                    AND (not up.is_bot)
                     AND
-                        ua.query in (
-                            '/json/send_message',
-                            'send_message_backend',
-                            '/api/v1/send_message',
-                            '/json/update_pointer',
-                            '/json/users/me/pointer'
-                        )
-                    GROUP by realm.id, up.email
-                    HAVING max(last_visit) between
-                        now() - interval '7 day' and
-                        now() - interval '1 day'
+                        uc.property = 'active_users'
+                    AND
+                        uc.frequency = 'hour'
+                    AND
+                        uc.end_time > now() - interval '7 day'
+                    GROUP by uc.realm_id, uc.user_id
+                    HAVING max(uc.end_time) <= now() - interval '1 day'
                 ) as at_risk_users
                 GROUP BY realm_id
             ) at_risk_counts
             ON at_risk_counts.realm_id = realm.id
         WHERE EXISTS (
                 SELECT *
-                FROM zerver_useractivity ua
-                JOIN zerver_userprofile up
-                    ON up.id = ua.user_profile_id
+                FROM analytics_realmcount rc
                 WHERE
-                    query in (
-                        '/json/send_message',
-                        '/api/v1/send_message',
-                        'send_message_backend',
-                        '/json/update_pointer',
-                        '/json/users/me/pointer'
-                    )
+                    rc.realm_id = realm.id
+                AND
+                    rc.property = 'active_users'
                 AND
-                    up.realm_id = realm.id
+                    rc.frequency = 'hour'
                 AND
-                    last_visit > now() - interval '2 week'
+                    rc.end_time > now() - interval '2 week'
         )
         ORDER BY active_user_count DESC, domain ASC
         '''
@@ -282,43 +280,36 @@ def user_activity_intervals():
     day_end = timestamp_to_datetime(time.time())
     day_start = day_end - timedelta(hours=24)
 
-    output = "Per-user online duration for the last 24 hours:\n"
+    output = "Per-user online duration for the last 24 (whole) hours:\n"
     total_duration = timedelta(0)
 
-    all_intervals = UserActivityInterval.objects.filter(
-        end__gte=day_start,
-        start__lte=day_end
-    ).select_related(
-        'user_profile',
-        'user_profile__realm'
-    ).only(
-        'start',
-        'end',
-        'user_profile__email',
-        'user_profile__realm__domain'
+    all_counts = UserCount.objects.filter(
+        property='active_seconds',
+        frequency='hour',
+        end_time__gt=day_start,
+        end_time__lte=day_end
+    ).values(
+        'realm__domain',
+        'user__email'
+    ).annotate(
+        seconds=Sum('value')
     ).order_by(
-        'user_profile__realm__domain',
-        'user_profile__email'
+        'realm__domain',
+        'user__email'
     )
 
-    by_domain = lambda row: row.user_profile.realm.domain
-    by_email = lambda row: row.user_profile.email
+    by_domain = lambda row: row['realm__domain']
 
     realm_minutes = {}
 
-    for domain, realm_intervals in itertools.groupby(all_intervals, by_domain):
+    for domain, realm_counts in itertools.groupby(all_counts, by_domain):
         realm_duration = timedelta(0)
         output += '<hr>%s\n' % (domain,)
-        for email, intervals in itertools.groupby(realm_intervals, by_email):
-            duration = timedelta(0)
-            for interval in intervals:
-                start = max(day_start, interval.start)
-                end = min(day_end, interval.end)
-                duration += end - start
-
+        for row in realm_counts:
+            duration = timedelta(seconds=row['seconds'])
             total_duration += duration
             realm_duration += duration
-            output += "  %-*s%s\n" % (37, email, duration)
+            output += "  %-*s%s\n" % (37, row['user__email'], duration)
 
         realm_minutes[domain] = realm_duration.total_seconds() / 60
 
@@ -352,43 +343,43 @@ def sent_messages_report(realm):
         ) as series
         left join (
             select
-                pub_date::date pub_date,
-                count(*) cnt
-            from zerver_message m
-            join zerver_userprofile up on up.id = m.sender_id
-            join zerver_realm r on r.id = up.realm_id
+                (uc.end_time - interval '1 second')::date as day,
+                sum(uc.value) cnt
+            from analytics_usercount uc
+            join zerver_userprofile up on up.id = uc.user_id
+            join zerver_realm r on r.id = uc.realm_id
             where
-                r.domain = %s
+                r.domain = %%s
             and
                 (not up.is_bot)
             and
-                pub_date > now() - interval '2 week'
+                uc.property = 'messages_sent:client'
+            and
+                %s
             group by
-                pub_date::date
-            order by
-                pub_date::date
+                day
         ) humans on
-            series.day = humans.pub_date
+            series.day = humans.day
         left join (
             select
-                pub_date::date pub_date,
-                count(*) cnt
-            from zerver_message m
-            join zerver_userprofile up on up.id = m.sender_id
-            join zerver_realm r on r.id = up.realm_id
+                (uc.end_time - interval '1 second')::date as day,
+                sum(uc.value) cnt
+            from analytics_usercount uc
+            join zerver_userprofile up on up.id = uc.user_id
+            join zerver_realm r on r.id = uc.realm_id
             where
-                r.domain = %s
+                r.domain = %%s
             and
                 up.is_bot
             and
-                pub_date > now() - interval '2 week'
+                uc.property = 'messages_sent:client'
+            and
+                %s
             group by
-                pub_date::date
-            order by
-                pub_date::date
+                day
         ) bots on
-            series.day = bots.pub_date
-    '''
+            series.day = bots.day
+    ''' % (recent_days_condition(15), recent_days_condition(15))
     cursor = connection.cursor()
     cursor.execute(query, [realm, realm])
     rows = cursor.fetchall()
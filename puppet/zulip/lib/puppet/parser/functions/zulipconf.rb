@@ -0,0 +1,20 @@
+# zulipconf(section, key, default) returns the value of `key` in
+# `section` of /etc/zulip/zulip.conf, or `default` if it isn't set.
+module Puppet::Parser::Functions
+  newfunction(:zulipconf, :type => :rvalue) do |args|
+    section, key, default = args
+    current_section = nil
+    value = default
+    if File.exist?("/etc/zulip/zulip.conf")
+      File.readlines("/etc/zulip/zulip.conf").each do |line|
+        line = line.strip
+        if line =~ /^\[(.*)\]$/
+          current_section = $1.strip
+        elsif current_section == section and line =~ /^([^=:#;]+)[=:](.*)$/ and $1.strip == key
+          value = $2.strip
+        end
+      end
+    end
+    value
+  end
+end
@@ -15,6 +15,11 @@ class zulip::app_frontend_base {
   }
   safepackage { $web_packages: ensure => "installed" }
 
+  # The number of Tornado processes the event queues are sharded
+  # across; this must agree with TORNADO_PROCESSES, which defaults to
+  # the same setting.
+  $tornado_processes = zulipconf("application_server", "tornado_processes", 1)
+
   file { "/etc/nginx/zulip-include/app":
     require => Package["nginx-full"],
     owner  => "root",
@@ -28,7 +33,7 @@ class zulip::app_frontend_base {
     owner  => "root",
     group  => "root",
     mode => 644,
-    source => "puppet:///modules/zulip/nginx/zulip-include-frontend/upstreams",
+    content => template("zulip/nginx/upstreams.template.erb"),
     notify => Service["nginx"],
   }
   file { "/etc/nginx/zulip-include/uploads.types":
@@ -54,6 +59,15 @@ class zulip::app_frontend_base {
     source => "puppet:///modules/zulip/supervisor/conf.d/zulip.conf",
     notify => Service["supervisor"],
   }
+  file { "/etc/supervisor/conf.d/zulip-tornado.conf":
+    require => Package[supervisor],
+    ensure => file,
+    owner => "root",
+    group => "root",
+    mode => 644,
+    content => template("zulip/supervisor/zulip-tornado.conf.template.erb"),
+    notify => Service["supervisor"],
+  }
   file { "/home/zulip/tornado":
     ensure => directory,
     owner => "zulip",
@@ -24,6 +24,13 @@ class zulip_internal::staging_app_frontend {
     mode => 644,
     source => "puppet:///modules/zulip_internal/cron.d/active-user-stats",
   }
+  file { "/etc/cron.d/update-analytics-counts":
+    ensure => file,
+    owner  => "root",
+    group  => "root",
+    mode => 644,
+    source => "puppet:///modules/zulip_internal/cron.d/update-analytics-counts",
+  }
   file { "/etc/cron.d/clearsessions":
     ensure => file,
     owner  => "root",
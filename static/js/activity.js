@@ -49,6 +49,11 @@ $("html").on("mousemove", function () {
 
 exports.presence_info = {};
 
+// The presence data the server sent us, by email and client; pings
+// ask the server only for what changed since the last one.
+var raw_presences = {};
+var last_ping_server_timestamp;
+
 var huddle_timestamps = new Dict();
 
 
@@ -352,10 +357,14 @@ function status_from_timestamp(baseline_time, presence) {
 exports._status_from_timestamp = status_from_timestamp;
 
 function focus_ping() {
+    var ping_data = {status: (exports.has_focus) ? exports.ACTIVE : exports.IDLE,
+                     new_user_input: exports.new_user_input};
+    if (last_ping_server_timestamp !== undefined) {
+        ping_data.presences_since = last_ping_server_timestamp;
+    }
     channel.post({
         url: '/json/users/me/presence',
-        data: {status: (exports.has_focus) ? exports.ACTIVE : exports.IDLE,
-               new_user_input: exports.new_user_input},
+        data: ping_data,
         idempotent: true,
         success: function (data) {
             exports.presence_info = {};
@@ -369,8 +378,22 @@ function focus_ping() {
 
             exports.new_user_input = false;
 
-            // Ping returns the active peer list
+            // Ping returns the active peer list, or, if we asked for
+            // presences_since, the peers who changed since then (with
+            // no clients for those who went away).
+            if (data.presences_since === undefined) {
+                raw_presences = {};
+            }
             _.each(data.presences, function (presence, this_email) {
+                if (_.isEmpty(presence)) {
+                    delete raw_presences[this_email];
+                } else {
+                    raw_presences[this_email] = presence;
+                }
+            });
+            last_ping_server_timestamp = data.server_timestamp;
+
+            _.each(raw_presences, function (presence, this_email) {
                 if (!util.is_current_user(this_email)) {
                     exports.presence_info[this_email] = status_from_timestamp(data.server_timestamp, presence);
                 }
@@ -416,6 +439,7 @@ exports.set_user_statuses = function (users, server_time) {
         if (util.is_current_user(email)) {
             return;
         }
+        raw_presences[email] = _.extend({}, raw_presences[email], presence);
         status = status_from_timestamp(server_time, presence);
         exports.presence_info[email] = status;
         updated_users[email] = status;
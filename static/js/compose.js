@@ -433,7 +433,7 @@ function report_send_time(send_time, receive_time, display_time, locally_echoed,
 
 var socket;
 if (feature_flags.use_socket) {
-    socket = new Socket("/sockjs");
+    socket = new Socket(page_params.sockjs_url);
 }
 // For debugging.  The socket will eventually move out of this file anyway.
 exports._socket = socket;
@@ -286,8 +286,12 @@ exports.update_messages = function update_messages(events) {
             msg.content = event.rendered_content;
         }
 
+        // Events without an edit_timestamp just add link previews
+        // the server fetched after the message was sent.
+        var is_edit = event.edit_timestamp !== undefined;
+
         var row = current_msg_list.get_row(event.message_id);
-        if (row.length > 0) {
+        if (is_edit && row.length > 0) {
             message_edit.end(row);
         }
 
@@ -353,8 +357,10 @@ exports.update_messages = function update_messages(events) {
             });
         }
 
-        msg.last_edit_timestamp = event.edit_timestamp;
-        delete msg.last_edit_timestr;
+        if (is_edit) {
+            msg.last_edit_timestamp = event.edit_timestamp;
+            delete msg.last_edit_timestr;
+        }
 
         notifications.received_messages([msg]);
         alert_words.process_message(msg);
@@ -147,19 +147,21 @@ function get_events_success(events) {
                 }
             } else if (event.op === 'peer_add' || event.op === 'peer_remove') {
                 _.each(event.subscriptions, function (sub) {
-                    var js_event_type;
-                    if (event.op === 'peer_add') {
-                        js_event_type = 'peer_subscribe.zulip';
+                    _.each(event.user_emails, function (user_email) {
+                        var js_event_type;
+                        if (event.op === 'peer_add') {
+                            js_event_type = 'peer_subscribe.zulip';
 
-                        stream_data.add_subscriber(sub, event.user_email);
-                    } else if (event.op === 'peer_remove') {
-                        js_event_type = 'peer_unsubscribe.zulip';
+                            stream_data.add_subscriber(sub, user_email);
+                        } else if (event.op === 'peer_remove') {
+                            js_event_type = 'peer_unsubscribe.zulip';
 
-                        stream_data.remove_subscriber(sub, event.user_email);
-                    }
+                            stream_data.remove_subscriber(sub, user_email);
+                        }
 
-                    $(document).trigger(js_event_type, {stream_name: sub,
-                                                        user_email: event.user_email});
+                        $(document).trigger(js_event_type, {stream_name: sub,
+                                                            user_email: user_email});
+                    });
                 });
 
             }
@@ -408,9 +410,10 @@ exports.cleanup_event_queue = function cleanup_event_queue() {
     }
     // Set expired because in a reload we may be called twice.
     page_params.event_queue_expired = true;
+    // The queue_id goes in the URL, where nginx can see which Tornado
+    // shard owns the queue.
     channel.del({
-        url:      '/json/events',
-        data:     {queue_id: page_params.event_queue_id}
+        url:      '/json/events?' + $.param({queue_id: page_params.event_queue_id})
     });
 };
 
@@ -22,11 +22,11 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     UserActivityInterval, get_active_user_dicts_in_realm, get_active_streams, \
     realm_filters_for_domain, RealmFilter, receives_offline_notifications, \
     ScheduledJob, realm_filters_for_domain, get_owned_bot_dicts, \
-    get_old_unclaimed_attachments, get_cross_realm_users
+    get_old_unclaimed_attachments, get_cross_realm_users, extract_message_dict
 
 from zerver.lib.avatar import get_avatar_url, avatar_url
 
-from django.db import transaction, IntegrityError
+from django.db import transaction, IntegrityError, connection
 from django.db.models import F, Q
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
@@ -36,7 +36,7 @@ from django.utils.timezone import now
 
 from confirmation.models import Confirmation
 import six
-from six import text_type
+from six import text_type, binary_type
 from six.moves import filter
 from six.moves import map
 from six.moves import range
@@ -44,6 +44,7 @@ from six import unichr
 
 session_engine = import_module(settings.SESSION_ENGINE)
 
+from zerver.lib.bulk_create import bulk_upsert
 from zerver.lib.create_user import random_api_key
 from zerver.lib.timestamp import timestamp_to_datetime, datetime_to_timestamp
 from zerver.lib.queue import queue_json_publish
@@ -51,16 +52,17 @@ from django.utils import timezone
 from zerver.lib.create_user import create_user
 from zerver.lib import bugdown
 from zerver.lib.cache import cache_with_key, cache_set, \
-    user_profile_by_email_cache_key, cache_set_many, \
-    cache_delete, cache_delete_many
+    user_profile_by_email_cache_key, user_profile_by_id_cache_key, cache_set_many, \
+    cache_delete, cache_delete_many, generic_bulk_cached_fetch, log_realm_presence_change
 from zerver.decorator import statsd_increment
-from zerver.lib.event_queue import request_event_queue, get_user_events, send_event
+from zerver.lib.event_queue import request_event_queue, get_user_events, send_event, \
+    batch_events
 from zerver.lib.utils import log_statsd_event, statsd
 from zerver.lib.html_diff import highlight_html_differences
+from zerver.lib.presence import get_presence_snapshot
 from zerver.lib.alert_words import user_alert_words, add_user_alert_words, \
     remove_user_alert_words, set_user_alert_words
-from zerver.lib.push_notifications import num_push_devices_for_user, \
-     send_apple_push_notification, send_android_push_notification
+from zerver.lib.push_notifications import get_push_devices, send_push_notifications
 from zerver.lib.notifications import clear_followup_emails_queue
 from zerver.lib.narrow import check_supported_events_narrow_filter
 from zerver.lib.request import JsonableError
@@ -487,8 +489,7 @@ def do_deactivate_user(user_profile, log=True, _cascade=True):
 def do_deactivate_stream(stream, log=True):
     # type: (Stream, bool) -> None
     user_profiles = UserProfile.objects.filter(realm=stream.realm)
-    for user_profile in user_profiles:
-        do_remove_subscription(user_profile, stream)
+    bulk_remove_subscriptions(user_profiles, [stream])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -627,36 +628,63 @@ def do_send_messages(messages):
         if not message['no_log']:
             log_message(message['message'])
 
+    # Resolve the recipients of the whole batch up front, with one
+    # query per recipient type rather than one query per message.
+    personal_user_ids = set() # type: Set[int]
+    subscription_recipient_ids = set() # type: Set[int]
     for message in messages:
-        if message['message'].recipient.type == Recipient.PERSONAL:
-            message['recipients'] = list(set([get_user_profile_by_id(message['message'].recipient.type_id),
-                                              get_user_profile_by_id(message['message'].sender_id)]))
+        recipient = message['message'].recipient
+        if recipient.type == Recipient.PERSONAL:
+            personal_user_ids.update([recipient.type_id, message['message'].sender_id])
+        elif recipient.type in (Recipient.STREAM, Recipient.HUDDLE):
+            subscription_recipient_ids.add(recipient.id)
+        else:
+            raise ValueError('Bad recipient type')
+
+    # The users involved in private messages come from the same remote
+    # cache entries as get_user_profile_by_id, fetched in one round trip.
+    personal_users = generic_bulk_cached_fetch(
+        user_profile_by_id_cache_key,
+        lambda user_ids: UserProfile.objects.select_related().filter(id__in=user_ids),
+        list(personal_user_ids)) # type: Dict[int, UserProfile]
+
+    subscribers_by_recipient = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    if subscription_recipient_ids:
+        # We use select_related()/only() here, while the PERSONAL case above
+        # gets UserProfile objects from cache.  Streams will typically have
+        # more recipients than PMs, so fetching them from the cache would
+        # be a bit more expensive here, given that we need to hit the DB
+        # anyway and only care about a few fields of each user profile.
+        fields = [
+            'recipient',
+            'user_profile__id',
+            'user_profile__email',
+            'user_profile__is_active',
+            'user_profile__realm__domain'
+        ]
+        query = Subscription.objects.select_related("user_profile", "user_profile__realm").only(*fields).filter(
+            recipient_id__in=subscription_recipient_ids, active=True)
+        for sub in query:
+            subscribers_by_recipient[sub.recipient_id].append(sub.user_profile)
+
+    # Render any messages that weren't rendered when they were checked,
+    # in parallel if there is a bugdown render pool.
+    Message.maybe_render_content_many([message['message'] for message in messages], None)
+
+    for message in messages:
+        recipient = message['message'].recipient
+        if recipient.type == Recipient.PERSONAL:
+            message['recipients'] = list(set([personal_users[recipient.type_id],
+                                              personal_users[message['message'].sender_id]]))
             # For personals, you send out either 1 or 2 copies of the message, for
             # personals to yourself or to someone else, respectively.
             assert((len(message['recipients']) == 1) or (len(message['recipients']) == 2))
-        elif (message['message'].recipient.type == Recipient.STREAM or
-              message['message'].recipient.type == Recipient.HUDDLE):
-            # We use select_related()/only() here, while the PERSONAL case above uses
-            # get_user_profile_by_id() to get UserProfile objects from cache.  Streams will
-            # typically have more recipients than PMs, so get_user_profile_by_id() would be
-            # a bit more expensive here, given that we need to hit the DB anyway and only
-            # care about the email from the user profile.
-            fields = [
-                'user_profile__id',
-                'user_profile__email',
-                'user_profile__is_active',
-                'user_profile__realm__domain'
-            ]
-            query = Subscription.objects.select_related("user_profile", "user_profile__realm").only(*fields).filter(
-                recipient=message['message'].recipient, active=True)
-            message['recipients'] = [s.user_profile for s in query]
         else:
-            raise ValueError('Bad recipient type')
+            message['recipients'] = list(subscribers_by_recipient[recipient.id])
 
         # Only deliver the message to active user recipients
         message['active_recipients'] = [user_profile for user_profile in message['recipients']
                                         if user_profile.is_active]
-        message['message'].maybe_render_content(None)
         message['message'].update_calculated_fields()
 
     # Save the message receipts in the database
@@ -696,54 +724,78 @@ def do_send_messages(messages):
             if Message.content_has_attachment(message['message'].content):
                 do_claim_attachments(message)
 
+    # Render Markdown etc. here and store in the remote cache, so
+    # that the single-threaded Tornado server doesn't have to.  Both
+    # variants of every message dict are rendered once and stored in
+    # a single cache round trip for the whole batch.
+    items_for_remote_cache = {} # type: Dict[text_type, Tuple[binary_type]]
     for message in messages:
-        # Render Markdown etc. here and store (automatically) in
-        # remote cache, so that the single-threaded Tornado server
-        # doesn't have to.
-        user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        user_presences = get_status_dict(sender)
-        presences = {}
-        for user_profile in message['active_recipients']:
-            if user_profile.email in user_presences:
-                presences[user_profile.id] = user_presences[user_profile.email]
+        message['message_json_markdown'] = message['message'].to_dict_uncached(apply_markdown=True)
+        message['message_json_no_markdown'] = message['message'].to_dict_uncached(apply_markdown=False)
+        items_for_remote_cache[to_dict_cache_key(message['message'], True)] = \
+            (message['message_json_markdown'],)
+        items_for_remote_cache[to_dict_cache_key(message['message'], False)] = \
+            (message['message_json_no_markdown'],)
+    cache_set_many(items_for_remote_cache, timeout=3600*24)
+
+    # Presence data only depends on the sender's realm.
+    status_dicts_by_realm = {} # type: Dict[int, Dict[text_type, Dict[text_type, Dict[str, Any]]]]
+
+    # Events for a batch of messages are sent to Tornado together.
+    with batch_events():
+        for message in messages:
+            user_flags = user_message_flags.get(message['message'].id, {})
+            sender = message['message'].sender
+            if sender.realm_id not in status_dicts_by_realm:
+                if sender.realm.domain == 'mit.edu':
+                    status_dicts_by_realm[sender.realm_id] = {}
+                else:
+                    status_dicts_by_realm[sender.realm_id] = get_presence_snapshot(sender.realm).presences
+            user_presences = status_dicts_by_realm[sender.realm_id]
+            presences = {}
+            for user_profile in message['active_recipients']:
+                if user_profile.email in user_presences:
+                    presences[user_profile.id] = user_presences[user_profile.email]
+
+            event = dict(
+                type         = 'message',
+                message      = message['message'].id,
+                message_dict_markdown = extract_message_dict(message['message_json_markdown']),
+                message_dict_no_markdown = extract_message_dict(message['message_json_no_markdown']),
+                presences    = presences)
+            users = [{'id': user.id,
+                      'flags': user_flags.get(user.id, []),
+                      'always_push_notify': always_push_notify(user)}
+                     for user in message['active_recipients']]
+            if message['message'].recipient.type == Recipient.STREAM:
+                # Note: This is where authorization for single-stream
+                # get_updates happens! We only attach stream data to the
+                # notify new_message request if it's a public stream,
+                # ensuring that in the tornado server, non-public stream
+                # messages are only associated to their subscribed users.
+                if message['stream'] is None:
+                    message['stream'] = Stream.objects.select_related("realm").get(id=message['message'].recipient.type_id)
+                if message['stream'].is_public():
+                    event['realm_id'] = message['stream'].realm.id
+                    event['stream_name'] = message['stream'].name
+                if message['stream'].invite_only:
+                    event['invite_only'] = True
+            if message['local_id'] is not None:
+                event['local_id'] = message['local_id']
+            if message['sender_queue_id'] is not None:
+                event['sender_queue_id'] = message['sender_queue_id']
+            send_event(event, users)
+            if (settings.ENABLE_FEEDBACK and
+                message['message'].recipient.type == Recipient.PERSONAL and
+                settings.FEEDBACK_BOT in [up.email for up in message['recipients']]):
+                queue_json_publish(
+                        'feedback_messages',
+                        extract_message_dict(message['message_json_no_markdown']),
+                        lambda x: None
+                )
 
-        event = dict(
-            type         = 'message',
-            message      = message['message'].id,
-            message_dict_markdown = message['message'].to_dict(apply_markdown=True),
-            message_dict_no_markdown = message['message'].to_dict(apply_markdown=False),
-            presences    = presences)
-        users = [{'id': user.id,
-                  'flags': user_flags.get(user.id, []),
-                  'always_push_notify': always_push_notify(user)}
-                 for user in message['active_recipients']]
-        if message['message'].recipient.type == Recipient.STREAM:
-            # Note: This is where authorization for single-stream
-            # get_updates happens! We only attach stream data to the
-            # notify new_message request if it's a public stream,
-            # ensuring that in the tornado server, non-public stream
-            # messages are only associated to their subscribed users.
-            if message['stream'] is None:
-                message['stream'] = Stream.objects.select_related("realm").get(id=message['message'].recipient.type_id)
-            if message['stream'].is_public():
-                event['realm_id'] = message['stream'].realm.id
-                event['stream_name'] = message['stream'].name
-            if message['stream'].invite_only:
-                event['invite_only'] = True
-        if message['local_id'] is not None:
-            event['local_id'] = message['local_id']
-        if message['sender_queue_id'] is not None:
-            event['sender_queue_id'] = message['sender_queue_id']
-        send_event(event, users)
-        if (settings.ENABLE_FEEDBACK and
-            message['message'].recipient.type == Recipient.PERSONAL and
-            settings.FEEDBACK_BOT in [up.email for up in message['recipients']]):
-            queue_json_publish(
-                    'feedback_messages',
-                    message['message'].to_dict(apply_markdown=False),
-                    lambda x: None
-            )
+    for message in messages:
+        queue_link_previews(message['message'])
 
     # Note that this does not preserve the order of message ids
     # returned.  In practice, this shouldn't matter, as we only
@@ -751,6 +803,67 @@ def do_send_messages(messages):
     # intermingle sending zephyr messages with other messages.
     return already_sent_ids + [message['message'].id for message in messages]
 
+def queue_link_previews(message):
+    # type: (Message) -> None
+    """Hands the links whose previews bugdown deferred when rendering
+    message to the embed_links queue worker, which fetches the preview
+    data and then updates the message."""
+    urls = getattr(message, 'links_for_preview', None)
+    if not urls:
+        return
+    event = {'message_id': message.id,
+             'message_content': message.content,
+             'urls': sorted(urls)}
+    queue_json_publish('embed_links', event, handle_link_previews)
+
+def handle_link_previews(event):
+    # type: (Mapping[str, Any]) -> None
+    bugdown.fetch_link_previews(event['urls'])
+    try:
+        message = Message.objects.select_related().get(id=event['message_id'])
+    except Message.DoesNotExist:
+        return
+    if message.content != event['message_content']:
+        # The message was edited since; the edit queued its own previews.
+        return
+    # Anything still not cached (e.g. because the fetch failed) is
+    # just left out this time, rather than queued again.
+    rendered_content = message.render_markdown(message.content)
+    if rendered_content is None or rendered_content == message.rendered_content:
+        return
+    do_update_embedded_data(message, rendered_content)
+
+def do_update_embedded_data(message, rendered_content):
+    # type: (Message, text_type) -> bool
+    """Updates message to rendered_content, which only adds link
+    previews, so unlike do_update_message this isn't an edit.  Does
+    nothing, and returns False, if the message has been edited since it
+    was read."""
+    with transaction.atomic():
+        # The UPDATE only applies to the content we rendered, and holds
+        # the row's lock until we've updated the caches, so that an
+        # edit racing with us either wins (and we do nothing) or waits
+        # for us (and then overwrites what we cache).
+        updated = Message.objects.filter(id=message.id, content=message.content).update(
+            rendered_content=rendered_content, rendered_content_version=bugdown.version)
+        if not updated:
+            return False
+        message.rendered_content = rendered_content
+        message.rendered_content_version = bugdown.version
+        cache_set_many({
+            to_dict_cache_key(message, True): (message.to_dict_uncached(apply_markdown=True),),
+            to_dict_cache_key(message, False): (message.to_dict_uncached(apply_markdown=False),)})
+
+    event = {'type': 'update_message',
+             'sender': message.sender.email,
+             'message_id': message.id,
+             'message_ids': [message.id],
+             'content': message.content,
+             'rendered_content': rendered_content} # type: Dict[str, Any]
+    ums = UserMessage.objects.filter(message=message.id)
+    send_event(event, [{'id': um.user_profile_id, 'flags': um.flags_list()} for um in ums])
+    return True
+
 def do_create_stream(realm, stream_name):
     # type: (Realm, text_type) -> None
     # This is used by a management command now, mostly to facilitate testing.  It
@@ -1079,6 +1192,11 @@ def pick_color(user_profile):
 
 def pick_color_helper(user_profile, subs):
     # type: (UserProfile, Iterable[Subscription]) -> text_type
+    used_colors = [sub.color for sub in subs if sub.active]
+    return pick_unused_color(set(used_colors), len(used_colors))
+
+def pick_unused_color(used_colors, num_used_colors):
+    # type: (Set[text_type], int) -> text_type
     # These colors are shared with the palette in subs.js.
     stream_assignment_colors = [
         "#76ce90", "#fae589", "#a6c7e5", "#e79ab5",
@@ -1087,13 +1205,12 @@ def pick_color_helper(user_profile, subs):
         "#ee7e4a", "#a6dcbf", "#95a5fd", "#53a063",
         "#9987e1", "#e4523d", "#c2c2c2", "#4f8de4",
         "#c6a8ad", "#e7cc4d", "#c8bebf", "#a47462"]
-    used_colors = [sub.color for sub in subs if sub.active]
     available_colors = [s for s in stream_assignment_colors if s not in used_colors]
 
     if available_colors:
         return available_colors[0]
     else:
-        return stream_assignment_colors[len(used_colors) % len(stream_assignment_colors)]
+        return stream_assignment_colors[num_used_colors % len(stream_assignment_colors)]
 
 def get_subscription(stream_name, user_profile):
     # type: (text_type, UserProfile) -> Subscription
@@ -1274,6 +1391,42 @@ def notify_subscriptions_added(user_profile, sub_pairs, stream_emails, no_log=Fa
                  subscriptions=payload)
     send_event(event, [user_profile.id])
 
+def peer_subscription_event(op, stream_names, user_emails):
+    # type: (str, List[text_type], List[text_type]) -> Dict[str, Any]
+    event = dict(type="subscription", op=op,
+                 subscriptions=stream_names,
+                 user_emails=user_emails)
+    # Clients from before user_emails only know about one user at a
+    # time; unless they register with multi_user_peer_events, their
+    # event queues split events about several users (see
+    # ClientDescriptor.add_event).
+    if len(user_emails) == 1:
+        event['user_email'] = user_emails[0]
+    return event
+
+def notify_subscription_peers(op, streams, users_by_stream, subscriber_ids_by_stream):
+    # type: (str, Iterable[Stream], Mapping[int, List[UserProfile]], Mapping[int, Set[int]]) -> None
+    """Sends the other subscribers of each stream a single op
+    ("peer_add" or "peer_remove") event about all of the users in
+    users_by_stream who joined or left it, rather than one per user."""
+    for stream in streams:
+        if stream.realm.domain == "mit.edu" and not stream.invite_only:
+            continue
+
+        users = users_by_stream.get(stream.id)
+        if not users:
+            continue
+        other_user_ids = subscriber_ids_by_stream.get(stream.id, set()) - \
+            set(user_profile.id for user_profile in users)
+        if other_user_ids:
+            event = peer_subscription_event(op, [stream.name],
+                                            [user_profile.email for user_profile in users])
+            send_event(event, list(other_user_ids))
+
+# Subscriptions are created in batches of this many rows, so that
+# subscribing a big realm to many streams isn't a single huge INSERT.
+SUBSCRIPTION_BULK_CREATE_BATCH_SIZE = 10000
+
 def bulk_add_subscriptions(streams, users):
     # type: (Iterable[Stream], Iterable[UserProfile]) -> Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
     recipients_map = bulk_get_recipients(Recipient.STREAM, [stream.id for stream in streams]) # type: Mapping[int, Recipient]
@@ -1283,10 +1436,10 @@ def bulk_add_subscriptions(streams, users):
     for stream in streams:
         stream_map[recipients_map[stream.id].id] = stream
 
+    users_by_id = dict((user_profile.id, user_profile) for user_profile in users) # type: Dict[int, UserProfile]
     subs_by_user = defaultdict(list) # type: Dict[int, List[Subscription]]
-    all_subs_query = Subscription.objects.select_related("user_profile")
-    for sub in all_subs_query.filter(user_profile__in=users,
-                                     recipient__type=Recipient.STREAM):
+    for sub in Subscription.objects.filter(user_profile__in=users,
+                                           recipient__type=Recipient.STREAM):
         subs_by_user[sub.user_profile_id].append(sub)
 
     already_subscribed = [] # type: List[Tuple[UserProfile, Stream]]
@@ -1302,27 +1455,36 @@ def bulk_add_subscriptions(streams, users):
                 else:
                     subs_to_activate.append((sub, stream_map[sub.recipient_id]))
                     # Mark the sub as active, without saving, so that
-                    # pick_color will consider this to be an active
-                    # subscription when picking colors
+                    # its color counts as used when picking colors
                     sub.active = True
         for recipient_id in needs_new_sub:
             new_subs.append((user_profile, recipient_id, stream_map[recipient_id]))
 
+    # Each user's colors are tallied once, and then updated as we pick
+    # colors for their new subscriptions.
+    used_colors = {} # type: Dict[int, Set[text_type]]
+    num_used_colors = {} # type: Dict[int, int]
     subs_to_add = [] # type: List[Tuple[Subscription, Stream]]
     for (user_profile, recipient_id, stream) in new_subs:
-        color = pick_color_helper(user_profile, subs_by_user[user_profile.id])
+        if user_profile.id not in used_colors:
+            colors = [sub.color for sub in subs_by_user[user_profile.id] if sub.active]
+            used_colors[user_profile.id] = set(colors)
+            num_used_colors[user_profile.id] = len(colors)
+        color = pick_unused_color(used_colors[user_profile.id], num_used_colors[user_profile.id])
+        used_colors[user_profile.id].add(color)
+        num_used_colors[user_profile.id] += 1
         sub_to_add = Subscription(user_profile=user_profile, active=True,
                                   color=color, recipient_id=recipient_id,
                                   desktop_notifications=user_profile.enable_stream_desktop_notifications,
                                   audible_notifications=user_profile.enable_stream_sounds)
-        subs_by_user[user_profile.id].append(sub_to_add)
         subs_to_add.append((sub_to_add, stream))
 
     # TODO: XXX: This transaction really needs to be done at the serializeable
     # transaction isolation level.
     with transaction.atomic():
         occupied_streams_before = list(get_occupied_streams(user_profile.realm))
-        Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add])
+        Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add],
+                                         batch_size=SUBSCRIPTION_BULK_CREATE_BATCH_SIZE)
         Subscription.objects.filter(id__in=[sub.id for (sub, stream) in subs_to_activate]).update(active=True)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
 
@@ -1337,19 +1499,17 @@ def bulk_add_subscriptions(streams, users):
 
     # Notify all existing users on streams that users have joined
 
-    # First, get all users subscribed to the streams that we care about
-    # We fetch all subscription information upfront, as it's used throughout
-    # the following code and we want to minize DB queries
-    all_subs = Subscription.objects.filter(recipient__type=Recipient.STREAM,
-                                           recipient__type_id__in=[stream.id for stream in streams],
-                                           user_profile__is_active=True,
-                                           active=True).select_related('recipient', 'user_profile')
-
-    all_subs_by_stream = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    # First, get all users subscribed to the streams that we care about,
+    # in a single query, as it's used throughout the following code
     emails_by_stream = defaultdict(list) # type: Dict[int, List[text_type]]
-    for sub in all_subs:
-        all_subs_by_stream[sub.recipient.type_id].append(sub.user_profile)
-        emails_by_stream[sub.recipient.type_id].append(sub.user_profile.email)
+    subscriber_ids_by_stream = defaultdict(set) # type: Dict[int, Set[int]]
+    for (stream_id, user_profile_id, email) in Subscription.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id__in=[stream.id for stream in streams],
+            user_profile__is_active=True,
+            active=True).values_list('recipient__type_id', 'user_profile_id', 'user_profile__email'):
+        emails_by_stream[stream_id].append(email)
+        subscriber_ids_by_stream[stream_id].add(user_profile_id)
 
     def fetch_stream_subscriber_emails(stream):
         # type: (Stream) -> List[text_type]
@@ -1358,34 +1518,23 @@ def bulk_add_subscriptions(streams, users):
         return emails_by_stream[stream.id]
 
     sub_tuples_by_user = defaultdict(list) # type: Dict[int, List[Tuple[Subscription, Stream]]]
-    new_streams = set() # type: Set[Tuple[int, int]]
     for (sub, stream) in subs_to_add + subs_to_activate:
-        sub_tuples_by_user[sub.user_profile.id].append((sub, stream))
-        new_streams.add((sub.user_profile.id, stream.id))
+        sub_tuples_by_user[sub.user_profile_id].append((sub, stream))
 
-    for user_profile in users:
-        if len(sub_tuples_by_user[user_profile.id]) == 0:
-            continue
-        sub_pairs = sub_tuples_by_user[user_profile.id]
-        notify_subscriptions_added(user_profile, sub_pairs, fetch_stream_subscriber_emails)
+    new_users_by_stream = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    with batch_events():
+        for user_profile in users:
+            if len(sub_tuples_by_user[user_profile.id]) == 0:
+                continue
+            sub_pairs = sub_tuples_by_user[user_profile.id]
+            notify_subscriptions_added(user_profile, sub_pairs, fetch_stream_subscriber_emails)
+            for (sub, stream) in sub_pairs:
+                new_users_by_stream[stream.id].append(user_profile)
 
-    for stream in streams:
-        if stream.realm.domain == "mit.edu" and not stream.invite_only:
-            continue
-
-        new_users = [user for user in users if (user.id, stream.id) in new_streams]
-        new_user_ids = [user.id for user in new_users]
-        all_subscribed_ids = [user.id for user in all_subs_by_stream[stream.id]]
-        other_user_ids = set(all_subscribed_ids) - set(new_user_ids)
-        if other_user_ids:
-            for user_profile in new_users:
-                event = dict(type="subscription", op="peer_add",
-                             subscriptions=[stream.name],
-                             user_email=user_profile.email)
-                send_event(event, other_user_ids)
+        notify_subscription_peers("peer_add", streams, new_users_by_stream, subscriber_ids_by_stream)
 
     return ([(user_profile, stream) for (user_profile, recipient_id, stream) in new_subs] +
-            [(sub.user_profile, stream) for (sub, stream) in subs_to_activate],
+            [(users_by_id[sub.user_profile_id], stream) for (sub, stream) in subs_to_activate],
             already_subscribed)
 
 # When changing this, also change bulk_add_subscriptions
@@ -1418,9 +1567,7 @@ def do_add_subscription(user_profile, stream, no_log=False):
                                    lambda stream: emails_by_stream[stream.id], no_log)
 
         user_ids = get_other_subscriber_ids(stream, user_profile.id)
-        event = dict(type="subscription", op="peer_add",
-                     subscriptions=[stream.name],
-                     user_email=user_profile.email)
+        event = peer_subscription_event("peer_add", [stream.name], [user_profile.email])
         send_event(event, user_ids)
 
     return did_subscribe
@@ -1438,24 +1585,6 @@ def notify_subscriptions_removed(user_profile, streams, no_log=False):
                  subscriptions=payload)
     send_event(event, [user_profile.id])
 
-    # As with a subscription add, send a 'peer subscription' notice to other
-    # subscribers so they know the user unsubscribed.
-    # FIXME: This code was mostly a copy-paste from notify_subscriptions_added.
-    #        We have since streamlined how we do notifications for adds, and
-    #        we should do the same for removes.
-    notifications_for = get_subscribers_to_streams(streams)
-
-    for event_recipient, notifications in six.iteritems(notifications_for):
-        # Don't send a peer subscription notice to yourself.
-        if event_recipient == user_profile:
-            continue
-
-        stream_names = [stream.name for stream in notifications]
-        event = dict(type="subscription", op="peer_remove",
-                     subscriptions=stream_names,
-                     user_email=user_profile.email)
-        send_event(event, [event_recipient.id])
-
 def bulk_remove_subscriptions(users, streams):
     # type: (Iterable[UserProfile], Iterable[Stream]) -> Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
     recipients_map = bulk_get_recipients(Recipient.STREAM,
@@ -1464,10 +1593,11 @@ def bulk_remove_subscriptions(users, streams):
     for stream in streams:
         stream_map[recipients_map[stream.id].id] = stream
 
-    subs_by_user = dict((user_profile.id, []) for user_profile in users) # type: Dict[int, List[Subscription]]
-    for sub in Subscription.objects.select_related("user_profile").filter(user_profile__in=users,
-                                                                          recipient__in=list(recipients_map.values()),
-                                                                          active=True):
+    users_by_id = dict((user_profile.id, user_profile) for user_profile in users) # type: Dict[int, UserProfile]
+    subs_by_user = dict((user_profile_id, []) for user_profile_id in users_by_id) # type: Dict[int, List[Subscription]]
+    for sub in Subscription.objects.filter(user_profile__in=users,
+                                           recipient__in=list(recipients_map.values()),
+                                           active=True):
         subs_by_user[sub.user_profile_id].append(sub)
 
     subs_to_deactivate = [] # type: List[Tuple[Subscription, Stream]]
@@ -1501,12 +1631,28 @@ def bulk_remove_subscriptions(users, streams):
     for (sub, stream) in subs_to_deactivate:
         streams_by_user[sub.user_profile_id].append(stream)
 
-    for user_profile in users:
-        if len(streams_by_user[user_profile.id]) == 0:
-            continue
-        notify_subscriptions_removed(user_profile, streams_by_user[user_profile.id])
-
-    return ([(sub.user_profile, stream) for (sub, stream) in subs_to_deactivate],
+    # The streams' remaining subscribers, who hear about who left them.
+    subscriber_ids_by_stream = defaultdict(set) # type: Dict[int, Set[int]]
+    if subs_to_deactivate:
+        for (stream_id, user_profile_id) in Subscription.objects.filter(
+                recipient__in=list(recipients_map.values()),
+                user_profile__is_active=True,
+                active=True).values_list('recipient__type_id', 'user_profile_id'):
+            subscriber_ids_by_stream[stream_id].add(user_profile_id)
+
+    removed_users_by_stream = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    with batch_events():
+        for user_profile in users:
+            if len(streams_by_user[user_profile.id]) == 0:
+                continue
+            notify_subscriptions_removed(user_profile, streams_by_user[user_profile.id])
+            for stream in streams_by_user[user_profile.id]:
+                removed_users_by_stream[stream.id].append(user_profile)
+
+        notify_subscription_peers("peer_remove", streams, removed_users_by_stream,
+                                  subscriber_ids_by_stream)
+
+    return ([(users_by_id[sub.user_profile_id], stream) for (sub, stream) in subs_to_deactivate],
             not_subscribed)
 
 def do_remove_subscription(user_profile, stream, no_log=False):
@@ -1531,6 +1677,13 @@ def do_remove_subscription(user_profile, stream, no_log=False):
     if did_remove:
         notify_subscriptions_removed(user_profile, [stream], no_log)
 
+        # As with a subscription add, send a 'peer subscription' notice to other
+        # subscribers so they know the user unsubscribed.
+        user_ids = get_other_subscriber_ids(stream, user_profile.id)
+        if user_ids:
+            event = peer_subscription_event("peer_remove", [stream.name], [user_profile.email])
+            send_event(event, user_ids)
+
     return did_remove
 
 def log_subscription_property_change(user_email, stream_name, property, value):
@@ -2101,41 +2254,77 @@ def streams_to_dicts_sorted(streams):
 
 def do_update_user_activity_interval(user_profile, log_time):
     # type: (UserProfile, datetime.datetime) -> None
-    effective_end = log_time + datetime.timedelta(minutes=15)
-    # This code isn't perfect, because with various races we might end
-    # up creating two overlapping intervals, but that shouldn't happen
-    # often, and can be corrected for in post-processing
-    try:
-        last = UserActivityInterval.objects.filter(user_profile=user_profile).order_by("-end")[0]
-        # There are two ways our intervals could overlap:
-        # (1) The start of the new interval could be inside the old interval
-        # (2) The end of the new interval could be inside the old interval
-        # In either case, we just extend the old interval to include the new interval.
-        if ((log_time <= last.end and log_time >= last.start) or
-            (effective_end <= last.end and effective_end >= last.start)):
-            last.end = max(last.end, effective_end)
-            last.start = min(last.start, log_time)
-            last.save(update_fields=["start", "end"])
-            return
-    except IndexError:
-        pass
-
-    # Otherwise, the intervals don't overlap, so we should make a new one
-    UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
-                                        end=effective_end)
+    do_update_user_activity_intervals([(user_profile.id, log_time)])
+
+def do_update_user_activity_intervals(activity):
+    # type: (Iterable[Tuple[int, datetime.datetime]]) -> None
+    """Extends or creates UserActivityIntervals for a batch of (user id,
+    time) activity, with a query for the users' latest intervals and a
+    statement each to update and create intervals."""
+    times_by_user = defaultdict(list) # type: Dict[int, List[datetime.datetime]]
+    for (user_profile_id, log_time) in activity:
+        times_by_user[user_profile_id].append(log_time)
+    latest = dict((interval.user_profile_id, interval) for interval in
+                  UserActivityInterval.objects.filter(user_profile_id__in=list(times_by_user.keys()))
+                  .order_by('user_profile_id', '-end').distinct('user_profile_id'))
+
+    changed = {} # type: Dict[int, UserActivityInterval]
+    created = [] # type: List[UserActivityInterval]
+    for (user_profile_id, times) in times_by_user.items():
+        last = latest.get(user_profile_id)
+        for log_time in sorted(times):
+            effective_end = log_time + datetime.timedelta(minutes=15)
+            # This code isn't perfect, because with various races we might end
+            # up creating two overlapping intervals, but that shouldn't happen
+            # often, and can be corrected for in post-processing
+            #
+            # There are two ways our intervals could overlap:
+            # (1) The start of the new interval could be inside the old interval
+            # (2) The end of the new interval could be inside the old interval
+            # In either case, we just extend the old interval to include the new interval.
+            if last is not None and ((log_time <= last.end and log_time >= last.start) or
+                                     (effective_end <= last.end and effective_end >= last.start)):
+                last.end = max(last.end, effective_end)
+                last.start = min(last.start, log_time)
+                if last.id is not None:
+                    changed[last.id] = last
+            else:
+                # Otherwise, the intervals don't overlap, so we should make a new one
+                last = UserActivityInterval(user_profile_id=user_profile_id, start=log_time,
+                                            end=effective_end)
+                created.append(last)
+
+    if changed:
+        connection.cursor().execute(
+            'UPDATE zerver_useractivityinterval AS t SET start = data.start, "end" = data."end" '
+            'FROM (VALUES %s) AS data (id, start, "end") WHERE t.id = data.id'
+            % (', '.join(['(%s, %s, %s)'] * len(changed)),),
+            [value for interval in changed.values()
+             for value in (interval.id, interval.start, interval.end)])
+    UserActivityInterval.objects.bulk_create(created)
 
-@statsd_increment('user_activity')
 def do_update_user_activity(user_profile, client, query, log_time):
     # type: (UserProfile, Client, text_type, datetime.datetime) -> None
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        query = query,
-        defaults={'last_visit': log_time, 'count': 0})
-
-    activity.count += 1
-    activity.last_visit = log_time
-    activity.save(update_fields=["last_visit", "count"])
+    do_update_user_activities([(user_profile.id, client, query, log_time)])
+
+def do_update_user_activities(activities):
+    # type: (Iterable[Tuple[int, Client, text_type, datetime.datetime]]) -> None
+    """Counts a batch of (user id, client, query, time) visits in
+    UserActivity, merging the visits to each row and writing them all
+    with one statement."""
+    visits = {} # type: Dict[Tuple[int, int, text_type], Tuple[int, datetime.datetime]]
+    num_visits = 0
+    for (user_profile_id, client, query, log_time) in activities:
+        key = (user_profile_id, client.id, query)
+        (count, last_visit) = visits.get(key, (0, log_time))
+        visits[key] = (count + 1, max(last_visit, log_time))
+        num_visits += 1
+    bulk_upsert('zerver_useractivity', ['user_profile_id', 'client_id', 'query', 'count', 'last_visit'],
+                ['user_profile_id', 'client_id', 'query'],
+                [row_key + counts for (row_key, counts) in visits.items()],
+                {'count': 't.count + data.count',
+                 'last_visit': 'GREATEST(t.last_visit, data.last_visit)'})
+    statsd.incr('user_activity', num_visits)
 
 def send_presence_changed(user_profile, presence):
     # type: (UserProfile, UserPresence) -> None
@@ -2158,51 +2347,73 @@ def consolidate_client(client):
     else:
         return client
 
-@statsd_increment('user_presence')
 def do_update_user_presence(user_profile, client, log_time, status):
     # type: (UserProfile, Client, datetime.datetime, int) -> None
-    client = consolidate_client(client)
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        defaults = {'timestamp': log_time,
-                    'status': status})
-
-    stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
-    was_idle = presence.status == UserPresence.IDLE
-    became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
-
-    # If an object was created, it has already been saved.
-    #
-    # We suppress changes from ACTIVE to IDLE before stale_status is reached;
-    # this protects us from the user having two clients open: one active, the
-    # other idle. Without this check, we would constantly toggle their status
-    # between the two states.
-    if not created and stale_status or was_idle or status == presence.status:
-        # The following block attempts to only update the "status"
-        # field in the event that it actually changed.  This is
-        # important to avoid flushing the UserPresence cache when the
-        # data it would return to a client hasn't actually changed
-        # (see the UserPresence post_save hook for details).
-        presence.timestamp = log_time
-        update_fields = ["timestamp"]
-        if presence.status != status:
+    do_update_user_presences([(user_profile, client, log_time, status)])
+
+def do_update_user_presences(updates):
+    # type: (Iterable[Tuple[UserProfile, Client, datetime.datetime, int]]) -> None
+    """Applies a batch of (user, client, time, status) presence updates,
+    with a query to read the affected UserPresence rows and a statement
+    to write them.  For each user and client, only the latest update
+    counts."""
+    latest = {} # type: Dict[Tuple[int, int], Tuple[UserProfile, Client, datetime.datetime, int]]
+    num_updates = 0
+    for (user_profile, client, log_time, status) in updates:
+        client = consolidate_client(client)
+        key = (user_profile.id, client.id)
+        if key not in latest or log_time >= latest[key][2]:
+            latest[key] = (user_profile, client, log_time, status)
+        num_updates += 1
+    existing = dict(((presence.user_profile_id, presence.client_id), presence) for presence in
+                    UserPresence.objects.filter(user_profile_id__in=set(key[0] for key in latest),
+                                                client_id__in=set(key[1] for key in latest)))
+
+    written = [] # type: List[Tuple[UserProfile, UserPresence, bool]]
+    for (key, (user_profile, client, log_time, status)) in latest.items():
+        presence = existing.get(key)
+        if presence is None:
+            presence = UserPresence(user_profile=user_profile, client=client,
+                                    timestamp=log_time, status=status)
+            written.append((user_profile, presence, True))
+            continue
+
+        stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
+        was_idle = presence.status == UserPresence.IDLE
+        became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
+
+        # We suppress changes from ACTIVE to IDLE before stale_status is reached;
+        # this protects us from the user having two clients open: one active, the
+        # other idle. Without this check, we would constantly toggle their status
+        # between the two states.
+        if stale_status or was_idle or status == presence.status:
+            presence.timestamp = log_time
             presence.status = status
-            update_fields.append("status")
-        presence.save(update_fields=update_fields)
-
-    if not user_profile.realm.domain == "mit.edu" and (created or became_online):
-        # Push event to all users in the realm so they see the new user
-        # appear in the presence list immediately, or the newly online
-        # user without delay.  Note that we won't send an update here for a
-        # timestamp update, because we rely on the browser to ping us every 50
-        # seconds for realm-wide status updates, and those updates should have
-        # recent timestamps, which means the browser won't think active users
-        # have gone idle.  If we were more aggressive in this function about
-        # sending timestamp updates, we could eliminate the ping responses, but
-        # that's not a high priority for now, considering that most of our non-MIT
-        # realms are pretty small.
-        send_presence_changed(user_profile, presence)
+            written.append((user_profile, presence, became_online))
+
+    bulk_upsert('zerver_userpresence', ['user_profile_id', 'client_id', 'timestamp', 'status'],
+                ['user_profile_id', 'client_id'],
+                [(row.user_profile_id, row.client_id, row.timestamp, row.status)
+                 for (row_user_profile, row, row_notify) in written],
+                {'timestamp': 'data.timestamp', 'status': 'data.status'})
+
+    for (user_profile, presence, notify) in written:
+        if not user_profile.is_bot:
+            log_realm_presence_change(user_profile.realm_id, user_profile.id, user_profile.email,
+                                      presence.to_dict())
+        if not user_profile.realm.domain == "mit.edu" and notify:
+            # Push event to all users in the realm so they see the new user
+            # appear in the presence list immediately, or the newly online
+            # user without delay.  Note that we won't send an update here for a
+            # timestamp update, because we rely on the browser to ping us every 50
+            # seconds for realm-wide status updates, and those updates should have
+            # recent timestamps, which means the browser won't think active users
+            # have gone idle.  If we were more aggressive in this function about
+            # sending timestamp updates, we could eliminate the ping responses, but
+            # that's not a high priority for now, considering that most of our non-MIT
+            # realms are pretty small.
+            send_presence_changed(user_profile, presence)
+    statsd.incr('user_presence', num_updates)
 
 def update_user_activity_interval(user_profile, log_time):
     # type: (UserProfile, datetime.datetime) -> None
@@ -2493,6 +2704,9 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
         }
     send_event(event, list(map(user_info, ums)))
 
+    if content is not None:
+        queue_link_previews(message)
+
 def encode_email_address(stream):
     # type: (Stream) -> text_type
     return encode_email_address_helper(stream.name, stream.email_token)
@@ -2632,7 +2846,18 @@ def get_status_dict(requesting_user_profile):
     if requesting_user_profile.realm.domain == 'mit.edu':
         return defaultdict(dict)
 
-    return UserPresence.get_status_dict_by_realm(requesting_user_profile.realm_id)
+    # Copied, since callers like apply_events modify it.
+    return dict(get_presence_snapshot(requesting_user_profile.realm).presences)
+
+def get_status_dict_changes(requesting_user_profile, since):
+    # type: (UserProfile, float) -> Optional[Dict[text_type, Dict[text_type, Dict[str, Any]]]]
+    """Like get_status_dict, but only for the users whose presence
+    changed since the timestamp since (with an empty dict for users who
+    no longer have one), or None if we can't tell which did."""
+    if requesting_user_profile.realm.domain == 'mit.edu':
+        return None
+
+    return get_presence_snapshot(requesting_user_profile.realm).get_changes_since(since)
 
 
 def get_realm_user_dicts(user_profile):
@@ -2856,17 +3081,19 @@ def apply_events(state, events, user_profile):
                     if sub['name'].lower() == event['name'].lower():
                         sub[event['property']] = event['value']
             elif event['op'] == 'peer_add':
-                user_id = get_user_profile_by_email(event['user_email']).id
+                user_ids = [get_user_profile_by_email(email).id for email in event['user_emails']]
                 for sub in state['subscriptions']:
-                    if (sub['name'] in event['subscriptions'] and
-                        user_id not in sub['subscribers']):
-                        sub['subscribers'].append(user_id)
+                    if sub['name'] in event['subscriptions']:
+                        for user_id in user_ids:
+                            if user_id not in sub['subscribers']:
+                                sub['subscribers'].append(user_id)
             elif event['op'] == 'peer_remove':
-                user_id = get_user_profile_by_email(event['user_email']).id
+                user_ids = [get_user_profile_by_email(email).id for email in event['user_emails']]
                 for sub in state['subscriptions']:
-                    if (sub['name'] in event['subscriptions'] and
-                        user_id in sub['subscribers']):
-                        sub['subscribers'].remove(user_id)
+                    if sub['name'] in event['subscriptions']:
+                        for user_id in user_ids:
+                            if user_id in sub['subscribers']:
+                                sub['subscribers'].remove(user_id)
         elif event['type'] == "presence":
             state['presences'][event['email']] = event['presence']
         elif event['type'] == "update_message":
@@ -2895,15 +3122,15 @@ def apply_events(state, events, user_profile):
 
 def do_events_register(user_profile, user_client, apply_markdown=True,
                        event_types=None, queue_lifespan_secs=0, all_public_streams=False,
-                       narrow=[]):
-    # type: (UserProfile, Client, bool, Optional[Iterable[str]], int, bool, Iterable[Sequence[text_type]]) -> Dict[str, Any]
+                       narrow=[], multi_user_peer_events=False):
+    # type: (UserProfile, Client, bool, Optional[Iterable[str]], int, bool, Iterable[Sequence[text_type]], bool) -> Dict[str, Any]
     # Technically we don't need to check this here because
     # build_narrow_filter will check it, but it's nicer from an error
     # handling perspective to do it before contacting Tornado
     check_supported_events_narrow_filter(narrow)
     queue_id = request_event_queue(user_profile, user_client, apply_markdown,
                                    queue_lifespan_secs, event_types, all_public_streams,
-                                   narrow=narrow)
+                                   narrow=narrow, multi_user_peer_events=multi_user_peer_events)
 
     if queue_id is None:
         raise JsonableError(_("Could not allocate event queue"))
@@ -2946,24 +3173,45 @@ def do_send_confirmation_email(invitee, referrer):
         subject_template_path=subject_template_path,
         body_template_path=body_template_path)
 
-@statsd_increment("push_notifications")
-def handle_push_notification(user_profile_id, missed_message):
-    # type: (int, Dict[str, Any]) -> None
-    try:
-        user_profile = get_user_profile_by_id(user_profile_id)
-        if not receives_offline_notifications(user_profile):
-            return
+def handle_push_notifications(missed_messages):
+    # type: (List[Dict[str, Any]]) -> None
+    """Sends the push notifications for a batch of
+    missedmessage_mobile_notifications notices, reading their users,
+    messages and devices with a query each."""
+    user_profiles = generic_bulk_cached_fetch(
+        user_profile_by_id_cache_key,
+        lambda user_ids: UserProfile.objects.select_related().filter(id__in=user_ids),
+        list(set(missed_message['user_profile_id'] for missed_message in missed_messages)))
+    missed_messages = [missed_message for missed_message in missed_messages
+                       if missed_message['user_profile_id'] in user_profiles and
+                       receives_offline_notifications(user_profiles[missed_message['user_profile_id']])]
+    if not missed_messages:
+        return
 
-        umessage = UserMessage.objects.get(user_profile=user_profile,
-                                           message__id=missed_message['message_id'])
+    umessages = dict(((umessage.user_profile_id, umessage.message_id), umessage) for umessage in
+                     UserMessage.objects.select_related('message', 'message__sender', 'message__recipient').filter(
+                         user_profile_id__in=set(missed_message['user_profile_id']
+                                                 for missed_message in missed_messages),
+                         message_id__in=set(missed_message['message_id']
+                                            for missed_message in missed_messages)))
+
+    notifications = [] # type: List[Tuple[Dict[str, Any], List[PushDeviceToken], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]
+    for (missed_message, devices) in zip(missed_messages, get_push_devices(missed_messages)):
+        user_profile = user_profiles[missed_message['user_profile_id']]
+        umessage = umessages.get((user_profile.id, missed_message['message_id']))
+        if umessage is None:
+            logging.error("Could not find UserMessage with message_id %s" %(missed_message['message_id'],))
+            continue
         message = umessage.message
         if umessage.flags.read:
-            return
+            continue
         sender_str = message.sender.full_name
 
-        apple = num_push_devices_for_user(user_profile, kind=PushDeviceToken.APNS)
-        android = num_push_devices_for_user(user_profile, kind=PushDeviceToken.GCM)
+        apple = any(device.kind == PushDeviceToken.APNS for device in devices)
+        android = any(device.kind == PushDeviceToken.GCM for device in devices)
 
+        apns_data = None # type: Optional[Dict[str, Any]]
+        android_data = None # type: Optional[Dict[str, Any]]
         if apple or android:
             # TODO: set badge count in a better way
             # Determine what alert string to display based on the missed messages
@@ -2978,7 +3226,7 @@ def handle_push_notification(user_profile_id, missed_message):
 
             if apple:
                 apple_extra_data = {'message_ids': [message.id]}
-                send_apple_push_notification(user_profile, alert, badge=1, zulip=apple_extra_data)
+                apns_data = dict(alert=alert, badge=1, zulip=apple_extra_data)
 
             if android:
                 content = message.content
@@ -3006,10 +3254,10 @@ def handle_push_notification(user_profile_id, missed_message):
                 elif message.recipient.type in (Recipient.HUDDLE, Recipient.PERSONAL):
                     android_data['recipient_type'] = "private"
 
-                send_android_push_notification(user_profile, android_data)
+            notifications.append((missed_message, devices, apns_data, android_data))
 
-    except UserMessage.DoesNotExist:
-        logging.error("Could not find UserMessage with message_id %s" %(missed_message['message_id'],))
+    send_push_notifications(notifications)
+    statsd.incr("push_notifications", len(missed_messages))
 
 def is_inactive(email):
     # type: (text_type) -> None
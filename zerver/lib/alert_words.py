@@ -6,7 +6,7 @@ from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
 import ujson
 import six
 from six import text_type
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Set, Tuple
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm):
@@ -17,6 +17,115 @@ def alert_words_in_realm(realm):
     user_ids_with_words = dict((user_id, w) for (user_id, w) in six.iteritems(all_user_words) if len(w))
     return user_ids_with_words
 
+# An alert word only matches when it is surrounded by whitespace, the
+# start or end of the message, or one of these punctuation characters.
+ALLOWED_BEFORE_ALERT_WORD = frozenset(u'(".,\';[*`>')
+ALLOWED_AFTER_ALERT_WORD = frozenset(u')"?:.,\';]!*`')
+
+class AlertWordMatcher(object):
+    """Finds which users' alert words occur in a message, with one pass
+    over the message no matter how many alert words the realm has.
+
+    This is an Aho-Corasick automaton over the lowercased words: a trie
+    whose nodes also have a failure link to the node for the longest
+    proper suffix of their string that is in the trie, so that scanning
+    never backtracks.  Each node's outputs are the words ending there,
+    including those reached through failure links."""
+
+    def __init__(self, realm_words):
+        # type: (Dict[int, List[text_type]]) -> None
+        self.goto = [{}] # type: List[Dict[text_type, int]]
+        self.outputs = [[]] # type: List[List[int]]
+        self.word_lengths = [] # type: List[int]
+        self.word_user_ids = [] # type: List[Set[int]]
+        word_indexes = {} # type: Dict[text_type, int]
+        for user_id, words in six.iteritems(realm_words):
+            for word in words:
+                word = word.lower()
+                # An empty alert word is meaningless, and would
+                # otherwise match between any two allowed characters.
+                if not word:
+                    continue
+                if word not in word_indexes:
+                    word_indexes[word] = len(self.word_lengths)
+                    self.word_lengths.append(len(word))
+                    self.word_user_ids.append(set())
+                    self.add_word(word, word_indexes[word])
+                self.word_user_ids[word_indexes[word]].add(user_id)
+        self.build_failure_links()
+
+    def add_word(self, word, word_index):
+        # type: (text_type, int) -> None
+        state = 0
+        for char in word:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append(word_index)
+
+    def build_failure_links(self):
+        # type: () -> None
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in six.iteritems(self.goto[state]):
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                # States are visited in breadth-first order, so the
+                # failure target's outputs are already complete.
+                self.outputs[next_state].extend(self.outputs[self.fail[next_state]])
+
+    def find_user_ids(self, content):
+        # type: (text_type) -> Set[int]
+        content = content.lower()
+        user_ids = set() # type: Set[int]
+        matched_words = set() # type: Set[int]
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for (end, char) in enumerate(content):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for word_index in outputs[state]:
+                if word_index in matched_words:
+                    continue
+                start = end - self.word_lengths[word_index] + 1
+                if start > 0:
+                    before = content[start - 1]
+                    if not (before.isspace() or before in ALLOWED_BEFORE_ALERT_WORD):
+                        continue
+                if end + 1 < len(content):
+                    after = content[end + 1]
+                    if not (after.isspace() or after in ALLOWED_AFTER_ALERT_WORD):
+                        continue
+                matched_words.add(word_index)
+                user_ids |= self.word_user_ids[word_index]
+        return user_ids
+
+# Matchers are cached per process, along with the alert words they were
+# built from, which we compare against the (cached) current alert words
+# to notice when they have changed.
+realm_alert_word_matchers = {} # type: Dict[int, Tuple[Dict[int, List[text_type]], AlertWordMatcher]]
+
+def get_alert_word_matcher(realm):
+    # type: (Realm) -> AlertWordMatcher
+    realm_words = alert_words_in_realm(realm)
+    cached = realm_alert_word_matchers.get(realm.id)
+    if cached is not None and cached[0] == realm_words:
+        return cached[1]
+    matcher = AlertWordMatcher(realm_words)
+    realm_alert_word_matchers[realm.id] = (realm_words, matcher)
+    return matcher
+
 def user_alert_words(user_profile):
     # type: (UserProfile) -> List[text_type]
     return ujson.loads(user_profile.alert_words)
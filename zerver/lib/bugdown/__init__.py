@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 # Zulip's main markdown implementation.  See docs/markdown.md for
 # detailed documentation on our markdown syntax.
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar, Union
 from typing.re import Match
 
 import markdown
@@ -16,6 +16,7 @@ import platform
 import time
 import httplib2
 import itertools
+from multiprocessing.pool import ThreadPool
 from six.moves import urllib
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element, SubElement
@@ -26,14 +27,18 @@ import requests
 
 from django.core import mail
 from django.conf import settings
+from django.db import connection
 
 from zerver.lib.avatar  import gravatar_hash
 from zerver.lib.bugdown import codehilite
 from zerver.lib.bugdown import fenced_code
+from zerver.lib.bugdown import render_pool
 from zerver.lib.bugdown.fenced_code import FENCE_RE
 from zerver.lib.camo import get_camo_url
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, cache_get_many, cache_set_many
+from zerver.lib.cache import cache_with_key, cache_get, cache_get_many, cache_set_many, \
+    get_bugdown_realm_token, remote_cache_set_many
+from zerver.lib.utils import make_safe_digest, statsd
 from zerver.models import Message
 import zerver.lib.alert_words as alert_words
 import zerver.lib.mention as mention
@@ -119,6 +124,13 @@ def add_a(root, url, link, height="", title=None, desc=None,
         desc_div = markdown.util.etree.SubElement(summary_div, "desc")
         desc_div.set("class", "message_inline_image_desc")
 
+# Sometimes Twitter hangs on responses.  Timing out here will cause
+# the Tweet to go through as-is with no inline preview, rather than
+# having the message be rejected entirely.  This timeout needs to be
+# less than our overall formatting timeout.
+TWEET_FETCH_TIMEOUT = 3
+OPEN_GRAPH_FETCH_TIMEOUT = 1
+
 @cache_with_key(lambda tweet_id: tweet_id, cache_name="database", with_statsd_key="tweet_data")
 def fetch_tweet_data(tweet_id):
     # type: (text_type) -> Optional[Dict[text_type, Any]]
@@ -136,13 +148,8 @@ def fetch_tweet_data(tweet_id):
            return None
 
         try:
-            api = twitter.Api(**creds)
-            # Sometimes Twitter hangs on responses.  Timing out here
-            # will cause the Tweet to go through as-is with no inline
-            # preview, rather than having the message be rejected
-            # entirely. This timeout needs to be less than our overall
-            # formatting timeout.
-            tweet = timeout(3, api.GetStatus, tweet_id)
+            api = twitter.Api(base_url=settings.TWITTER_API_URL, **creds)
+            tweet = timeout(TWEET_FETCH_TIMEOUT, api.GetStatus, tweet_id)
             res = tweet.AsDict()
         except AttributeError:
             logging.error('Unable to load twitter api, you may have the wrong '
@@ -180,6 +187,17 @@ HEAD_END_RE = re.compile(u'^/head[ >]')
 META_START_RE = re.compile(u'^meta[ >]')
 META_END_RE = re.compile(u'^/meta[ >]')
 
+def open_graph_fetch_proxies():
+    # type: () -> Optional[Dict[str, str]]
+    if settings.OPEN_GRAPH_FETCH_PROXY is None:
+        return None
+    return {'http': settings.OPEN_GRAPH_FETCH_PROXY, 'https': settings.OPEN_GRAPH_FETCH_PROXY}
+
+def open_graph_image_cache_key(url):
+    # type: (text_type) -> text_type
+    return u'open_graph_image:%s' % (make_safe_digest(url),)
+
+@cache_with_key(open_graph_image_cache_key, timeout=3600*24, with_statsd_key="open_graph_image")
 def fetch_open_graph_image(url):
     # type: (text_type) -> Optional[Dict[str, Any]]
     in_head = False
@@ -189,7 +207,8 @@ def fetch_open_graph_image(url):
 
     # TODO: What if response content is huge? Should we get headers first?
     try:
-        content = requests.get(url, timeout=1).text
+        content = requests.get(url, timeout=OPEN_GRAPH_FETCH_TIMEOUT,
+                               proxies=open_graph_fetch_proxies()).text
     except:
         return None
 
@@ -261,6 +280,54 @@ def get_tweet_id(url):
         return None
     return tweet_id_match.group("tweetid")
 
+def is_dropbox_shared_link(url):
+    # type: (text_type) -> bool
+    # Only Dropbox shared links get previews.
+    parsed_url = urllib.parse.urlparse(url)
+    if not (parsed_url.netloc == 'dropbox.com' or parsed_url.netloc.endswith('.dropbox.com')):
+        return False
+    return any(parsed_url.path.startswith(prefix) for prefix in ['/s/', '/sh/', '/sc/', '/photos/'])
+
+def link_preview_is_cached(url):
+    # type: (text_type) -> bool
+    """Whether we can preview url without fetching anything from a
+    third party, either because its data is cached or because it needs
+    none."""
+    tweet_id = get_tweet_id(url)
+    if tweet_id is not None:
+        return cache_get(tweet_id, cache_name="database") is not None
+    if is_dropbox_shared_link(url):
+        return cache_get(open_graph_image_cache_key(url)) is not None
+    return True
+
+def fetch_link_preview(url):
+    # type: (text_type) -> None
+    try:
+        tweet_id = get_tweet_id(url)
+        if tweet_id is not None:
+            fetch_tweet_data(tweet_id)
+        elif is_dropbox_shared_link(url):
+            fetch_open_graph_image(url)
+    except Exception:
+        # The preview is just left out, as when rendering inline.
+        logging.warning(traceback.format_exc())
+    finally:
+        # This runs in a thread of link_preview_pool, which must not
+        # hold on to a database connection (for the tweet cache).
+        connection.close()
+
+LINK_PREVIEW_FETCH_THREADS = 5
+link_preview_pool = None # type: Optional[ThreadPool]
+
+def fetch_link_previews(urls):
+    # type: (Iterable[text_type]) -> None
+    """Fetches the data for previewing urls into their caches,
+    concurrently.  Used by the embed_links queue worker."""
+    global link_preview_pool
+    if link_preview_pool is None:
+        link_preview_pool = ThreadPool(LINK_PREVIEW_FETCH_THREADS)
+    link_preview_pool.map(fetch_link_preview, list(urls))
+
 class InlineHttpsProcessor(markdown.treeprocessors.Treeprocessor):
     def run(self, root):
         # type: (Element) -> None
@@ -298,13 +365,8 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
         # type: (text_type) -> Optional[Dict]
         # TODO: specify details of returned Dict
         parsed_url = urllib.parse.urlparse(url)
-        if (parsed_url.netloc == 'dropbox.com' or parsed_url.netloc.endswith('.dropbox.com')):
+        if is_dropbox_shared_link(url):
             is_album = parsed_url.path.startswith('/sc/') or parsed_url.path.startswith('/photos/')
-            # Only allow preview Dropbox shared links
-            if not (parsed_url.path.startswith('/s/') or
-                    parsed_url.path.startswith('/sh/') or
-                    is_album):
-                return None
 
             # Try to retrieve open graph protocol info for a preview
             # This might be redundant right now for shared links for images.
@@ -509,6 +571,17 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             logging.warning(traceback.format_exc())
             return None
 
+    def defer_preview(self, url):
+        # type: (text_type) -> bool
+        """Whether to leave previewing url to the embed_links queue
+        worker, because it needs data we would have to fetch from a
+        third party.  Only messages' previews are deferred, since the
+        worker updates the message once it has the data."""
+        if current_message is None or link_preview_is_cached(url):
+            return False
+        current_message.links_for_preview.add(url)
+        return True
+
     def run(self, root):
         # type: (Element) -> None
         # Get all URLs from the blob
@@ -521,6 +594,8 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
         rendered_tweet_count = 0
 
         for url in found_urls:
+            if self.defer_preview(url):
+                continue
             dropbox_image = self.dropbox_image(url)
             if dropbox_image is not None:
                 class_attr = "message_inline_ref"
@@ -825,20 +900,154 @@ def prepare_realm_pattern(source):
     characters directly after, and saves what was matched as "name". """
     return r"""(?<![^\s'"\(,:<])(?P<name>""" + source + ')(?!\w)'
 
+# A named group, or a reference to one, not escaped by a backslash.
+REALM_FILTER_GROUP_RE = re.compile(u'(?<!\\\\)((?:\\\\\\\\)*)\\(\\?P([<=])(\\w+)')
+# Inline flags, like (?i), not escaped by a backslash.
+REALM_FILTER_FLAGS_RE = re.compile(u'(?<!\\\\)(?:\\\\\\\\)*\\(\\?[iLmsux]+\\)')
+
+# The flags python-markdown compiles inline patterns with.
+INLINE_PATTERN_FLAGS = re.DOTALL | re.UNICODE
+
+class RealmFilterMatcher(object):
+    """Finds which of a realm's filters match a text in one pass over
+    it, rather than one pass per filter.
+
+    The filters are still applied one at a time and in order, so an
+    earlier filter's matches take precedence over overlapping matches of
+    later ones; the combined pass only lets us skip the filters that
+    don't match anywhere, which for most texts is all of them.
+
+    The filters are combined into a single alternation, in order.  Each
+    alternative is wrapped in a group named for the filter's index, and
+    the filters' own named groups are renamed to be unique across the
+    alternation.  Python 2's re allows only 100 groups in a pattern, so
+    a realm with very many filters gets a few combined patterns.  Inline
+    flags like (?i) apply to the whole pattern they're in, so filters
+    with them are left out of the combined patterns and always tried on
+    their own."""
+
+    # Python 2's limit, less group 0 and the "name" group.
+    MAX_GROUPS_PER_PATTERN = 98
+
+    def __init__(self, filters):
+        # type: (List[Tuple[text_type, text_type]]) -> None
+        self.filters = filters
+        self.patterns = [] # type: List[text_type]
+        # The indexes of the filters in each of the patterns.
+        self.pattern_filters = [] # type: List[List[int]]
+        # The indexes of the filters left out of the patterns.
+        self.separate_filters = [] # type: List[int]
+        # For each set of flags, the compiled combined patterns and the
+        # filters' own compiled patterns.
+        self.compiled = {} # type: Dict[int, Tuple[List[Any], List[Any]]]
+        # The arguments and result of the last filters_matching call;
+        # python-markdown asks once per filter about the same text.
+        self.last_matching = None # type: Optional[Tuple[int, text_type, Set[int]]]
+
+        alternatives = [] # type: List[text_type]
+        alternative_filters = [] # type: List[int]
+        num_groups = 0
+        for (i, (source, format_string)) in enumerate(filters):
+            if REALM_FILTER_FLAGS_RE.search(source):
+                self.separate_filters.append(i)
+                continue
+
+            def rename_group(m):
+                # type: (Match[text_type]) -> text_type
+                (backslashes, kind, name) = m.groups()
+                return u'%s(?P%srealm_filter_%d_%s' % (backslashes, kind, i, name)
+            alternative = u'(?P<realm_filter_%d>%s)' % (i, REALM_FILTER_GROUP_RE.sub(rename_group, source))
+
+            alternative_groups = re.compile(alternative).groups
+            if alternatives and num_groups + alternative_groups > self.MAX_GROUPS_PER_PATTERN:
+                self.add_pattern(alternatives, alternative_filters)
+                alternatives = []
+                alternative_filters = []
+                num_groups = 0
+            alternatives.append(alternative)
+            alternative_filters.append(i)
+            num_groups += alternative_groups
+        if alternatives:
+            self.add_pattern(alternatives, alternative_filters)
+
+    def add_pattern(self, alternatives, filter_indexes):
+        # type: (List[text_type], List[int]) -> None
+        self.patterns.append(prepare_realm_pattern(u'|'.join(alternatives)))
+        self.pattern_filters.append(filter_indexes)
+
+    def compile(self, flags):
+        # type: (int) -> Tuple[List[Any], List[Any]]
+        if flags not in self.compiled:
+            self.compiled[flags] = ([re.compile(pattern, flags) for pattern in self.patterns],
+                                    [re.compile(prepare_realm_pattern(source), flags)
+                                     for (source, format_string) in self.filters])
+        return self.compiled[flags]
+
+    def filters_matching(self, text, flags=0):
+        # type: (text_type, int) -> Set[int]
+        """The indexes of the filters that match somewhere in text, when
+        compiled with the given flags."""
+        if self.last_matching is not None and self.last_matching[:2] == (flags, text):
+            return self.last_matching[2]
+
+        (patterns, filter_patterns) = self.compile(flags)
+        matching = set(i for i in self.separate_filters if filter_patterns[i].search(text))
+        for (pattern, filter_indexes) in zip(patterns, self.pattern_filters):
+            m = pattern.search(text)
+            while m is not None:
+                # The alternation only tells us the first filter that
+                # matches here, so check the later ones.  Then search
+                # again from the next position rather than the end of
+                # the match, since another filter's match, which will be
+                # applied separately, may start inside this one.
+                start = m.start()
+                first = [i for i in filter_indexes if m.group(u'realm_filter_%d' % (i,)) is not None][0]
+                matching.add(first)
+                for i in filter_indexes[filter_indexes.index(first) + 1:]:
+                    if i not in matching and filter_patterns[i].match(text, start):
+                        matching.add(i)
+                m = pattern.search(text, start + 1)
+
+        self.last_matching = (flags, text, matching)
+        return matching
+
+    def find_urls(self, text):
+        # type: (text_type) -> List[text_type]
+        (patterns, filter_patterns) = self.compile(0)
+        urls = [] # type: List[text_type]
+        for i in sorted(self.filters_matching(text)):
+            for m in filter_patterns[i].finditer(text):
+                urls.append(self.filters[i][1] % m.groupdict())
+        return urls
+
 # Given a regular expression pattern, linkifies groups that match it
 # using the provided format string to construct the URL.
 class RealmFilterPattern(markdown.inlinepatterns.Pattern):
     """ Applied a given realm filter to the input """
-    def __init__(self, source_pattern, format_string, markdown_instance=None):
-        # type: (text_type, text_type, Optional[markdown.Markdown]) -> None
+    def __init__(self, matcher, filter_index, markdown_instance=None):
+        # type: (RealmFilterMatcher, int, Optional[markdown.Markdown]) -> None
+        self.matcher = matcher
+        self.filter_index = filter_index
+        (source_pattern, self.format_string) = matcher.filters[filter_index]
         self.pattern = prepare_realm_pattern(source_pattern)
-        self.format_string = format_string
         markdown.inlinepatterns.Pattern.__init__(self, self.pattern, markdown_instance)
 
+    def getCompiledRegExp(self):
+        # type: () -> RealmFilterPattern
+        # python-markdown calls match() on this, for each text.
+        return self
+
+    def match(self, text):
+        # type: (text_type) -> Optional[Match[text_type]]
+        if self.filter_index not in self.matcher.filters_matching(text, INLINE_PATTERN_FLAGS):
+            return None
+        return self.compiled_re.match(text)
+
     def handleMatch(self, m):
         # type: (Match[text_type]) -> Union[Element, text_type]
+        # Later filters mustn't linkify parts of the link's text.
         return url_to_a(self.format_string % m.groupdict(),
-                        m.group("name"))
+                        markdown.util.AtomicString(m.group("name")))
 
 class UserMentionPattern(markdown.inlinepatterns.Pattern):
     def find_user_for_mention(self, name):
@@ -849,11 +1058,9 @@ class UserMentionPattern(markdown.inlinepatterns.Pattern):
         if mention.user_mention_matches_wildcard(name):
             return (True, None)
 
-        user = db_data['full_names'].get(name.lower(), None)
-        if user is None:
-            user = db_data['short_names'].get(name.lower(), None)
-
-        return (False, user)
+        if db_data['mention_index'] is None:
+            return (False, None)
+        return (False, db_data['mention_index'].find_user(name))
 
     def handleMatch(self, m):
         # type: (Match[text_type]) -> Optional[Element]
@@ -885,21 +1092,10 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
         if current_message and db_data is not None:
             # We check for a user's custom notifications here, as we want
             # to check for plaintext words that depend on the recipient.
-            realm_words = db_data['realm_alert_words']
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
-
-            for user_id, words in six.iteritems(realm_words):
-                for word in words:
-                    escaped = re.escape(word.lower())
-                    match_re = re.compile(u'(?:%s)%s(?:%s)' %
-                                            (allowed_before_punctuation,
-                                             escaped,
-                                             allowed_after_punctuation))
-                    if re.search(match_re, content):
-                        current_message.user_ids_with_alert_words.add(user_id)
+            content = '\n'.join(lines)
+            user_ids = db_data['alert_word_matcher'].find_user_ids(content)
+            if user_ids:
+                current_message.user_ids_with_alert_words.update(user_ids)
 
         return lines
 
@@ -961,9 +1157,12 @@ class Bugdown(markdown.Extension):
 
         md.inlinePatterns.add('link', AtomicLinkPattern(markdown.inlinepatterns.LINK_RE, md), '>backtick')
 
-        for (pattern, format_string) in self.getConfig("realm_filters"):
-            md.inlinePatterns.add('realm_filters/%s' % (pattern,),
-                                  RealmFilterPattern(pattern, format_string), '>link')
+        realm_filter_matcher = self.getConfig("realm_filter_matcher")
+        location = '>link'
+        for filter_index in range(len(realm_filter_matcher.filters)):
+            md.inlinePatterns.add('realm_filters/%d' % (filter_index,),
+                                  RealmFilterPattern(realm_filter_matcher, filter_index), location)
+            location = '>realm_filters/%d' % (filter_index,)
 
         # A link starts at a word boundary, and ends at space, punctuation, or end-of-input.
         #
@@ -1035,7 +1234,7 @@ class Bugdown(markdown.Extension):
                     del md.parser.blockprocessors[k]
 
 md_engines = {}
-realm_filter_data = {} # type: Dict[text_type, List[Tuple[text_type, text_type]]]
+realm_filter_data = {} # type: Dict[text_type, RealmFilterMatcher]
 
 def make_md_engine(key, opts):
     # type: (text_type, Dict[str, Any]) -> None
@@ -1052,27 +1251,20 @@ def make_md_engine(key, opts):
 
 def subject_links(domain, subject):
     # type: (text_type, text_type) -> List[text_type]
-    from zerver.models import get_realm, RealmFilter, realm_filters_for_domain
-    matches = [] # type: List[text_type]
-
-    realm_filters = realm_filters_for_domain(domain)
-
-    for realm_filter in realm_filters:
-        pattern = prepare_realm_pattern(realm_filter[0])
-        for m in re.finditer(pattern, subject):
-            matches += [realm_filter[1] % m.groupdict()]
-    return matches
+    maybe_update_realm_filters(domain)
+    return realm_filter_data[domain].find_urls(subject)
 
 def make_realm_filters(domain, filters):
     # type: (text_type, List[Tuple[text_type, text_type]]) -> None
     global md_engines, realm_filter_data
     if domain in md_engines:
         del md_engines[domain]
-    realm_filter_data[domain] = filters
+    realm_filter_data[domain] = RealmFilterMatcher(filters)
 
     # Because of how the Markdown config API works, this has confusing
     # large number of layers of dicts/arrays :(
-    make_md_engine(domain, {"realm_filters": [filters, "Realm-specific filters for %s" % (domain,)],
+    make_md_engine(domain, {"realm_filter_matcher": [realm_filter_data[domain],
+                                                     "Realm-specific filters for %s" % (domain,)],
                            "realm": [domain, "Realm name"]})
 
 def maybe_update_realm_filters(domain):
@@ -1088,8 +1280,11 @@ def maybe_update_realm_filters(domain):
         # Hack to ensure that getConfig("realm") is right for mirrored Zephyrs
         make_realm_filters("mit.edu/zephyr_mirror", [])
     else:
+        # flush_realm_filter clears the realm's filters from the
+        # caches realm_filters_for_domain reads, which is how we notice
+        # changes here.
         realm_filters = realm_filters_for_domain(domain)
-        if domain not in realm_filter_data or realm_filter_data[domain] != realm_filters:
+        if domain not in realm_filter_data or realm_filter_data[domain].filters != realm_filters:
             # Data has changed, re-load filters
             make_realm_filters(domain, realm_filters)
 
@@ -1109,18 +1304,47 @@ def _sanitize_for_log(md):
 
 # Filters such as UserMentionPattern need a message, but python-markdown
 # provides no way to pass extra params through to a pattern. Thus, a global.
-current_message = None # type: Optional[Message]
+# In a render pool worker, it's a RenderContext standing in for the message.
+current_message = None # type: Optional[Union[Message, render_pool.RenderContext]]
 
 # We avoid doing DB queries in our markdown thread to avoid the overhead of
 # opening a new DB connection. These connections tend to live longer than the
 # threads themselves, as well.
 db_data = None # type: Dict[text_type, Any]
 
+# How long we let a single message take to render.
+RENDER_TIMEOUT = 5
+
+# Set in bugdown_render_worker processes, which leave enforcing the
+# timeout to the RenderPool that sends them work.
+in_render_worker = False
+
+def active_render_pool():
+    # type: () -> Optional[render_pool.RenderPool]
+    if in_render_worker:
+        return None
+    return render_pool.get_render_pool(RENDER_TIMEOUT)
+
+def report_render_failure(md, details):
+    # type: (markdown.Markdown, str) -> None
+    from zerver.lib.actions import internal_send_message
+
+    cleaned = _sanitize_for_log(md)
+
+    # Output error to log as well as sending a zulip and email
+    logging.getLogger('').error('Exception in Markdown parser: %sInput (sanitized) was: %s'
+        % (details, cleaned))
+    subject = "Markdown parser failure on %s" % (platform.node(),)
+    if settings.ERROR_BOT is not None:
+        internal_send_message(settings.ERROR_BOT, "stream",
+                "errors", subject, "Markdown parser failed, email sent with details.")
+    mail.mail_admins(subject, "Failed message: %s\n\n%s\n\n" % (
+                                cleaned, details),
+                     fail_silently=False)
+
 def do_convert(md, realm_domain=None, message=None):
-    # type: (markdown.Markdown, Optional[text_type], Optional[Message]) -> Optional[text_type]
+    # type: (markdown.Markdown, Optional[text_type], Optional[Union[Message, render_pool.RenderContext]]) -> Optional[text_type]
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
-    from zerver.models import get_active_user_dicts_in_realm, UserProfile
-
     if message:
         maybe_update_realm_filters(message.get_realm().domain)
 
@@ -1137,38 +1361,53 @@ def do_convert(md, realm_domain=None, message=None):
     # Pre-fetch data from the DB that is used in the bugdown thread
     global db_data
     if message:
-        realm_users = get_active_user_dicts_in_realm(message.get_realm())
+        # Only messages that could mention someone need the realm's users.
+        if '@' in md:
+            mention_index = mention.get_mention_index(message.get_realm())
+        else:
+            mention_index = None
 
-        db_data = {'realm_alert_words': alert_words.alert_words_in_realm(message.get_realm()),
-                   'full_names':        dict((user['full_name'].lower(), user) for user in realm_users),
-                   'short_names':       dict((user['short_name'].lower(), user) for user in realm_users),
-                   'emoji':             message.get_realm().get_emoji()}
+        db_data = {'alert_word_matcher': alert_words.get_alert_word_matcher(message.get_realm()),
+                   'mention_index':      mention_index,
+                   'emoji':              message.get_realm().get_emoji()}
 
     try:
+        if in_render_worker:
+            return _md_engine.convert(md)
         # Spend at most 5 seconds rendering.
         # Sometimes Python-Markdown is really slow; see
         # https://trac.zulip.net/ticket/345
-        return timeout(5, _md_engine.convert, md)
+        return timeout(RENDER_TIMEOUT, _md_engine.convert, md)
     except:
-        from zerver.lib.actions import internal_send_message
-
-        cleaned = _sanitize_for_log(md)
-
-        # Output error to log as well as sending a zulip and email
-        logging.getLogger('').error('Exception in Markdown parser: %sInput (sanitized) was: %s'
-            % (traceback.format_exc(), cleaned))
-        subject = "Markdown parser failure on %s" % (platform.node(),)
-        if settings.ERROR_BOT is not None:
-            internal_send_message(settings.ERROR_BOT, "stream",
-                    "errors", subject, "Markdown parser failed, email sent with details.")
-        mail.mail_admins(subject, "Failed message: %s\n\n%s\n\n" % (
-                                    cleaned, traceback.format_exc()),
-                         fail_silently=False)
+        report_render_failure(md, traceback.format_exc())
         return None
     finally:
         current_message = None
         db_data = None
 
+def convert_in_render_pool(pool, requests):
+    # type: (render_pool.RenderPool, List[Tuple[text_type, Optional[text_type], Optional[Message]]]) -> List[Optional[text_type]]
+    try:
+        results = pool.render_many([(md, realm_domain, message.get_realm() if message else None)
+                                    for (md, realm_domain, message) in requests]) # type: List[Any]
+    except render_pool.RenderPoolError as e:
+        results = [e] * len(requests)
+
+    rendered = [] # type: List[Optional[text_type]]
+    for ((md, realm_domain, message), result) in zip(requests, results):
+        if isinstance(result, render_pool.RenderPoolError):
+            report_render_failure(md, "%s\n" % (result,))
+            rendered.append(None)
+            continue
+        (rendered_content, properties) = result
+        # Copy over what the worker's bugdown noted about the message,
+        # e.g. mentions_user_ids.
+        if message and properties is not None:
+            for (name, value) in six.iteritems(properties):
+                setattr(message, name, value)
+        rendered.append(rendered_content)
+    return rendered
+
 bugdown_time_start = 0.0
 bugdown_total_time = 0.0
 bugdown_total_requests = 0
@@ -1194,9 +1433,99 @@ def bugdown_stats_finish():
     bugdown_total_requests += 1
     bugdown_total_time += (time.time() - bugdown_time_start)
 
+# Renders are cached, keyed on the content and everything else they
+# depend on, along with the properties bugdown sets on the message, so
+# that identical messages (e.g. from bots and integrations) skip
+# python-markdown entirely.
+RENDER_CACHE_TIMEOUT = 3600*24
+render_cache_hits = 0
+render_cache_misses = 0
+
+def get_render_cache_hits():
+    # type: () -> int
+    return render_cache_hits
+
+def get_render_cache_misses():
+    # type: () -> int
+    return render_cache_misses
+
+def render_cache_key(md, realm_domain, message):
+    # type: (markdown.Markdown, Optional[text_type], Optional[Message]) -> text_type
+    # realm_domain picks the markdown processor, and may be a special
+    # one like "mit.edu/zephyr_mirror"; the users, emoji and alert
+    # words come from the message's realm.  Without a message, bugdown
+    # doesn't look at those at all.
+    context_domain = message.get_realm().domain if message else realm_domain
+    token = get_bugdown_realm_token(context_domain) if context_domain else u''
+    # None of the other fields can contain a newline, so this is unambiguous.
+    key_data = u'\n'.join([str(version), realm_domain or u'', context_domain or u'',
+                           str(bool(message)), token, force_text(md)])
+    return u'bugdown_render:%s' % (make_safe_digest(key_data),)
+
 def convert(md, realm_domain=None, message=None):
     # type: (markdown.Markdown, Optional[text_type], Optional[Message]) -> Optional[text_type]
+    return convert_many([(md, realm_domain, message)])[0]
+
+def convert_many(requests):
+    # type: (List[Tuple[text_type, Optional[text_type], Optional[Message]]]) -> List[Optional[text_type]]
+    """Like convert, for a list of (md, realm_domain, message) tuples,
+    which a render pool renders in parallel."""
+    global render_cache_hits, render_cache_misses
     bugdown_stats_start()
-    ret = do_convert(md, realm_domain, message)
+    cache_keys = [render_cache_key(md, realm_domain, message)
+                  for (md, realm_domain, message) in requests]
+    cached = cache_get_many(cache_keys)
+
+    ret = [None] * len(requests) # type: List[Optional[text_type]]
+    misses = [] # type: List[int]
+    for (i, (md, realm_domain, message)) in enumerate(requests):
+        if cache_keys[i] not in cached:
+            misses.append(i)
+            continue
+        cached_entry = cached[cache_keys[i]][0]
+        if message:
+            message.mentions_wildcard = cached_entry['mentions_wildcard']
+            message.mentions_user_ids = set(cached_entry['mentions_user_ids'])
+            message.user_ids_with_alert_words = set(cached_entry['user_ids_with_alert_words'])
+        ret[i] = cached_entry['rendered_content']
+    num_hits = len(requests) - len(misses)
+    render_cache_hits += num_hits
+    render_cache_misses += len(misses)
+    if num_hits:
+        statsd.incr("bugdown.render_cache.hit", num_hits)
+    if misses:
+        statsd.incr("bugdown.render_cache.miss", len(misses))
+
+    to_render = [requests[i] for i in misses]
+    pool = active_render_pool()
+    if pool is None:
+        rendered = [do_convert(md, realm_domain, message) for (md, realm_domain, message) in to_render]
+    else:
+        rendered = convert_in_render_pool(pool, to_render)
+
+    items_for_remote_cache = {} # type: Dict[text_type, Any]
+    for (i, rendered_content) in zip(misses, rendered):
+        ret[i] = rendered_content
+        if rendered_content is None:
+            # Don't remember failures; they may be timeouts.
+            continue
+        message = requests[i][2]
+        if message and getattr(message, 'links_for_preview', None):
+            # The render is missing previews, which the embed_links
+            # worker will add once it has fetched their data.
+            continue
+        entry = dict(rendered_content=rendered_content,
+                     mentions_wildcard=False,
+                     mentions_user_ids=[],
+                     user_ids_with_alert_words=[]) # type: Dict[str, Any]
+        if message:
+            # Unless Message.prepare_to_render reset them, rendering
+            # only sets these on a message with mentions or alert words.
+            entry['mentions_wildcard'] = getattr(message, 'mentions_wildcard', False)
+            entry['mentions_user_ids'] = list(getattr(message, 'mentions_user_ids', []))
+            entry['user_ids_with_alert_words'] = list(getattr(message, 'user_ids_with_alert_words', []))
+        items_for_remote_cache[cache_keys[i]] = (entry,)
+    if items_for_remote_cache:
+        remote_cache_set_many(items_for_remote_cache, timeout=RENDER_CACHE_TIMEOUT)
     bugdown_stats_finish()
     return ret
@@ -0,0 +1,207 @@
+from __future__ import absolute_import
+# A pool of worker processes that render markdown for bugdown.convert.
+#
+# Rendering is CPU-bound, so in a single process renders serialize on
+# the GIL, and the thread-based timeout in zerver.lib.timeout can only
+# ask a runaway render to stop.  With settings.BUGDOWN_RENDER_PROCESSES
+# set, each Django process instead keeps that many `manage.py
+# bugdown_render_worker` subprocesses, each with its own warm per-realm
+# markdown engines, and hands renders to them over pipes.  A render that
+# runs past its timeout gets its worker killed and replaced.
+
+from typing import Any, Dict, IO, List, Optional, Set, Tuple
+
+from django.conf import settings
+from six import text_type
+from six.moves import cPickle as pickle
+
+import logging
+import os
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+# How long a new worker may take to set up Django before we give up on it.
+WORKER_STARTUP_TIMEOUT = 60
+
+class RenderPoolError(Exception):
+    pass
+
+def write_message(stream, data):
+    # type: (IO[bytes], Any) -> None
+    payload = pickle.dumps(data, 2)
+    stream.write(struct.pack('!I', len(payload)) + payload)
+    stream.flush()
+
+def read_exactly(stream, length):
+    # type: (IO[bytes], int) -> bytes
+    data = b''
+    while len(data) < length:
+        chunk = stream.read(length - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+def read_message(stream):
+    # type: (IO[bytes]) -> Any
+    (length,) = struct.unpack('!I', read_exactly(stream, 4))
+    return pickle.loads(read_exactly(stream, length))
+
+class RenderContext(object):
+    """Stands in for the Message being rendered in a render worker,
+    collecting the properties bugdown sets on the message so that they
+    can be sent back and set on the real one."""
+
+    def __init__(self, realm):
+        # type: (Any) -> None
+        self.realm = realm
+        self.mentions_wildcard = False
+        self.mentions_user_ids = set() # type: Set[int]
+        self.user_ids_with_alert_words = set() # type: Set[int]
+        self.links_for_preview = set() # type: Set[text_type]
+
+    def get_realm(self):
+        # type: () -> Any
+        return self.realm
+
+    def properties(self):
+        # type: () -> Dict[str, Any]
+        return dict(mentions_wildcard=self.mentions_wildcard,
+                    mentions_user_ids=self.mentions_user_ids,
+                    user_ids_with_alert_words=self.user_ids_with_alert_words,
+                    links_for_preview=self.links_for_preview)
+
+def render_request(request):
+    # type: (Tuple[text_type, Optional[text_type], Any]) -> Tuple[Optional[text_type], Optional[Dict[str, Any]]]
+    """Runs in the worker: renders one request from RenderPool.render_many."""
+    from zerver.lib import bugdown
+    (content, realm_domain, realm) = request
+    if realm is None:
+        return (bugdown.do_convert(content, realm_domain), None)
+    context = RenderContext(realm)
+    return (bugdown.do_convert(content, realm_domain, context), context.properties())
+
+class RenderWorker(object):
+    def __init__(self):
+        # type: () -> None
+        self.process = subprocess.Popen([sys.executable,
+                                         os.path.join(settings.DEPLOY_ROOT, 'manage.py'),
+                                         'bugdown_render_worker'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        close_fds=True)
+        self.ready = False
+        self.deadline = time.time() + WORKER_STARTUP_TIMEOUT
+        self.request_index = None # type: Optional[int]
+
+    def fileno(self):
+        # type: () -> int
+        return self.process.stdout.fileno()
+
+    def send(self, request_index, request, timeout):
+        # type: (int, Any, float) -> None
+        self.request_index = request_index
+        self.deadline = time.time() + timeout
+        write_message(self.process.stdin, request)
+
+    def receive(self):
+        # type: () -> Any
+        self.request_index = None
+        return read_message(self.process.stdout)
+
+    def kill(self):
+        # type: () -> None
+        try:
+            self.process.kill()
+        except OSError:
+            # It already exited.
+            pass
+        self.process.wait()
+
+class RenderPool(object):
+    def __init__(self, num_workers, timeout):
+        # type: (int, float) -> None
+        self.pid = os.getpid()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.workers = [RenderWorker() for i in range(num_workers)]
+
+    def replace(self, worker):
+        # type: (RenderWorker) -> None
+        worker.kill()
+        self.workers[self.workers.index(worker)] = RenderWorker()
+
+    def render_many(self, requests):
+        # type: (List[Tuple[text_type, Optional[text_type], Any]]) -> List[Any]
+        """Renders the requests in parallel across the workers.  Returns,
+        for each request, either the result of render_request or a
+        RenderPoolError describing why it failed."""
+        with self.lock:
+            results = [None] * len(requests) # type: List[Any]
+            next_request = 0
+            while True:
+                for worker in self.workers:
+                    if next_request < len(requests) and worker.ready and worker.request_index is None:
+                        try:
+                            worker.send(next_request, requests[next_request], self.timeout)
+                        except (IOError, OSError):
+                            results[next_request] = RenderPoolError("Render worker exited")
+                            self.replace(worker)
+                        next_request += 1
+
+                waiting = [worker for worker in self.workers
+                           if not worker.ready or worker.request_index is not None]
+                if next_request == len(requests) and \
+                        not any(worker.request_index is not None for worker in waiting):
+                    return results
+                if not any(worker.ready for worker in self.workers) and \
+                        all(time.time() > worker.deadline for worker in waiting):
+                    # Start over with fresh workers on the next call.
+                    for worker in waiting:
+                        self.replace(worker)
+                    raise RenderPoolError("No render worker could be started")
+
+                wait = max(0, min(worker.deadline for worker in waiting) - time.time())
+                readable = select.select(waiting, [], [], wait)[0]
+                for worker in waiting:
+                    if worker in readable:
+                        request_index = worker.request_index
+                        try:
+                            result = worker.receive()
+                        except (EOFError, IOError, OSError):
+                            logging.warning("Render worker %d exited" % (worker.process.pid,))
+                            if request_index is not None:
+                                results[request_index] = RenderPoolError("Render worker exited")
+                            self.replace(worker)
+                            continue
+                        if worker.ready:
+                            results[request_index] = result
+                        else:
+                            worker.ready = True
+                    elif time.time() > worker.deadline:
+                        if worker.request_index is not None:
+                            results[worker.request_index] = RenderPoolError(
+                                "Rendering timed out after %s seconds" % (self.timeout,))
+                        elif not any(other.ready for other in self.workers):
+                            # Leave it for the check above, so that we
+                            # don't spin restarting workers that can't start.
+                            continue
+                        else:
+                            logging.warning("Render worker %d failed to start" % (worker.process.pid,))
+                        self.replace(worker)
+
+render_pool = None # type: Optional[RenderPool]
+
+def get_render_pool(timeout):
+    # type: (float) -> Optional[RenderPool]
+    global render_pool
+    if settings.BUGDOWN_RENDER_PROCESSES <= 0:
+        return None
+    # A pool is only usable by the process that started it, so a
+    # forked server process starts its own.
+    if render_pool is None or render_pool.pid != os.getpid():
+        render_pool = RenderPool(settings.BUGDOWN_RENDER_PROCESSES, timeout)
+    return render_pool
@@ -1,7 +1,10 @@
 from __future__ import absolute_import
-from typing import Any, Iterable, Mapping, Optional, Set, Tuple
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from django.db import IntegrityError, connection, transaction
 from six import text_type
+from six.moves import range
 
+from zerver.lib.cache import cache_delete_many, get_stream_cache_key
 from zerver.lib.initial_password import initial_password
 from zerver.models import Realm, Stream, UserProfile, Huddle, \
     Subscription, Recipient, Client, get_huddle_hash, resolve_email_to_domain
@@ -75,6 +78,10 @@ def bulk_create_streams(realms, stream_list):
         if (domain, name.lower()) not in existing_streams:
             streams_to_create.append(Stream(realm=realms[domain], name=name))
     Stream.objects.bulk_create(streams_to_create)
+    # bulk_create doesn't send post_save, so clear any cached misses
+    # for these names ourselves (see bulk_get_streams).
+    cache_delete_many([get_stream_cache_key(stream.name, stream.realm)
+                       for stream in streams_to_create])
 
     recipients_to_create = [] # type: List[Recipient]
     for stream in Stream.objects.select_related().all():
@@ -133,3 +140,49 @@ def bulk_create_huddles(users, huddle_user_list):
             subscriptions_to_create.append(Subscription(active=True, user_profile_id=user_id,
                                                         recipient=huddle_recipients[huddle_hash]))
     Subscription.objects.bulk_create(subscriptions_to_create)
+
+# The most rows bulk_upsert writes with one statement.
+BULK_UPSERT_BATCH_SIZE = 1000
+
+def bulk_upsert(db_table, columns, key_columns, rows, updates):
+    # type: (str, List[str], List[str], List[Tuple[Any, ...]], Dict[str, str]) -> None
+    """Writes rows (tuples of values for columns) to db_table with one
+    statement per BULK_UPSERT_BATCH_SIZE rows: rows whose key_columns
+    match an existing row update it, setting each column in updates to
+    its SQL expression (in which `t` is the existing row and `data` the
+    new one); the rest are inserted.  The keys must be unique within
+    rows.  Works without ON CONFLICT, which needs PostgreSQL 9.5."""
+    key_match = lambda table: ' AND '.join('%s.%s = data.%s' % (table, column, column)
+                                           for column in key_columns)
+    for i in range(0, len(rows), BULK_UPSERT_BATCH_SIZE):
+        batch = rows[i:i + BULK_UPSERT_BATCH_SIZE]
+        row_sql = '(%s)' % (', '.join(['%s'] * len(columns)),)
+        sql = '''
+            WITH data (%(columns)s) AS (VALUES %(values)s),
+            updated AS (
+                UPDATE %(table)s AS t SET %(updates)s FROM data
+                WHERE %(key_match)s
+                RETURNING %(keys)s
+            )
+            INSERT INTO %(table)s (%(columns)s)
+            SELECT %(columns)s FROM data
+            WHERE NOT EXISTS (SELECT 1 FROM updated WHERE %(updated_match)s)
+        ''' % dict(columns=', '.join(columns),
+                   values=', '.join([row_sql] * len(batch)),
+                   table=db_table,
+                   updates=', '.join('%s = %s' % (column, expression)
+                                     for (column, expression) in sorted(updates.items())),
+                   key_match=key_match('t'),
+                   keys=', '.join('t.%s' % (column,) for column in key_columns),
+                   updated_match=key_match('updated'))
+        params = [value for row in batch for value in row]
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    connection.cursor().execute(sql, params)
+                break
+            except IntegrityError:
+                # Someone else inserted one of our new rows since the
+                # statement started; now it will update it instead.
+                if attempt == 1:
+                    raise
@@ -9,9 +9,13 @@ from django.conf import settings
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
-from typing import Any, Callable, Iterable, Optional, Union, TypeVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union, TypeVar
 
-from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from zerver.lib.utils import statsd, statsd_key, make_safe_digest, generate_random_token
+from collections import OrderedDict, defaultdict
+from six.moves import cPickle as pickle
+from six.moves import range
+import threading
 import time
 import base64
 import random
@@ -98,14 +102,182 @@ def get_cache_backend(cache_name):
         return djcache
     return get_cache(cache_name)
 
-def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None):
+# An optional in-process LRU tier in front of the remote cache, for
+# small, hot objects (user profiles, streams, recipients, clients)
+# that a single request can look up many times.  It is enabled by
+# setting LOCAL_CACHE_SIZE, and only used by cache_with_key functions
+# that declare a local_cache_family.
+#
+# Values are stored pickled, so that callers get a fresh copy on each
+# lookup just as they do from memcached.  Entries expire after
+# LOCAL_CACHE_TTL seconds.  Writes and deletes through this module
+# drop the local entries for their keys, and are announced to other
+# processes through an invalidation log kept in the remote cache: a
+# counter plus one entry per invalidation listing the keys.  Each
+# process replays the log at the start of every request (see
+# zerver.middleware.SyncLocalCache), and at most every
+# LOCAL_CACHE_SYNC_SECS seconds otherwise.  If it can't tell what it
+# missed, it clears its local tier.
+LOCAL_CACHE_INVALIDATION_COUNTER_KEY = u'local_cache_invalidation_counter'
+LOCAL_CACHE_MAX_INVALIDATIONS_REPLAYED = 1000
+LOCAL_CACHE_SYNC_SECS = 1
+local_cache_families = set() # type: Set[str]
+
+def local_cache_invalidation_key(counter):
+    # type: (int) -> text_type
+    return u'local_cache_invalidation:%d' % (counter,)
+
+def get_local_cache_family(key):
+    # type: (text_type) -> Optional[text_type]
+    family = key.split(':')[0]
+    if family in local_cache_families:
+        return family
+    return None
+
+class LocalCache(object):
+    def __init__(self):
+        # type: () -> None
+        self.entries = OrderedDict() # type: OrderedDict[text_type, Tuple[float, str, bytes]]
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: dict(hit=0, miss=0, eviction=0)) # type: Dict[str, Dict[str, int]]
+        self.last_invalidation = None # type: Optional[int]
+        self.last_sync = 0.0
+
+    def count(self, family, event):
+        # type: (str, str) -> None
+        self.stats[family][event] += 1
+        statsd.incr("cache.local.%s.%s" % (family, event))
+
+    def get(self, key, family):
+        # type: (text_type, str) -> Any
+        """Returns the value as a singleton tuple, like cache_get, or
+        None if the key is not in the local tier."""
+        if time.time() - self.last_sync > LOCAL_CACHE_SYNC_SECS:
+            self.sync()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.count(family, 'miss')
+                return None
+            # Move the entry to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.count(family, 'hit')
+        return (pickle.loads(entry[2]),)
+
+    def set(self, key, family, val):
+        # type: (text_type, str, Any) -> None
+        entry = (time.time() + settings.LOCAL_CACHE_TTL, family,
+                 pickle.dumps(val, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > settings.LOCAL_CACHE_SIZE:
+                (evicted_key, evicted_entry) = self.entries.popitem(last=False)
+                self.count(evicted_entry[1], 'eviction')
+
+    def delete(self, keys):
+        # type: (Iterable[text_type]) -> None
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self.entries.clear()
+
+    def publish_invalidation(self, keys):
+        # type: (List[text_type]) -> None
+        backend = get_cache_backend(None)
+        remote_cache_stats_start()
+        backend.add(KEY_PREFIX + LOCAL_CACHE_INVALIDATION_COUNTER_KEY, 0, timeout=None)
+        try:
+            counter = backend.incr(KEY_PREFIX + LOCAL_CACHE_INVALIDATION_COUNTER_KEY)
+        except ValueError:
+            # The counter was evicted between the add and the incr;
+            # other processes will notice and clear their local tiers.
+            counter = None
+        if counter is not None:
+            backend.set(KEY_PREFIX + local_cache_invalidation_key(counter), keys,
+                        timeout=3600)
+        remote_cache_stats_finish()
+
+    def sync(self):
+        # type: () -> None
+        """Replays the invalidations published by other processes since
+        the last sync."""
+        self.last_sync = time.time()
+        backend = get_cache_backend(None)
+        remote_cache_stats_start()
+        counter = backend.get(KEY_PREFIX + LOCAL_CACHE_INVALIDATION_COUNTER_KEY)
+        remote_cache_stats_finish()
+        last_invalidation = self.last_invalidation
+        self.last_invalidation = counter
+        if counter == last_invalidation:
+            return
+        if (counter is None or last_invalidation is None or counter < last_invalidation or
+                counter - last_invalidation > LOCAL_CACHE_MAX_INVALIDATIONS_REPLAYED):
+            # The counter was created, evicted or reset, or we are too
+            # far behind to replay the log.
+            self.clear()
+            return
+        invalidation_keys = [KEY_PREFIX + local_cache_invalidation_key(i)
+                             for i in range(last_invalidation + 1, counter + 1)]
+        remote_cache_stats_start()
+        invalidations = backend.get_many(invalidation_keys)
+        remote_cache_stats_finish()
+        if len(invalidations) < len(invalidation_keys):
+            self.clear()
+            return
+        for keys in invalidations.values():
+            self.delete(keys)
+
+local_cache = LocalCache()
+
+def local_cache_enabled():
+    # type: () -> bool
+    return settings.LOCAL_CACHE_SIZE > 0
+
+def local_cache_sync():
+    # type: () -> None
+    if local_cache_enabled():
+        local_cache.sync()
+
+def get_local_cache_stats():
+    # type: () -> Dict[str, Dict[str, int]]
+    """Hit, miss and eviction counts of the local cache tier in this
+    process, per key family."""
+    return dict((family, dict(stats)) for (family, stats) in local_cache.stats.items())
+
+def invalidate_local_cache(keys):
+    # type: (Iterable[text_type]) -> None
+    if not local_cache_enabled() or not local_cache_families:
+        return
+    local_keys = [key for key in keys if get_local_cache_family(key) is not None]
+    if local_keys:
+        local_cache.delete(local_keys)
+        local_cache.publish_invalidation(local_keys)
+
+def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None,
+                   local_cache_family=None):
     # type: ignore # CANNOT_INFER_LAMBDA_TYPE issue with models.py
     """Decorator which applies Django caching to a function.
 
        Decorator argument is a function which computes a cache key
        from the original function's arguments.  You are responsible
        for avoiding collisions with other uses of this decorator or
-       other uses of caching."""
+       other uses of caching.
+
+       If local_cache_family is given, results are also kept in the
+       in-process LocalCache tier when it is enabled; it must be the
+       part of the cache keys before the first ':'."""
+
+    if local_cache_family is not None:
+        local_cache_families.add(local_cache_family)
 
     def decorator(func):
         # type: (Callable[..., Any]) -> (Callable[..., Any])
@@ -114,6 +286,12 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
             # type: (*Any, **Any) -> Callable[..., Any]
             key = keyfunc(*args, **kwargs)
 
+            use_local_cache = local_cache_family is not None and local_cache_enabled()
+            if use_local_cache:
+                val = local_cache.get(key, local_cache_family)
+                if val is not None:
+                    return val[0]
+
             val = cache_get(key, cache_name=cache_name)
 
             extra = ""
@@ -125,17 +303,25 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
             else:
                 metric_key = statsd_key(key)
 
-            status = "hit" if val is not None else "miss"
+            status = "hit" if val else "miss"
             statsd.incr("cache%s.%s.%s" % (extra, metric_key, status))
 
             # Values are singleton tuples so that we can distinguish
-            # a result of None from a missing key.
-            if val is not None:
+            # a result of None from a missing key.  An empty tuple is a
+            # negative cache entry written by generic_bulk_cached_fetch,
+            # which we treat as a miss.
+            if val:
+                if use_local_cache:
+                    local_cache.set(key, local_cache_family, val[0])
                 return val[0]
 
             val = func(*args, **kwargs)
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            # Filling in a missing value doesn't invalidate anything,
+            # so this skips cache_set's local cache invalidation.
+            remote_cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            if use_local_cache:
+                local_cache.set(key, local_cache_family, val)
 
             return val
 
@@ -143,13 +329,18 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
 
     return decorator
 
-def cache_set(key, val, cache_name=None, timeout=None):
+def remote_cache_set(key, val, cache_name=None, timeout=None):
     # type: (text_type, Any, Optional[str], Optional[int]) -> None
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
 
+def cache_set(key, val, cache_name=None, timeout=None):
+    # type: (text_type, Any, Optional[str], Optional[int]) -> None
+    remote_cache_set(key, val, cache_name=cache_name, timeout=timeout)
+    invalidate_local_cache([key])
+
 def cache_get(key, cache_name=None):
     # type: (text_type, Optional[str]) -> Any
     remote_cache_stats_start()
@@ -166,7 +357,7 @@ def cache_get_many(keys, cache_name=None):
     remote_cache_stats_finish()
     return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
 
-def cache_set_many(items, cache_name=None, timeout=None):
+def remote_cache_set_many(items, cache_name=None, timeout=None):
     # type: (Dict[text_type, Any], Optional[str], Optional[int]) -> None
     new_items = {}
     for key in items:
@@ -176,18 +367,26 @@ def cache_set_many(items, cache_name=None, timeout=None):
     get_cache_backend(cache_name).set_many(items, timeout=timeout)
     remote_cache_stats_finish()
 
+def cache_set_many(items, cache_name=None, timeout=None):
+    # type: (Dict[text_type, Any], Optional[str], Optional[int]) -> None
+    remote_cache_set_many(items, cache_name=cache_name, timeout=timeout)
+    invalidate_local_cache(items.keys())
+
 def cache_delete(key, cache_name=None):
     # type: (text_type, Optional[str]) -> None
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    invalidate_local_cache([key])
 
 def cache_delete_many(items, cache_name=None):
     # type: (Iterable[text_type], Optional[str]) -> None
+    items = list(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
+    invalidate_local_cache(items)
 
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
@@ -203,6 +402,17 @@ def cache_delete_many(items, cache_name=None):
 # * cache_transformer: Function mapping an object from database =>
 #   value for cache (in case the values that we're caching are some
 #   function of the objects, not the objects themselves)
+# * chunk_size: Query the database for at most this many ids at a
+#   time, storing each chunk's results in the remote cache before
+#   querying the next, so that a large fetch neither builds one huge
+#   query nor holds every row in memory before caching anything.
+# * negative_cache_timeout: If set, ids the database doesn't have are
+#   remembered in the remote cache (as an empty tuple) for this many
+#   seconds, so that repeated fetches don't query for them again.
+#   Keep it short: a fetch that queried the database before an
+#   object's creation committed can write the negative entry after
+#   the creation's cache update, and the object then looks missing
+#   until the entry expires.
 ObjKT = TypeVar('ObjKT', int, text_type)
 ItemT = Any # https://github.com/python/mypy/issues/1721
 CompressedItemT = Any # https://github.com/python/mypy/issues/1721
@@ -210,27 +420,45 @@ def generic_bulk_cached_fetch(cache_key_function, query_function, object_ids,
                               extractor=lambda obj: obj,
                               setter=lambda obj: obj,
                               id_fetcher=lambda obj: obj.id,
-                              cache_transformer=lambda obj: obj):
-    # type: (Callable[[ObjKT], text_type], Callable[[List[ObjKT]], Iterable[Any]], Iterable[ObjKT], Callable[[CompressedItemT], ItemT], Callable[[ItemT], CompressedItemT], Callable[[Any], ObjKT], Callable[[Any], ItemT]) -> Dict[ObjKT, Any]
+                              cache_transformer=lambda obj: obj,
+                              chunk_size=None,
+                              negative_cache_timeout=None):
+    # type: (Callable[[ObjKT], text_type], Callable[[List[ObjKT]], Iterable[Any]], Iterable[ObjKT], Callable[[CompressedItemT], ItemT], Callable[[ItemT], CompressedItemT], Callable[[Any], ObjKT], Callable[[Any], ItemT], Optional[int], Optional[int]) -> Dict[ObjKT, Any]
     cache_keys = {} # type: Dict[ObjKT, text_type]
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
     cached_objects = cache_get_many([cache_keys[object_id]
                                      for object_id in object_ids])
-    for (key, val) in cached_objects.items():
-        cached_objects[key] = extractor(cached_objects[key][0])
+    known_missing_keys = set() # type: Set[text_type]
+    for (key, val) in list(cached_objects.items()):
+        if len(val) == 0:
+            known_missing_keys.add(key)
+            del cached_objects[key]
+        else:
+            cached_objects[key] = extractor(val[0])
     needed_ids = [object_id for object_id in object_ids if
-                  cache_keys[object_id] not in cached_objects]
-    db_objects = query_function(needed_ids)
-
-    items_for_remote_cache = {} # type: Dict[text_type, Any]
-    for obj in db_objects:
-        key = cache_keys[id_fetcher(obj)]
-        item = cache_transformer(obj)
-        items_for_remote_cache[key] = (setter(item),)
-        cached_objects[key] = item
-    if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+                  cache_keys[object_id] not in cached_objects and
+                  cache_keys[object_id] not in known_missing_keys]
+
+    if chunk_size is None:
+        chunk_size = max(len(needed_ids), 1)
+    for i in range(0, len(needed_ids), chunk_size):
+        chunk_ids = needed_ids[i:i + chunk_size]
+        items_for_remote_cache = {} # type: Dict[text_type, Any]
+        for obj in query_function(chunk_ids):
+            key = cache_keys[id_fetcher(obj)]
+            item = cache_transformer(obj)
+            items_for_remote_cache[key] = (setter(item),)
+            cached_objects[key] = item
+        if negative_cache_timeout is not None:
+            missing_items = dict((cache_keys[object_id], ()) for object_id in chunk_ids
+                                 if cache_keys[object_id] not in cached_objects)
+            if len(missing_items) > 0:
+                remote_cache_set_many(missing_items, timeout=negative_cache_timeout)
+        # Filling in missing values doesn't invalidate anything, so
+        # this skips cache_set_many's local cache invalidation.
+        if len(items_for_remote_cache) > 0:
+            remote_cache_set_many(items_for_remote_cache)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
@@ -279,6 +507,108 @@ def active_user_dicts_in_realm_cache_key(realm):
     # type: (Realm) -> text_type
     return u"active_user_dicts_in_realm:%s" % (realm.id,)
 
+# Changes to some of a realm's data are logged so that per-process
+# copies of it (see zerver.lib.mention.get_mention_index and
+# zerver.lib.presence.get_presence_snapshot) can apply them
+# incrementally: each log is a counter per realm, plus one entry per
+# change.  Like the local cache invalidation log above, a reader that
+# can't tell what it missed rebuilds from scratch.
+#
+# Changes to which users are active in a realm, or to their names, are
+# logged with the changed user's id.
+REALM_USER_CHANGES_MAX_REPLAYED = 1000
+
+def realm_changes_counter_cache_key(log_name, realm_id):
+    # type: (str, int) -> text_type
+    return u"realm_%s_changes_counter:%s" % (log_name, realm_id)
+
+def realm_change_cache_key(log_name, realm_id, counter):
+    # type: (str, int, int) -> text_type
+    return u"realm_%s_change:%s:%d" % (log_name, realm_id, counter)
+
+def start_realm_changes_counter(backend, counter_key):
+    # type: (BaseCache, text_type) -> None
+    # Start at a random value, so that to a reader a counter that was
+    # evicted and recreated doesn't look like the one it replaced.
+    backend.add(counter_key, random.randint(0, 2**31), timeout=None)
+
+def log_realm_change(log_name, realm_id, entry, timeout=3600*24):
+    # type: (str, int, Any, Optional[int]) -> None
+    backend = get_cache_backend(None)
+    counter_key = KEY_PREFIX + realm_changes_counter_cache_key(log_name, realm_id)
+    remote_cache_stats_start()
+    start_realm_changes_counter(backend, counter_key)
+    try:
+        counter = backend.incr(counter_key)
+    except ValueError:
+        # The counter was evicted between the add and the incr;
+        # readers will notice and rebuild.
+        counter = None
+    if counter is not None:
+        backend.set(KEY_PREFIX + realm_change_cache_key(log_name, realm_id, counter), entry,
+                    timeout=timeout)
+    remote_cache_stats_finish()
+
+def get_realm_changes_counter(log_name, realm_id):
+    # type: (str, int) -> Optional[int]
+    backend = get_cache_backend(None)
+    counter_key = KEY_PREFIX + realm_changes_counter_cache_key(log_name, realm_id)
+    remote_cache_stats_start()
+    counter = backend.get(counter_key)
+    if counter is None:
+        # Start the log, so that the next change can be replayed.
+        start_realm_changes_counter(backend, counter_key)
+        counter = backend.get(counter_key)
+    remote_cache_stats_finish()
+    return counter
+
+def get_realm_changes(log_name, realm_id, since, until, max_replayed):
+    # type: (str, int, Optional[int], Optional[int], int) -> Optional[List[Any]]
+    """The entries logged after counter value since, up to until, in
+    order, or None if the log can't tell."""
+    if (since is None or until is None or until < since or
+            until - since > max_replayed):
+        # The counter was created, evicted or reset, or there are too
+        # many changes to replay.
+        return None
+    keys = [KEY_PREFIX + realm_change_cache_key(log_name, realm_id, counter)
+            for counter in range(since + 1, until + 1)]
+    remote_cache_stats_start()
+    changes = get_cache_backend(None).get_many(keys)
+    remote_cache_stats_finish()
+    if len(changes) < len(keys):
+        return None
+    return [changes[key] for key in keys]
+
+def log_realm_user_change(realm_id, user_id):
+    # type: (int, int) -> None
+    log_realm_change('user', realm_id, user_id)
+
+def get_realm_user_changes_counter(realm_id):
+    # type: (int) -> Optional[int]
+    return get_realm_changes_counter('user', realm_id)
+
+def get_realm_user_changes(realm_id, since, until):
+    # type: (int, Optional[int], Optional[int]) -> Optional[Set[int]]
+    """The ids of the users changed after counter value since, up to
+    until, or None if the log can't tell."""
+    changes = get_realm_changes('user', realm_id, since, until, REALM_USER_CHANGES_MAX_REPLAYED)
+    if changes is None:
+        return None
+    return set(changes)
+
+# Presence changes are logged with (user id, email, presence, time),
+# where presence is the presence dict (see UserPresence.to_presence_dict)
+# of the client the user updated, or None if everything about the
+# user's presence has to be read again (say, because they were
+# deactivated or registered a push device).  Users ping every 50
+# seconds, so this log grows quickly and its entries needn't last long.
+REALM_PRESENCE_CHANGES_MAX_REPLAYED = 2000
+
+def log_realm_presence_change(realm_id, user_id, email, presence):
+    # type: (int, int, text_type, Optional[Dict[str, Any]]) -> None
+    log_realm_change('presence', realm_id, (user_id, email, presence, time.time()), timeout=600)
+
 active_bot_dict_fields = ['id', 'full_name', 'short_name',
                           'email', 'default_sending_stream__name',
                           'default_events_register_stream__name',
@@ -318,6 +648,12 @@ def flush_user_profile(sender, **kwargs):
     if kwargs.get('update_fields') is None or \
         len(set(active_user_dict_fields + ['is_active']) & set(kwargs['update_fields'])) > 0:
         cache_delete(active_user_dicts_in_realm_cache_key(user_profile.realm))
+        flush_bugdown_realm_token(user_profile.realm.domain)
+        log_realm_user_change(user_profile.realm_id, user_profile.id)
+
+    if kwargs.get('update_fields') is None or \
+            set(['is_active', 'is_bot', 'enable_offline_push_notifications']) & set(kwargs['update_fields']):
+        log_realm_presence_change(user_profile.realm_id, user_profile.id, user_profile.email, None)
 
     # Invalidate our active_bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
@@ -330,6 +666,7 @@ def flush_user_profile(sender, **kwargs):
     # alert words
     if kwargs.get('update_fields') is None or "alert_words" in kwargs['update_fields']:
         cache_delete(realm_alert_words_cache_key(user_profile.realm))
+        flush_bugdown_realm_token(user_profile.realm.domain)
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -339,6 +676,7 @@ def flush_realm(sender, **kwargs):
     realm = kwargs['instance']
     users = realm.get_active_users()
     update_user_profile_caches(users)
+    flush_bugdown_realm_token(realm.domain)
 
     if realm.deactivated:
         cache_delete(active_user_dicts_in_realm_cache_key(realm))
@@ -349,6 +687,32 @@ def realm_alert_words_cache_key(realm):
     # type: (Realm) -> text_type
     return u"realm_alert_words:%s" % (realm.domain,)
 
+# How a message renders depends on its realm's filters, emoji, users
+# and alert words, so the bugdown render cache keys include a token for
+# the realm, which we replace whenever any of those change.
+def bugdown_realm_token_cache_key(domain):
+    # type: (text_type) -> text_type
+    return u"bugdown_realm_token:%s" % (domain.lower(),)
+
+def get_bugdown_realm_token(domain):
+    # type: (text_type) -> text_type
+    key = bugdown_realm_token_cache_key(domain)
+    val = cache_get(key)
+    if val is None:
+        token = generate_random_token(16)
+        # Use add, so that concurrent callers settle on one token.
+        remote_cache_stats_start()
+        get_cache_backend(None).add(KEY_PREFIX + key, (token,), timeout=3600*24*7)
+        remote_cache_stats_finish()
+        val = cache_get(key)
+        if val is None:
+            return token
+    return val[0]
+
+def flush_bugdown_realm_token(domain):
+    # type: (text_type) -> None
+    cache_delete(bugdown_realm_token_cache_key(domain))
+
 # Called by models.py to flush the stream cache whenever we save a stream
 # object.
 def flush_stream(sender, **kwargs):
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 from six import text_type
-from typing import Any, Dict, Callable, Tuple
+from typing import Any, Dict, Callable, List, Optional, Tuple
 
 # This file needs to be different from cache.py because cache.py
 # cannot import anything from zerver.models or we'd have an import
@@ -10,22 +10,24 @@ from django.conf import settings
 from zerver.models import Message, UserProfile, Stream, get_stream_cache_key, \
     Recipient, get_recipient_cache_key, Client, get_client_cache_key, \
     Huddle, huddle_hash_cache_key, to_dict_cache_key_id
-from zerver.lib.cache import cache_with_key, cache_set, \
+from zerver.lib.cache import cache_with_key, cache_set, cache_get, cache_delete, remote_cache_set, \
     user_profile_by_email_cache_key, user_profile_by_id_cache_key, \
-    get_remote_cache_time, get_remote_cache_requests, cache_set_many
+    get_remote_cache_time, get_remote_cache_requests, remote_cache_set_many
 from django.utils.importlib import import_module
 from django.contrib.sessions.models import Session
 import logging
+import time
 from django.db.models import Q
+from django.db.models.query import QuerySet
 
 MESSAGE_CACHE_SIZE = 75000
 
 def message_fetch_objects():
-    # type: () -> List[Any]
+    # type: () -> QuerySet
     try:
         max_id = Message.objects.only('id').order_by("-id")[0].id
     except IndexError:
-        return []
+        return Message.objects.none()
     return Message.objects.select_related().filter(~Q(sender__email='tabbott/extra@mit.edu'),
                                                     id__gt=max_id - MESSAGE_CACHE_SIZE)
 
@@ -74,22 +76,58 @@ cache_fillers = {
     'message': (message_fetch_objects, message_cache_items, 3600 * 24, 1000),
     'huddle': (lambda: Huddle.objects.select_related().all(), huddle_cache_items, 3600*24*7, 10000),
     'session': (lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
-    } # type: Dict[str, Tuple[Callable[[], List[Any]], Callable[[Dict[text_type, Any], Any], None], int, int]]
+    } # type: Dict[str, Tuple[Callable[[], QuerySet], Callable[[Dict[text_type, Any], Any], None], int, int]]
 
-def fill_remote_cache(cache):
-    # type: (str) -> None
+def fill_remote_cache_checkpoint_key(cache):
+    # type: (str) -> text_type
+    return u'fill_remote_cache_checkpoint:%s' % (cache,)
+
+def fill_remote_cache(cache, resume=False):
+    # type: (str, bool) -> None
+    """Populates the remote cache with the objects of one of the
+    cache_fillers.
+
+    Rather than holding a single cursor open across the whole table,
+    this walks the objects in primary key order one batch at a time,
+    and after writing each batch to the remote cache records the last
+    primary key written in a checkpoint (itself in the remote cache, so
+    that a memcached restart also discards it).  With resume=True, we
+    start after the checkpoint left by an interrupted run."""
     remote_cache_time_start = get_remote_cache_time()
     remote_cache_requests_start = get_remote_cache_requests()
-    items_for_remote_cache = {} # type: Dict[text_type, Any]
+    start = time.time()
     (objects, items_filler, timeout, batch_size) = cache_fillers[cache]
+    checkpoint_key = fill_remote_cache_checkpoint_key(cache)
+    last_pk = None # type: Any
+    if resume:
+        checkpoint = cache_get(checkpoint_key)
+        if checkpoint is not None:
+            last_pk = checkpoint[0]
+            logging.info("Resuming %s cache population after %s" % (cache, last_pk))
+
+    query = objects().order_by('pk')
     count = 0
-    for obj in objects():
-        items_filler(items_for_remote_cache, obj)
-        count += 1
-        if (count % batch_size == 0):
-            cache_set_many(items_for_remote_cache, timeout=3600*24)
-            items_for_remote_cache = {}
-    cache_set_many(items_for_remote_cache, timeout=3600*24*7)
-    logging.info("Succesfully populated %s cache!  Consumed %s remote cache queries (%s time)" % \
-                     (cache, get_remote_cache_requests() - remote_cache_requests_start,
+    while True:
+        batch_query = query
+        if last_pk is not None:
+            batch_query = query.filter(pk__gt=last_pk)
+        batch = list(batch_query[:batch_size])
+        if not batch:
+            break
+        items_for_remote_cache = {} # type: Dict[text_type, Any]
+        for obj in batch:
+            items_filler(items_for_remote_cache, obj)
+        # This is filling in values straight from the database, so
+        # there is nothing to invalidate in the local cache tier.
+        remote_cache_set_many(items_for_remote_cache, timeout=timeout)
+        last_pk = batch[-1].pk
+        remote_cache_set(checkpoint_key, last_pk, timeout=3600*24)
+        count += len(batch)
+    cache_delete(checkpoint_key)
+
+    elapsed = time.time() - start
+    logging.info("Succesfully populated %s cache with %d objects in %.2fs (%.1f objects/s)!  "
+                 "Consumed %s remote cache queries (%s time)" % \
+                     (cache, count, elapsed, count / max(elapsed, 0.001),
+                      get_remote_cache_requests() - remote_cache_requests_start,
                       round(get_remote_cache_time() - remote_cache_time_start, 2)))
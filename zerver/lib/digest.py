@@ -1,18 +1,21 @@
 from __future__ import absolute_import
-from typing import Any, Callable, Iterable, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
 
 from collections import defaultdict
 import datetime
+import itertools
 import six
 from six import text_type
 
-from django.db.models import Q, QuerySet
+from django.db import connection
+from django.db.models import Count, Q, QuerySet
 from django.template import loader
 from django.conf import settings
 
+from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.notifications import build_message_list, hashchange_encode, \
     send_future_email, one_click_unsubscribe_link
-from zerver.models import UserProfile, UserMessage, Recipient, Stream, \
+from zerver.models import Message, Realm, UserProfile, UserMessage, Recipient, Stream, \
     Subscription, get_active_streams
 
 import logging
@@ -35,90 +38,83 @@ logger.addHandler(file_handler)
 # 4. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
 
-def gather_hot_conversations(user_profile, stream_messages):
-    # type: (UserProfile, QuerySet) -> List[Dict[str, Any]]
-    # Gather stream conversations of 2 types:
-    # 1. long conversations
-    # 2. conversations where many different people participated
-    #
-    # Returns a list of dictionaries containing the templating
-    # information for each hot conversation.
-
-    conversation_length = defaultdict(int) # type: Dict[Tuple[int, text_type], int]
-    conversation_diversity = defaultdict(set) # type: Dict[Tuple[int, text_type], Set[text_type]]
-    for user_message in stream_messages:
-        if not user_message.message.sent_by_human():
-            # Don't include automated messages in the count.
-            continue
-
-        key = (user_message.message.recipient.type_id,
-               user_message.message.subject)
-        conversation_diversity[key].add(
-            user_message.message.sender.full_name)
-        conversation_length[key] += 1
-
-    diversity_list = list(conversation_diversity.items())
-    diversity_list.sort(key=lambda entry: len(entry[1]), reverse=True)
-
-    length_list = list(conversation_length.items())
-    length_list.sort(key=lambda entry: entry[1], reverse=True)
-
-    # Get up to the 4 best conversations from the diversity list
-    # and length list, filtering out overlapping conversations.
-    hot_conversations = [elt[0] for elt in diversity_list[:2]]
-    for candidate, _ in length_list:
-        if candidate not in hot_conversations:
-            hot_conversations.append(candidate)
+def sent_by_human_filter(prefix=''):
+    # type: (str) -> Q
+    """The query version of Message.sent_by_human, for the messages
+    at prefix (e.g. 'message__' from UserMessage)."""
+    client_name = prefix + 'sending_client__name'
+    sent_by_human = Q(**{client_name + '__icontains': 'desktop app'})
+    for name in Message.HUMAN_SENDING_CLIENTS:
+        sent_by_human |= Q(**{client_name + '__iexact': name})
+    return sent_by_human
+
+def count_conversations(rows):
+    # type: (Iterable[Tuple[int, text_type, text_type, int]]) -> Dict[Tuple[int, text_type], Tuple[int, List[text_type]]]
+    """Totals (recipient id, subject, sender name, count) rows up by
+    conversation: (count, participants) by (recipient id, subject)."""
+    conversations = {} # type: Dict[Tuple[int, text_type], Tuple[int, List[text_type]]]
+    for (recipient_id, subject, sender_name, count) in rows:
+        key = (recipient_id, subject)
+        (total, participants) = conversations.get(key, (0, []))
+        conversations[key] = (total + count, participants + [sender_name])
+    return conversations
+
+def gather_conversations(recipient_ids, cutoff_date):
+    # type: (Iterable[int], datetime.datetime) -> Dict[Tuple[int, text_type], Tuple[int, List[text_type]]]
+    """How many messages people sent to each conversation in the
+    streams recipient_ids since cutoff_date, and who sent them, by
+    (recipient id, subject); with one aggregate query.  Only for
+    public streams, whose whole history their subscribers can read."""
+    # Don't include automated messages in the count; see
+    # Message.sent_by_human.
+    return count_conversations(Message.objects.filter(
+        sent_by_human_filter(), recipient_id__in=list(recipient_ids), pub_date__gt=cutoff_date).values_list(
+        'recipient_id', 'subject', 'sender__full_name').annotate(count=Count('id')))
+
+def gather_user_conversations(user_profile, recipient_ids, cutoff_date):
+    # type: (UserProfile, Iterable[int], datetime.datetime) -> Dict[Tuple[int, text_type], Tuple[int, List[text_type]]]
+    """Like gather_conversations, but from the messages user_profile
+    received, for invite-only streams, where what someone can see
+    depends on when they joined."""
+    return count_conversations(UserMessage.objects.filter(
+        sent_by_human_filter('message__'), user_profile=user_profile,
+        message__recipient_id__in=list(recipient_ids), message__pub_date__gt=cutoff_date).values_list(
+        'message__recipient_id', 'message__subject', 'message__sender__full_name').annotate(
+        count=Count('id')))
+
+def pick_hot_conversations(by_diversity, by_length):
+    # type: (Iterable[Tuple[int, text_type]], Iterable[Tuple[int, text_type]]) -> List[Tuple[int, text_type]]
+    """Up to 4 hot conversations, from conversations sorted by how many
+    different people participated and by length: the 2 most diverse,
+    then the longest."""
+    hot_conversations = list(itertools.islice(by_diversity, 2))
+    for key in by_length:
         if len(hot_conversations) >= 4:
             break
+        if key not in hot_conversations:
+            hot_conversations.append(key)
+    return hot_conversations
 
-    # There was so much overlap between the diversity and length lists that we
-    # still have < 4 conversations. Try to use remaining diversity items to pad
-    # out the hot conversations.
-    num_convos = len(hot_conversations)
-    if num_convos < 4:
-        hot_conversations.extend([elt[0] for elt in diversity_list[num_convos:4]])
-
-    hot_conversation_render_payloads = []
-    for h in hot_conversations:
-        stream_id, subject = h
-        users = list(conversation_diversity[h])
-        count = conversation_length[h]
-
-        # We'll display up to 2 messages from the conversation.
-        first_few_messages = [user_message.message for user_message in \
-                                  stream_messages.filter(
-                message__recipient__type_id=stream_id,
-                message__subject=subject)[:2]]
-
-        teaser_data = {"participants": users,
-                       "count": count - len(first_few_messages),
-                       "first_few_messages": build_message_list(
-                user_profile, first_few_messages)}
-
-        hot_conversation_render_payloads.append(teaser_data)
-    return hot_conversation_render_payloads
-
-def gather_new_users(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, List[text_type]]
+def gather_new_users(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, List[text_type]]
     # Gather information on users in the realm who have recently
     # joined.
-    if user_profile.realm.domain == "mit.edu":
+    if realm.domain == "mit.edu":
         new_users = [] # type: List[UserProfile]
     else:
         new_users = list(UserProfile.objects.filter(
-                realm=user_profile.realm, date_joined__gt=threshold,
+                realm=realm, date_joined__gt=threshold,
                 is_bot=False))
     user_names = [user.full_name for user in new_users]
 
     return len(user_names), user_names
 
-def gather_new_streams(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, Dict[str, List[text_type]]]
-    if user_profile.realm.domain == "mit.edu":
+def gather_new_streams(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, Dict[str, List[text_type]]]
+    if realm.domain == "mit.edu":
         new_streams = [] # type: List[Stream]
     else:
-        new_streams = list(get_active_streams(user_profile.realm).filter(
+        new_streams = list(get_active_streams(realm).filter(
                 invite_only=False, date_created__gt=threshold))
 
     base_url = u"https://%s/#narrow/stream/" % (settings.EXTERNAL_HOST,)
@@ -134,6 +130,115 @@ def gather_new_streams(user_profile, threshold):
 
     return len(new_streams), {"html": streams_html, "plain": streams_plain}
 
+class RealmDigest(object):
+    """The parts of a realm's digest emails since a cutoff that are the
+    same for each of its users: its new users and streams, and how
+    long and how diverse each of its public stream conversations was.
+    Each user's digest is assembled from these, rather than from
+    reading through the user's own messages; only conversations in
+    invite-only streams, of which a user may have missed the start,
+    are read from the messages they received."""
+
+    def __init__(self, realm, cutoff_date):
+        # type: (Realm, datetime.datetime) -> None
+        self.cutoff_date = cutoff_date
+        self.new_streams_count, self.new_streams = gather_new_streams(realm, cutoff_date)
+        self.new_users_count, self.new_users = gather_new_users(realm, cutoff_date)
+        self.public_recipient_ids = set(Recipient.objects.filter(
+            type=Recipient.STREAM,
+            type_id__in=Stream.objects.filter(realm=realm, invite_only=False).values('id')).values_list(
+            'id', flat=True)) # type: Set[int]
+        self.conversations = gather_conversations(self.public_recipient_ids, cutoff_date)
+        self.by_diversity = sorted(self.conversations,
+                                   key=lambda key: len(self.conversations[key][1]), reverse=True)
+        self.by_length = sorted(self.conversations,
+                                key=lambda key: self.conversations[key][0], reverse=True)
+        # The first messages of public conversations, by (recipient
+        # id, subject).
+        self.first_messages = {} # type: Dict[Tuple[int, text_type], List[Message]]
+        self.teasers = {} # type: Dict[Tuple[int, text_type], Dict[str, Any]]
+        # Each user's invite-only stream conversations, by user id.
+        self.user_conversations = {} # type: Dict[int, Dict[Tuple[int, text_type], Tuple[int, List[text_type]]]]
+
+    def hot_conversations(self, user_profile, recipient_ids):
+        # type: (UserProfile, Set[int]) -> List[Tuple[int, text_type]]
+        """Up to 4 hot conversations for user_profile in the streams
+        recipient_ids; see pick_hot_conversations."""
+        public_conversations = pick_hot_conversations(
+            (key for key in self.by_diversity if key[0] in recipient_ids),
+            (key for key in self.by_length if key[0] in recipient_ids))
+        private_recipient_ids = recipient_ids - self.public_recipient_ids
+        if not private_recipient_ids:
+            return public_conversations
+
+        # Pick from the user's invite-only conversations and the public
+        # ones that could still make the cut.
+        conversations = gather_user_conversations(user_profile, private_recipient_ids,
+                                                  self.cutoff_date)
+        self.user_conversations[user_profile.id] = conversations
+        candidates = dict(conversations)
+        for key in itertools.chain(
+                public_conversations,
+                itertools.islice((key for key in self.by_length if key[0] in recipient_ids), 6)):
+            candidates[key] = self.conversations[key]
+        return pick_hot_conversations(
+            sorted(candidates, key=lambda key: len(candidates[key][1]), reverse=True),
+            sorted(candidates, key=lambda key: candidates[key][0], reverse=True))
+
+    def fetch_first_messages(self, keys):
+        # type: (Iterable[Tuple[int, text_type]]) -> None
+        """Reads the first 2 messages since the cutoff of each of the
+        public conversations among keys, which we display, in two
+        queries."""
+        keys = set(key for key in keys if key in self.conversations) - set(self.first_messages)
+        if not keys:
+            return
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT id, recipient_id, subject FROM (
+                SELECT id, recipient_id, subject,
+                       row_number() OVER (PARTITION BY recipient_id, subject
+                                          ORDER BY pub_date, id) AS position
+                FROM zerver_message
+                WHERE recipient_id = ANY(%s) AND pub_date > %s) AS conversation_messages
+            WHERE position <= 2""", [list(set(key[0] for key in keys)), self.cutoff_date])
+        message_keys = dict((message_id, (recipient_id, subject))
+                            for (message_id, recipient_id, subject) in cursor.fetchall()
+                            if (recipient_id, subject) in keys)
+        cursor.close()
+        for key in keys:
+            self.first_messages[key] = []
+        for message in Message.objects.select_related('recipient', 'sender').filter(
+                id__in=list(message_keys)).order_by('pub_date', 'id'):
+            self.first_messages[message_keys[message.id]].append(message)
+
+    def teaser(self, user_profile, key):
+        # type: (UserProfile, Tuple[int, text_type]) -> Dict[str, Any]
+        user_conversations = self.user_conversations.get(user_profile.id, {})
+        if key in user_conversations:
+            (count, participants) = user_conversations[key]
+            first_few_messages = [user_message.message for user_message in
+                                  UserMessage.objects.select_related(
+                                      'message__recipient', 'message__sender').filter(
+                    user_profile=user_profile, message__recipient_id=key[0],
+                    message__subject=key[1], message__pub_date__gt=self.cutoff_date).order_by(
+                    'message__pub_date', 'message__id')[:2]]
+            return {"participants": participants,
+                    "count": count - len(first_few_messages),
+                    "first_few_messages": build_message_list(user_profile, first_few_messages)}
+
+        # Public stream messages are displayed the same way to
+        # everyone, so the first user's rendering is shared.
+        if key not in self.teasers:
+            (count, participants) = self.conversations[key]
+            self.fetch_first_messages([key])
+            first_few_messages = self.first_messages[key]
+            self.teasers[key] = {"participants": participants,
+                                 "count": count - len(first_few_messages),
+                                 "first_few_messages": build_message_list(
+                    user_profile, list(first_few_messages))}
+        return self.teasers[key]
+
 def enough_traffic(unread_pms, hot_conversations, new_streams, new_users):
     # type: (text_type, text_type, int, int) -> bool
     if unread_pms or hot_conversations:
@@ -158,14 +263,51 @@ def send_digest_email(user_profile, html_content, text_content):
 
 def handle_digest_email(user_profile_id, cutoff):
     # type: (int, int) -> None
-    user_profile=UserProfile.objects.get(id=user_profile_id)
-    # Convert from epoch seconds to a datetime object.
-    cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
-
-    all_messages = UserMessage.objects.filter(
-        user_profile=user_profile,
-        message__pub_date__gt=cutoff_date).order_by("message__pub_date")
-
+    handle_digest_emails([user_profile_id], cutoff)
+
+def handle_digest_emails(user_profile_ids, cutoff):
+    # type: (List[int], int) -> List[int]
+    """Sends the digest emails for activity since cutoff (epoch seconds)
+    to the users user_profile_ids, computing the parts they share once
+    per realm; see RealmDigest.  A failure only costs the users it
+    affects their emails: returns the ids of those users."""
+    # Convert from epoch seconds to a datetime object.  It has to be
+    # an aware one: Django would take a naive one to be in TIME_ZONE.
+    cutoff_date = timestamp_to_datetime(cutoff)
+
+    users_by_realm = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    for user_profile in UserProfile.objects.select_related('realm').filter(id__in=user_profile_ids):
+        users_by_realm[user_profile.realm_id].append(user_profile)
+
+    home_view_recipients = defaultdict(set) # type: Dict[int, Set[int]]
+    for (user_profile_id, recipient_id) in Subscription.objects.filter(
+            user_profile_id__in=user_profile_ids, active=True, in_home_view=True,
+            recipient__type=Recipient.STREAM).values_list('user_profile_id', 'recipient_id'):
+        home_view_recipients[user_profile_id].add(recipient_id)
+
+    failed_user_profile_ids = [] # type: List[int]
+    for user_profiles in users_by_realm.values():
+        try:
+            realm_digest = RealmDigest(user_profiles[0].realm, cutoff_date)
+            hot_conversations = dict((user_profile.id,
+                                      realm_digest.hot_conversations(user_profile,
+                                                                     home_view_recipients[user_profile.id]))
+                                     for user_profile in user_profiles)
+            realm_digest.fetch_first_messages(itertools.chain(*hot_conversations.values()))
+        except Exception:
+            logger.exception("Failed to compute the digest for realm %s" % (user_profiles[0].realm.domain,))
+            failed_user_profile_ids.extend(user_profile.id for user_profile in user_profiles)
+            continue
+        for user_profile in user_profiles:
+            try:
+                send_user_digest_email(user_profile, realm_digest, hot_conversations[user_profile.id])
+            except Exception:
+                logger.exception("Failed to send the digest email to %s" % (user_profile.email,))
+                failed_user_profile_ids.append(user_profile.id)
+    return failed_user_profile_ids
+
+def send_user_digest_email(user_profile, realm_digest, hot_conversations):
+    # type: (UserProfile, RealmDigest, List[Tuple[int, text_type]]) -> None
     # Start building email template data.
     template_payload = {
         'name': user_profile.full_name,
@@ -176,48 +318,40 @@ def handle_digest_email(user_profile_id, cutoff):
     # Gather recent missed PMs, re-using the missed PM email logic.
     # You can't have an unread message that you sent, but when testing
     # this causes confusion so filter your messages out.
-    pms = all_messages.filter(
-        ~Q(message__recipient__type=Recipient.STREAM) & \
-             ~Q(message__sender=user_profile))
+    pms = UserMessage.objects.select_related('message__recipient', 'message__sender').filter(
+        ~Q(message__recipient__type=Recipient.STREAM) &
+        ~Q(message__sender=user_profile),
+        user_profile=user_profile,
+        message__pub_date__gt=realm_digest.cutoff_date).order_by("message__pub_date")
 
     # Show up to 4 missed PMs.
     pms_limit = 4
 
     template_payload['unread_pms'] = build_message_list(
         user_profile, [pm.message for pm in pms[:pms_limit]])
-    template_payload['remaining_unread_pms_count'] = min(0, len(pms) - pms_limit)
-
-    home_view_recipients = [sub.recipient for sub in \
-                                Subscription.objects.filter(
-            user_profile=user_profile, active=True, in_home_view=True)]
-
-    stream_messages = all_messages.filter(
-        message__recipient__type=Recipient.STREAM,
-        message__recipient__in=home_view_recipients)
+    template_payload['remaining_unread_pms_count'] = max(0, pms.count() - pms_limit)
 
     # Gather hot conversations.
-    template_payload["hot_conversations"] = gather_hot_conversations(
-        user_profile, stream_messages)
+    template_payload["hot_conversations"] = [realm_digest.teaser(user_profile, key)
+                                             for key in hot_conversations]
 
     # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
-    template_payload["new_streams"] = new_streams
-    template_payload["new_streams_count"] = new_streams_count
+    template_payload["new_streams"] = realm_digest.new_streams
+    template_payload["new_streams_count"] = realm_digest.new_streams_count
 
     # Gather users who signed up recently.
-    new_users_count, new_users = gather_new_users(
-        user_profile, cutoff_date)
-    template_payload["new_users"] = new_users
+    template_payload["new_users"] = realm_digest.new_users
+
+    # We don't want to send emails containing almost no information.
+    if not enough_traffic(template_payload["unread_pms"],
+                          template_payload["hot_conversations"],
+                          realm_digest.new_streams_count, realm_digest.new_users_count):
+        return
 
     text_content = loader.render_to_string(
         'zerver/emails/digest/digest_email.txt', template_payload)
     html_content = loader.render_to_string(
         'zerver/emails/digest/digest_email_html.txt', template_payload)
 
-    # We don't want to send emails containing almost no information.
-    if enough_traffic(template_payload["unread_pms"],
-                      template_payload["hot_conversations"],
-                      new_streams_count, new_users_count):
-        logger.info("Sending digest email for %s" % (user_profile.email,))
-        send_digest_email(user_profile, html_content, text_content)
+    logger.info("Sending digest email for %s" % (user_profile.email,))
+    send_digest_email(user_profile, html_content, text_content)
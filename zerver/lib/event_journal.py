@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+import glob
+import os
+import shutil
+import ujson
+
+# Crash-safe storage for Tornado's event queues.
+#
+# The state is stored as a snapshot plus an append-only journal:
+#
+# * The snapshot file has a JSON header line recording the first
+#   journal segment that is not included in the snapshot and an index
+#   of the queue ids in it, followed by one `[queue_id, client_dict]`
+#   JSON line per event queue, so that it can be loaded incrementally,
+#   and any one queue can be looked up without reading the others.
+#
+# * Journal segments (`<snapshot>.journal.<segment>`) contain one JSON
+#   line per change to the event queues made after the snapshot was
+#   started (queue creation and removal, events pushed, events
+#   acknowledged, virtual events resolved into their queue).  Records are buffered in memory and flushed to disk
+#   frequently, so a crash loses at most one flush interval of changes.
+#
+# Taking a snapshot starts a new journal segment; once the snapshot is
+# safely on disk, the segments it covers are deleted.
+
+JournalRecord = Tuple[str, str, Any]
+
+class EventQueueJournal(object):
+    def __init__(self, snapshot_filename):
+        # type: (str) -> None
+        self.snapshot_filename = snapshot_filename
+        self.pending = [] # type: List[JournalRecord]
+        self.segment = max(self.existing_segments() or [0]) + 1
+        self.file = open(self.segment_filename(self.segment), "a")
+
+    def segment_filename(self, segment):
+        # type: (int) -> str
+        return "%s.journal.%d" % (self.snapshot_filename, segment)
+
+    def existing_segments(self):
+        # type: () -> List[int]
+        prefix = self.segment_filename(0)[:-1]
+        segments = []
+        for filename in glob.glob(prefix + "*"):
+            suffix = filename[len(prefix):]
+            if suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    def record(self, op, queue_id, data):
+        # type: (str, str, Any) -> None
+        # Serialization is deferred to flush(), keeping the event
+        # delivery path down to a list append.
+        self.pending.append((op, queue_id, data))
+
+    def flush(self):
+        # type: () -> None
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.file.write("".join(ujson.dumps(record) + "\n" for record in pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def rotate(self):
+        # type: () -> int
+        """Flushes and closes the current segment and starts a new one.
+        Returns the number of the new segment."""
+        self.flush()
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_filename(self.segment), "a")
+        return self.segment
+
+    def remove_segments_before(self, segment):
+        # type: (int) -> None
+        for old_segment in self.existing_segments():
+            if old_segment < segment:
+                os.remove(self.segment_filename(old_segment))
+
+    def read_segments(self, first_segment, last_segment):
+        # type: (int, int) -> Iterator[JournalRecord]
+        """Yields the records of the segments in [first_segment,
+        last_segment), in order.  A truncated final line (from a crash
+        in the middle of a flush) is ignored."""
+        for segment in self.existing_segments():
+            if not first_segment <= segment < last_segment:
+                continue
+            with open(self.segment_filename(segment), "r") as journal_file:
+                for line in journal_file:
+                    try:
+                        (op, queue_id, data) = ujson.loads(line)
+                    except ValueError:
+                        break
+                    yield (op, queue_id, data)
+
+    def close(self):
+        # type: () -> None
+        self.flush()
+        self.file.close()
+
+def write_snapshot(filename, journal_segment, clients):
+    # type: (str, int, Iterable[Tuple[str, Any]]) -> int
+    """Writes the (queue_id, client_dict) pairs in `clients` as a new
+    snapshot that supersedes all journal segments before
+    `journal_segment`.  The snapshot is written to a temporary file and
+    renamed into place, so readers never see a partial snapshot."""
+    tmp_filename = filename + ".tmp"
+    body_filename = filename + ".body.tmp"
+    # The index (of each queue's offset past the header) goes in the
+    # header, so the queues are written out before it.
+    index = {} # type: Dict[str, int]
+    offset = 0
+    with open(body_filename, "wb") as body:
+        for (queue_id, client_dict) in clients:
+            # ujson escapes non-ASCII, so this is the length in bytes.
+            line = ujson.dumps([queue_id, client_dict]) + "\n"
+            body.write(line.encode("ascii"))
+            index[queue_id] = offset
+            offset += len(line)
+    with open(tmp_filename, "wb") as snapshot:
+        header = ujson.dumps(dict(journal_segment=journal_segment, index=index)) + "\n"
+        snapshot.write(header.encode("ascii"))
+        with open(body_filename, "rb") as body:
+            shutil.copyfileobj(body, snapshot)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.remove(body_filename)
+    os.rename(tmp_filename, filename)
+    return len(index)
+
+class EventQueueSnapshot(object):
+    """A snapshot being loaded.  `clients` iterates over its
+    (queue_id, client_dict) pairs in order; `queue_ids` is its index,
+    and `read_client` reads just the one queue.
+
+    Also reads the older single-JSON-document format written by
+    previous versions of dump_event_queues, which has no journal (or
+    index: `queue_ids` is None)."""
+
+    def __init__(self, filename):
+        # type: (str) -> None
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.lookup_file = None # type: Optional[IO[bytes]]
+        first_line = self.file.readline()
+        if first_line.startswith(b"["):
+            # Legacy format: the whole file is one JSON list of pairs.
+            legacy_data = ujson.loads(first_line + self.file.read())
+            self.file.close()
+            self.journal_segment = 0
+            self.queue_ids = None # type: Optional[Dict[str, int]]
+            self.legacy_clients = [(queue_id, client_dict)
+                                   for (queue_id, client_dict) in legacy_data] # type: Optional[List[Tuple[str, Any]]]
+            return
+
+        header = ujson.loads(first_line)
+        self.journal_segment = header["journal_segment"]
+        self.queue_ids = header.get("index")
+        self.legacy_clients = None
+        self.data_start = len(first_line)
+
+    def clients(self):
+        # type: () -> Iterator[Tuple[str, Any]]
+        if self.legacy_clients is not None:
+            for pair in self.legacy_clients:
+                yield pair
+            return
+        try:
+            while True:
+                line = self.file.readline()
+                if not line:
+                    break
+                (queue_id, client_dict) = ujson.loads(line)
+                yield (queue_id, client_dict)
+        finally:
+            self.close()
+
+    def read_client(self, queue_id):
+        # type: (str) -> Any
+        """The client_dict of the queue queue_id in the index."""
+        if self.lookup_file is None:
+            self.lookup_file = open(self.filename, "rb")
+        self.lookup_file.seek(self.data_start + self.queue_ids[queue_id])
+        (stored_queue_id, client_dict) = ujson.loads(self.lookup_file.readline())
+        assert stored_queue_id == queue_id
+        return client_dict
+
+    def close(self):
+        # type: () -> None
+        self.file.close()
+        if self.lookup_file is not None:
+            self.lookup_file.close()
+            self.lookup_file = None
@@ -1,10 +1,11 @@
 from __future__ import absolute_import
-from typing import cast, AbstractSet, Any, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Union
+from typing import cast, AbstractSet, Any, Optional, Iterable, Iterator, Sequence, Mapping, MutableMapping, Callable, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.utils.timezone import now
 from collections import deque
+from contextlib import contextmanager
 import datetime
 import os
 import time
@@ -15,25 +16,29 @@ import requests
 import atexit
 import sys
 import signal
+import threading
 import tornado
 import tornado.autoreload
 import random
 import traceback
 from zerver.models import UserProfile, Client
 from zerver.decorator import RespondAsynchronously
+from zerver.lib.event_journal import EventQueueJournal, EventQueueSnapshot, write_snapshot
 from zerver.lib.cache import cache_get_many, \
     user_profile_by_id_cache_key, cache_save_user_profile, cache_with_key
 from zerver.lib.handlers import clear_handler_by_id, get_handler_by_id, \
     finish_handler, handler_stats_string
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_restart
-from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.narrow import build_narrow_filter, get_narrow_stream, \
+    narrow_excludes_stream_messages
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.lib.timestamp import timestamp_to_datetime
 import copy
 import six
 from six import text_type
+from six.moves import urllib
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
@@ -41,6 +46,18 @@ from six import text_type
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
 
+# Event queue changes are journaled to disk every second, and a full
+# snapshot (which lets us discard the journal) is taken in the
+# background every 10 minutes.
+EVENT_QUEUE_JOURNAL_FLUSH_MSECS = 1000
+EVENT_QUEUE_SNAPSHOT_FREQ_MSECS = 1000 * 60 * 10
+# How many event queues to restore per IOLoop callback on startup
+EVENT_QUEUE_LOAD_CHUNK_SIZE = 1000
+
+# Maximum number of notices sent to Tornado in a single batch by
+# batch_events
+NOTIFY_TORNADO_BATCH_SIZE = 500
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -52,11 +69,59 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+# In sharded mode (settings.TORNADO_PROCESSES > 1), each Tornado
+# process owns the event queues of a fixed partition of the users:
+# shard N listens on the TORNADO_SERVER port + N, consumes the
+# notify_tornado queue for shard N, and holds the queues (including
+# all_public_streams and narrowed queues) of the users whose id is
+# congruent to N modulo the number of shards.  Django routes each
+# notification only to the shards that own its recipients.
+def get_tornado_shard(user_profile_id):
+    # type: (int) -> int
+    return user_profile_id % settings.TORNADO_PROCESSES
+
+def get_tornado_server(shard):
+    # type: (int) -> text_type
+    if shard == 0:
+        return settings.TORNADO_SERVER
+    url = urllib.parse.urlsplit(settings.TORNADO_SERVER)
+    netloc = '%s:%d' % (url.hostname, (url.port or 80) + shard)
+    return urllib.parse.urlunsplit((url.scheme, netloc, url.path, url.query, url.fragment))
+
+def get_tornado_server_for_user(user_profile_id):
+    # type: (int) -> text_type
+    return get_tornado_server(get_tornado_shard(user_profile_id))
+
+def get_sockjs_url(user_profile_id):
+    # type: (int) -> str
+    # nginx routes /sockjs-shardN to shard N, so that the socket
+    # reaches the Tornado process that owns the user's event queue.
+    if settings.TORNADO_PROCESSES == 1:
+        return '/sockjs'
+    return '/sockjs-shard%d' % (get_tornado_shard(user_profile_id),)
+
+def get_notify_tornado_queue_name(shard):
+    # type: (int) -> str
+    if settings.TORNADO_PROCESSES == 1:
+        return 'notify_tornado'
+    return 'notify_tornado_shard%d' % (shard,)
+
+def get_tornado_return_queue_name(shard):
+    # type: (int) -> str
+    if settings.TORNADO_PROCESSES == 1:
+        return 'tornado_return'
+    return 'tornado_return_shard%d' % (shard,)
+
+def is_local_user(user_profile_id):
+    # type: (int) -> bool
+    return get_tornado_shard(user_profile_id) == settings.TORNADO_SHARD
+
 class ClientDescriptor(object):
     def __init__(self, user_profile_id, user_profile_email, realm_id, event_queue,
                  event_types, client_type_name, apply_markdown=True,
-                 all_public_streams=False, lifespan_secs=0, narrow=[]):
-        # type: (int, text_type, int, EventQueue, Optional[Sequence[str]], text_type, bool, bool, int, Iterable[Sequence[text_type]]) -> None
+                 all_public_streams=False, lifespan_secs=0, narrow=[],
+                 multi_user_peer_events=False):
+        # type: (int, text_type, int, EventQueue, Optional[Sequence[str]], text_type, bool, bool, int, Iterable[Sequence[text_type]], bool) -> None
         # These objects are serialized on shutdown and restored on restart.
         # If fields are added or semantics are changed, temporary code must be
         # added to load_event_queues() to update the restored objects.
@@ -76,6 +141,9 @@ class ClientDescriptor(object):
         self._timeout_handle = None # type: Any # TODO: should be return type of ioloop.add_timeout
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        # Whether the client understands peer_add and peer_remove events
+        # about several users at once; see add_event.
+        self.multi_user_peer_events = multi_user_peer_events
 
         # Clamp queue_timeout to between minimum and maximum timeouts
         self.queue_timeout = max(IDLE_EVENT_QUEUE_TIMEOUT_SECS, min(self.queue_timeout, MAX_QUEUE_TIMEOUT_SECS))
@@ -95,7 +163,8 @@ class ClientDescriptor(object):
                     apply_markdown=self.apply_markdown,
                     all_public_streams=self.all_public_streams,
                     narrow=self.narrow,
-                    client_type_name=self.client_type_name)
+                    client_type_name=self.client_type_name,
+                    multi_user_peer_events=self.multi_user_peer_events)
 
     def __repr__(self):
         # type: () -> str
@@ -114,7 +183,8 @@ class ClientDescriptor(object):
         ret = cls(d['user_profile_id'], d['user_profile_email'], d['realm_id'],
                   EventQueue.from_dict(d['event_queue']), d['event_types'],
                   d['client_type_name'], d['apply_markdown'], d['all_public_streams'],
-                  d['queue_timeout'], d.get('narrow', []))
+                  d['queue_timeout'], d.get('narrow', []),
+                  d.get('multi_user_peer_events', False))
         ret.last_connection_time = d['last_connection_time']
         return ret
 
@@ -129,7 +199,17 @@ class ClientDescriptor(object):
             handler = get_handler_by_id(self.current_handler_id)
             async_request_restart(handler._request)
 
-        self.event_queue.push(event)
+        if (event['type'] == 'subscription' and event['op'] in ('peer_add', 'peer_remove') and
+                len(event['user_emails']) > 1 and not self.multi_user_peer_events):
+            # Older clients only read user_email, so they get an event
+            # per user.
+            events = [dict(event, user_email=email, user_emails=[email])
+                      for email in event['user_emails']]
+        else:
+            events = [event]
+        for event in events:
+            self.event_queue.push(event)
+            journal_record('event', self.event_queue.id, event)
         self.finish_current_handler()
 
     def finish_current_handler(self, need_timeout=False):
@@ -138,7 +218,7 @@ class ClientDescriptor(object):
             err_msg = "Got error finishing handler for queue %s" % (self.event_queue.id,)
             try:
                 finish_handler(self.current_handler_id, self.event_queue.id,
-                               self.event_queue.contents(), self.apply_markdown)
+                               self.event_queue_contents(), self.apply_markdown)
             except Exception:
                 logging.exception(err_msg)
             finally:
@@ -146,6 +226,15 @@ class ClientDescriptor(object):
                 return True
         return False
 
+    def event_queue_contents(self):
+        # type: () -> List[Dict[str, Any]]
+        """The queue's contents, for sending to the client.  Resolving
+        its virtual events into the queue is journaled, so that a
+        restored queue resolves them at the same point."""
+        if self.event_queue.virtual_events:
+            journal_record('resolve', self.event_queue.id, None)
+        return self.event_queue.contents()
+
     def accepts_event(self, event):
         # type: (Mapping[str, Any]) -> bool
         if self.event_types is not None and event["type"] not in self.event_types:
@@ -332,6 +421,10 @@ clients = {} # type: Dict[str, ClientDescriptor]
 user_clients = {} # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams = {} # type: Dict[int, List[ClientDescriptor]]
+# maps realm id to a dict mapping the (lowercased) stream in the narrow
+# of narrowed client descriptors, or None for narrows without a stream
+# term, to the list of those client descriptors
+realm_clients_narrowed = {} # type: Dict[int, Dict[Optional[text_type], List[ClientDescriptor]]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -342,12 +435,39 @@ gc_hooks = [] # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
 next_queue_id = 0
 
+# The journal of changes to the event queues since the last snapshot;
+# None when persistence is disabled (e.g. in the test suite).
+journal = None # type: Optional[EventQueueJournal]
+# The pid of the process writing the current background snapshot
+snapshot_pid = None # type: Optional[int]
+
+# While the persisted event queues are being restored at startup,
+# `loading_clients` iterates over `loading_snapshot`,
+# `restored_early` holds the ids of the queues it has looked up ahead
+# of that, `journal_backlog` holds the journaled changes not yet
+# applied, by queue id, and incoming notifications are held in
+# `pending_notifications`.
+loading_clients = None # type: Optional[Iterator[Tuple[str, Dict[str, Any]]]]
+loading_snapshot = None # type: Optional[EventQueueSnapshot]
+restored_early = set() # type: Set[str]
+journal_backlog = {} # type: Dict[str, List[Tuple[str, Any]]]
+pending_notifications = [] # type: List[Mapping[str, Any]]
+
+def journal_record(op, queue_id, data):
+    # type: (str, str, Any) -> None
+    if journal is not None:
+        journal.record(op, queue_id, data)
+
 def add_client_gc_hook(hook):
     # type: (Callable[[int, ClientDescriptor, bool], None]) -> None
     gc_hooks.append(hook)
 
 def get_client_descriptor(queue_id):
     # type: (str) -> ClientDescriptor
+    if queue_id not in clients and loading_clients is not None:
+        # Restore this queue now rather than making the client wait
+        # for all the other queues to be loaded.
+        load_event_queues_until(queue_id)
     return clients.get(queue_id)
 
 def get_client_descriptors_for_user(user_profile_id):
@@ -358,27 +478,47 @@ def get_client_descriptors_for_realm_all_streams(realm_id):
     # type: (int) -> List[ClientDescriptor]
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_client_descriptors_for_realm_narrowed(realm_id, stream_name):
+    # type: (int, text_type) -> List[ClientDescriptor]
+    """Returns the narrowed client descriptors in the realm whose narrow
+    could match a message to the given stream."""
+    narrowed = realm_clients_narrowed.get(realm_id)
+    if narrowed is None:
+        return []
+    return narrowed.get(stream_name.lower(), []) + narrowed.get(None, [])
+
 def add_to_client_dicts(client):
     # type: (ClientDescriptor) -> None
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
+    if client.narrow != []:
+        if not narrow_excludes_stream_messages(client.narrow):
+            realm_clients_narrowed.setdefault(client.realm_id, {}).setdefault(
+                get_narrow_stream(client.narrow), []).append(client)
+    elif client.all_public_streams:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
 
 def allocate_client_descriptor(new_queue_data):
     # type: (MutableMapping[str, Any]) -> ClientDescriptor
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    if settings.TORNADO_PROCESSES == 1:
+        queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    else:
+        # Sharded queue ids carry their shard, so that the frontend
+        # proxy can route long-polling requests to the owning process.
+        queue_id = '%s:%s:%s' % (settings.SERVER_GENERATION, settings.TORNADO_SHARD,
+                                 next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    journal_record('create', queue_id, client.to_dict())
     return client
 
 def do_gc_event_queues(to_remove, affected_users, affected_realms):
     # type: (AbstractSet[str], AbstractSet[int], AbstractSet[int]) -> None
     def filter_client_dict(client_dict, key):
-        # type: (MutableMapping[int, List[ClientDescriptor]], int) -> None
+        # type: (MutableMapping[Any, List[ClientDescriptor]], Any) -> None
         if key not in client_dict:
             return
 
@@ -393,8 +533,15 @@ def do_gc_event_queues(to_remove, affected_users, affected_realms):
 
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id in realm_clients_narrowed:
+            narrowed = realm_clients_narrowed[realm_id]
+            for stream_name in list(narrowed.keys()):
+                filter_client_dict(narrowed, stream_name)
+            if len(narrowed) == 0:
+                del realm_clients_narrowed[realm_id]
 
     for id in to_remove:
+        journal_record('remove', id, None)
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
@@ -423,43 +570,202 @@ def gc_event_queues():
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
+def get_persistent_queue_filename():
+    # type: () -> str
+    if settings.TORNADO_PROCESSES == 1:
+        return settings.JSON_PERSISTENT_QUEUE_FILENAME
+    # Each shard persists its own partition of the event queues
+    (root, ext) = os.path.splitext(settings.JSON_PERSISTENT_QUEUE_FILENAME)
+    return '%s.%d%s' % (root, settings.TORNADO_SHARD, ext)
+
 def dump_event_queues():
     # type: () -> None
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)],
-                   stored_queues)
+    if loading_clients is not None:
+        # We're shutting down before the restore finished; make sure
+        # we don't drop the queues we haven't gotten to yet.
+        load_event_queues_until(None)
+        finish_loading_event_queues(send_restart=False)
+    if snapshot_pid is not None:
+        # Don't race a background snapshot for the snapshot file
+        os.waitpid(snapshot_pid, 0)
+
+    if journal is not None:
+        journal_segment = journal.rotate()
+    else:
+        journal_segment = 0
+    write_snapshot(get_persistent_queue_filename(), journal_segment,
+                   ((qid, client.to_dict()) for (qid, client) in six.iteritems(clients)))
+    if journal is not None:
+        journal.remove_segments_before(journal_segment)
 
     logging.info('Tornado dumped %d event queues in %.3fs'
                  % (len(clients), time.time() - start))
 
+def snapshot_event_queues():
+    # type: () -> None
+    """Writes a snapshot of the event queues from a forked child, so
+    that the IOLoop keeps serving while the (copy-on-write) state is
+    serialized, and discards the journal segments it supersedes."""
+    global snapshot_pid
+    if loading_clients is not None:
+        return
+    if snapshot_pid is not None:
+        (pid, status) = os.waitpid(snapshot_pid, os.WNOHANG)
+        if pid == 0:
+            logging.warning('Previous event queue snapshot is still being written')
+            return
+        snapshot_pid = None
+
+    journal_segment = journal.rotate()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            start = time.time()
+            count = write_snapshot(get_persistent_queue_filename(), journal_segment,
+                                   ((qid, client.to_dict()) for (qid, client) in six.iteritems(clients)))
+            journal.remove_segments_before(journal_segment)
+            logging.info('Tornado snapshotted %d event queues in %.3fs'
+                         % (count, time.time() - start))
+        except Exception:
+            logging.exception("Could not snapshot event queues")
+        finally:
+            os._exit(0)
+    snapshot_pid = pid
+
+def flush_event_queue_journal():
+    # type: () -> None
+    try:
+        journal.flush()
+    except Exception:
+        logging.exception("Could not write event queue journal")
+
+def restore_event_queue(queue_id, client_dict):
+    # type: (str, Optional[Dict[str, Any]]) -> None
+    client = None # type: Optional[ClientDescriptor]
+    if client_dict is not None:
+        client = ClientDescriptor.from_dict(client_dict)
+    for (op, data) in journal_backlog.pop(queue_id, []):
+        if op == 'create':
+            client = ClientDescriptor.from_dict(data)
+        elif op == 'remove':
+            client = None
+        elif client is None:
+            continue
+        elif op == 'event':
+            client.event_queue.push(data)
+        elif op == 'prune':
+            (through_id, last_connection_time) = data
+            client.event_queue.prune(through_id)
+            client.last_connection_time = last_connection_time
+        elif op == 'resolve':
+            client.event_queue.contents()
+
+    if client is None:
+        return
+    # Put code for migrations due to event queue data format changes here
+
+    clients[queue_id] = client
+    add_to_client_dicts(client)
+
+def load_event_queues_until(queue_id, limit=None):
+    # type: (Optional[str], Optional[int]) -> bool
+    """Restores event queues from the snapshot until `queue_id` has been
+    restored or `limit` queues have been restored (all of them if both
+    are None).  Returns whether the snapshot has been fully read."""
+    global loading_clients, loading_snapshot
+    if queue_id in journal_backlog and journal_backlog[queue_id][0][0] == 'create':
+        # Created after the snapshot was taken, so it's not in there.
+        restore_event_queue(queue_id, None)
+        return False
+
+    if (queue_id is not None and loading_snapshot is not None and
+            loading_snapshot.queue_ids is not None):
+        # Look the queue up in the snapshot's index rather than
+        # reading up to it; a queue id that isn't there (e.g. of a
+        # queue long since garbage collected) costs nothing.
+        if queue_id in loading_snapshot.queue_ids and queue_id not in restored_early:
+            restored_early.add(queue_id)
+            try:
+                restore_event_queue(queue_id, loading_snapshot.read_client(queue_id))
+            except Exception:
+                logging.exception("Could not deserialize event queue %s" % (queue_id,))
+        return False
+
+    count = 0
+    try:
+        for (qid, client_dict) in loading_clients:
+            if qid in restored_early:
+                continue
+            restore_event_queue(qid, client_dict)
+            count += 1
+            if qid == queue_id or (limit is not None and count >= limit):
+                return False
+    except Exception:
+        logging.exception("Could not deserialize event queues")
+
+    # Queues that were created after the snapshot was taken
+    for qid in list(journal_backlog.keys()):
+        restore_event_queue(qid, None)
+    loading_clients = iter([])
+    if loading_snapshot is not None:
+        loading_snapshot.close()
+        loading_snapshot = None
+    restored_early.clear()
+    return True
+
+def finish_loading_event_queues(send_restart=True):
+    # type: (bool) -> None
+    global loading_clients, pending_notifications
+    loading_clients = None
+    logging.info('Tornado loaded %d event queues; processing %d held notifications'
+                 % (len(clients), len(pending_notifications)))
+    notifications = pending_notifications
+    pending_notifications = []
+    for notice in notifications:
+        process_notification(notice)
+    if send_restart:
+        send_restart_events(immediate=settings.DEVELOPMENT)
+
 def load_event_queues():
     # type: () -> None
-    global clients
+    """Starts restoring the persisted event queues.  The snapshot is
+    streamed in chunks from the IOLoop, so that Tornado can serve
+    requests (including for the already-restored queues) while the
+    rest of the state is being loaded."""
+    global journal, loading_clients, loading_snapshot
     start = time.time()
+    filename = get_persistent_queue_filename()
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
+    journal_segment = 0
+    loading_clients = iter([])
     try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
-            json_data = stored_queues.read()
-        try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
-        except Exception:
-            logging.exception("Could not deserialize event queues")
+        loading_snapshot = EventQueueSnapshot(filename)
+        journal_segment = loading_snapshot.journal_segment
+        loading_clients = loading_snapshot.clients()
     except (IOError, EOFError):
         pass
+    except Exception:
+        logging.exception("Could not deserialize event queues")
 
-    for client in six.itervalues(clients):
-        # Put code for migrations due to event queue data format changes here
+    journal = EventQueueJournal(filename)
+    for (op, qid, data) in journal.read_segments(journal_segment, journal.segment):
+        journal_backlog.setdefault(qid, []).append((op, data))
 
-        add_to_client_dicts(client)
-
-    logging.info('Tornado loaded %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+    ioloop = tornado.ioloop.IOLoop.instance()
+    def load_chunk():
+        # type: () -> None
+        if loading_clients is None:
+            # Already finished by a shutdown
+            return
+        if load_event_queues_until(None, limit=EVENT_QUEUE_LOAD_CHUNK_SIZE):
+            finish_loading_event_queues()
+            logging.info('Tornado loaded %d event queues in %.3fs'
+                         % (len(clients), time.time() - start))
+        else:
+            ioloop.add_callback(load_chunk)
+    ioloop.add_callback(load_chunk)
 
 def send_restart_events(immediate=False):
     # type: (bool) -> None
@@ -472,26 +778,27 @@ def send_restart_events(immediate=False):
 
 def setup_event_queue():
     # type: () -> None
+    ioloop = tornado.ioloop.IOLoop.instance()
     if not settings.TEST_SUITE:
+        # Restart events are sent once the queues are loaded
         load_event_queues()
         atexit.register(dump_event_queues)
         # Make sure we dump event queues even if we exit via signal
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
         tornado.autoreload.add_reload_hook(dump_event_queues) # type: ignore # TODO: Fix missing tornado.autoreload stub
 
-    try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
-    except OSError:
-        pass
+        tornado.ioloop.PeriodicCallback(flush_event_queue_journal,
+                                        EVENT_QUEUE_JOURNAL_FLUSH_MSECS, ioloop).start()
+        tornado.ioloop.PeriodicCallback(snapshot_event_queues,
+                                        EVENT_QUEUE_SNAPSHOT_FREQ_MSECS, ioloop).start()
+    else:
+        send_restart_events(immediate=settings.DEVELOPMENT)
 
     # Set up event queue garbage collection
-    ioloop = tornado.ioloop.IOLoop.instance()
     pc = tornado.ioloop.PeriodicCallback(gc_event_queues,
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
-    send_restart_events(immediate=settings.DEVELOPMENT)
-
 def fetch_events(query):
     # type: (Mapping[str, Any]) -> Dict[str, Any]
     queue_id = query["queue_id"] # type: str
@@ -509,6 +816,8 @@ def fetch_events(query):
         extra_log_data = ""
         if queue_id is None:
             if dont_block:
+                if not is_local_user(user_profile_id):
+                    raise JsonableError(_("Event queues for this user are served by another Tornado shard"))
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
             else:
@@ -522,10 +831,11 @@ def fetch_events(query):
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
             client.event_queue.prune(last_event_id)
+            journal_record('prune', queue_id, [last_event_id, time.time()])
             was_connected = client.finish_current_handler()
 
         if not client.event_queue.empty() or dont_block:
-            response = dict(events=client.event_queue.contents(),
+            response = dict(events=client.event_queue_contents(),
                             handler_id=handler_id) # type: Dict[str, Any]
             if orig_queue_id is None:
                 response['queue_id'] = queue_id
@@ -562,8 +872,8 @@ def extract_json_response(resp):
 
 def request_event_queue(user_profile, user_client, apply_markdown,
                         queue_lifespan_secs, event_types=None, all_public_streams=False,
-                        narrow=[]):
-    # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[text_type]]) -> Optional[str]
+                        narrow=[], multi_user_peer_events=False):
+    # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[text_type]], bool) -> Optional[str]
     if settings.TORNADO_SERVER:
         req = {'dont_block'    : 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
@@ -571,10 +881,11 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                'client'        : 'internal',
                'user_client'   : user_client.name,
                'narrow'        : ujson.dumps(narrow),
+               'multi_user_peer_events': ujson.dumps(multi_user_peer_events),
                'lifespan_secs' : queue_lifespan_secs}
         if event_types is not None:
             req['event_types'] = ujson.dumps(event_types)
-        resp = requests.get(settings.TORNADO_SERVER + '/api/v1/events',
+        resp = requests.get(get_tornado_server_for_user(user_profile.id) + '/api/v1/events',
                             auth=requests.auth.HTTPBasicAuth(user_profile.email,
                                                              user_profile.api_key),
                             params=req)
@@ -588,7 +899,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
 def get_user_events(user_profile, queue_id, last_event_id):
     # type: (UserProfile, str, int) -> List[Dict]
     if settings.TORNADO_SERVER:
-        resp = requests.get(settings.TORNADO_SERVER + '/api/v1/events',
+        resp = requests.get(get_tornado_server_for_user(user_profile.id) + '/api/v1/events',
                             auth=requests.auth.HTTPBasicAuth(user_profile.email,
                                                              user_profile.api_key),
                             params={'queue_id'     : queue_id,
@@ -678,41 +989,61 @@ def process_message_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
     realm_presences = {int(k): v for k, v in event_template['presences'].items()} # type: Dict[int, Dict[text_type, Dict[str, Any]]]
     sender_queue_id = event_template.get('sender_queue_id', None) # type: Optional[str]
+    local_message_id = event_template.get('local_id', None) # type: Optional[Any]
     message_dict_markdown = event_template['message_dict_markdown'] # type: Dict[str, Any]
     message_dict_no_markdown = event_template['message_dict_no_markdown'] # type: Dict[str, Any]
     sender_id = message_dict_markdown['sender_id'] # type: int
     message_id = message_dict_markdown['id'] # type: int
     message_type = message_dict_markdown['type'] # type: str
     sending_client = message_dict_markdown['client'] # type: text_type
+    invite_only = event_template.get("invite_only", False) # type: bool
+
+    # The message bodies are shared by every queue receiving the
+    # message; the one variant that differs per client type is built
+    # at most once per markdown setting.
+    message_dicts = {True: message_dict_markdown,
+                     False: message_dict_no_markdown} # type: Dict[bool, Dict[str, Any]]
+    mirror_message_dicts = {} # type: Dict[bool, Dict[str, Any]]
 
-    # To remove duplicate clients: Maps queue ID to {'client': Client, 'flags': flags}
-    send_to_clients = {} # type: Dict[str, Dict[str, Any]]
+    # The below prevents (Zephyr) mirroring loops.
+    mirror_sending_client = None # type: Optional[text_type]
+    if 'mirror' in sending_client:
+        mirror_sending_client = sending_client.lower()
+
+    # To remove duplicate clients: Maps queue ID to (client, flags)
+    send_to_clients = {} # type: Dict[str, Tuple[ClientDescriptor, Optional[Iterable[str]]]]
 
     # Extra user-specific data to include
     extra_user_data = {} # type: Dict[int, Any]
 
-    if 'stream_name' in event_template and not event_template.get("invite_only"):
+    if 'stream_name' in event_template and not invite_only:
         for client in get_client_descriptors_for_realm_all_streams(event_template['realm_id']):
-            send_to_clients[client.event_queue.id] = {'client': client, 'flags': None}
-            if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
-                send_to_clients[client.event_queue.id]['is_sender'] = True
+            send_to_clients[client.event_queue.id] = (client, None)
+        # Narrowed queues are indexed by the stream in their narrow, so
+        # we only check the ones that could match this message.
+        for client in get_client_descriptors_for_realm_narrowed(event_template['realm_id'],
+                                                                event_template['stream_name']):
+            send_to_clients[client.event_queue.id] = (client, None)
 
     for user_data in users:
         user_profile_id = user_data['id'] # type: int
         flags = user_data.get('flags', []) # type: Iterable[str]
 
         for client in get_client_descriptors_for_user(user_profile_id):
-            send_to_clients[client.event_queue.id] = {'client': client, 'flags': flags}
-            if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
-                send_to_clients[client.event_queue.id]['is_sender'] = True
+            send_to_clients[client.event_queue.id] = (client, flags)
 
         # If the recipient was offline and the message was a single or group PM to him
         # or she was @-notified potentially notify more immediately
         received_pm = message_type == "private" and user_profile_id != sender_id
         mentioned = 'mentioned' in flags
+        if not (received_pm or mentioned):
+            # Only these recipients can need a notification, so we
+            # skip the (comparatively expensive) idle check for the
+            # rest, which on a big stream is nearly everyone.
+            continue
         idle = receiver_is_idle(user_profile_id, realm_presences)
         always_push_notify = user_data.get('always_push_notify', False)
-        if (received_pm or mentioned) and (idle or always_push_notify):
+        if idle or always_push_notify:
             notice = build_offline_notification(user_profile_id, message_id)
             queue_json_publish("missedmessage_mobile_notifications", notice, lambda notice: None)
             notified = dict(push_notified=True) # type: Dict[str, bool]
@@ -725,44 +1056,40 @@ def process_message_event(event_template, users):
 
             extra_user_data[user_profile_id] = notified
 
-    for client_data in six.itervalues(send_to_clients):
-        client = client_data['client']
-        flags = client_data['flags']
-        is_sender = client_data.get('is_sender', False) # type: bool
-        extra_data = extra_user_data.get(client.user_profile_id, None) # type: Optional[Mapping[str, bool]]
-
+    for (queue_id, (client, flags)) in six.iteritems(send_to_clients):
         if not client.accepts_messages():
             # The actual check is the accepts_event() check below;
             # this line is just an optimization to avoid copying
             # message data unnecessarily
             continue
 
-        if client.apply_markdown:
-            message_dict = message_dict_markdown
-        else:
-            message_dict = message_dict_no_markdown
+        if (mirror_sending_client is not None and
+                mirror_sending_client == client.client_type_name.lower()):
+            continue
 
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
+        if invite_only and "mirror" in client.client_type_name:
+            message_dict = mirror_message_dicts.get(client.apply_markdown)
+            if message_dict is None:
+                message_dict = message_dicts[client.apply_markdown].copy()
+                message_dict["invite_only_stream"] = True
+                mirror_message_dicts[client.apply_markdown] = message_dict
+        else:
+            message_dict = message_dicts[client.apply_markdown]
 
+        # Each queue needs its own (shallow) event dict, since
+        # EventQueue.push assigns the event its per-queue id.
         user_event = dict(type='message', message=message_dict, flags=flags) # type: Dict[str, Any]
+        extra_data = extra_user_data.get(client.user_profile_id, None) # type: Optional[Mapping[str, bool]]
         if extra_data is not None:
             user_event.update(extra_data)
 
-        if is_sender:
-            local_message_id = event_template.get('local_id', None)
-            if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
+        if queue_id == sender_queue_id and local_message_id is not None:
+            user_event["local_message_id"] = local_message_id
 
         if not client.accepts_event(user_event):
             continue
 
-        # The below prevents (Zephyr) mirroring loops.
-        if ('mirror' in sending_client and
-            sending_client.lower() == client.client_type_name.lower()):
-            continue
         client.add_event(user_event)
 
 def process_event(event, users):
@@ -787,6 +1114,9 @@ def process_userdata_event(event_template, users):
 
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
+    if loading_clients is not None:
+        pending_notifications.append(notice)
+        return
     event = notice['event'] # type: Mapping[str, Any]
     users = notice['users'] # type: Union[Iterable[int], Iterable[Mapping[str, Any]]]
     if event['type'] in ["update_message"]:
@@ -801,24 +1131,113 @@ def process_notification(notice):
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data):
+def process_notifications(data):
     # type: (Mapping[str, Any]) -> None
+    """Processes either a single notice or a batch of notices, in the
+    `{'notices': [...]}` format sent by batch_events."""
+    if 'notices' in data:
+        for notice in data['notices']:
+            process_notification(notice)
+    else:
+        process_notification(data)
+
+# A single keep-alive session is used for all requests to Tornado, so
+# that a burst of notifications reuses one connection rather than
+# paying for a new TCP handshake on every event.
+notify_tornado_session = None # type: Optional[requests.Session]
+
+def get_notify_tornado_session():
+    # type: () -> requests.Session
+    global notify_tornado_session
+    if notify_tornado_session is None:
+        notify_tornado_session = requests.Session()
+    return notify_tornado_session
+
+def send_notification_http(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+        get_notify_tornado_session().post(str(get_tornado_server(shard) + '/notify_tornado'), data=dict(
                 data   = ujson.dumps(data),
                 secret = settings.SHARED_SECRET))
     else:
-        process_notification(data)
+        process_notifications(data)
+
+def get_notification_shards(event, users):
+    # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> Dict[int, Any]
+    """Partitions `users` by the Tornado shard that owns their event
+    queues.  Shards that own none of the users are omitted, except for
+    public stream messages, which every shard needs to see because
+    all_public_streams and narrowed queues are not tied to recipients.
+    With a single shard, `users` is passed along as is."""
+    if settings.TORNADO_PROCESSES == 1:
+        return {0: users}
+
+    shard_users = {} # type: Dict[int, List[Any]]
+    if event['type'] == 'message' and 'stream_name' in event and not event.get('invite_only'):
+        for shard in range(settings.TORNADO_PROCESSES):
+            shard_users[shard] = []
+    for user in users:
+        if isinstance(user, six.integer_types):
+            user_profile_id = user
+        else:
+            user_profile_id = user['id']
+        shard_users.setdefault(get_tornado_shard(user_profile_id), []).append(user)
+    return shard_users
 
 def send_notification(data):
     # type: (Mapping[str, Any]) -> None
-    queue_json_publish("notify_tornado", data, send_notification_http)
+    send_event(data['event'], data['users'])
+
+# Per-thread state for batch_events
+event_batch = threading.local()
+
+def publish_notification(shard, data):
+    # type: (int, Mapping[str, Any]) -> None
+    queue_json_publish(get_notify_tornado_queue_name(shard), data,
+                       lambda data: send_notification_http(data, shard))
+
+def flush_event_batch(shard):
+    # type: (int) -> None
+    notices = event_batch.notices.pop(shard, None)
+    if notices:
+        publish_notification(shard, dict(notices=notices))
+
+@contextmanager
+def batch_events():
+    # type: () -> Iterator[None]
+    """Within this context, events passed to send_event are collected
+    and sent to each Tornado shard as batches of up to
+    NOTIFY_TORNADO_BATCH_SIZE notices, rather than as one queue message
+    (and one /notify_tornado request) per event.  Any remaining events
+    are sent when the outermost batch_events block exits.
+
+    Events are still delivered in order, but not until the batch is
+    flushed, so this is only for bulk operations that don't need to
+    interleave their events with anything else."""
+    if getattr(event_batch, 'depth', 0) == 0:
+        event_batch.notices = {}
+        event_batch.depth = 0
+    event_batch.depth += 1
+    try:
+        yield
+    finally:
+        event_batch.depth -= 1
+        if event_batch.depth == 0:
+            for shard in sorted(event_batch.notices.keys()):
+                flush_event_batch(shard)
 
 def send_event(event, users):
     # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    batching = getattr(event_batch, 'depth', 0) > 0
+    for shard, shard_users in six.iteritems(get_notification_shards(event, users)):
+        notice = dict(event=event, users=shard_users)
+        if not batching:
+            publish_notification(shard, notice)
+            continue
+        notices = event_batch.notices.setdefault(shard, [])
+        notices.append(notice)
+        if len(notices) >= NOTIFY_TORNADO_BATCH_SIZE:
+            flush_event_batch(shard)
@@ -0,0 +1,448 @@
+from __future__ import absolute_import
+# Streaming export and import of a realm's message history, for moving
+# a large realm between servers.
+#
+# An export is a directory holding a manifest.json and, for each table,
+# gzipped files of newline-delimited JSON rows (lists of column values,
+# in the order the manifest lists the columns), with at most
+# EXPORT_CHUNK_SIZE rows per file.  Rows are read with server-side
+# cursors, so the exporter's memory use doesn't grow with the realm.
+# The message-keyed tables can be exported in parallel, each process
+# taking a range of message ids.
+#
+# The importer maps the export's users (by email), streams (by name),
+# huddles (by members), recipients and clients to the importing
+# server's, creating streams and huddles as needed.  The users must
+# already exist.  It allocates new ids for messages and attachments,
+# preserving their order, and bulk loads each chunk with COPY.  Only
+# the attachments' metadata is moved; the uploaded files themselves
+# have to be copied separately.
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from django.db import connection, transaction
+from django.db.models import Max, Min, Q
+from six import text_type
+from six.moves import range
+
+from zerver.lib.actions import create_stream_if_needed
+from zerver.lib.cache_helpers import fill_remote_cache
+from zerver.lib.parallel import run_parallel
+from zerver.models import Attachment, Client, Message, Realm, Recipient, Stream, \
+    Subscription, UserMessage, UserProfile, get_client, get_huddle
+
+import array
+import bisect
+from contextlib import closing
+import datetime
+import glob
+import gzip
+import io
+import logging
+import os
+import time
+import ujson
+
+EXPORT_FORMAT_VERSION = 1
+EXPORT_CHUNK_SIZE = 10000
+# How many rows a server-side cursor fetches from the database at once.
+EXPORT_CURSOR_ITERSIZE = 2000
+# Message id ranges are uneven in how many of a realm's messages they
+# hold, so we cut more ranges than there are processes.
+EXPORT_SHARDS_PER_PROCESS = 4
+
+class RealmMigrationError(Exception):
+    pass
+
+class ExportTable(object):
+    def __init__(self, name, model, from_sql, message_id_column=None,
+                 allocate_ids=False, remap_columns=None):
+        # type: (str, Any, str, Optional[str], bool, Optional[Dict[str, str]]) -> None
+        self.name = name
+        self.model = model
+        # Joins the table to the zerver_userprofile rows whose realm
+        # the table's rows belong to.
+        self.from_sql = from_sql
+        # Set for tables exported by ranges of message ids.
+        self.message_id_column = message_id_column
+        # Whether the importer allocates new ids for the rows (and
+        # remembers them, for other tables' references), rather than
+        # leaving the id to the column default.
+        self.allocate_ids = allocate_ids
+        # Maps columns referencing other objects to the name of the
+        # id map the importer translates them with.
+        self.remap_columns = remap_columns or {}
+
+    def columns(self):
+        # type: () -> List[str]
+        return [field.column for field in self.model._meta.local_fields]
+
+    def db_table(self):
+        # type: () -> str
+        return self.model._meta.db_table
+
+# In import order: rows only reference tables before them.
+EXPORT_TABLES = [
+    ExportTable('message', Message,
+                'zerver_message JOIN zerver_userprofile ON zerver_message.sender_id = zerver_userprofile.id',
+                message_id_column='zerver_message.id', allocate_ids=True,
+                remap_columns={'sender_id': 'user', 'recipient_id': 'recipient',
+                               'sending_client_id': 'client'}),
+    ExportTable('attachment', Attachment,
+                'zerver_attachment JOIN zerver_userprofile ON zerver_attachment.owner_id = zerver_userprofile.id',
+                allocate_ids=True,
+                remap_columns={'owner_id': 'user', 'realm_id': 'realm'}),
+    ExportTable('usermessage', UserMessage,
+                'zerver_usermessage JOIN zerver_userprofile ON zerver_usermessage.user_profile_id = zerver_userprofile.id',
+                message_id_column='zerver_usermessage.message_id',
+                remap_columns={'user_profile_id': 'user', 'message_id': 'message'}),
+    ExportTable('attachment_messages', Attachment.messages.through,
+                'zerver_attachment_messages '
+                'JOIN zerver_attachment ON zerver_attachment_messages.attachment_id = zerver_attachment.id '
+                'JOIN zerver_userprofile ON zerver_attachment.owner_id = zerver_userprofile.id',
+                message_id_column='zerver_attachment_messages.message_id',
+                remap_columns={'attachment_id': 'attachment', 'message_id': 'message'}),
+    ExportTable('subscription', Subscription,
+                'zerver_subscription JOIN zerver_userprofile ON zerver_subscription.user_profile_id = zerver_userprofile.id',
+                remap_columns={'user_profile_id': 'user', 'recipient_id': 'recipient'}),
+] # type: List[ExportTable]
+
+def export_file_name(table_name, shard, chunk):
+    # type: (str, int, int) -> str
+    return '%s-%03d-%06d.json.gz' % (table_name, shard, chunk)
+
+def export_value(value):
+    # type: (Any) -> Any
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def log_throughput(action, table_name, count, start):
+    # type: (str, str, int, float) -> None
+    elapsed = time.time() - start
+    logging.info("%s %d %s rows in %.2fs (%.1f rows/s)" %
+                 (action, count, table_name, elapsed, count / max(elapsed, 0.001)))
+
+def export_table(realm_id, table, output_dir, shard, message_id_range):
+    # type: (int, ExportTable, str, int, Optional[Tuple[int, int]]) -> int
+    """Writes the realm's rows of table (in message_id_range, if given)
+    to chunk files, reading them with a server-side cursor.  Returns the
+    number of rows written."""
+    start = time.time()
+    columns = ', '.join('%s.%s' % (table.db_table(), column) for column in table.columns())
+    sql = 'SELECT %s FROM %s WHERE zerver_userprofile.realm_id = %%s' % (columns, table.from_sql)
+    params = [realm_id]
+    if message_id_range is not None:
+        sql += ' AND %s BETWEEN %%s AND %%s' % (table.message_id_column,)
+        params.extend(message_id_range)
+    sql += ' ORDER BY %s.id' % (table.db_table(),)
+
+    count = 0
+    output = None # type: Any
+    connection.ensure_connection()
+    # Server-side cursors only live inside a transaction.
+    with transaction.atomic():
+        cursor = connection.connection.cursor(name='export_%s_%d' % (table.name, shard))
+        cursor.itersize = EXPORT_CURSOR_ITERSIZE
+        try:
+            cursor.execute(sql, params)
+            for row in cursor:
+                if count % EXPORT_CHUNK_SIZE == 0:
+                    if output is not None:
+                        output.close()
+                    file_name = export_file_name(table.name, shard, count // EXPORT_CHUNK_SIZE)
+                    output = gzip.open(os.path.join(output_dir, file_name), 'wb')
+                # ujson escapes non-ASCII characters, so this is ASCII.
+                output.write(ujson.dumps([export_value(value) for value in row]).encode('utf-8') + b'\n')
+                count += 1
+        finally:
+            cursor.close()
+            if output is not None:
+                output.close()
+    log_throughput("Exported", table.name, count, start)
+    return count
+
+def export_shard(realm_id, output_dir, shard, message_id_range):
+    # type: (int, str, int, Tuple[int, int]) -> None
+    for table in EXPORT_TABLES:
+        if table.message_id_column is not None:
+            export_table(realm_id, table, output_dir, shard, message_id_range)
+        elif shard == 0:
+            # The first shard also takes the tables we don't split up.
+            export_table(realm_id, table, output_dir, shard, None)
+
+def export_shard_job(realm_id, output_dir, shard, message_id_range):
+    # type: (int, str, int, Tuple[int, int]) -> int
+    try:
+        export_shard(realm_id, output_dir, shard, message_id_range)
+    except Exception:
+        logging.exception("Error exporting shard %d (messages %d to %d)" %
+                          (shard, message_id_range[0], message_id_range[1]))
+        return 1
+    return 0
+
+def export_realm_metadata(realm):
+    # type: (Realm) -> Dict[str, Any]
+    """What the importer needs to map the ids in the exported rows to
+    objects on the importing server."""
+    users = dict(UserProfile.objects.filter(realm=realm).values_list('id', 'email'))
+    streams = dict((stream.id, dict(name=stream.name, invite_only=bool(stream.invite_only),
+                                    description=stream.description))
+                   for stream in Stream.objects.filter(realm=realm))
+    huddle_ids = set(Subscription.objects.filter(user_profile__realm=realm,
+                                                 recipient__type=Recipient.HUDDLE)
+                     .values_list('recipient__type_id', flat=True))
+    # Huddles can include users from other realms, so we list all of
+    # their members by email.
+    huddles = {} # type: Dict[int, List[text_type]]
+    for (huddle_id, email) in Subscription.objects.filter(
+            recipient__type=Recipient.HUDDLE,
+            recipient__type_id__in=huddle_ids).values_list('recipient__type_id', 'user_profile__email'):
+        huddles.setdefault(huddle_id, []).append(email)
+    recipients = dict((recipient_id, (recipient_type, type_id)) for (recipient_id, recipient_type, type_id) in
+                      Recipient.objects.filter(Q(type=Recipient.PERSONAL, type_id__in=list(users.keys())) |
+                                               Q(type=Recipient.STREAM, type_id__in=list(streams.keys())) |
+                                               Q(type=Recipient.HUDDLE, type_id__in=list(huddles.keys())))
+                      .values_list('id', 'type', 'type_id'))
+    return dict(realm_id=realm.id,
+                users=users,
+                streams=streams,
+                huddles=huddles,
+                recipients=recipients,
+                clients=dict(Client.objects.values_list('id', 'name')))
+
+def message_id_shards(num_shards, min_id=None, max_id=None):
+    # type: (int, Optional[int], Optional[int]) -> List[Tuple[int, int]]
+    bounds = Message.objects.aggregate(Min('id'), Max('id'))
+    if bounds['id__min'] is None:
+        return []
+    min_id = max(min_id or 0, bounds['id__min'])
+    max_id = min(max_id or bounds['id__max'], bounds['id__max'])
+    if min_id > max_id:
+        return []
+    width = (max_id - min_id) // num_shards + 1
+    return [(low, min(low + width - 1, max_id)) for low in range(min_id, max_id + 1, width)]
+
+def export_realm_messages(realm, output_dir, processes=1, min_id=None, max_id=None):
+    # type: (Realm, str, int, Optional[int], Optional[int]) -> None
+    """Exports the realm's messages with ids from min_id to max_id (by
+    default, all of them), with the usermessages and attachments that go
+    with them, and its subscriptions, to output_dir."""
+    if os.path.exists(output_dir) and os.listdir(output_dir):
+        raise RealmMigrationError("%s is not empty" % (output_dir,))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    start = time.time()
+    manifest = export_realm_metadata(realm)
+    shards = message_id_shards(max(processes, 1) * EXPORT_SHARDS_PER_PROCESS, min_id, max_id)
+    if not shards:
+        # Still export the tables that aren't split by message id.
+        shards = [(0, -1)]
+
+    if processes <= 1:
+        for (shard, message_id_range) in enumerate(shards):
+            export_shard(realm.id, output_dir, shard, message_id_range)
+    else:
+        # Each shard is exported by a forked process, which must not
+        # share our database connection.
+        connection.close()
+        succeeded = set() # type: Set[int]
+        for (status, shard) in run_parallel(lambda shard: export_shard_job(realm.id, output_dir, shard,
+                                                                           shards[shard]),
+                                            range(len(shards)), threads=processes):
+            if status == 0:
+                succeeded.add(shard)
+        if len(succeeded) < len(shards):
+            raise RealmMigrationError("Failed to export message ids %s" %
+                                      (", ".join("%d-%d" % shards[shard] for shard in range(len(shards))
+                                                 if shard not in succeeded),))
+
+    manifest['version'] = EXPORT_FORMAT_VERSION
+    manifest['domain'] = realm.domain
+    manifest['tables'] = [dict(name=table.name,
+                               columns=table.columns(),
+                               files=sorted(os.path.basename(path) for path in
+                                            glob.glob(os.path.join(output_dir, '%s-*.json.gz' % (table.name,)))))
+                          for table in EXPORT_TABLES]
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        f.write(ujson.dumps(manifest))
+    logging.info("Exported %s to %s in %.2fs" % (realm.domain, output_dir, time.time() - start))
+
+class IdMap(object):
+    """Maps exported ids to the ids of the imported rows.  Rows are
+    imported in increasing order of their exported ids, so we can keep
+    the ids in two sorted arrays rather than a much larger dict."""
+
+    def __init__(self):
+        # type: () -> None
+        self.old_ids = array.array('l') # type: Any
+        self.new_ids = array.array('l') # type: Any
+
+    def add(self, old_ids, new_ids):
+        # type: (List[int], List[int]) -> None
+        if self.old_ids and old_ids and old_ids[0] <= self.old_ids[-1]:
+            raise RealmMigrationError("Exported ids out of order")
+        self.old_ids.extend(old_ids)
+        self.new_ids.extend(new_ids)
+
+    def get(self, old_id):
+        # type: (int) -> Optional[int]
+        i = bisect.bisect_left(self.old_ids, old_id)
+        if i < len(self.old_ids) and self.old_ids[i] == old_id:
+            return self.new_ids[i]
+        return None
+
+def import_user_map(realm, manifest):
+    # type: (Realm, Dict[str, Any]) -> Dict[int, int]
+    ids_by_email = dict((email.lower(), user_id) for (user_id, email) in
+                        UserProfile.objects.filter(realm=realm).values_list('id', 'email'))
+    missing = [email for email in manifest['users'].values() if email.lower() not in ids_by_email]
+    if missing:
+        raise RealmMigrationError("Users missing from %s: %s" % (realm.domain, ", ".join(sorted(missing))))
+    return dict((int(user_id), ids_by_email[email.lower()])
+                for (user_id, email) in manifest['users'].items())
+
+def import_recipient_map(realm, manifest, user_map):
+    # type: (Realm, Dict[str, Any], Dict[int, int]) -> Dict[int, int]
+    stream_map = {} # type: Dict[int, int]
+    for (stream_id, stream_data) in manifest['streams'].items():
+        (stream, created) = create_stream_if_needed(realm, stream_data['name'],
+                                                    invite_only=stream_data['invite_only'])
+        if created:
+            stream.description = stream_data['description']
+            stream.save(update_fields=['description'])
+        stream_map[int(stream_id)] = stream.id
+
+    huddle_map = {} # type: Dict[int, int]
+    for (huddle_id, emails) in manifest['huddles'].items():
+        member_ids = list(UserProfile.objects.filter(email__in=emails).values_list('id', flat=True))
+        if len(member_ids) < len(emails):
+            logging.warning("Skipping huddle %s, whose members aren't all on this server" % (huddle_id,))
+            continue
+        huddle_map[int(huddle_id)] = get_huddle(member_ids).id
+
+    type_maps = {Recipient.PERSONAL: user_map,
+                 Recipient.STREAM: stream_map,
+                 Recipient.HUDDLE: huddle_map}
+    new_recipient_ids = {} # type: Dict[Tuple[int, int], int]
+    for (recipient_type, type_map) in type_maps.items():
+        for (recipient_id, type_id) in Recipient.objects.filter(
+                type=recipient_type, type_id__in=list(type_map.values())).values_list('id', 'type_id'):
+            new_recipient_ids[(recipient_type, type_id)] = recipient_id
+
+    recipient_map = {} # type: Dict[int, int]
+    for (recipient_id, (recipient_type, type_id)) in manifest['recipients'].items():
+        new_type_id = type_maps[recipient_type].get(type_id)
+        if new_type_id is not None and (recipient_type, new_type_id) in new_recipient_ids:
+            recipient_map[int(recipient_id)] = new_recipient_ids[(recipient_type, new_type_id)]
+    return recipient_map
+
+def read_export_file(path):
+    # type: (str) -> List[List[Any]]
+    with closing(gzip.GzipFile(path, 'rb')) as f:
+        return [ujson.loads(line) for line in f.read().splitlines()]
+
+def copy_value(value):
+    # type: (Any) -> text_type
+    """Formats value for COPY's text format."""
+    if value is None:
+        return u'\\N'
+    if value is True:
+        return u't'
+    if value is False:
+        return u'f'
+    return (text_type(value).replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+            .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+def allocate_ids(db_table, count):
+    # type: (str, int) -> List[int]
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                   [db_table, count])
+    return sorted(row[0] for row in cursor.fetchall())
+
+def import_rows(table, columns, rows, id_maps):
+    # type: (ExportTable, List[str], List[List[Any]], Dict[str, Any]) -> int
+    """Remaps and bulk loads one chunk of rows; returns how many were
+    skipped because they reference objects that weren't imported."""
+    id_column = columns.index('id')
+    remapped = [(columns.index(column), id_maps[map_name])
+                for (column, map_name) in table.remap_columns.items()]
+    kept = [] # type: List[List[Any]]
+    for row in rows:
+        for (i, id_map) in remapped:
+            if row[i] is not None:
+                row[i] = id_map.get(row[i])
+                if row[i] is None:
+                    break
+        else:
+            kept.append(row)
+
+    if table.name == 'subscription':
+        # Some subscriptions, e.g. to huddles created during the
+        # import, already exist.
+        (user_column, recipient_column) = (columns.index('user_profile_id'), columns.index('recipient_id'))
+        existing = set(Subscription.objects.filter(
+            user_profile_id__in=set(row[user_column] for row in kept)).values_list('user_profile_id',
+                                                                                   'recipient_id'))
+        kept = [row for row in kept if (row[user_column], row[recipient_column]) not in existing]
+
+    if table.allocate_ids:
+        old_ids = [row[id_column] for row in kept]
+        new_ids = allocate_ids(table.db_table(), len(kept))
+        id_maps[table.name].add(old_ids, new_ids)
+        for (row, new_id) in zip(kept, new_ids):
+            row[id_column] = new_id
+        copy_columns = columns
+    else:
+        # Let the column default pick the id.
+        kept = [row[:id_column] + row[id_column + 1:] for row in kept]
+        copy_columns = columns[:id_column] + columns[id_column + 1:]
+
+    data = io.BytesIO()
+    for row in kept:
+        data.write(u'\t'.join(copy_value(value) for value in row).encode('utf-8') + b'\n')
+    data.seek(0)
+    connection.cursor().copy_from(data, table.db_table(), columns=copy_columns)
+    return len(rows) - len(kept)
+
+def import_realm_messages(realm, input_dir):
+    # type: (Realm, str) -> None
+    """Imports an export made by export_realm_messages into realm, in
+    a single transaction, and then refills the message cache."""
+    start = time.time()
+    with open(os.path.join(input_dir, 'manifest.json')) as f:
+        manifest = ujson.load(f)
+    if manifest['version'] != EXPORT_FORMAT_VERSION:
+        raise RealmMigrationError("Unsupported export format version %s" % (manifest['version'],))
+    tables = dict((table.name, table) for table in EXPORT_TABLES)
+
+    with transaction.atomic():
+        user_map = import_user_map(realm, manifest)
+        id_maps = {
+            'user': user_map,
+            'recipient': import_recipient_map(realm, manifest, user_map),
+            'client': dict((int(client_id), get_client(name).id)
+                           for (client_id, name) in manifest['clients'].items()),
+            'realm': {manifest['realm_id']: realm.id},
+            'message': IdMap(),
+            'attachment': IdMap(),
+        } # type: Dict[str, Any]
+
+        for table_data in manifest['tables']:
+            table = tables[table_data['name']]
+            table_start = time.time()
+            count = 0
+            skipped = 0
+            for file_name in table_data['files']:
+                rows = read_export_file(os.path.join(input_dir, file_name))
+                skipped += import_rows(table, table_data['columns'], rows, id_maps)
+                count += len(rows)
+            log_throughput("Imported", table.name, count - skipped, table_start)
+            if skipped:
+                logging.warning("Skipped %d %s rows referencing objects that weren't imported" %
+                                (skipped, table.name))
+
+    # The imported messages have the newest ids, so this caches them.
+    fill_remote_cache('message')
+    logging.info("Imported %s into %s in %.2fs" % (input_dir, realm.domain, time.time() - start))
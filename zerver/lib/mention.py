@@ -1,5 +1,12 @@
 from __future__ import absolute_import
 
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from zerver.lib.cache import active_user_dict_fields, get_realm_user_changes, \
+    get_realm_user_changes_counter
+from zerver.models import Realm, UserProfile, get_active_user_dicts_in_realm
+
+import bisect
 from six import text_type
 # Match multi-word string between @** ** or match any one-word
 # sequences after @
@@ -10,3 +17,110 @@ wildcards = ['all', 'everyone']
 def user_mention_matches_wildcard(mention):
     # type: (text_type) -> bool
     return mention in wildcards
+
+class MentionIndex(object):
+    """A realm's active users, by lowercased full name and short name,
+    for resolving mentions, with a sorted list of the names for finding
+    the users whose names start with a prefix (as typeahead does).
+
+    Building one is linear in the realm's size, so we keep one per
+    realm in each process and apply changes to it as users are
+    created, renamed or deactivated; see get_mention_index."""
+
+    def __init__(self, user_dicts, counter=None):
+        # type: (Iterable[Dict[str, Any]], Optional[int]) -> None
+        # The realm's user changes counter value this index is current with.
+        self.counter = counter
+        self.users = {} # type: Dict[int, Dict[str, Any]]
+        self.full_names = {} # type: Dict[text_type, Dict[int, Dict[str, Any]]]
+        self.short_names = {} # type: Dict[text_type, Dict[int, Dict[str, Any]]]
+        self.sorted_names = [] # type: List[Tuple[text_type, int]]
+        for user in user_dicts:
+            self.sorted_names.extend(self.index_user(user))
+        self.sorted_names.sort()
+
+    @staticmethod
+    def user_names(user):
+        # type: (Dict[str, Any]) -> Set[text_type]
+        return set([user['full_name'].lower(), user['short_name'].lower()])
+
+    def index_user(self, user):
+        # type: (Dict[str, Any]) -> List[Tuple[text_type, int]]
+        """Adds user to the name dicts, and returns its entries for
+        sorted_names."""
+        self.users[user['id']] = user
+        self.full_names.setdefault(user['full_name'].lower(), {})[user['id']] = user
+        self.short_names.setdefault(user['short_name'].lower(), {})[user['id']] = user
+        return [(name, user['id']) for name in self.user_names(user)]
+
+    def add_user(self, user):
+        # type: (Dict[str, Any]) -> None
+        self.remove_user(user['id'])
+        for entry in self.index_user(user):
+            bisect.insort(self.sorted_names, entry)
+
+    def remove_user(self, user_id):
+        # type: (int) -> None
+        user = self.users.pop(user_id, None)
+        if user is None:
+            return
+        for (names, name) in [(self.full_names, user['full_name'].lower()),
+                              (self.short_names, user['short_name'].lower())]:
+            del names[name][user_id]
+            if not names[name]:
+                del names[name]
+        for name in self.user_names(user):
+            del self.sorted_names[bisect.bisect_left(self.sorted_names, (name, user_id))]
+
+    def find_user(self, name):
+        # type: (text_type) -> Optional[Dict[str, Any]]
+        """The user a mention of name refers to.  Full names take
+        precedence over short names; if several users share the name,
+        the oldest account wins."""
+        name = name.lower()
+        for names in [self.full_names, self.short_names]:
+            users = names.get(name)
+            if users:
+                return users[min(users)]
+        return None
+
+    def find_users_by_prefix(self, prefix, limit=None):
+        # type: (text_type, Optional[int]) -> List[Dict[str, Any]]
+        """The users with a full or short name starting with prefix, in
+        order of the matching name."""
+        prefix = prefix.lower()
+        user_ids = [] # type: List[int]
+        i = bisect.bisect_left(self.sorted_names, (prefix,))
+        while i < len(self.sorted_names) and self.sorted_names[i][0].startswith(prefix):
+            if limit is not None and len(user_ids) >= limit:
+                break
+            user_id = self.sorted_names[i][1]
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+            i += 1
+        return [self.users[matched_id] for matched_id in user_ids]
+
+realm_mention_indexes = {} # type: Dict[int, MentionIndex]
+
+def get_mention_index(realm):
+    # type: (Realm) -> MentionIndex
+    counter = get_realm_user_changes_counter(realm.id)
+    index = realm_mention_indexes.get(realm.id)
+    if index is not None and index.counter != counter:
+        changed_user_ids = get_realm_user_changes(realm.id, index.counter, counter)
+        if changed_user_ids is None:
+            index = None
+        else:
+            users = UserProfile.objects.filter(id__in=changed_user_ids, realm=realm,
+                                               is_active=True).values(*active_user_dict_fields)
+            for user_id in changed_user_ids:
+                index.remove_user(user_id)
+            for user in users:
+                index.add_user(user)
+            index.counter = counter
+    if index is None:
+        # Read the counter before the users, so that changes made while
+        # we build the index are applied again rather than missed.
+        index = MentionIndex(get_active_user_dicts_in_realm(realm), counter)
+        realm_mention_indexes[realm.id] = index
+    return index
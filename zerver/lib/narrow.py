@@ -1,7 +1,7 @@
 from zerver.lib.request import JsonableError
 from django.utils.translation import ugettext as _
 
-from typing import Any, Callable, Iterable, Mapping, Sequence
+from typing import Any, Callable, Iterable, List, Mapping, Optional, Sequence
 from six import text_type
 
 
@@ -12,38 +12,72 @@ def check_supported_events_narrow_filter(narrow):
         if operator not in ["stream", "topic", "sender", "is"]:
             raise JsonableError(_("Operator %s not supported.") % (operator,))
 
+def get_narrow_stream(narrow):
+    # type: (Iterable[Sequence[text_type]]) -> Optional[text_type]
+    """Returns the (lowercased) stream a narrow is restricted to, if
+    any.  Used to index narrowed event queues by stream, so that a
+    stream message is only checked against queues that could match it."""
+    for element in narrow:
+        if element[0] == "stream":
+            return element[1].lower()
+    return None
+
+def narrow_excludes_stream_messages(narrow):
+    # type: (Iterable[Sequence[text_type]]) -> bool
+    return any(element[0] == "is" and element[1] == "private" for element in narrow)
+
 def build_narrow_filter(narrow):
     # type: (Iterable[Sequence[text_type]]) -> Callable[[Mapping[str, Any]], bool]
     check_supported_events_narrow_filter(narrow)
+
+    # The narrow is compiled once, when the event queue is registered,
+    # into one predicate per term with its operand already lowercased.
+    predicates = [] # type: List[Callable[[Mapping[str, Any], Sequence[str]], bool]]
+    for element in narrow:
+        operator = element[0]
+        operand = element[1]
+        if operator == "stream":
+            def stream_predicate(message, flags, stream=operand.lower()):
+                # type: (Mapping[str, Any], Sequence[str], text_type) -> bool
+                return (message["type"] == "stream" and
+                        message["display_recipient"].lower() == stream)
+            predicates.append(stream_predicate)
+        elif operator == "topic":
+            def topic_predicate(message, flags, topic=operand.lower()):
+                # type: (Mapping[str, Any], Sequence[str], text_type) -> bool
+                return (message["type"] == "stream" and
+                        message["subject"].lower() == topic)
+            predicates.append(topic_predicate)
+        elif operator == "sender":
+            def sender_predicate(message, flags, sender=operand.lower()):
+                # type: (Mapping[str, Any], Sequence[str], text_type) -> bool
+                return message["sender_email"].lower() == sender
+            predicates.append(sender_predicate)
+        elif operator == "is" and operand == "private":
+            def private_predicate(message, flags):
+                # type: (Mapping[str, Any], Sequence[str]) -> bool
+                return message["type"] == "private"
+            predicates.append(private_predicate)
+        elif operator == "is" and operand in ["starred"]:
+            def flag_predicate(message, flags, flag=operand):
+                # type: (Mapping[str, Any], Sequence[str], text_type) -> bool
+                return flag in flags
+            predicates.append(flag_predicate)
+        elif operator == "is" and operand in ["alerted", "mentioned"]:
+            def mentioned_predicate(message, flags):
+                # type: (Mapping[str, Any], Sequence[str]) -> bool
+                return "mentioned" in flags
+            predicates.append(mentioned_predicate)
+
+    if not predicates:
+        return lambda event: True
+
     def narrow_filter(event):
         # type: (Mapping[str, Any]) -> bool
         message = event["message"]
         flags = event["flags"]
-        for element in narrow:
-            operator = element[0]
-            operand = element[1]
-            if operator == "stream":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["display_recipient"].lower():
-                    return False
-            elif operator == "topic":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["subject"].lower():
-                    return False
-            elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
-                    return False
-            elif operator == "is" and operand == "private":
-                if message["type"] != "private":
-                    return False
-            elif operator == "is" and operand in ["starred"]:
-                if operand not in flags:
-                    return False
-            elif operator == "is" and operand in ["alerted", "mentioned"]:
-                if "mentioned" not in flags:
-                    return False
-
+        for predicate in predicates:
+            if not predicate(message, flags):
+                return False
         return True
     return narrow_filter
@@ -1,7 +1,7 @@
 from __future__ import print_function
 
 from six import text_type
-from typing import cast, Any, Iterable, Mapping, Optional, Sequence, Tuple
+from typing import cast, Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 import mandrill
 from confirmation.models import Confirmation
@@ -9,6 +9,8 @@ from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.template import loader
 from zerver.decorator import statsd_increment, uses_mandrill
+from zerver.lib.cache import generic_bulk_cached_fetch, user_profile_by_id_cache_key
+from zerver.lib.utils import statsd
 from zerver.models import (
     Recipient,
     ScheduledJob,
@@ -24,11 +26,14 @@ from zerver.models import (
 )
 
 import datetime
+import logging
 import re
 import subprocess
+import time
 import ujson
 from six.moves import urllib
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 def unsubscribe_token(user_profile):
     # type: (UserProfile) -> text_type
@@ -72,12 +77,15 @@ def topic_narrow_url(stream, topic):
     return u"%s%s/topic/%s" % (base_url, hashchange_encode(stream),
                               hashchange_encode(topic))
 
-def build_message_list(user_profile, messages):
-    # type: (UserProfile, List[Message]) -> List[Dict[str, Any]]
+def build_message_list(user_profile, messages, message_payloads=None):
+    # type: (UserProfile, List[Message], Optional[Dict[int, Dict[str, text_type]]]) -> List[Dict[str, Any]]
     """
     Builds the message list object for the missed message email template.
     The messages are collapsed into per-recipient and per-sender blocks, like
     our web interface
+
+    `message_payloads`, if given, caches the formatted content of messages
+    by id, for sharing between the lists of everyone they're sent to.
     """
     messages_to_render = [] # type: List[Dict[str, Any]]
 
@@ -127,6 +135,8 @@ def build_message_list(user_profile, messages):
 
     def build_message_payload(message):
         # type: (Message) -> Dict[str, text_type]
+        if message_payloads is not None and message.id in message_payloads:
+            return message_payloads[message.id]
         plain = message.content
         plain = fix_plaintext_image_urls(plain)
         plain = relative_to_full_url(plain)
@@ -135,7 +145,10 @@ def build_message_list(user_profile, messages):
         html = relative_to_full_url(html)
         html = fix_emoji_sizes(html)
 
-        return {'plain': plain, 'html': html}
+        payload = {'plain': plain, 'html': html}
+        if message_payloads is not None:
+            message_payloads[message.id] = payload
+        return payload
 
     def build_sender_payload(message):
         # type: (Message) -> Dict[str, Any]
@@ -219,25 +232,13 @@ def build_message_list(user_profile, messages):
 
     return messages_to_render
 
-@statsd_increment("missed_message_reminders")
-def do_send_missedmessage_events_reply_in_zulip(user_profile, missed_messages, message_count):
-    # type: (UserProfile, List[Message], int) -> None
+def prepare_missedmessage_email(user_profile, missed_messages, message_count, message_payloads=None):
+    # type: (UserProfile, List[Message], int, Optional[Dict[int, Dict[str, text_type]]]) -> Dict[str, Any]
     """
-    Send a reminder email to a user if she's missed some PMs by being offline.
-
-    The email will have its reply to address set to a limited used email
-    address that will send a zulip message to the correct recipient. This
-    allows the user to respond to missed PMs, huddles, and @-mentions directly
-    from the email.
-
-    `user_profile` is the user to send the reminder to
-    `missed_messages` is a list of Message objects to remind about they should
-                      all have the same recipient and subject
+    Gathers what's needed to render a missed message reminder email (see
+    do_send_missedmessage_events_reply_in_zulip) with render_missedmessage_email,
+    which, unlike this, doesn't touch the database.
     """
-    # Disabled missedmessage emails internally
-    if not user_profile.enable_offline_email_notifications:
-        return
-
     recipients = set((msg.recipient_id, msg.subject) for msg in missed_messages)
     if len(recipients) != 1:
         raise ValueError(
@@ -247,7 +248,7 @@ def do_send_missedmessage_events_reply_in_zulip(user_profile, missed_messages, m
 
     template_payload = {
         'name': user_profile.full_name,
-        'messages': build_message_list(user_profile, missed_messages),
+        'messages': build_message_list(user_profile, missed_messages, message_payloads),
         'message_count': message_count,
         'url': 'https://%s' % (settings.EXTERNAL_HOST,),
         'reply_warning': False,
@@ -273,53 +274,140 @@ def do_send_missedmessage_events_reply_in_zulip(user_profile, missed_messages, m
         from_email = "%s <%s>" % (sender_str, sender.email)
         headers['Sender'] = "Zulip <%s>" % (settings.NOREPLY_EMAIL_ADDRESS,)
 
-    text_content = loader.render_to_string('zerver/missed_message_email.txt', template_payload)
-    html_content = loader.render_to_string('zerver/missed_message_email_html.txt', template_payload)
+    return {'template_payload': template_payload,
+            'subject': subject,
+            'from_email': from_email,
+            'to': user_profile.email,
+            'headers': headers}
+
+def render_missedmessage_email(email):
+    # type: (Dict[str, Any]) -> EmailMultiAlternatives
+    text_content = loader.render_to_string('zerver/missed_message_email.txt', email['template_payload'])
+    html_content = loader.render_to_string('zerver/missed_message_email_html.txt', email['template_payload'])
 
-    msg = EmailMultiAlternatives(subject, text_content, from_email, [user_profile.email],
-                                 headers = headers)
+    msg = EmailMultiAlternatives(email['subject'], text_content, email['from_email'], [email['to']],
+                                 headers = email['headers'])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    return msg
+
+@statsd_increment("missed_message_reminders")
+def do_send_missedmessage_events_reply_in_zulip(user_profile, missed_messages, message_count):
+    # type: (UserProfile, List[Message], int) -> None
+    """
+    Send a reminder email to a user if she's missed some PMs by being offline.
+
+    The email will have its reply to address set to a limited used email
+    address that will send a zulip message to the correct recipient. This
+    allows the user to respond to missed PMs, huddles, and @-mentions directly
+    from the email.
+
+    `user_profile` is the user to send the reminder to
+    `missed_messages` is a list of Message objects to remind about they should
+                      all have the same recipient and subject
+    """
+    # Disabled missedmessage emails internally
+    if not user_profile.enable_offline_email_notifications:
+        return
+
+    email = prepare_missedmessage_email(user_profile, missed_messages, message_count)
+    render_missedmessage_email(email).send()
 
     user_profile.last_reminder = datetime.datetime.now()
     user_profile.save(update_fields=['last_reminder'])
 
+# How many missed message emails are rendered and sent at once.
+MISSEDMESSAGE_EMAIL_THREADS = 4
+missedmessage_email_pool = None # type: Optional[ThreadPool]
+
+def send_missedmessage_email(email):
+    # type: (Dict[str, Any]) -> bool
+    # Runs in missedmessage_email_pool, so mustn't touch the database.
+    try:
+        start = time.time()
+        msg = render_missedmessage_email(email)
+        statsd.timing("missed_message_emails.render_time", 1000 * (time.time() - start))
+        msg.send()
+        return True
+    except Exception:
+        logging.exception("Problem sending missed message email to %s" % (email['to'],))
+        return False
+
 def handle_missedmessage_emails(user_profile_id, missed_email_events):
     # type: (int, Iterable[Dict[str, Any]]) -> None
-    message_ids = [event.get('message_id') for event in missed_email_events]
+    handle_missedmessage_emails_for_users({user_profile_id: list(missed_email_events)})
 
-    user_profile = get_user_profile_by_id(user_profile_id)
-    if not receives_offline_notifications(user_profile):
-        return
-
-    messages = [um.message for um in UserMessage.objects.filter(user_profile=user_profile,
-                                                                message__id__in=message_ids,
-                                                                flags=~UserMessage.flags.read)]
-    if not messages:
+def handle_missedmessage_emails_for_users(missed_email_events_by_user):
+    # type: (Dict[int, List[Dict[str, Any]]]) -> None
+    """
+    Sends the missed message emails for a batch of users' missedmessage_emails
+    events: an email per recipient and subject, with the context of stream
+    messages.  Their messages are read in one query, the context of each
+    conversation once, and each message is formatted once for everyone it's
+    sent to; the emails are rendered and sent from missedmessage_email_pool.
+    """
+    user_profiles = generic_bulk_cached_fetch(
+        user_profile_by_id_cache_key,
+        lambda user_ids: UserProfile.objects.select_related().filter(id__in=user_ids),
+        list(missed_email_events_by_user))
+    wanted = set((user_profile_id, event.get('message_id'))
+                 for (user_profile_id, events) in missed_email_events_by_user.items()
+                 if user_profile_id in user_profiles and
+                 receives_offline_notifications(user_profiles[user_profile_id])
+                 for event in events)
+    if not wanted:
         return
 
-    messages_by_recipient_subject = defaultdict(list) # type: Dict[Tuple[int, text_type], List[Message]]
-    for msg in messages:
-        messages_by_recipient_subject[(msg.recipient_id, msg.topic_name())].append(msg)
-
-    message_count_by_recipient_subject = {
-        recipient_subject: len(msgs)
-        for recipient_subject, msgs in messages_by_recipient_subject.items()
-    }
+    messages_by_user = defaultdict(list) # type: Dict[int, List[Message]]
+    for um in UserMessage.objects.select_related('message__recipient', 'message__sender').filter(
+            user_profile_id__in=set(user_profile_id for (user_profile_id, message_id) in wanted),
+            message_id__in=set(message_id for (user_profile_id, message_id) in wanted),
+            flags=~UserMessage.flags.read):
+        if (um.user_profile_id, um.message_id) in wanted:
+            messages_by_user[um.user_profile_id].append(um.message)
+
+    # Everyone mentioned in a stream message gets the same context.
+    context_by_message = {} # type: Dict[int, List[Message]]
+    message_payloads = {} # type: Dict[int, Dict[str, text_type]]
+    emails = [] # type: List[Dict[str, Any]]
+    for (user_profile_id, messages) in messages_by_user.items():
+        user_profile = user_profiles[user_profile_id]
+        if not user_profile.enable_offline_email_notifications:
+            # Disabled missedmessage emails internally
+            continue
 
-    for msg_list in messages_by_recipient_subject.values():
-        msg = min(msg_list, key=lambda msg: msg.pub_date)
-        if msg.recipient.type == Recipient.STREAM:
-            msg_list.extend(get_context_for_message(msg))
-
-    # Send an email per recipient subject pair
-    for recipient_subject, msg_list in messages_by_recipient_subject.items():
-        unique_messages = {m.id: m for m in msg_list}
-        do_send_missedmessage_events_reply_in_zulip(
-            user_profile,
-            list(unique_messages.values()),
-            message_count_by_recipient_subject[recipient_subject],
-        )
+        messages_by_recipient_subject = defaultdict(list) # type: Dict[Tuple[int, text_type], List[Message]]
+        for msg in messages:
+            messages_by_recipient_subject[(msg.recipient_id, msg.topic_name())].append(msg)
+
+        # Send an email per recipient subject pair
+        for recipient_subject, msg_list in messages_by_recipient_subject.items():
+            message_count = len(msg_list)
+            msg = min(msg_list, key=lambda msg: msg.pub_date)
+            if msg.recipient.type == Recipient.STREAM:
+                if msg.id not in context_by_message:
+                    context_by_message[msg.id] = list(get_context_for_message(msg))
+                msg_list = msg_list + context_by_message[msg.id]
+            unique_messages = {m.id: m for m in msg_list}
+            emails.append(prepare_missedmessage_email(
+                user_profile,
+                list(unique_messages.values()),
+                message_count,
+                message_payloads,
+            ))
+
+    if not emails:
+        return
+    global missedmessage_email_pool
+    if missedmessage_email_pool is None:
+        missedmessage_email_pool = ThreadPool(MISSEDMESSAGE_EMAIL_THREADS)
+    sent = missedmessage_email_pool.map(send_missedmessage_email, emails)
+    statsd.incr("missed_message_reminders", len([email for email in sent if email]))
+
+    reminded = set(email['to'] for (email, email_sent) in zip(emails, sent) if email_sent)
+    for user_profile in user_profiles.values():
+        if user_profile.email in reminded:
+            user_profile.last_reminder = datetime.datetime.now()
+            user_profile.save(update_fields=['last_reminder'])
 
 @uses_mandrill
 def clear_followup_emails_queue(email, mail_client=None):
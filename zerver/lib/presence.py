@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+
+from typing import Any, Dict, Optional, Tuple
+
+from six import text_type
+
+from zerver.lib.cache import REALM_PRESENCE_CHANGES_MAX_REPLAYED, get_realm_changes, \
+    get_realm_changes_counter
+from zerver.models import Realm, UserPresence
+
+from collections import OrderedDict
+import time
+
+# Changes are timestamped by the server that logged them, whose clock
+# may be a little behind ours, and a change logged while we were
+# answering the previous request can carry a time before that answer's
+# timestamp; so deltas reach back this much further, and may repeat a
+# few changes the client already has.
+PRESENCE_DELTA_OVERLAP_SECS = 10
+
+class PresenceSnapshot(object):
+    """The presence dicts of a realm's users, by email and client name,
+    as UserPresence.get_status_dict_by_realm returns them, with when
+    each user's changed, for sending clients only what changed since
+    their last request.
+
+    Reading them from the database is linear in the realm's size, so
+    we keep one per realm in each process and apply the presence
+    changes logged by do_update_user_presence to it; see
+    get_presence_snapshot."""
+
+    def __init__(self, presences, counter=None):
+        # type: (Dict[text_type, Dict[text_type, Dict[str, Any]]], Optional[int]) -> None
+        # The realm's presence changes counter value this snapshot is current with.
+        self.counter = counter
+        self.built_at = time.time()
+        # Each user's dict is replaced rather than changed when they
+        # change, so that callers can hold on to them.
+        self.presences = dict(presences)
+        # Emails by when they last changed, oldest first; users who
+        # were removed stay here (but not in presences) so that
+        # clients hear about it.
+        self.changed_at = OrderedDict((email, self.built_at) for email in self.presences) # type: OrderedDict[text_type, float]
+        self.last_changed_at = self.built_at
+
+    def mark_changed(self, email, changed_at):
+        # type: (text_type, float) -> None
+        # Keep the times in order even if the servers' clocks aren't,
+        # erring towards sending a change again.
+        self.last_changed_at = max(self.last_changed_at, changed_at)
+        self.changed_at.pop(email, None)
+        self.changed_at[email] = self.last_changed_at
+
+    def set_user(self, email, presence, changed_at):
+        # type: (text_type, Optional[Dict[text_type, Dict[str, Any]]], float) -> None
+        if presence:
+            self.presences[email] = presence
+        else:
+            self.presences.pop(email, None)
+        self.mark_changed(email, changed_at)
+
+    def update_client(self, email, presence, changed_at):
+        # type: (text_type, Dict[str, Any], float) -> bool
+        """Applies a change to one of the user's clients, if we know
+        enough about the user to; returns whether we did."""
+        old_presence = self.presences.get(email)
+        if not old_presence:
+            return False
+        # Push notifications are a property of the user, and so the
+        # same for all of their clients.
+        presence = dict(presence, pushable=next(iter(old_presence.values()))['pushable'])
+        new_presence = dict(old_presence)
+        new_presence[presence['client']] = presence
+        self.set_user(email, new_presence, changed_at)
+        return True
+
+    def get_changes_since(self, since):
+        # type: (float) -> Optional[Dict[text_type, Dict[text_type, Dict[str, Any]]]]
+        """The presence dicts of the users who changed since the
+        timestamp since (with an empty dict for users who were removed),
+        or None if we can't tell."""
+        if since < self.built_at:
+            return None
+        changes = {} # type: Dict[text_type, Dict[text_type, Dict[str, Any]]]
+        for email in reversed(self.changed_at): # type: ignore # typeshed's OrderedDict lacks __reversed__
+            if self.changed_at[email] <= since - PRESENCE_DELTA_OVERLAP_SECS:
+                break
+            changes[email] = self.presences.get(email, {})
+        return changes
+
+realm_presence_snapshots = {} # type: Dict[int, PresenceSnapshot]
+
+def get_presence_snapshot(realm):
+    # type: (Realm) -> PresenceSnapshot
+    counter = get_realm_changes_counter('presence', realm.id)
+    snapshot = realm_presence_snapshots.get(realm.id)
+    if snapshot is not None and snapshot.counter != counter:
+        changes = get_realm_changes('presence', realm.id, snapshot.counter, counter,
+                                    REALM_PRESENCE_CHANGES_MAX_REPLAYED)
+        if changes is None:
+            snapshot = None
+        else:
+            reread = {} # type: Dict[int, Tuple[text_type, float]]
+            for (user_id, email, presence, changed_at) in changes:
+                if presence is not None and user_id not in reread and \
+                        snapshot.update_client(email, presence, changed_at):
+                    continue
+                reread[user_id] = (email, changed_at)
+            if reread:
+                presences = UserPresence.get_status_dict_by_realm(realm.id, user_ids=reread.keys())
+                for (email, changed_at) in reread.values():
+                    snapshot.set_user(email, presences.get(email), changed_at)
+            snapshot.counter = counter
+    if snapshot is None:
+        # Read the counter before the presences, so that changes made
+        # while we read them are applied again rather than missed.
+        snapshot = PresenceSnapshot(UserPresence.get_status_dict_by_realm(realm.id), counter)
+        realm_presence_snapshots[realm.id] = snapshot
+    return snapshot
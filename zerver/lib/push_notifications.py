@@ -1,22 +1,25 @@
 from __future__ import absolute_import
 
 from six import text_type
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from zerver.models import PushDeviceToken, UserProfile
+from zerver.lib.queue import queue_json_publish_delayed
 from zerver.lib.timestamp import timestamp_to_datetime
-from zerver.decorator import statsd_increment
-from zerver.lib.utils import generate_random_token
+from zerver.lib.utils import generate_random_token, statsd
 from zerver.lib.redis_utils import get_redis_client
 
 from apns import APNs, Frame, Payload, SENT_BUFFER_QTY
-import gcmclient
 
 from django.conf import settings
 
 import base64, binascii, logging, os, time
-from collections import OrderedDict
+import requests
+import threading
+import ujson
+from collections import defaultdict, OrderedDict
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
 # APNS error codes
 ERROR_CODES = {
@@ -48,22 +51,30 @@ def get_apns_key(token):
 class APNsMessage(object):
     def __init__(self, user, tokens, alert=None, badge=None, sound=None,
             category=None, **kwargs):
-        self.frame = Frame()
+        self.items = [] # type: List[Tuple[text_type, Payload, text_type, float, int]]
         self.tokens = tokens
         expiry = time.time() + 24 * 3600
         priority = 10
         payload = Payload(alert=alert, badge=badge, sound=sound,
                           category=category, custom=kwargs)
+        pipeline = redis_client.pipeline()
         for token in tokens:
             data = {'token': token, 'user': user}
             identifier = generate_random_token(32)
             key = get_apns_key(identifier)
-            redis_client.hmset(key, data)
-            redis_client.expire(key, expiry)
-            self.frame.add_item(token, payload, identifier, expiry, priority)
+            pipeline.hmset(key, data)
+            pipeline.expire(key, expiry)
+            self.items.append((token, payload, identifier, expiry, priority))
+        pipeline.execute()
+
+    def add_to_frame(self, frame):
+        for item in self.items:
+            frame.add_item(*item)
 
     def get_frame(self):
-        return self.frame
+        frame = Frame()
+        self.add_to_frame(frame)
+        return frame
 
 def response_listener(error_response, connection):
     identifier = error_response['identifier']
@@ -88,21 +99,25 @@ def response_listener(error_response, connection):
         except PushDeviceToken.DoesNotExist:
             pass
 
+def make_apns_connection(cert_file, key_file):
+    # type: (str, str) -> APNs
+    apns_connection = APNs(use_sandbox=settings.APNS_SANDBOX,
+                           cert_file=cert_file,
+                           key_file=key_file,
+                           enhanced=True)
+    if settings.APNS_GATEWAY is not None:
+        # E.g. a fake APNs to test against.
+        (apns_connection.gateway_server.server,
+         apns_connection.gateway_server.port) = settings.APNS_GATEWAY
+    apns_connection.gateway_server.register_response_listener(
+        partial(response_listener, connection=apns_connection))
+    return apns_connection
+
 if settings.APNS_CERT_FILE is not None and os.path.exists(settings.APNS_CERT_FILE):
-    connection = APNs(use_sandbox=settings.APNS_SANDBOX,
-                      cert_file=settings.APNS_CERT_FILE,
-                      key_file=settings.APNS_KEY_FILE,
-                      enhanced=True)
-    connection.gateway_server.register_response_listener(
-        partial(response_listener, connection=connection))
+    connection = make_apns_connection(settings.APNS_CERT_FILE, settings.APNS_KEY_FILE)
 
 if settings.DBX_APNS_CERT_FILE is not None and os.path.exists(settings.DBX_APNS_CERT_FILE):
-    dbx_connection = APNs(use_sandbox=settings.APNS_SANDBOX,
-                          cert_file=settings.DBX_APNS_CERT_FILE,
-                          key_file=settings.DBX_APNS_KEY_FILE,
-                          enhanced=True)
-    dbx_connection.gateway_server.register_response_listener(
-        partial(response_listener, connection=dbx_connection))
+    dbx_connection = make_apns_connection(settings.DBX_APNS_CERT_FILE, settings.DBX_APNS_KEY_FILE)
 
 def num_push_devices_for_user(user_profile, kind = None):
     # type: (UserProfile, Optional[int]) -> PushDeviceToken
@@ -120,42 +135,15 @@ def hex_to_b64(data):
     # type: (text_type) -> bytes
     return base64.b64encode(binascii.unhexlify(data.encode('utf-8')))
 
-def _do_push_to_apns_service(user, message, apns_connection):
-    # type: (UserProfile, APNsMessage, APNs) -> None
-    if not apns_connection:
-        logging.info("Not delivering APNS message %s to user %s due to missing connection" % (message, user))
-        return
-
-    frame = message.get_frame()
+def send_to_apns(apns_connection, messages):
+    # type: (APNs, List[APNsMessage]) -> None
+    # In one frame, so one write to the connection.  APNs reports
+    # problems with individual tokens asynchronously, to
+    # response_listener; this only fails if we can't reach APNs.
+    frame = Frame()
+    for message in messages:
+        message.add_to_frame(frame)
     apns_connection.gateway_server.send_notification_multiple(frame)
-
-# Send a push notification to the desired clients
-# extra_data is a dict that will be passed to the
-# mobile app
-@statsd_increment("apple_push_notification")
-def send_apple_push_notification(user, alert, **extra_data):
-    # type: (UserProfile, text_type, **Any) -> None
-    if not connection and not dbx_connection:
-        logging.error("Attempting to send push notification, but no connection was found. "
-                      "This may be because we could not find the APNS Certificate file.")
-        return
-
-    devices = PushDeviceToken.objects.filter(user=user, kind=PushDeviceToken.APNS)
-    # Plain b64 token kept for debugging purposes
-    tokens = [(b64_to_hex(device.token), device.ios_app_id, device.token) for device in devices]
-
-    logging.info("APNS: Sending apple push notification to devices: %s" % (tokens,))
-    zulip_message = APNsMessage(user,
-        [token[0] for token in tokens if token[1] in (settings.ZULIP_IOS_APP_ID, None)],
-        alert=alert, **extra_data)
-
-    dbx_message = APNsMessage(user,
-        [token[0] for token in tokens if token[1] in (settings.DBX_IOS_APP_ID,)],
-        alert=alert, **extra_data)
-
-    _do_push_to_apns_service(user, zulip_message, connection)
-    _do_push_to_apns_service(user, dbx_message, dbx_connection)
-
 # NOTE: This is used by the check_apns_tokens manage.py command. Do not call it otherwise, as the
 # feedback() call can take up to 15s
 def check_apns_feedback():
@@ -173,59 +161,200 @@ def check_apns_feedback():
     logging.info("Finished checking feedback for stale tokens")
 
 
-if settings.ANDROID_GCM_API_KEY:
-    gcm = gcmclient.GCM(settings.ANDROID_GCM_API_KEY)
-else:
-    gcm = None
-
-@statsd_increment("android_push_notification")
-def send_android_push_notification(user, data):
-    # type: (UserProfile, Dict[str, Any]) -> None
-    if not gcm:
-        logging.error("Attempting to send a GCM push notification, but no API key was configured")
-        return
-
-    reg_ids = [device.token for device in
-        PushDeviceToken.objects.filter(user=user, kind=PushDeviceToken.GCM)]
-
-    msg = gcmclient.JSONMessage(reg_ids, data)
-    res = gcm.send(msg)
-
-    for reg_id, msg_id in res.success.items():
-        logging.info("GCM: Sent %s as %s" % (reg_id, msg_id))
-
-    # res.canonical will contain results when there are duplicate registrations for the same
-    # device. The "canonical" registration is the latest registration made by the device.
+# GCM's responses get a connection's worth of time to arrive.
+GCM_TIMEOUT = 10
+
+# requests sessions keep their connection to GCM open between
+# requests, but aren't safe to share between threads, so each thread
+# of push_notification_pool has its own.
+gcm_sessions = threading.local()
+
+def post_to_gcm(registration_ids, data):
+    # type: (List[text_type], Dict[str, Any]) -> requests.Response
+    session = getattr(gcm_sessions, 'session', None)
+    if session is None:
+        session = gcm_sessions.session = requests.Session()
+    return session.post(settings.ANDROID_GCM_URL,
+                        data=ujson.dumps({'registration_ids': registration_ids, 'data': data}),
+                        headers={'Authorization': 'key=%s' % (settings.ANDROID_GCM_API_KEY,),
+                                 'Content-Type': 'application/json'},
+                        timeout=GCM_TIMEOUT)
+
+def handle_gcm_canonical(reg_id, new_reg_id):
+    # type: (text_type, text_type) -> None
+    # GCM sends a canonical registration id when there are duplicate
+    # registrations for the same device.  The "canonical" registration
+    # is the latest registration made by the device.
     # Ref: http://developer.android.com/google/gcm/adv.html#canonical
-    for reg_id, new_reg_id in res.canonical.items():
-        if reg_id == new_reg_id:
-            # I'm not sure if this should happen. In any case, not really actionable.
-            logging.warning("GCM: Got canonical ref but it already matches our ID %s!" % (reg_id,))
-        elif not PushDeviceToken.objects.filter(token=new_reg_id, kind=PushDeviceToken.GCM).count():
-            # This case shouldn't happen; any time we get a canonical ref it should have been
-            # previously registered in our system.
-            #
-            # That said, recovery is easy: just update the current PDT object to use the new ID.
-            logging.warning(
-                    "GCM: Got canonical ref %s replacing %s but new ID not registered! Updating." %
-                    (new_reg_id, reg_id))
-            PushDeviceToken.objects.filter(
-                    token=reg_id, kind=PushDeviceToken.GCM).update(token=new_reg_id)
-        else:
-            # Since we know the new ID is registered in our system we can just drop the old one.
-            logging.info("GCM: Got canonical ref %s, dropping %s" % (new_reg_id, reg_id))
-
+    if reg_id == new_reg_id:
+        # I'm not sure if this should happen. In any case, not really actionable.
+        logging.warning("GCM: Got canonical ref but it already matches our ID %s!" % (reg_id,))
+    elif not PushDeviceToken.objects.filter(token=new_reg_id, kind=PushDeviceToken.GCM).count():
+        # This case shouldn't happen; any time we get a canonical ref it should have been
+        # previously registered in our system.
+        #
+        # That said, recovery is easy: just update the current PDT object to use the new ID.
+        logging.warning(
+                "GCM: Got canonical ref %s replacing %s but new ID not registered! Updating." %
+                (new_reg_id, reg_id))
+        PushDeviceToken.objects.filter(
+                token=reg_id, kind=PushDeviceToken.GCM).update(token=new_reg_id)
+    else:
+        # Since we know the new ID is registered in our system we can just drop the old one.
+        logging.info("GCM: Got canonical ref %s, dropping %s" % (new_reg_id, reg_id))
+
+        PushDeviceToken.objects.filter(token=reg_id, kind=PushDeviceToken.GCM).delete()
+
+def handle_gcm_response(registration_ids, response):
+    # type: (List[text_type], requests.Response) -> Tuple[List[text_type], float]
+    """Updates our devices from GCM's response to a notification sent
+    to registration_ids, and returns the registration ids it's worth
+    retrying, and how many seconds GCM asks us to wait first."""
+    try:
+        retry_after = float(response.headers.get('Retry-After', '0'))
+    except ValueError:
+        # An HTTP date, which is rare enough not to bother with.
+        retry_after = 0
+
+    if response.status_code >= 500:
+        logging.warning("GCM: Server error %s, retrying" % (response.status_code,))
+        return (registration_ids, retry_after)
+    if response.status_code != 200:
+        logging.error("GCM: Request failed with status %s: %s" % (response.status_code, response.text))
+        return ([], 0)
+
+    retry_reg_ids = [] # type: List[text_type]
+    for (reg_id, result) in zip(registration_ids, response.json()['results']):
+        if 'message_id' in result:
+            logging.info("GCM: Sent %s as %s" % (reg_id, result['message_id']))
+            if 'registration_id' in result:
+                handle_gcm_canonical(reg_id, result['registration_id'])
+        elif result.get('error') == 'NotRegistered':
+            logging.info("GCM: Removing %s" % (reg_id,))
             PushDeviceToken.objects.filter(token=reg_id, kind=PushDeviceToken.GCM).delete()
-
-    for reg_id in res.not_registered:
-        logging.info("GCM: Removing %s" % (reg_id,))
-
-        device = PushDeviceToken.objects.get(token=reg_id, kind=PushDeviceToken.GCM)
-        device.delete()
-
-    for reg_id, err_code in res.failed.items():
-        logging.warning("GCM: Delivery to %s failed: %s" % (reg_id, err_code))
-
-    if res.needs_retry():
-        # TODO
-        logging.warning("GCM: delivery needs a retry but ignoring")
+        elif result.get('error') in ('Unavailable', 'InternalServerError'):
+            retry_reg_ids.append(reg_id)
+        else:
+            logging.warning("GCM: Delivery to %s failed: %s" % (reg_id, result.get('error')))
+    return (retry_reg_ids, retry_after)
+
+# How many requests to APNs and GCM are in flight at once.
+PUSH_NOTIFICATION_THREADS = 8
+push_notification_pool = None # type: Optional[ThreadPool]
+
+# A notice whose notification fails in a way worth retrying is
+# requeued, up to this many times: first after this many seconds, and
+# then after twice as long as the time before.  It waits out the delay
+# in a RabbitMQ delay queue; see SimpleQueueClient.publish_delayed.
+PUSH_NOTIFICATION_MAX_RETRIES = 5
+PUSH_NOTIFICATION_RETRY_DELAY = 2
+
+def get_push_devices(notices):
+    # type: (List[Dict[str, Any]]) -> List[List[PushDeviceToken]]
+    """The devices to send each missedmessage_mobile_notifications
+    notice's notification to, with one query: all of its user's, or
+    for a retry, those it failed for."""
+    devices_by_user = defaultdict(list) # type: Dict[int, List[PushDeviceToken]]
+    for device in PushDeviceToken.objects.filter(
+            user_id__in=set(notice['user_profile_id'] for notice in notices)):
+        devices_by_user[device.user_id].append(device)
+    return [[device for device in devices_by_user[notice['user_profile_id']]
+             if 'devices' not in notice or device.token in notice['devices']]
+            for notice in notices]
+
+def retry_push_notification(notice, tokens, retry_after):
+    # type: (Dict[str, Any], List[text_type], float) -> None
+    retries = notice.get('retries', 0)
+    if retries >= PUSH_NOTIFICATION_MAX_RETRIES:
+        logging.warning("Giving up on push notification of message %s to %s after %d retries" %
+                        (notice['message_id'], tokens, retries))
+        return
+    delay = max(PUSH_NOTIFICATION_RETRY_DELAY * 2 ** retries, retry_after)
+    notice = dict(notice, devices=tokens, retries=retries + 1)
+    queue_json_publish_delayed("missedmessage_mobile_notifications", notice, delay, lambda notice: None)
+
+def run_push_job(job):
+    # type: (Tuple[Callable[..., Any], Tuple[Any, ...]]) -> Tuple[bool, Any]
+    # Runs in push_notification_pool; the failure is handled, and
+    # logged, by send_push_notifications.
+    (func, args) = job
+    try:
+        return (True, func(*args))
+    except Exception as e:
+        return (False, e)
+
+def send_push_notifications(notifications):
+    # type: (List[Tuple[Dict[str, Any], List[PushDeviceToken], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) -> None
+    """Sends a batch of push notifications, each a (notice, devices,
+    apns_data, gcm_data) tuple: the keyword arguments for the
+    APNsMessage to the APNs devices among devices, and the data to
+    send to the GCM ones.
+
+    The APNs notifications go out as a frame per connection, and the
+    GCM ones as a request each, all at once from push_notification_pool;
+    the database is only touched from this thread.  Where one fails in a
+    way worth retrying, its notice is requeued for the devices it
+    failed for; see retry_push_notification."""
+    # (kind, function, arguments, the (notice, tokens) it sends)
+    jobs = [] # type: List[Tuple[str, Callable[..., Any], Tuple[Any, ...], List[Tuple[Dict[str, Any], List[text_type]]]]]
+    apns_messages = OrderedDict() # type: Dict[APNs, List[Tuple[Dict[str, Any], List[text_type], APNsMessage]]]
+    for (notice, devices, apns_data, gcm_data) in notifications:
+        apple_devices = [device for device in devices if device.kind == PushDeviceToken.APNS]
+        if apple_devices and apns_data is not None:
+            if not connection and not dbx_connection:
+                logging.error("Attempting to send push notification, but no connection was found. "
+                              "This may be because we could not find the APNS Certificate file.")
+            # Plain b64 tokens kept for debugging purposes
+            logging.info("APNS: Sending apple push notification to devices: %s" %
+                         ([device.token for device in apple_devices],))
+            apns_targets = [(connection, [settings.ZULIP_IOS_APP_ID, None]),
+                            (dbx_connection, [settings.DBX_IOS_APP_ID])] # type: List[Tuple[APNs, List[str]]]
+            for (apns_connection, app_ids) in apns_targets:
+                apns_tokens = [device.token for device in apple_devices
+                               if device.ios_app_id in app_ids] # type: List[text_type]
+                if not apns_tokens or not apns_connection:
+                    continue
+                apns_message = APNsMessage(notice['user_profile_id'],
+                                           [b64_to_hex(token.encode('ascii')) for token in apns_tokens],
+                                           **apns_data)
+                apns_messages.setdefault(apns_connection, []).append((notice, apns_tokens, apns_message))
+
+        android_devices = [device for device in devices if device.kind == PushDeviceToken.GCM]
+        if android_devices and gcm_data is not None:
+            if not settings.ANDROID_GCM_API_KEY:
+                logging.error("Attempting to send a GCM push notification, but no API key was configured")
+            else:
+                reg_ids = [device.token for device in android_devices]
+                jobs.append(('gcm', post_to_gcm, (reg_ids, gcm_data), [(notice, reg_ids)]))
+
+    for (apns_connection, messages) in apns_messages.items():
+        jobs.append(('apns', send_to_apns, (apns_connection, [entry[2] for entry in messages]),
+                     [(entry[0], entry[1]) for entry in messages]))
+        statsd.incr("apple_push_notification", len(messages))
+    if not jobs:
+        return
+    statsd.incr("android_push_notification", len([job for job in jobs if job[0] == 'gcm']))
+
+    global push_notification_pool
+    if push_notification_pool is None:
+        push_notification_pool = ThreadPool(PUSH_NOTIFICATION_THREADS)
+    results = push_notification_pool.map(run_push_job, [(func, args) for (kind, func, args, sent) in jobs])
+
+    # By id(notice): the notice, the tokens to retry, and the wait.
+    retries = OrderedDict() # type: Dict[int, Tuple[Dict[str, Any], List[text_type], float]]
+    for ((kind, func, args, sent), (succeeded, result)) in zip(jobs, results):
+        retry_after = 0.0
+        if not succeeded:
+            logging.warning("%s: Failed to send %d notifications: %r" % (kind.upper(), len(sent), result))
+            failed = sent
+        elif kind == 'gcm':
+            ((notice, reg_ids),) = sent
+            (retry_reg_ids, retry_after) = handle_gcm_response(reg_ids, result)
+            failed = [(notice, retry_reg_ids)] if retry_reg_ids else []
+        else:
+            failed = []
+        for (notice, tokens) in failed:
+            (_, retry_tokens, wait) = retries.get(id(notice), (notice, [], 0.0))
+            retries[id(notice)] = (notice, retry_tokens + tokens, max(wait, retry_after))
+    for (notice, tokens, wait) in retries.values():
+        retry_push_notification(notice, tokens, wait)
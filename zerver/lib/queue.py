@@ -13,10 +13,13 @@ import atexit
 from collections import defaultdict
 
 from zerver.lib.utils import statsd
-from typing import Any, Callable, Dict, Mapping, Optional, Set, Union
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Set, Tuple, Union
 
 Consumer = Callable[[BlockingChannel, Basic.Deliver, pika.BasicProperties, str], None]
 
+# How long an unused delay queue lives on; see publish_delayed.
+DELAY_QUEUE_EXPIRY_MS = 60 * 60 * 1000
+
 # This simple queuing library doesn't expose much of the power of
 # rabbitmq/pika's queuing system; its purpose is to just provide an
 # interface for external files to put things into queues and take them
@@ -82,15 +85,15 @@ class SimpleQueueClient(object):
         # type: () -> bool
         return self.channel is not None
 
-    def ensure_queue(self, queue_name, callback):
-        # type: (str, Callable[[], None]) -> None
+    def ensure_queue(self, queue_name, callback, arguments=None):
+        # type: (str, Callable[[], None], Optional[Dict[str, Any]]) -> None
         '''Ensure that a given queue has been declared, and then call
            the callback with no arguments.'''
         if not self.connection.is_open:
             self._connect()
 
         if queue_name not in self.queues:
-            self.channel.queue_declare(queue=queue_name, durable=True)
+            self.channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
             self.queues.add(queue_name)
         callback()
 
@@ -108,6 +111,47 @@ class SimpleQueueClient(object):
 
         self.ensure_queue(queue_name, do_publish)
 
+    def publish_delayed(self, queue_name, body, delay):
+        # type: (str, str, float) -> None
+        """Publishes to queue_name after at least delay seconds.  The
+        event waits on a delay queue without consumers, which RabbitMQ
+        dead-letters events to queue_name from when their TTL runs
+        out.  RabbitMQ only expires the events at the head of a queue,
+        so each delay queue holds events of a single delay: delays are
+        rounded up to a power of two seconds."""
+        delay_secs = 1
+        while delay_secs < delay:
+            delay_secs *= 2
+        delay_queue_name = "%s.delay_%ds" % (queue_name, delay_secs)
+        arguments = {'x-dead-letter-exchange': '',
+                     'x-dead-letter-routing-key': queue_name,
+                     'x-message-ttl': delay_secs * 1000,
+                     # Drop the delay queue once it's been unused for a while.
+                     'x-expires': max(delay_secs * 1000 * 2, DELAY_QUEUE_EXPIRY_MS)}
+        def do_publish():
+            # type: () -> None
+            self.channel.basic_publish(
+                            exchange='',
+                            routing_key=delay_queue_name,
+                            properties=pika.BasicProperties(delivery_mode=2),
+                            body=body)
+
+            statsd.incr("rabbitmq.publish_delayed.%s" % (queue_name,))
+
+        # The events have to have somewhere to go.
+        self.ensure_queue(queue_name, lambda: None)
+        self.ensure_queue(delay_queue_name, do_publish, arguments)
+
+    def json_publish_delayed(self, queue_name, body, delay):
+        # type: (str, Mapping[str, Any], float) -> None
+        try:
+            self.publish_delayed(queue_name, ujson.dumps(body), delay)
+        except (AttributeError, pika.exceptions.AMQPConnectionError):
+            self.log.warning("Failed to send to rabbitmq, trying to reconnect and send again")
+            self._reconnect()
+
+            self.publish_delayed(queue_name, ujson.dumps(body), delay)
+
     def json_publish(self, queue_name, body):
         # type: (str, Union[Mapping[str, Any], str]) -> None
         # Union because of zerver.middleware.write_log_line uses a str
@@ -162,6 +206,31 @@ class SimpleQueueClient(object):
         self.ensure_queue(queue_name, opened)
         return messages
 
+    def json_consume(self, queue_name, prefetch_count, inactivity_timeout):
+        # type: (str, int, float) -> Iterator[Optional[Tuple[int, Any]]]
+        """Yields (delivery tag, event) for the events on the queue as
+        they arrive, and None whenever inactivity_timeout seconds pass
+        without one.  RabbitMQ sends us at most prefetch_count events
+        that we haven't acked, and redelivers them if we go away before
+        acking them."""
+        def opened():
+            # type: () -> None
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+        self.ensure_queue(queue_name, opened)
+
+        for delivery in self.channel.consume(queue_name, inactivity_timeout=inactivity_timeout):
+            if delivery is None:
+                yield None
+                continue
+            (method, properties, body) = delivery
+            yield (method.delivery_tag, ujson.loads(body))
+
+    def ack(self, delivery_tag, multiple=False):
+        # type: (int, bool) -> None
+        """Acks an event from json_consume; with multiple, also every
+        earlier one we haven't acked yet."""
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
     def start_consuming(self):
         # type: () -> None
         self.channel.start_consuming()
@@ -243,8 +312,8 @@ class TornadoQueueClient(SimpleQueueClient):
 
         ioloop.IOLoop.instance().add_timeout(time.time() + retry_seconds, on_timeout)
 
-    def ensure_queue(self, queue_name, callback):
-        # type: (str, Callable[[], None]) -> None
+    def ensure_queue(self, queue_name, callback, arguments=None):
+        # type: (str, Callable[[], None], Optional[Dict[str, Any]]) -> None
         def finish(frame):
             # type: (Any) -> None
             self.queues.add(queue_name)
@@ -254,10 +323,11 @@ class TornadoQueueClient(SimpleQueueClient):
             # If we're not connected yet, send this message
             # once we have created the channel
             if not self.ready():
-                self._on_open_cbs.append(lambda: self.ensure_queue(queue_name, callback))
+                self._on_open_cbs.append(lambda: self.ensure_queue(queue_name, callback, arguments))
                 return
 
-            self.channel.queue_declare(queue=queue_name, durable=True, callback=finish)
+            self.channel.queue_declare(queue=queue_name, durable=True, arguments=arguments,
+                                       callback=finish)
         else:
             callback()
 
@@ -310,3 +380,13 @@ def queue_json_publish(queue_name, event, processor):
             get_queue_client().json_publish(queue_name, event)
         else:
             processor(event)
+
+def queue_json_publish_delayed(queue_name, event, delay, processor):
+    # type: (str, Mapping[str, Any], float, Callable[[Any], None]) -> None
+    """Like queue_json_publish, but the event only reaches the queue
+    after at least delay seconds."""
+    with queue_lock:
+        if settings.USING_RABBITMQ:
+            get_queue_client().json_publish_delayed(queue_name, event, delay)
+        else:
+            processor(event)
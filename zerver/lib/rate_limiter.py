@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 from six import text_type
-from typing import Any, Iterator, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
@@ -9,9 +9,8 @@ from six.moves import zip
 
 from zerver.models import UserProfile
 
-import redis
+import threading
 import time
-import logging
 
 # Implement a rate-limiting scheme inspired by the one described here, but heavily modified
 # http://blog.domaintools.com/2013/04/rate-limiting-with-redis/
@@ -166,62 +165,163 @@ def is_ratelimited(user, domain='all'):
     # No api calls recorded yet
     return False, 0.0
 
+# Checks a user's rules and records their API calls, atomically, in
+# one round trip.  KEYS are redis_key's; ARGV is now, the most calls and
+# the window of the longest rule, whether to check the rules (or just
+# record one call), how many calls to record, and then each rule's
+# range_seconds and num_requests, shortest first.  Returns {1,
+# secs_to_freedom} if the user is over a limit, and otherwise {0, the
+# number of calls recorded, calls left in the longest rule}.  Keeps the
+# same list and sorted set incr_ratelimit always did.
+RATELIMIT_SCRIPT = """
+local list_key, set_key, blocking_key = KEYS[1], KEYS[2], KEYS[3]
+local now = tonumber(ARGV[1])
+local max_calls = tonumber(ARGV[2])
+local max_window = tonumber(ARGV[3])
+local wanted = tonumber(ARGV[5])
+
+if ARGV[4] == '1' then
+    if redis.call('EXISTS', blocking_key) == 1 then
+        local ttl = redis.call('TTL', blocking_key)
+        if ttl < 0 then
+            return {1, '0.5'}
+        end
+        return {1, tostring(ttl)}
+    end
+    for i = 6, #ARGV, 2 do
+        local range_seconds = tonumber(ARGV[i])
+        local num_requests = tonumber(ARGV[i + 1])
+        -- Over the limit if the nth newest call is within the range
+        local timestamp = redis.call('LINDEX', list_key, num_requests - 1)
+        if timestamp and tonumber(timestamp) + range_seconds > now then
+            return {1, tostring(tonumber(timestamp) + range_seconds - now)}
+        end
+        if wanted > 1 then
+            -- Don't record more calls than the rule still allows
+            local recent = 0
+            for _, timestamp in ipairs(redis.call('LRANGE', list_key, 0, num_requests - 1)) do
+                if tonumber(timestamp) + range_seconds <= now then
+                    break
+                end
+                recent = recent + 1
+            end
+            wanted = math.min(wanted, num_requests - recent)
+        end
+    end
+end
+
+-- Each call needs its own member in the sorted set, so calls recorded
+-- together get timestamps a microsecond apart, newest last.
+for i = wanted - 1, 0, -1 do
+    local timestamp = string.format('%.6f', now - i / 1000000)
+    local last_val = redis.call('LINDEX', list_key, max_calls - 1)
+    redis.call('LPUSH', list_key, timestamp)
+    redis.call('LTRIM', list_key, 0, max_calls - 1)
+    redis.call('ZADD', set_key, timestamp, timestamp)
+    if last_val then
+        redis.call('ZREM', set_key, last_val)
+    end
+end
+redis.call('EXPIRE', list_key, max_window)
+redis.call('EXPIRE', set_key, max_window)
+
+local boundary = string.format('%.6f', now - max_window)
+return {0, wanted, max_calls - redis.call('ZCOUNT', set_key, boundary, ARGV[1])}
+"""
+ratelimit_script = client.register_script(RATELIMIT_SCRIPT)
+
+def _run_ratelimit_script(user, domain, rules, check, wanted):
+    # type: (UserProfile, text_type, List[Tuple[int, int]], bool, int) -> Tuple[bool, float, int, int]
+    """Returns (rate_limited, time_till_free or time_reset, calls_left,
+    calls_recorded); see RATELIMIT_SCRIPT."""
+    now = time.time()
+    (max_window, max_calls) = rules[-1]
+    args = ['%.6f' % (now,), max_calls, max_window, int(check), wanted] # type: List[Any]
+    for range_seconds, num_requests in rules:
+        args.extend([range_seconds, num_requests])
+    result = ratelimit_script(keys=redis_key(user, domain), args=args)
+    if result[0]:
+        return True, float(result[1]), 0, 0
+    # The newest call is the one we just made.
+    return False, now + max_window, int(result[2]), int(result[1])
+
 def incr_ratelimit(user, domain='all'):
     # type: (UserProfile, text_type) -> None
     """Increases the rate-limit for the specified user"""
-    list_key, set_key, _ = redis_key(user, domain)
-    now = time.time()
+    rules = _rules_for_user(user)
 
     # If we have no rules, we don't store anything
     if len(rules) == 0:
         return
 
-    # Start redis transaction
-    with client.pipeline() as pipe:
-        count = 0
-        while True:
-            try:
-                # To avoid a race condition between getting the element we might trim from our list
-                # and removing it from our associated set, we abort this whole transaction if
-                # another agent manages to change our list out from under us
-                # When watching a value, the pipeline is set to Immediate mode
-                pipe.watch(list_key)
-
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(user) - 1)
-
-                # Restart buffered execution
-                pipe.multi()
-
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
-
-                # Trim our list to the oldest rule we have
-                pipe.ltrim(list_key, 0, max_api_calls(user) - 1)
-
-                # Add our new value to the sorted set that we keep
-                # We need to put the score and val both as timestamp,
-                # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
-
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
-
-                # Set the TTL for our keys as well
-                api_window = max_api_window(user)
-                pipe.expire(list_key, api_window)
-                pipe.expire(set_key, api_window)
-
-                pipe.execute()
-
-                # If no exception was raised in the execution, there were no transaction conflicts
-                break
-            except redis.WatchError:
-                if count > 10:
-                    logging.error("Failed to complete incr_ratelimit transaction without interference 10 times "
-                                  "in a row! Aborting rate-limit increment")
-                    break
-                count += 1
+    _run_ratelimit_script(user, domain, rules, False, 1)
+
+# How long a process may use API calls it reserved for a user.
+TOKEN_LEASE_SECS = 1.0
+
+class TokenLease(object):
+    """API calls this process has recorded in Redis for a user ahead
+    of making them, with what to report for them."""
+    def __init__(self):
+        # type: () -> None
+        self.tokens = 0
+        self.expires = 0.0
+        self.size = 1
+        self.calls_left = 0
+        self.time_reset = 0.0
+
+token_leases = {} # type: Dict[text_type, TokenLease]
+token_leases_lock = threading.Lock()
+
+def _check_and_incr_local_tokens(user, domain, rules):
+    # type: (UserProfile, text_type, List[Tuple[int, int]]) -> Tuple[bool, float, int]
+    list_key = redis_key(user, domain)[0]
+    with token_leases_lock:
+        lease = token_leases.setdefault(list_key, TokenLease())
+        now = time.time()
+        if lease.tokens > 0 and now < lease.expires:
+            lease.tokens -= 1
+            return False, lease.time_reset, lease.calls_left + lease.tokens
+        # Users who used up their last lease in time get twice as many
+        # calls next time; everyone else one at a time, since calls
+        # that go unused before the lease expires are still counted.
+        if now < lease.expires:
+            size = min(2 * lease.size, settings.RATE_LIMITING_LOCAL_TOKENS)
+        else:
+            size = 1
+
+    (ratelimited, time_till_free, calls_left, recorded) = _run_ratelimit_script(
+        user, domain, rules, True, size)
+
+    with token_leases_lock:
+        if ratelimited:
+            lease.tokens = 0
+            lease.expires = 0.0
+            return True, time_till_free, 0
+        lease.tokens = recorded - 1
+        lease.expires = time.time() + TOKEN_LEASE_SECS
+        lease.size = size
+        lease.calls_left = calls_left
+        lease.time_reset = time_till_free
+        return False, time_till_free, calls_left + lease.tokens
+
+def check_and_incr_ratelimit(user, domain='all'):
+    # type: (UserProfile, text_type) -> Tuple[bool, float, int]
+    """Checks the user's rate limits and, unless they are over one,
+    records an API call, in one round trip to Redis.  Returns a tuple
+    of (rate_limited, time_till_free, calls_left); if the user isn't
+    rate limited, the second is when the rate-limit will be reset to 0,
+    as with api_calls_left.
+
+    With settings.RATE_LIMITING_LOCAL_TOKENS, a busy user's calls are
+    recorded several at a time, and the calls after that don't go to
+    Redis until they're used up or TOKEN_LEASE_SECS pass; so a manual
+    block_user may take that long to apply."""
+    rules = _rules_for_user(user)
+
+    if len(rules) == 0:
+        return False, 0.0, 0
 
-                continue
+    if settings.RATE_LIMITING_LOCAL_TOKENS > 1:
+        return _check_and_incr_local_tokens(user, domain, rules)
+    return _run_ratelimit_script(user, domain, rules, True, 1)[:3]
@@ -7,7 +7,7 @@ from typing import Any
 
 from django.core.management.base import BaseCommand
 
-from zerver.lib.actions import create_stream_if_needed, do_add_subscription
+from zerver.lib.actions import bulk_add_subscriptions, create_stream_if_needed
 from zerver.models import UserProfile, get_realm, get_user_profile_by_email
 
 class Command(BaseCommand):
@@ -51,10 +51,9 @@ class Command(BaseCommand):
             for email in emails:
                 user_profiles.append(get_user_profile_by_email(email))
 
-        for stream_name in set(stream_names):
-            for user_profile in user_profiles:
-                stream, _ = create_stream_if_needed(user_profile.realm, stream_name)
-                did_subscribe = do_add_subscription(user_profile, stream)
-                print("%s %s to %s" % (
-                    "Subscribed" if did_subscribe else "Already subscribed",
-                    user_profile.email, stream_name))
+        streams = [create_stream_if_needed(realm, stream_name)[0] for stream_name in stream_names]
+        (subscribed, already_subscribed) = bulk_add_subscriptions(streams, user_profiles)
+        for (user_profile, stream) in subscribed:
+            print("Subscribed %s to %s" % (user_profile.email, stream.name))
+        for (user_profile, stream) in already_subscribed:
+            print("Already subscribed %s to %s" % (user_profile.email, stream.name))
@@ -0,0 +1,34 @@
+from __future__ import absolute_import
+
+from typing import Any
+
+from django.core.management.base import BaseCommand
+
+from zerver.lib import bugdown
+from zerver.lib.bugdown.render_pool import read_message, render_request, write_message
+
+import os
+import sys
+
+class Command(BaseCommand):
+    help = """Render markdown for the bugdown render pool of a server
+process (see zerver/lib/bugdown/render_pool.py), reading requests on
+stdin and writing results to stdout.  Not meant to be run by hand."""
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        # Keep stdout to ourselves, so that nothing printed while
+        # rendering can corrupt the results.
+        output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        input = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+
+        bugdown.in_render_worker = True
+        write_message(output, 'ready')
+        while True:
+            try:
+                request = read_message(input)
+            except EOFError:
+                # The server process exited.
+                return
+            write_message(output, render_request(request))
@@ -3,10 +3,11 @@ import datetime
 import pytz
 import logging
 
-from typing import Any
+from typing import Any, Set
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Max, QuerySet
 
 from zerver.lib.queue import queue_json_publish
 from zerver.models import UserActivity, UserProfile, get_realm, Realm
@@ -26,19 +27,13 @@ logger.addHandler(file_handler)
 
 
 VALID_DIGEST_DAYS = (1, 2, 3, 4)
-def inactive_since(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> bool
-    # Hasn't used the app in the last 24 business-day hours.
-    most_recent_visit = [row.last_visit for row in \
-                             UserActivity.objects.filter(
-            user_profile=user_profile)]
-
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+def active_since(user_profiles, cutoff):
+    # type: (QuerySet, datetime.datetime) -> Set[int]
+    # The ids of those who have used the app since the cutoff, with
+    # one aggregate query; people who never have aren't among them.
+    return set(UserActivity.objects.filter(user_profile__in=user_profiles).values(
+        'user_profile_id').annotate(last_visit=Max('last_visit')).filter(
+        last_visit__gte=cutoff).values_list('user_profile_id', flat=True))
 
 def last_business_day():
     # type: () -> datetime.datetime
@@ -49,7 +44,7 @@ def last_business_day():
     return previous_day
 
 # Changes to this should also be reflected in
-# zerver/worker/queue_processors.py:DigestWorker.consume()
+# zerver/worker/queue_processors.py:DigestWorker.consume_batch()
 def queue_digest_recipient(user_profile, cutoff):
     # type: (UserProfile, datetime.datetime) -> None
     # Convert cutoff to epoch seconds for transit.
@@ -100,6 +95,7 @@ in a while.
             return
 
         deployment_domains = domains_for_this_deployment()
+        cutoff = last_business_day()
         for realm in Realm.objects.filter(deactivated=False, show_digest_email=True):
             domain = realm.domain
             if not should_process_digest(domain, deployment_domains):
@@ -109,9 +105,10 @@ in a while.
                 realm=get_realm(domain), is_active=True, is_bot=False,
                 enable_digest_emails=True)
 
+            # Hasn't used the app in the last 24 business-day hours.
+            active_user_ids = active_since(user_profiles, cutoff)
             for user_profile in user_profiles:
-                cutoff = last_business_day()
-                if inactive_since(user_profile, cutoff):
+                if user_profile.id not in active_user_ids:
                     queue_digest_recipient(user_profile, cutoff)
                     logger.info("%s is inactive, queuing for potential digest" % (
                             user_profile.email,))
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+
+from typing import Any
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand, CommandError
+
+from zerver.lib.export import RealmMigrationError, export_realm_messages
+from zerver.models import get_realm
+
+class Command(BaseCommand):
+    help = """Export a realm's messages, with their usermessages and
+attachment metadata, and the realm's subscriptions, for loading into
+another server with import_realm_messages.  See zerver/lib/export.py
+for the format."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('domain', metavar='<domain>', type=str,
+                            help='domain of realm to export')
+        parser.add_argument('output_dir', metavar='<output directory>', type=str,
+                            help='directory to write the export to; must be empty or not exist')
+        parser.add_argument('--processes', dest='processes', type=int, default=4,
+                            help='number of ranges of message ids to export concurrently')
+        parser.add_argument('--min-id', dest='min_id', type=int, default=None,
+                            help='only export messages with at least this id')
+        parser.add_argument('--max-id', dest='max_id', type=int, default=None,
+                            help='only export messages with at most this id')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = get_realm(options["domain"])
+        if realm is None:
+            raise CommandError("Could not find realm %s" % (options["domain"],))
+        try:
+            export_realm_messages(realm, options["output_dir"], processes=options["processes"],
+                                  min_id=options["min_id"], max_id=options["max_id"])
+        except RealmMigrationError as e:
+            raise CommandError(str(e))
@@ -1,22 +1,52 @@
 from __future__ import absolute_import
 
-from typing import Any
+from typing import Any, Set
 
 from optparse import make_option
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from zerver.lib.cache_helpers import fill_remote_cache, cache_fillers
+from zerver.lib.parallel import run_parallel
+
+import logging
+
+def fill_remote_cache_job(cache, resume):
+    # type: (str, bool) -> int
+    try:
+        fill_remote_cache(cache, resume=resume)
+    except Exception:
+        logging.exception("Error populating %s cache" % (cache,))
+        return 1
+    return 0
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
-        make_option('--cache', dest="cache", default=None),)
+        make_option('--cache', dest="cache", default=None),
+        make_option('--processes', dest="processes", type="int", default=4,
+                    help="Number of caches to populate concurrently."),
+        make_option('--resume', dest="resume", action="store_true", default=False,
+                    help="Continue from where an interrupted run left off."),)
     help = "Populate the memcached cache of messages."
 
     def handle(self, *args, **options):
-        # type: (*Any, **str) -> None
+        # type: (*Any, **Any) -> None
         if options["cache"] is not None:
-            fill_remote_cache(options["cache"])
+            fill_remote_cache(options["cache"], resume=options["resume"])
             return
 
-        for cache in cache_fillers.keys():
-            fill_remote_cache(cache)
-
+        # Each cache is filled in a forked process, which must not share
+        # our database connection.
+        connection.close()
+        succeeded = set() # type: Set[str]
+        # Start with the message cache, which takes by far the longest.
+        caches = sorted(cache_fillers.keys(), key=lambda cache: cache != 'message')
+        for (status, cache) in run_parallel(lambda cache: fill_remote_cache_job(cache, options["resume"]),
+                                            caches, threads=options["processes"]):
+            if status == 0:
+                succeeded.add(cache)
+        # run_parallel stops starting new jobs after a failure, so this
+        # also covers caches that were never attempted.
+        failed = [cache for cache in caches if cache not in succeeded]
+        if failed:
+            raise CommandError("Failed to populate caches: %s (rerun with --resume to continue)"
+                               % (", ".join(failed),))
@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+
+from typing import Any
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand, CommandError
+
+from zerver.lib.export import RealmMigrationError, import_realm_messages
+from zerver.models import get_realm
+
+class Command(BaseCommand):
+    help = """Import an export made by export_realm_messages into a
+realm, whose users must already exist.  The imported messages get new
+ids, after those of the messages already on this server."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('domain', metavar='<domain>', type=str,
+                            help='domain of realm to import into')
+        parser.add_argument('input_dir', metavar='<input directory>', type=str,
+                            help='directory holding the export')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = get_realm(options["domain"])
+        if realm is None:
+            raise CommandError("Could not find realm %s" % (options["domain"],))
+        try:
+            import_realm_messages(realm, options["input_dir"])
+        except RealmMigrationError as e:
+            raise CommandError(str(e))
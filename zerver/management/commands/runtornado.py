@@ -23,9 +23,10 @@ import logging
 from tornado import ioloop
 from zerver.lib.debug import interactive_debug_listen
 from zerver.lib.response import json_response
-from zerver.lib.event_queue import process_notification, missedmessage_hook
+from zerver.lib.event_queue import process_notifications, missedmessage_hook
 from zerver.lib.event_queue import setup_event_queue, add_client_gc_hook, \
-    get_descriptor_by_handler_id, clear_handler_by_id
+    get_descriptor_by_handler_id, clear_handler_by_id, get_notify_tornado_queue_name, \
+    get_tornado_return_queue_name
 from zerver.lib.handlers import allocate_handler_id
 from zerver.lib.queue import setup_tornado_rabbitmq
 from zerver.lib.socket import get_sockjs_router, respond_send_message
@@ -53,12 +54,15 @@ class Command(BaseCommand):
         make_option('--noxheaders', action='store_false',
             dest='xheaders', default=True,
             help="Tells Tornado to NOT override remote IP with X-Real-IP."),
+        make_option('--shard', type='int',
+            dest='shard', default=0,
+            help="Which event queue shard this server owns (when TORNADO_PROCESSES > 1)."),
     )
     help = "Starts a Tornado Web server wrapping Django."
     args = '[optional port number or ipaddr:port]\n  (use multiple ports to start multiple servers)'
 
     def handle(self, addrport, **options):
-        # type: (str, **bool) -> None
+        # type: (str, **Any) -> None
         interactive_debug_listen()
 
         import django
@@ -77,6 +81,11 @@ class Command(BaseCommand):
 
         xheaders = options.get('xheaders', True)
         no_keep_alive = options.get('no_keep_alive', False)
+        shard = options.get('shard', 0)
+        if not 0 <= shard < settings.TORNADO_PROCESSES:
+            raise CommandError("Shard %d is out of range for TORNADO_PROCESSES=%d."
+                               % (shard, settings.TORNADO_PROCESSES))
+        settings.TORNADO_SHARD = shard
         quit_command = 'CTRL-C'
 
         if settings.DEBUG:
@@ -93,13 +102,17 @@ class Command(BaseCommand):
             self.validate(display_num_errors=True)
             print("\nDjango version %s" % (django.get_version()))
             print("Tornado server is running at http://%s:%s/" % (addr, port))
+            if settings.TORNADO_PROCESSES > 1:
+                print("Serving event queue shard %d of %d." % (shard, settings.TORNADO_PROCESSES))
             print("Quit the server with %s." % (quit_command,))
 
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(get_notify_tornado_queue_name(shard),
+                                                    process_notifications)
+                queue_client.register_json_consumer(get_tornado_return_queue_name(shard),
+                                                    respond_send_message)
 
             try:
                 urls = (r"/notify_tornado",
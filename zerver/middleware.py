@@ -12,7 +12,8 @@ from django.db import connection
 from django.http import HttpRequest, HttpResponse
 from zerver.lib.utils import statsd
 from zerver.lib.queue import queue_json_publish
-from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests
+from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests, \
+    local_cache_sync
 from zerver.lib.bugdown import get_bugdown_time, get_bugdown_requests
 from zerver.models import flush_per_request_caches
 from zerver.exceptions import RateLimited
@@ -343,6 +344,14 @@ class FlushDisplayRecipientCache(object):
         flush_per_request_caches()
         return response
 
+class SyncLocalCache(object):
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        # Pick up cache invalidations from other processes, so that a
+        # request sees the changes made by requests that finished
+        # before it started.
+        local_cache_sync()
+
 class SessionHostDomainMiddleware(SessionMiddleware):
     def process_response(self, request, response):
         # type: (HttpRequest, HttpResponse) -> HttpResponse
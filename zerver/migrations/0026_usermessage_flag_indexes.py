@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0025_realm_message_content_edit_limit'),
+    ]
+
+    # Partial indexes for the is:starred (flags & 2) and is:mentioned
+    # (flags & 8) narrows, which get_old_messages answers from
+    # zerver_usermessage alone.
+    operations = [
+        migrations.RunSQL("CREATE INDEX zerver_usermessage_starred_message_id "
+                          "ON zerver_usermessage (user_profile_id, message_id) WHERE (flags & 2) != 0;",
+                          reverse_sql="DROP INDEX zerver_usermessage_starred_message_id;"),
+        migrations.RunSQL("CREATE INDEX zerver_usermessage_mentioned_message_id "
+                          "ON zerver_usermessage (user_profile_id, message_id) WHERE (flags & 8) != 0;",
+                          reverse_sql="DROP INDEX zerver_usermessage_mentioned_message_id;"),
+    ]
@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from typing import Any, List, Set, Tuple, TypeVar, \
+from typing import Any, Dict, Iterable, List, Set, Tuple, TypeVar, \
     Union, Optional, Sequence, AbstractSet
 from typing.re import Match
 from zerver.lib.str_utils import NonBinaryStr
@@ -17,7 +17,7 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     display_recipient_cache_key, cache_delete, \
     get_stream_cache_key, active_user_dicts_in_realm_cache_key, \
     active_bot_dicts_in_realm_cache_key, active_user_dict_fields, \
-    active_bot_dict_fields
+    active_bot_dict_fields, flush_bugdown_realm_token, log_realm_presence_change
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from zerver.lib.str_utils import force_bytes, ModelReprMixin, dict_with_str_keys
 from django.db import transaction
@@ -282,6 +282,7 @@ def flush_realm_emoji(sender, **kwargs):
     cache_set(get_realm_emoji_cache_key(realm),
               get_realm_emoji_uncached(realm),
               timeout=3600*24*7)
+    flush_bugdown_realm_token(realm.domain)
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
 post_delete.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -332,6 +333,7 @@ def flush_realm_filter(sender, **kwargs):
     # type: (Any, **Any) -> None
     realm = kwargs['instance'].realm
     cache_delete(get_realm_filters_cache_key(realm.domain))
+    flush_bugdown_realm_token(realm.domain)
     try:
         per_request_realm_filters_cache.pop(realm.domain.lower())
     except KeyError:
@@ -539,6 +541,19 @@ class PushDeviceToken(models.Model):
     # [optional] Contains the app id of the device if it is an iOS device
     ios_app_id = models.TextField(null=True) # type: Optional[text_type]
 
+def flush_push_device_token(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    # Whether a user has push devices is part of their presence.
+    try:
+        user_profile = get_user_profile_by_id(kwargs['instance'].user_id)
+    except UserProfile.DoesNotExist:
+        # The token is being deleted along with its user.
+        return
+    log_realm_presence_change(user_profile.realm_id, user_profile.id, user_profile.email, None)
+
+post_save.connect(flush_push_device_token, sender=PushDeviceToken)
+post_delete.connect(flush_push_device_token, sender=PushDeviceToken)
+
 class MitUser(models.Model):
     email = models.EmailField(unique=True) # type: text_type
     # status: whether an object has been confirmed.
@@ -663,14 +678,16 @@ def get_client_cache_key(name):
     # type: (text_type) -> text_type
     return u'get_client:%s' % (make_safe_digest(name),)
 
-@cache_with_key(get_client_cache_key, timeout=3600*24*7)
+@cache_with_key(get_client_cache_key, timeout=3600*24*7,
+                local_cache_family='get_client')
 def get_client_remote_cache(name):
     # type: (text_type) -> Client
     (client, _) = Client.objects.get_or_create(name=name)
     return client
 
 # get_stream_backend takes either a realm id or a realm
-@cache_with_key(get_stream_cache_key, timeout=3600*24*7)
+@cache_with_key(get_stream_cache_key, timeout=3600*24*7,
+                local_cache_family='stream_by_realm_and_name')
 def get_stream_backend(stream_name, realm):
     # type: (text_type, Realm) -> Stream
     if isinstance(realm, Realm):
@@ -695,6 +712,9 @@ def get_stream(stream_name, realm):
     except Stream.DoesNotExist:
         return None
 
+# How long bulk_get_streams remembers that a stream name doesn't exist.
+STREAM_NEGATIVE_CACHE_SECS = 10
+
 def bulk_get_streams(realm, stream_names):
     # type: (Realm, STREAM_NAMES) -> Dict[text_type, Any]
     if isinstance(realm, Realm):
@@ -720,16 +740,20 @@ def bulk_get_streams(realm, stream_names):
             where=[where_clause],
             params=stream_names)
 
+    # Names that don't exist are only remembered briefly, since a
+    # stream created concurrently can be shadowed until they expire.
     return generic_bulk_cached_fetch(lambda stream_name: get_stream_cache_key(stream_name, realm),
                                      fetch_streams_by_name,
                                      [stream_name.lower() for stream_name in stream_names],
-                                     id_fetcher=lambda stream: stream.name.lower())
+                                     id_fetcher=lambda stream: stream.name.lower(),
+                                     negative_cache_timeout=STREAM_NEGATIVE_CACHE_SECS)
 
 def get_recipient_cache_key(type, type_id):
     # type: (int, int) -> text_type
     return u"get_recipient:%s:%s" % (type, type_id,)
 
-@cache_with_key(get_recipient_cache_key, timeout=3600*24*7)
+@cache_with_key(get_recipient_cache_key, timeout=3600*24*7,
+                local_cache_family='get_recipient')
 def get_recipient(type, type_id):
     # type: (int, int) -> Recipient
     return Recipient.objects.get(type_id=type_id, type=type)
@@ -752,13 +776,24 @@ def linebreak(string):
     # type: (text_type) -> text_type
     return string.replace('\n\n', '<p/>').replace('\n', '<br/>')
 
+# Message dicts are stored in the remote cache as JSON, zlib-compressed
+# if they are at least this many bytes long.  Shorter ones gain little
+# or nothing from compression, so we save the CPU time.
+MESSAGE_DICT_COMPRESSION_THRESHOLD = 1024
+
 def extract_message_dict(message_bytes):
     # type: (binary_type) -> Dict[str, Any]
-    return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes).decode("utf-8")))
+    # The JSON for a dict starts with "{"; a zlib stream never does.
+    if message_bytes[:1] != b"{":
+        message_bytes = zlib.decompress(message_bytes)
+    return dict_with_str_keys(ujson.loads(message_bytes.decode("utf-8")))
 
 def stringify_message_dict(message_dict):
     # type: (Dict[str, Any]) -> binary_type
-    return zlib.compress(force_bytes(ujson.dumps(message_dict)))
+    message_bytes = force_bytes(ujson.dumps(message_dict))
+    if len(message_bytes) >= MESSAGE_DICT_COMPRESSION_THRESHOLD:
+        return zlib.compress(message_bytes)
+    return message_bytes
 
 def to_dict_cache_key_id(message_id, apply_markdown):
     # type: (int, bool) -> text_type
@@ -812,10 +847,22 @@ class Message(ModelReprMixin, models.Model):
             import zerver.lib.bugdown as bugdown
             # 'from zerver.lib import bugdown' gives mypy error in python 3 mode.
 
+        domain = self.prepare_to_render(domain)
+        rendered_content = bugdown.convert(content, domain, self)
+
+        self.is_me_message = Message.is_status_message(content, rendered_content)
+
+        return rendered_content
+
+    def prepare_to_render(self, domain):
+        # type: (Optional[text_type]) -> text_type
+        """Resets the properties bugdown sets, and returns the domain
+        whose markdown processor should render this message."""
         self.mentions_wildcard = False
         self.is_me_message = False
         self.mentions_user_ids = set() # type: Set[int]
         self.user_ids_with_alert_words = set() # type: Set[int]
+        self.links_for_preview = set() # type: Set[text_type]
 
         if not domain:
             domain = self.sender.realm.domain
@@ -823,11 +870,7 @@ class Message(ModelReprMixin, models.Model):
             # Use slightly customized Markdown processor for content
             # delivered via zephyr_mirror
             domain = u"mit.edu/zephyr_mirror"
-        rendered_content = bugdown.convert(content, domain, self)
-
-        self.is_me_message = Message.is_status_message(content, rendered_content)
-
-        return rendered_content
+        return domain
 
     def set_rendered_content(self, rendered_content, save = False):
         # type: (text_type, bool) -> bool
@@ -865,6 +908,29 @@ class Message(ModelReprMixin, models.Model):
         else:
             return True
 
+    @staticmethod
+    def maybe_render_content_many(messages, domain, save = False):
+        # type: (Sequence[Message], Optional[text_type], bool) -> bool
+        """Like maybe_render_content, for several messages, which a
+        bugdown render pool renders in parallel.  Returns whether all of
+        them rendered successfully."""
+        global bugdown
+        if bugdown is None:
+            import zerver.lib.bugdown as bugdown
+            # 'from zerver.lib import bugdown' gives mypy error in python 3 mode.
+
+        messages = [message for message in messages if
+                    Message.need_to_render_content(message.rendered_content,
+                                                   message.rendered_content_version)]
+        requests = [(message.content, message.prepare_to_render(domain), message)
+                    for message in messages]
+        success = True
+        for (message, rendered_content) in zip(messages, bugdown.convert_many(requests)):
+            message.is_me_message = Message.is_status_message(message.content, rendered_content)
+            if not message.set_rendered_content(rendered_content, save):
+                success = False
+        return success
+
     @staticmethod
     def need_to_render_content(rendered_content, rendered_content_version):
         # type: (Optional[text_type], int) -> bool
@@ -1100,12 +1166,16 @@ class Message(ModelReprMixin, models.Model):
         """Remove all Messages that are not referred to by any UserMessage."""
         cls.objects.exclude(id__in = UserMessage.objects.values('message_id')).delete()
 
+    # The (lowercased) names of the clients that only people send
+    # messages from, besides desktop apps; see sent_by_human.
+    HUMAN_SENDING_CLIENTS = ('zulipandroid', 'zulipios', 'zulipdesktop',
+                             'website', 'ios', 'android')
+
     def sent_by_human(self):
         # type: () -> bool
         sending_client = self.sending_client.name.lower()
 
-        return (sending_client in ('zulipandroid', 'zulipios', 'zulipdesktop',
-                                   'website', 'ios', 'android')) or \
+        return (sending_client in self.HUMAN_SENDING_CLIENTS) or \
                                    ('desktop app' in sending_client)
 
     @staticmethod
@@ -1281,7 +1351,8 @@ class Subscription(ModelReprMixin, models.Model):
         # type: () -> text_type
         return u"<Subscription: %r -> %s>" % (self.user_profile, self.recipient)
 
-@cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
+@cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7,
+                local_cache_family='user_profile_by_id')
 def get_user_profile_by_id(uid):
     # type: (int) -> UserProfile
     return UserProfile.objects.select_related().get(id=uid)
@@ -1428,15 +1499,28 @@ class UserPresence(models.Model):
             return 'idle'
 
     @staticmethod
-    def get_status_dict_by_realm(realm_id):
-        # type: (int) -> defaultdict[Any, Dict[Any, Any]]
+    def get_status_dict_by_realm(realm_id, user_ids=None):
+        # type: (int, Optional[Iterable[int]]) -> defaultdict[Any, Dict[Any, Any]]
+        """The presence dicts of the realm's active human users (or just
+        the ones in user_ids), by email and client name.  This reads
+        the whole realm; zerver.lib.presence keeps an up-to-date copy."""
         user_statuses = defaultdict(dict) # type: defaultdict[Any, Dict[Any, Any]]
 
         query = UserPresence.objects.filter(
                 user_profile__realm_id=realm_id,
                 user_profile__is_active=True,
                 user_profile__is_bot=False
-        ).values(
+        )
+        push_device_query = PushDeviceToken.objects.filter(
+                user__realm_id=realm_id,
+                user__is_active=True,
+                user__is_bot=False,
+        )
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            query = query.filter(user_profile_id__in=user_ids)
+            push_device_query = push_device_query.filter(user_id__in=user_ids)
+        query = query.values(
                 'client__name',
                 'status',
                 'timestamp',
@@ -1446,12 +1530,7 @@ class UserPresence(models.Model):
                 'user_profile__is_mirror_dummy',
         )
 
-        mobile_user_ids = [row['user'] for row in PushDeviceToken.objects.filter(
-                user__realm_id=1,
-                user__is_active=True,
-                user__is_bot=False,
-        ).distinct("user").values("user")]
-
+        mobile_user_ids = set(push_device_query.values_list('user_id', flat=True))
 
         for row in query:
             info = UserPresence.to_presence_dict(
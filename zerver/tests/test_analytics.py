@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from django.template import loader
+from django.utils import timezone
+from typing import Any, Dict, List, Optional
+
+from analytics.lib.counts import COUNT_STATS, HOUR, DAY, INTERVAL_TAIL, \
+    USER_HOUR_RETENTION_DAYS, floor_to_hour, process_count_stat
+from analytics.models import FillState, RealmCount, UserCount
+from analytics.views import get_realm_day_counts, realm_summary_table, \
+    sent_messages_report, user_activity_intervals
+from zerver.lib.test_helpers import AuthedTestCase
+from zerver.models import Client, Message, Recipient, UserActivity, \
+    UserActivityInterval, get_user_profile_by_email
+
+from datetime import datetime, timedelta
+import mock
+import re
+
+class AnalyticsCountTest(AuthedTestCase):
+    # Midnight UTC, long before any of the fixture data.
+    midnight = datetime(2016, 6, 2, tzinfo=timezone.utc)
+
+    def setUp(self):
+        # type: () -> None
+        self.hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        self.bot = get_user_profile_by_email("default-bot@zulip.com")
+        self.iago = get_user_profile_by_email("iago@zulip.com")
+        self.client_id = Client.objects.get_or_create(name="test suite")[0].id
+
+    def send_message_at(self, sender, pub_date):
+        # type: (str, datetime) -> None
+        message_id = self.send_message(sender, "othello@zulip.com", Recipient.PERSONAL)
+        Message.objects.filter(id=message_id).update(pub_date=pub_date)
+
+    def fill(self, start_time, fill_to_time, properties=None):
+        # type: (datetime, datetime, Optional[List[str]]) -> None
+        """Fills in the hours after start_time up to fill_to_time, as
+        though the stats had been filled up to start_time before."""
+        if properties is None:
+            properties = list(COUNT_STATS.keys())
+        for property in properties:
+            FillState.objects.update_or_create(property=property,
+                                               defaults={'end_time': start_time})
+            process_count_stat(COUNT_STATS[property], fill_to_time)
+
+    def user_counts(self, property, frequency):
+        # type: (str, str) -> Dict[Any, int]
+        return dict(((row.user.email, row.subgroup, row.end_time), row.value)
+                    for row in UserCount.objects.filter(property=property, frequency=frequency))
+
+    def realm_counts(self, property, frequency):
+        # type: (str, str) -> Dict[Any, int]
+        return dict(((row.realm.domain, row.subgroup, row.end_time), row.value)
+                    for row in RealmCount.objects.filter(property=property, frequency=frequency))
+
+    def add_fixture_activity(self):
+        # type: () -> None
+        midnight = self.midnight
+        self.send_message_at("hamlet@zulip.com", midnight - 2 * HOUR - HOUR // 2)
+        self.send_message_at("hamlet@zulip.com", midnight - 2 * HOUR - HOUR // 6)
+        self.send_message_at("hamlet@zulip.com", midnight - HOUR // 2)
+        self.send_message_at("default-bot@zulip.com", midnight - HOUR // 2)
+        self.send_message_at("hamlet@zulip.com", midnight + HOUR // 6)
+
+        # 10 minutes in the hour before the last of the day, and 40 in the last.
+        UserActivityInterval.objects.create(user_profile=self.hamlet,
+                                            start=midnight - HOUR - HOUR // 6,
+                                            end=midnight - HOUR // 3)
+        # The last 15 minutes of an interval come after the activity it
+        # logs, so iago was only active in the hour before the last.
+        UserActivityInterval.objects.create(user_profile=self.iago,
+                                            start=midnight - HOUR - HOUR // 2,
+                                            end=midnight - HOUR - HOUR // 6 + INTERVAL_TAIL)
+
+    def test_fill_hours(self):
+        # type: () -> None
+        self.add_fixture_activity()
+        self.fill(self.midnight - 3 * HOUR, self.midnight + HOUR)
+
+        for property in COUNT_STATS:
+            self.assertEqual(FillState.objects.get(property=property).end_time,
+                             self.midnight + HOUR)
+
+        subgroup = str(self.client_id)
+        self.assertEqual(self.user_counts('messages_sent:client', 'hour'), {
+            ('hamlet@zulip.com', subgroup, self.midnight - 2 * HOUR): 2,
+            ('hamlet@zulip.com', subgroup, self.midnight): 1,
+            ('default-bot@zulip.com', subgroup, self.midnight): 1,
+            ('hamlet@zulip.com', subgroup, self.midnight + HOUR): 1,
+        })
+        self.assertEqual(self.realm_counts('messages_sent:client', 'hour'), {
+            ('zulip.com', subgroup, self.midnight - 2 * HOUR): 2,
+            ('zulip.com', subgroup, self.midnight): 2,
+            ('zulip.com', subgroup, self.midnight + HOUR): 1,
+        })
+        # Every hour hamlet sent a message or used the app in, unlike
+        # the bot, which sent a message in the last hour of the day.
+        self.assertEqual(self.user_counts('active_users', 'hour'), {
+            ('hamlet@zulip.com', '', self.midnight - 2 * HOUR): 1,
+            ('hamlet@zulip.com', '', self.midnight - HOUR): 1,
+            ('hamlet@zulip.com', '', self.midnight): 1,
+            ('hamlet@zulip.com', '', self.midnight + HOUR): 1,
+            ('iago@zulip.com', '', self.midnight - HOUR): 1,
+        })
+        self.assertEqual(self.realm_counts('active_users', 'hour'), {
+            ('zulip.com', '', self.midnight - 2 * HOUR): 1,
+            ('zulip.com', '', self.midnight - HOUR): 2,
+            ('zulip.com', '', self.midnight): 1,
+            ('zulip.com', '', self.midnight + HOUR): 1,
+        })
+        self.assertEqual(self.user_counts('active_seconds', 'hour'), {
+            ('hamlet@zulip.com', '', self.midnight - HOUR): 10 * 60,
+            ('hamlet@zulip.com', '', self.midnight): 40 * 60,
+            ('iago@zulip.com', '', self.midnight - HOUR): 30 * 60,
+            ('iago@zulip.com', '', self.midnight): 5 * 60,
+        })
+
+    def test_day_rollup(self):
+        # type: () -> None
+        self.add_fixture_activity()
+        self.fill(self.midnight - 3 * HOUR, self.midnight + HOUR)
+
+        # The day is rolled up at midnight, from the hours up to it.
+        subgroup = str(self.client_id)
+        self.assertEqual(self.user_counts('messages_sent:client', 'day'), {
+            ('hamlet@zulip.com', subgroup, self.midnight): 3,
+            ('default-bot@zulip.com', subgroup, self.midnight): 1,
+        })
+        self.assertEqual(self.realm_counts('messages_sent:client', 'day'), {
+            ('zulip.com', subgroup, self.midnight): 4,
+        })
+        self.assertEqual(self.user_counts('active_seconds', 'day'), {
+            ('hamlet@zulip.com', '', self.midnight): 50 * 60,
+            ('iago@zulip.com', '', self.midnight): 35 * 60,
+        })
+        # active_users takes the max over the hours, not the sum.
+        self.assertEqual(self.user_counts('active_users', 'day'), {
+            ('hamlet@zulip.com', '', self.midnight): 1,
+            ('iago@zulip.com', '', self.midnight): 1,
+        })
+        self.assertEqual(self.realm_counts('active_users', 'day'), {
+            ('zulip.com', '', self.midnight): 2,
+        })
+
+    def test_refill(self):
+        # type: () -> None
+        self.add_fixture_activity()
+        self.fill(self.midnight - 3 * HOUR, self.midnight + HOUR)
+        user_counts = list(UserCount.objects.values_list(
+            'user_id', 'property', 'subgroup', 'frequency', 'end_time', 'value').order_by('id'))
+        realm_counts = list(RealmCount.objects.values_list(
+            'realm_id', 'property', 'subgroup', 'frequency', 'end_time', 'value').order_by('id'))
+
+        # Filling in the same hours again, e.g. after the FillState
+        # was lost, replaces their rows rather than adding to them.
+        self.fill(self.midnight - 3 * HOUR, self.midnight + HOUR)
+        self.assertEqual(sorted(UserCount.objects.values_list(
+            'user_id', 'property', 'subgroup', 'frequency', 'end_time', 'value')),
+            sorted(user_counts))
+        self.assertEqual(sorted(RealmCount.objects.values_list(
+            'realm_id', 'property', 'subgroup', 'frequency', 'end_time', 'value')),
+            sorted(realm_counts))
+
+        # And with the FillState up to date, there's nothing to fill.
+        self.assertEqual(process_count_stat(COUNT_STATS['active_seconds'], self.midnight + HOUR), 0)
+
+    def test_prune_hourly_user_counts(self):
+        # type: () -> None
+        def add_hour(end_time):
+            # type: (datetime) -> None
+            UserCount.objects.create(user=self.hamlet, realm=self.hamlet.realm,
+                                     property='active_seconds', frequency='hour',
+                                     end_time=end_time, value=60)
+        retention = USER_HOUR_RETENTION_DAYS * DAY
+        add_hour(self.midnight - retention - HOUR)
+        add_hour(self.midnight - retention + HOUR)
+        RealmCount.objects.create(realm=self.hamlet.realm, property='active_seconds',
+                                  frequency='hour', end_time=self.midnight - retention - HOUR,
+                                  value=60)
+
+        self.fill(self.midnight - HOUR, self.midnight, ['active_seconds'])
+        self.assertEqual(list(UserCount.objects.filter(frequency='hour').values_list('end_time', flat=True)),
+                         [self.midnight - retention + HOUR])
+        self.assertEqual(RealmCount.objects.filter(frequency='hour').count(), 1)
+
+    def test_dashboard_queries(self):
+        # type: () -> None
+        # Only count what this test adds.
+        Message.objects.update(pub_date=self.midnight)
+        UserActivity.objects.all().delete()
+        UserActivityInterval.objects.all().delete()
+
+        now = timezone.now()
+        self.send_message_at("hamlet@zulip.com", now)
+        self.send_message_at("hamlet@zulip.com", now)
+        self.send_message_at("default-bot@zulip.com", now)
+        UserActivity.objects.create(user_profile=self.hamlet, client_id=self.client_id,
+                                    query='/json/send_message', count=1, last_visit=now)
+        # In the last whole hour, which user_activity_intervals reads.
+        UserActivityInterval.objects.create(user_profile=self.hamlet,
+                                            start=floor_to_hour(now) - HOUR,
+                                            end=floor_to_hour(now) - HOUR // 2)
+        self.fill(floor_to_hour(now) - 2 * HOUR, floor_to_hour(now) + HOUR)
+        # Othello was last active 3 days ago, so is at risk.
+        UserActivityInterval.objects.create(user_profile=get_user_profile_by_email("othello@zulip.com"),
+                                            start=now - 3 * DAY, end=now - 3 * DAY + HOUR)
+        self.fill(floor_to_hour(now) - 4 * DAY, floor_to_hour(now) + HOUR, ['active_users'])
+
+        # Today's messages come from the hourly rows.
+        self.assertIn('<td class="number good">2</td>',
+                      get_realm_day_counts()['zulip.com']['cnts'])
+        today = (floor_to_hour(now) + HOUR - timedelta(seconds=1)).date()
+        self.assertTrue(re.search(r'<td sortable>%s</td>\s*<td sortable>2</td>\s*<td sortable>1</td>' % (today,),
+                                  sent_messages_report('zulip.com')))
+
+        content, realm_minutes = user_activity_intervals()
+        self.assertIn('hamlet@zulip.com', content)
+        self.assertEqual(realm_minutes, {'zulip.com': 30})
+
+        with mock.patch.object(loader, 'render_to_string', return_value='') as render:
+            realm_summary_table(realm_minutes)
+        [row] = [row for row in render.call_args[0][1]['rows'] if 'zulip.com' in row['domain']]
+        self.assertEqual((row['active_user_count'], row['at_risk_count']), (1, 1))
+
+        self.login("iago@zulip.com")
+        result = self.client.get('/activity')
+        self.assertEqual(result.status_code, 200)
+        self.assert_in_response('hamlet@zulip.com', result)
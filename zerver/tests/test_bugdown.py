@@ -4,23 +4,36 @@ from __future__ import absolute_import
 from django.conf import settings
 from django.test import TestCase
 
-from zerver.lib import bugdown
+from zerver.lib import bugdown, mention
+from zerver.lib.alert_words import AlertWordMatcher
+from zerver.lib.bugdown import render_pool
 from zerver.lib.actions import (
     check_add_realm_emoji,
+    do_change_full_name,
+    do_deactivate_user,
     do_remove_realm_emoji,
     do_set_alert_words,
+    do_update_embedded_data,
     get_realm,
 )
+from zerver.lib.cache import cache_get
 from zerver.lib.camo import get_camo_url
+from zerver.lib.utils import generate_random_token
 from zerver.models import (
     get_client,
     get_user_profile_by_email,
     Message,
     RealmFilter,
+    realm_filters_for_domain,
 )
 
+from six.moves import BaseHTTPServer, socketserver, urllib
+
 import mock
 import os
+import random
+import threading
+import time
 import ujson
 import six
 
@@ -134,6 +147,134 @@ class FencedBlockPreprocessorTest(TestCase):
 def bugdown_convert(text):
     return bugdown.convert(text, "zulip.com")
 
+class StubHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Answers GET requests for each path in `responses` with its
+    (delay in seconds, status, body), recording the requests made."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHTTPRequestHandler)
+        self.responses = {}
+        self.requests = []
+        self.url = 'http://127.0.0.1:%d' % (self.server_address[1],)
+
+    def handle_error(self, request, client_address):
+        # The client stopped waiting for a delayed response.
+        pass
+
+class StubHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        # As a proxy, we are sent the whole URL rather than the path.
+        self.server.requests.append(self.path)
+        (delay, status, body) = self.server.responses.get(
+            urllib.parse.urlsplit(self.path).path, (0, 404, '{}'))
+        time.sleep(delay)
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+class LinkPreviewFetchTest(TestCase):
+    """fetch_link_previews (run by the embed_links queue worker)
+    against a local server standing in for Twitter's API and, as an
+    HTTP proxy, for the linked sites."""
+    def setUp(self):
+        self.server = StubHTTPServer()
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.sender = get_user_profile_by_email("othello@zulip.com")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def render(self, content):
+        msg = Message(sender=self.sender, sending_client=get_client("test"))
+        return (msg.render_markdown(content), msg.links_for_preview)
+
+    def dropbox_url(self):
+        # Unique, so that data cached by earlier test runs don't count.
+        path = "/sh/%s/AAAII5NK-9daee3FcF41anEua" % (generate_random_token(16),)
+        return ("http://www.dropbox.com" + path, path)
+
+    def test_open_graph_preview(self):
+        (url, path) = self.dropbox_url()
+        html = ('<html><head><meta property="og:image" content="https://zulip.com/saves.png">'
+                '<meta property="og:title" content="Saves"></head></html>')
+        self.server.responses[path] = (0, 200, html)
+
+        with self.settings(OPEN_GRAPH_FETCH_PROXY=self.server.url):
+            (converted, links_for_preview) = self.render(url)
+            self.assertEqual(self.server.requests, [])
+            self.assertNotIn('message_inline_ref', converted)
+            self.assertEqual(links_for_preview, set([url]))
+
+            bugdown.fetch_link_previews([url])
+            self.assertEqual(self.server.requests, [url])
+
+            (converted, links_for_preview) = self.render(url)
+        self.assertIn('<img src="https://zulip.com/saves.png">', converted)
+        self.assertEqual(links_for_preview, set())
+
+    def test_open_graph_errors(self):
+        (error_url, error_path) = self.dropbox_url()
+        self.server.responses[error_path] = (0, 500, '<html><head></head></html>')
+        (slow_url, slow_path) = self.dropbox_url()
+        self.server.responses[slow_path] = (0.5, 200, '<html><head></head></html>')
+
+        start = time.time()
+        with self.settings(OPEN_GRAPH_FETCH_PROXY=self.server.url), \
+                mock.patch.object(bugdown, 'OPEN_GRAPH_FETCH_TIMEOUT', 0.1):
+            bugdown.fetch_link_previews([error_url, slow_url])
+            self.assertLess(time.time() - start, 0.5)
+            self.assertEqual(sorted(self.server.requests), sorted([error_url, slow_url]))
+
+            # Both are rendered without a preview, and not fetched again.
+            for url in [error_url, slow_url]:
+                (converted, links_for_preview) = self.render(url)
+                self.assertNotIn('message_inline_ref', converted)
+                self.assertEqual(links_for_preview, set())
+
+    def fetch_tweet(self, delay, status, body):
+        """Returns what was cached for the tweet: the tests' database
+        cache doesn't store anything."""
+        tweet_id = str(random.randrange(10 ** 17, 10 ** 18))
+        self.server.responses['/1.1/statuses/show.json'] = (delay, status, body)
+        with self.settings(TEST_SUITE=False, TWITTER_API_URL=self.server.url + '/1.1',
+                           TWITTER_CONSUMER_KEY='key', TWITTER_CONSUMER_SECRET='secret',
+                           TWITTER_ACCESS_TOKEN_KEY='token', TWITTER_ACCESS_TOKEN_SECRET='secret'), \
+                mock.patch.object(bugdown, 'TWEET_FETCH_TIMEOUT', 0.1), \
+                mock.patch('zerver.lib.cache.remote_cache_set') as cache_set, \
+                mock.patch('logging.warning'):
+            bugdown.fetch_link_previews(['https://twitter.com/wdaher/status/%s' % (tweet_id,)])
+        self.assertEqual([urllib.parse.parse_qs(urllib.parse.urlsplit(request).query)['id']
+                          for request in self.server.requests], [[tweet_id]])
+        return [call[0][1] for call in cache_set.call_args_list if call[0][0] == tweet_id]
+
+    def test_tweet_preview(self):
+        tweet = {'id': 287977969287315456, 'text': 'Just a tweet',
+                 'user': {'id': 1, 'screen_name': 'wdaher', 'name': 'Waseem Daher'}}
+        [cached] = self.fetch_tweet(0, 200, ujson.dumps(tweet))
+        self.assertEqual(cached['text'], 'Just a tweet')
+        self.assertEqual(cached['user']['screen_name'], 'wdaher')
+
+    def test_tweet_errors(self):
+        # A missing tweet is remembered...
+        error = {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]}
+        self.assertEqual(self.fetch_tweet(0, 404, ujson.dumps(error)), [None])
+
+        # ... but being rate-limited or timing out is not, so that the
+        # tweet is fetched again for a later message.
+        del self.server.requests[:]
+        error = {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}
+        self.assertEqual(self.fetch_tweet(0, 429, ujson.dumps(error)), [])
+
+        del self.server.requests[:]
+        self.assertEqual(self.fetch_tweet(0.3, 200, '{}'), [])
+
 class BugdownTest(TestCase):
     def common_bugdown_test(self, text, expected):
         converted = bugdown_convert(text)
@@ -397,6 +538,74 @@ class BugdownTest(TestCase):
         converted_boring_subject = bugdown.subject_links(realm.domain.lower(), boring_msg.subject)
         self.assertEqual(converted_boring_subject,  [])
 
+    def test_realm_patterns_combined(self):
+        realm = get_realm('zulip.com')
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        RealmFilter(realm=realm, pattern=r"(?P<repo>[a-z]+)#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://github.com/zulip/%(repo)s/pull/%(id)s").save()
+        msg = Message(sender=get_user_profile_by_email("othello@zulip.com"),
+                      subject="#444 and zulip#555")
+
+        content = "Fixed by zulip#224, see #115."
+        converted = bugdown.convert(content, realm_domain='zulip.com', message=msg)
+        self.assertEqual(converted, '<p>Fixed by <a href="https://github.com/zulip/zulip/pull/224" target="_blank" title="https://github.com/zulip/zulip/pull/224">zulip#224</a>, see <a href="https://trac.zulip.net/ticket/115" target="_blank" title="https://trac.zulip.net/ticket/115">#115</a>.</p>')
+        self.assertEqual(bugdown.subject_links(realm.domain.lower(), msg.subject),
+                         [u'https://trac.zulip.net/ticket/444', u'https://github.com/zulip/zulip/pull/555'])
+
+        matcher = bugdown.RealmFilterMatcher([(r"T%d-(?P<id>[0-9]+)" % (i,), u"https://zulip.com/%d/%%(id)s" % (i,))
+                                              for i in range(100)])
+        self.assertGreater(len(matcher.patterns), 1)
+        self.assertEqual(matcher.find_urls(u"T0-1 T99-2"), [u"https://zulip.com/0/1", u"https://zulip.com/99/2"])
+
+    def test_realm_patterns_overlapping(self):
+        realm = get_realm('zulip.com')
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        RealmFilter(realm=realm, pattern=r"PR #(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://github.com/zulip/zulip/pull/%(id)s").save()
+        msg = Message(sender=get_user_profile_by_email("othello@zulip.com"), subject="PR #444")
+
+        # The first filter claims its matches before the second is
+        # tried, though the second's match starts further left.
+        converted = bugdown.convert("See PR #224.", realm_domain='zulip.com', message=msg)
+        self.assertEqual(converted, '<p>See PR <a href="https://trac.zulip.net/ticket/224" target="_blank" title="https://trac.zulip.net/ticket/224">#224</a>.</p>')
+        # Topics get every filter's matches.
+        self.assertEqual(bugdown.subject_links(realm.domain.lower(), msg.subject),
+                         [u'https://trac.zulip.net/ticket/444', u'https://github.com/zulip/zulip/pull/444'])
+
+        filters = list(reversed(realm_filters_for_domain('zulip.com')))
+        with mock.patch('zerver.models.realm_filters_for_domain', return_value=filters):
+            converted = bugdown.convert("See PR #225.", realm_domain='zulip.com', message=msg)
+        self.assertEqual(converted, '<p>See <a href="https://github.com/zulip/zulip/pull/225" target="_blank" title="https://github.com/zulip/zulip/pull/225">PR #225</a>.</p>')
+
+        # A filter's inline flags don't apply to the other filters.
+        matcher = bugdown.RealmFilterMatcher([(r"T-(?P<id>[0-9]+)", u"https://zulip.com/t/%(id)s"),
+                                              (r"(?i)bug-(?P<id>[0-9]+)", u"https://zulip.com/bug/%(id)s")])
+        self.assertEqual(matcher.find_urls(u"t-1 T-2 BUG-3 bug-4"),
+                         [u"https://zulip.com/t/2", u"https://zulip.com/bug/3", u"https://zulip.com/bug/4"])
+
+    def test_mention_index(self):
+        realm = get_realm('zulip.com')
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        index = mention.get_mention_index(realm)
+        self.assertEqual(index.find_user("King Hamlet")['id'], hamlet.id)
+        self.assertEqual(index.find_user("HAMLET")['id'], hamlet.id)
+        self.assertIn(hamlet.id, [user['id'] for user in index.find_users_by_prefix("kin")])
+        self.assertEqual(len(index.find_users_by_prefix("", limit=2)), 2)
+
+        # Changes to the realm's users are applied to the same index.
+        do_change_full_name(hamlet, "Prince Hamlet")
+        self.assertIs(mention.get_mention_index(realm), index)
+        self.assertIsNone(index.find_user("King Hamlet"))
+        self.assertEqual(index.find_user("prince hamlet")['id'], hamlet.id)
+        self.assertNotIn(hamlet.id, [user['id'] for user in index.find_users_by_prefix("kin")])
+
+        do_deactivate_user(hamlet)
+        self.assertIs(mention.get_mention_index(realm), index)
+        self.assertIsNone(index.find_user("hamlet"))
+        self.assertEqual(index.find_users_by_prefix("prince"), [])
+
     def test_alert_words(self):
         user_profile = get_user_profile_by_email("othello@zulip.com")
         do_set_alert_words(user_profile, ["ALERTWORD", "scaryword"])
@@ -411,6 +620,15 @@ class BugdownTest(TestCase):
         self.assertEqual(msg.render_markdown(content), "<p>We have a NOTHINGWORD day today!</p>")
         self.assertEqual(msg.user_ids_with_alert_words, set())
 
+    def test_alert_word_matcher(self):
+        matcher = AlertWordMatcher({1: [u"Cat", u"he said"], 2: [u"catalog", u"at"], 3: [u"said"]})
+        self.assertEqual(matcher.find_user_ids(u"the catalog"), set([2]))
+        self.assertEqual(matcher.find_user_ids(u"(CAT)"), set([1]))
+        self.assertEqual(matcher.find_user_ids(u"cats"), set())
+        self.assertEqual(matcher.find_user_ids(u"then he said, at last"), set([1, 2, 3]))
+        self.assertEqual(matcher.find_user_ids(u"sheep said"), set([3]))
+        self.assertEqual(matcher.find_user_ids(u""), set())
+
     def test_mention_wildcard(self):
         user_profile = get_user_profile_by_email("othello@zulip.com")
         msg = Message(sender=user_profile, sending_client=get_client("test"))
@@ -439,6 +657,69 @@ class BugdownTest(TestCase):
                          '<p><span class="user-mention" data-user-email="hamlet@zulip.com">@King Hamlet</span></p>')
         self.assertEqual(msg.mentions_user_ids, set([user_profile.id]))
 
+    def test_maybe_render_content_many(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        mention = Message(sender=sender_user_profile, sending_client=get_client("test"),
+                          content="@**King Hamlet**")
+        me_message = Message(sender=sender_user_profile, sending_client=get_client("test"),
+                             content="/me waves")
+        self.assertTrue(Message.maybe_render_content_many([mention, me_message], None))
+        self.assertEqual(mention.rendered_content,
+                         '<p><span class="user-mention" data-user-email="hamlet@zulip.com">@King Hamlet</span></p>')
+        self.assertEqual(mention.mentions_user_ids, set([user_profile.id]))
+        self.assertFalse(mention.is_me_message)
+        self.assertTrue(me_message.is_me_message)
+
+    def test_render_cache(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        # Unique, so that renders cached by earlier test runs don't count.
+        content = "@**King Hamlet** %s" % (generate_random_token(32),)
+
+        with mock.patch('zerver.lib.bugdown.do_convert', wraps=bugdown.do_convert) as do_convert:
+            rendered = Message(sender=sender_user_profile, sending_client=get_client("test")).render_markdown(content)
+            self.assertEqual(do_convert.call_count, 1)
+
+            msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+            self.assertEqual(msg.render_markdown(content), rendered)
+            self.assertEqual(msg.mentions_user_ids, set([user_profile.id]))
+            self.assertEqual(do_convert.call_count, 1)
+
+            # Changing the realm's emoji (or users, filters or alert
+            # words) means rendering again.
+            check_add_realm_emoji(get_realm('zulip.com'), "render_cache", "https://zulip.com/test.png")
+            msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+            self.assertEqual(msg.render_markdown(content), rendered)
+            self.assertEqual(do_convert.call_count, 2)
+
+    def test_link_previews_after_edit(self):
+        message = Message.objects.filter(rendered_content__isnull=False).latest('id')
+        original_rendered_content = message.rendered_content
+        # The message is edited after we read it...
+        Message.objects.filter(id=message.id).update(content=message.content + " (edited)")
+        with mock.patch('zerver.lib.actions.send_event') as send_event:
+            self.assertFalse(do_update_embedded_data(message, u'<p>With a preview</p>'))
+        # ... so our previews for the old content are dropped.
+        self.assertFalse(send_event.called)
+        self.assertEqual(Message.objects.get(id=message.id).rendered_content, original_rendered_content)
+
+        message = Message.objects.get(id=message.id)
+        with mock.patch('zerver.lib.actions.send_event') as send_event:
+            self.assertTrue(do_update_embedded_data(message, u'<p>With a preview</p>'))
+        self.assertTrue(send_event.called)
+        self.assertEqual(Message.objects.get(id=message.id).rendered_content, u'<p>With a preview</p>')
+
+    def test_render_pool_messages(self):
+        stream = six.BytesIO()
+        render_pool.write_message(stream, (u"**bold**", u"zulip.com", None))
+        render_pool.write_message(stream, 'ready')
+        stream.seek(0)
+        self.assertEqual(render_pool.read_message(stream), (u"**bold**", u"zulip.com", None))
+        self.assertEqual(render_pool.read_message(stream), 'ready')
+        with self.assertRaises(EOFError):
+            render_pool.read_message(stream)
+
     def test_mention_shortname(self):
         sender_user_profile = get_user_profile_by_email("othello@zulip.com")
         user_profile = get_user_profile_by_email("hamlet@zulip.com")
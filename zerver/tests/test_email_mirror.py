@@ -10,19 +10,20 @@ from zerver.lib.test_helpers import (
 )
 
 from zerver.models import (
-    get_display_recipient, get_stream, get_user_profile_by_email,
-    Recipient,
+    get_client, get_display_recipient, get_stream, get_user_profile_by_email,
+    Message, Recipient,
 )
 
 from zerver.lib.actions import (
-    encode_email_address,
+    create_stream_if_needed, encode_email_address,
 )
 from zerver.lib.email_mirror import (
     process_message, process_stream_message, ZulipEmailForwardError,
     create_missed_message_address,
 )
 
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import handle_digest_email, handle_digest_emails, RealmDigest
+from zerver.lib.timestamp import timestamp_to_datetime
 
 from zerver.lib.notifications import (
     handle_missedmessage_emails,
@@ -209,6 +210,94 @@ class TestDigestEmailMessages(AuthedTestCase):
         self.assertEqual(mock_send_future_email.call_args[0][0][0]['email'],
                          u'othello@zulip.com')
 
+    @mock.patch('zerver.lib.digest.enough_traffic')
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_digest_email_failures(self, mock_send_future_email, mock_enough_traffic):
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        othello = get_user_profile_by_email("othello@zulip.com")
+
+        def send_future_email(recipients, *args, **kwargs):
+            if recipients[0]['email'] == hamlet.email:
+                raise Exception("Mail server down")
+        mock_send_future_email.side_effect = send_future_email
+
+        # Only the user whose email failed is reported.
+        cutoff = time.mktime(datetime.datetime(year=2016, month=1, day=1).timetuple())
+        with mock.patch('zerver.lib.digest.logger'):
+            failed = handle_digest_emails([hamlet.id, othello.id], int(cutoff))
+        self.assertEqual(failed, [hamlet.id])
+        self.assertEqual(mock_send_future_email.call_count, 2)
+
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_hot_conversations(self, mock_send_future_email):
+        # Nothing before the cutoff counts.
+        cutoff = time.time() - 1
+        senders = {"diverse": ["hamlet@zulip.com", "othello@zulip.com", "cordelia@zulip.com"],
+                   "long": ["iago@zulip.com"] * 5,
+                   "quiet": ["hamlet@zulip.com", "iago@zulip.com"]}
+        message_ids = []
+        for (subject, emails) in senders.items():
+            for email in emails:
+                self.subscribe_to_stream(email, "Denmark")
+                message_ids.append(self.send_message(email, "Denmark", Recipient.STREAM,
+                                                     subject=subject))
+        # Digests only count messages people sent themselves.
+        Message.objects.filter(id__in=message_ids).update(sending_client=get_client("website"))
+        self.send_message("iago@zulip.com", "Denmark", Recipient.STREAM, subject="long")
+
+        user_profile = get_user_profile_by_email("othello@zulip.com")
+        recipient = Recipient.objects.get(type=Recipient.STREAM,
+                                          type_id=get_stream("Denmark", user_profile.realm).id)
+        realm_digest = RealmDigest(user_profile.realm, timestamp_to_datetime(cutoff))
+        (count, participants) = realm_digest.conversations[(recipient.id, "diverse")]
+        self.assertEqual((count, sorted(participants)),
+                         (3, ["Cordelia Lear", "King Hamlet", "Othello, the Moor of Venice"]))
+        # The 2 most diverse conversations, then the longest.
+        self.assertEqual(realm_digest.hot_conversations(user_profile, set([recipient.id])),
+                         [(recipient.id, "diverse"), (recipient.id, "quiet"), (recipient.id, "long")])
+        self.assertEqual(realm_digest.hot_conversations(user_profile, set()), [])
+
+        handle_digest_emails([user_profile.id], int(cutoff))
+        self.assertEqual(mock_send_future_email.call_count, 1)
+        text_content = mock_send_future_email.call_args[0][2]
+        self.assertIn("+ 3 more messages by Iago.", text_content)
+
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_invite_only_conversations(self, mock_send_future_email):
+        cutoff = time.time() - 1
+        user_profile = get_user_profile_by_email("othello@zulip.com")
+        (stream, _) = create_stream_if_needed(user_profile.realm, "Secret", invite_only=True)
+        recipient = Recipient.objects.get(type=Recipient.STREAM, type_id=stream.id)
+        self.subscribe_to_stream("hamlet@zulip.com", "Secret")
+        self.subscribe_to_stream("iago@zulip.com", "Secret")
+
+        def send(email, content):
+            # type: (str, str) -> None
+            message_id = self.send_message(email, "Secret", Recipient.STREAM,
+                                           content=content, subject="plans")
+            Message.objects.filter(id=message_id).update(sending_client=get_client("website"))
+        send("hamlet@zulip.com", "before othello joined")
+        send("iago@zulip.com", "also before othello joined")
+        self.subscribe_to_stream("othello@zulip.com", "Secret")
+        send("hamlet@zulip.com", "after othello joined")
+
+        # Invite-only streams aren't in the realm-wide statistics; each
+        # user's digest only covers the messages they received.
+        realm_digest = RealmDigest(user_profile.realm, timestamp_to_datetime(cutoff))
+        self.assertNotIn((recipient.id, "plans"), realm_digest.conversations)
+        self.assertEqual(realm_digest.hot_conversations(user_profile, set([recipient.id])),
+                         [(recipient.id, "plans")])
+        teaser = realm_digest.teaser(user_profile, (recipient.id, "plans"))
+        self.assertEqual(teaser["participants"], ["King Hamlet"])
+        self.assertEqual(teaser["count"], 0)
+        self.assertIn("after othello joined", str(teaser["first_few_messages"]))
+        self.assertNotIn("before othello joined", str(teaser["first_few_messages"]))
+
+        handle_digest_emails([user_profile.id], int(cutoff))
+        text_content = mock_send_future_email.call_args[0][2]
+        self.assertIn("after othello joined", text_content)
+        self.assertNotIn("before othello joined", text_content)
+
 class TestReplyExtraction(AuthedTestCase):
     def test_reply_is_extracted_from_plain(self):
 
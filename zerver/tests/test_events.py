@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from django.http import HttpRequest, HttpResponse
 from django.test import TestCase
@@ -12,6 +12,8 @@ from zerver.models import (
 
 from zerver.lib.actions import (
     apply_events,
+    bulk_add_subscriptions,
+    bulk_remove_subscriptions,
     create_stream_if_needed,
     do_add_alert_words,
     check_add_realm_emoji,
@@ -224,8 +226,8 @@ class EventsRegisterTest(AuthedTestCase):
             ])),
         ])
 
-    def do_test(self, action, event_types=None):
-        # type: (Callable[[], Any], Optional[List[str]]) -> List[Dict[str, Any]]
+    def do_test(self, action, event_types=None, multi_user_peer_events=False):
+        # type: (Callable[[], Any], Optional[List[str]], bool) -> List[Dict[str, Any]]
         client = allocate_client_descriptor(
             dict(user_profile_id = self.user_profile.id,
                  user_profile_email = self.user_profile.email,
@@ -236,7 +238,8 @@ class EventsRegisterTest(AuthedTestCase):
                  all_public_streams = False,
                  queue_timeout = 600,
                  last_connection_time = time.time(),
-                 narrow = [])
+                 narrow = [],
+                 multi_user_peer_events = multi_user_peer_events)
             )
         # hybrid_state = initial fetch state + re-applying events triggered by our action
         # normal_state = do action then fetch at the end (the "normal" code path)
@@ -747,12 +750,20 @@ class EventsRegisterTest(AuthedTestCase):
             ('type', equals('subscription')),
             ('op', equals('peer_add')),
             ('user_email', check_string),
+            ('user_emails', check_list(check_string)),
             ('subscriptions', check_list(check_string)),
         ])
         peer_remove_schema_checker = check_dict([
             ('type', equals('subscription')),
             ('op', equals('peer_remove')),
             ('user_email', check_string),
+            ('user_emails', check_list(check_string)),
+            ('subscriptions', check_list(check_string)),
+        ])
+        multi_user_peer_add_schema_checker = check_dict([
+            ('type', equals('subscription')),
+            ('op', equals('peer_add')),
+            ('user_emails', check_list(check_string)),
             ('subscriptions', check_list(check_string)),
         ])
         stream_update_schema_checker = check_dict([
@@ -780,6 +791,26 @@ class EventsRegisterTest(AuthedTestCase):
         error = peer_remove_schema_checker('events[0]', events[0])
         self.assert_on_error(error)
 
+        # Clients that ask for them get one event about several users...
+        othello = get_user_profile_by_email("othello@zulip.com")
+        cordelia = get_user_profile_by_email("cordelia@zulip.com")
+        action = lambda: bulk_add_subscriptions([stream], [othello, cordelia])
+        events = self.do_test(action, multi_user_peer_events=True)
+        self.assertEqual(len(events), 1)
+        error = multi_user_peer_add_schema_checker('events[0]', events[0])
+        self.assert_on_error(error)
+        self.assertEqual(sorted(events[0]['user_emails']), [cordelia.email, othello.email])
+        self.assertNotIn('user_email', events[0])
+
+        # ... and the others one event per user, as before.
+        action = lambda: bulk_remove_subscriptions([othello, cordelia], [stream])
+        events = self.do_test(action)
+        self.assertEqual(sorted(event['user_email'] for event in events), [cordelia.email, othello.email])
+        for (i, event) in enumerate(events):
+            error = peer_remove_schema_checker('events[%d]' % (i,), event)
+            self.assert_on_error(error)
+            self.assertEqual(event['user_emails'], [event['user_email']])
+
         action = lambda: do_remove_subscription(get_user_profile_by_email("hamlet@zulip.com"), stream)
         events = self.do_test(action)
         error = remove_schema_checker('events[1]', events[1])
@@ -954,6 +985,314 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+from django.conf import settings
+from six.moves import urllib
+from zerver.lib.event_queue import get_notification_shards, get_sockjs_url, \
+    get_tornado_server, get_notify_tornado_queue_name
+import os
+import re
+
+class TornadoShardingTest(TestCase):
+    def nginx_map(self, variable, shards):
+        # type: (str, int) -> List[Tuple[Any, str]]
+        """The regex entries of one of the maps in the nginx upstreams
+        template, as puppet would render them for `shards` processes."""
+        template = open(os.path.join(settings.DEPLOY_ROOT, 'puppet/zulip/templates/nginx',
+                                     'upstreams.template.erb')).read()
+        body = template.split('map %s ' % (variable,))[1].split('}')[0]
+        entry = re.search(r'"~(.*)" (.*);', body)
+        return [(re.compile(entry.group(1).replace('<%= shard %>', str(shard))),
+                 entry.group(2).replace('<%= shard %>', str(shard)))
+                for shard in range(shards)]
+
+    def route(self, nginx_map, value):
+        # type: (List[Tuple[Any, str]], str) -> str
+        upstreams = [upstream for (regex, upstream) in nginx_map if regex.search(value)]
+        self.assertLessEqual(len(upstreams), 1)
+        return upstreams[0] if upstreams else 'tornado'
+
+    def test_nginx_routing(self):
+        # type: () -> None
+        events_map = self.nginx_map('$arg_queue_id', 12)
+        for shard in range(12):
+            queue_id = '1466000000:%d:%d' % (shard, 11)
+            self.assertEqual(self.route(events_map, queue_id), 'tornado%d' % (shard,))
+            # nginx matches the query string argument as it was sent.
+            self.assertEqual(self.route(events_map, urllib.parse.quote(queue_id)),
+                             'tornado%d' % (shard,))
+        # Queues of unsharded servers, and requests creating queues.
+        self.assertEqual(self.route(events_map, '1466000000:1'), 'tornado')
+        self.assertEqual(self.route(events_map, ''), 'tornado')
+
+        sockjs_map = self.nginx_map('$request_uri', 3)
+        with self.settings(TORNADO_PROCESSES=3):
+            for user_profile_id in range(3):
+                url = get_sockjs_url(user_profile_id) + '/123/abcd1234/websocket'
+                self.assertEqual(self.route(sockjs_map, url), 'tornado%d' % (user_profile_id,))
+        with self.settings(TORNADO_PROCESSES=1):
+            self.assertEqual(get_sockjs_url(1), '/sockjs')
+
+    def test_unsharded(self):
+        # type: () -> None
+        with self.settings(TORNADO_PROCESSES=1, TORNADO_SERVER='http://127.0.0.1:9993'):
+            self.assertEqual(get_notification_shards({'type': 'pointer'}, [1, 2, 3]),
+                             {0: [1, 2, 3]})
+            self.assertEqual(get_tornado_server(0), 'http://127.0.0.1:9993')
+            self.assertEqual(get_notify_tornado_queue_name(0), 'notify_tornado')
+
+    def test_partition_users(self):
+        # type: () -> None
+        with self.settings(TORNADO_PROCESSES=3, TORNADO_SERVER='http://127.0.0.1:9993'):
+            self.assertEqual(get_notification_shards({'type': 'pointer'}, [1, 2, 4, 6]),
+                             {0: [6], 1: [1, 4], 2: [2]})
+            users = [{'id': 3, 'flags': []}, {'id': 5, 'flags': ['mentioned']}]
+            self.assertEqual(get_notification_shards({'type': 'message'}, users),
+                             {0: [users[0]], 2: [users[1]]})
+            self.assertEqual(get_tornado_server(2), 'http://127.0.0.1:9995')
+            self.assertEqual(get_notify_tornado_queue_name(2), 'notify_tornado_shard2')
+
+    def test_public_stream_messages_reach_every_shard(self):
+        # type: () -> None
+        with self.settings(TORNADO_PROCESSES=3):
+            event = {'type': 'message', 'stream_name': 'Denmark', 'invite_only': False}
+            self.assertEqual(get_notification_shards(event, [{'id': 4}]),
+                             {0: [], 1: [{'id': 4}], 2: []})
+            event['invite_only'] = True
+            self.assertEqual(get_notification_shards(event, [{'id': 4}]),
+                             {1: [{'id': 4}]})
+
+from zerver.lib import event_queue
+from zerver.lib.event_queue import batch_events, process_notifications, send_event
+from zerver.lib.test_helpers import stub, tornado_redirected_to_list
+
+class BatchEventsTest(TestCase):
+    def test_batch_events(self):
+        # type: () -> None
+        published = [] # type: List[Tuple[int, Dict[str, Any]]]
+        def publish(shard, data):
+            # type: (int, Dict[str, Any]) -> None
+            published.append((shard, data))
+
+        old_batch_size = event_queue.NOTIFY_TORNADO_BATCH_SIZE
+        event_queue.NOTIFY_TORNADO_BATCH_SIZE = 2
+        try:
+            with stub(event_queue, 'publish_notification', publish):
+                send_event({'type': 'pointer', 'pointer': 1}, [1])
+                self.assertEqual(len(published), 1)
+                self.assertEqual(published[0][1], dict(event={'type': 'pointer', 'pointer': 1},
+                                                       users=[1]))
+
+                del published[:]
+                with batch_events():
+                    with batch_events():
+                        for pointer in range(3):
+                            send_event({'type': 'pointer', 'pointer': pointer}, [1])
+                    # The first two notices filled a batch; the third
+                    # waits for the outermost block to exit.
+                    self.assertEqual(len(published), 1)
+                self.assertEqual([len(data['notices']) for (shard, data) in published], [2, 1])
+                self.assertEqual([notice['event']['pointer']
+                                  for (shard, data) in published
+                                  for notice in data['notices']], [0, 1, 2])
+        finally:
+            event_queue.NOTIFY_TORNADO_BATCH_SIZE = old_batch_size
+
+        events = [] # type: List[Dict[str, Any]]
+        with tornado_redirected_to_list(events):
+            process_notifications(published[0][1])
+            process_notifications(dict(event={'type': 'pointer', 'pointer': 3}, users=[1]))
+        self.assertEqual([notice['event']['pointer'] for notice in events], [0, 1, 3])
+
+from zerver.lib.event_queue import do_gc_event_queues, \
+    get_client_descriptors_for_realm_narrowed
+from zerver.lib.narrow import build_narrow_filter
+
+class NarrowFilterTest(TestCase):
+    def test_build_narrow_filter(self):
+        # type: () -> None
+        narrow_filter = build_narrow_filter([["stream", "Denmark"], ["topic", "Lunch"]])
+        message = {"type": "stream", "display_recipient": "denmark", "subject": "LUNCH",
+                   "sender_email": "hamlet@zulip.com"}
+        self.assertTrue(narrow_filter({"message": message, "flags": []}))
+        self.assertFalse(narrow_filter({"message": dict(message, subject="dinner"), "flags": []}))
+        self.assertFalse(narrow_filter({"message": dict(message, type="private"), "flags": []}))
+
+        narrow_filter = build_narrow_filter([["is", "mentioned"]])
+        self.assertTrue(narrow_filter({"message": message, "flags": ["mentioned"]}))
+        self.assertFalse(narrow_filter({"message": message, "flags": []}))
+
+        self.assertTrue(build_narrow_filter([])({"message": message, "flags": []}))
+
+    def test_narrowed_queue_index(self):
+        # type: () -> None
+        def allocate(narrow):
+            # type: (List[List[str]]) -> str
+            client = allocate_client_descriptor(
+                dict(user_profile_id = 1,
+                     user_profile_email = "hamlet@zulip.com",
+                     realm_id = 999,
+                     event_types = None,
+                     client_type_name = "website",
+                     apply_markdown = True,
+                     all_public_streams = False,
+                     queue_timeout = 600,
+                     last_connection_time = time.time(),
+                     narrow = narrow))
+            return client.event_queue.id
+
+        denmark = allocate([["stream", "Denmark"]])
+        sender = allocate([["sender", "othello@zulip.com"]])
+        private = allocate([["is", "private"]])
+
+        def narrowed_queue_ids(stream_name):
+            # type: (str) -> Set[str]
+            return set(client.event_queue.id for client in
+                       get_client_descriptors_for_realm_narrowed(999, stream_name))
+
+        self.assertEqual(narrowed_queue_ids("denmark"), {denmark, sender})
+        self.assertEqual(narrowed_queue_ids("Verona"), {sender})
+
+        do_gc_event_queues({denmark, sender, private}, {1}, {999})
+        self.assertEqual(narrowed_queue_ids("Denmark"), set())
+
+from zerver.lib.event_journal import EventQueueJournal, EventQueueSnapshot, write_snapshot
+from zerver.lib.event_queue import ClientDescriptor, get_client_descriptor, load_event_queues_until, \
+    restore_event_queue
+import mock
+import os
+import shutil
+import tempfile
+
+class EventQueueJournalTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "event_queues.json")
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_snapshot_round_trip(self):
+        # type: () -> None
+        clients = [("1:0", {"user_profile_id": 1}), ("1:1", {"user_profile_id": 2})]
+        self.assertEqual(write_snapshot(self.filename, 3, iter(clients)), 2)
+        snapshot = EventQueueSnapshot(self.filename)
+        self.assertEqual(snapshot.journal_segment, 3)
+        self.assertEqual(sorted(snapshot.queue_ids), ["1:0", "1:1"])
+        self.assertEqual(snapshot.read_client("1:1"), {"user_profile_id": 2})
+        self.assertEqual(list(snapshot.clients()), clients)
+
+    def test_legacy_snapshot(self):
+        # type: () -> None
+        clients = [["1:0", {"user_profile_id": 1}]]
+        with open(self.filename, "w") as stored_queues:
+            ujson.dump(clients, stored_queues)
+        snapshot = EventQueueSnapshot(self.filename)
+        self.assertEqual(snapshot.journal_segment, 0)
+        self.assertEqual(snapshot.queue_ids, None)
+        self.assertEqual(list(snapshot.clients()), [("1:0", {"user_profile_id": 1})])
+
+    def test_journal_segments(self):
+        # type: () -> None
+        journal = EventQueueJournal(self.filename)
+        self.assertEqual(journal.segment, 1)
+        journal.record("create", "1:0", {"user_profile_id": 1})
+        journal.record("event", "1:0", {"type": "pointer", "pointer": 5})
+        new_segment = journal.rotate()
+        journal.record("prune", "1:0", [0, 1000.0])
+        journal.flush()
+
+        self.assertEqual(list(journal.read_segments(1, new_segment)),
+                         [("create", "1:0", {"user_profile_id": 1}),
+                          ("event", "1:0", {"type": "pointer", "pointer": 5})])
+        self.assertEqual(list(journal.read_segments(new_segment, new_segment + 1)),
+                         [("prune", "1:0", [0, 1000.0])])
+
+        journal.remove_segments_before(new_segment)
+        self.assertEqual(journal.existing_segments(), [new_segment])
+        journal.close()
+
+        # A restarted server appends to a fresh segment
+        restarted_journal = EventQueueJournal(self.filename)
+        self.assertEqual(restarted_journal.segment, new_segment + 1)
+        restarted_journal.close()
+
+    def allocate_client(self):
+        # type: () -> ClientDescriptor
+        return allocate_client_descriptor(
+            dict(user_profile_id = 1,
+                 user_profile_email = "hamlet@zulip.com",
+                 realm_id = 999,
+                 event_types = None,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = []))
+
+    def test_replay_resolved_virtual_events(self):
+        # type: () -> None
+        def read_flag_event(message_id):
+            # type: (int) -> Dict[str, Any]
+            return dict(type="update_message_flags", flag="read", operation="add",
+                        all=False, messages=[message_id])
+
+        journal = EventQueueJournal(self.filename)
+        with mock.patch.object(event_queue, 'journal', journal):
+            client = self.allocate_client()
+            queue_id = client.event_queue.id
+            client.add_event(read_flag_event(1))
+            self.assertEqual([event['messages'] for event in client.event_queue_contents()], [[1]])
+            client.add_event(read_flag_event(2))
+            # The client acknowledges the first flags event.
+            client.event_queue.prune(0)
+            event_queue.journal_record('prune', queue_id, [0, client.last_connection_time])
+            journal.flush()
+            live_queue = client.event_queue.to_dict()
+            do_gc_event_queues({queue_id}, {1}, {999})
+
+        journal_backlog = {} # type: Dict[str, List[Tuple[str, Any]]]
+        for (op, qid, data) in journal.read_segments(0, journal.segment + 1):
+            journal_backlog.setdefault(qid, []).append((op, data))
+        journal.close()
+        with mock.patch.object(event_queue, 'journal_backlog', journal_backlog):
+            restore_event_queue(queue_id, None)
+        restored = get_client_descriptor(queue_id)
+        # Only the unacknowledged flag change is left.
+        self.assertEqual(restored.event_queue.to_dict(), live_queue)
+        self.assertEqual([event['messages'] for event in restored.event_queue.contents()], [[2]])
+        do_gc_event_queues({queue_id}, {1}, {999})
+
+    def test_restore_queue_from_index(self):
+        # type: () -> None
+        queues = [self.allocate_client() for i in range(3)]
+        queue_ids = [client.event_queue.id for client in queues]
+        write_snapshot(self.filename, 1, [(client.event_queue.id, client.to_dict())
+                                          for client in queues])
+        do_gc_event_queues(set(queue_ids), {1}, {999})
+
+        snapshot = EventQueueSnapshot(self.filename)
+        with mock.patch.object(event_queue, 'loading_snapshot', snapshot), \
+                mock.patch.object(event_queue, 'loading_clients', snapshot.clients()), \
+                mock.patch.object(event_queue, 'journal_backlog', {}):
+            # A queue id that isn't in the snapshot is unknown without
+            # reading any of it.
+            self.assertIsNone(get_client_descriptor("1:garbage"))
+            self.assertEqual(snapshot.file.tell(), snapshot.data_start)
+
+            # A queue in the middle is looked up, and not restored
+            # again when the load gets to it.
+            client = get_client_descriptor(queue_ids[1])
+            self.assertEqual(client.to_dict(), queues[1].to_dict())
+            self.assertEqual(snapshot.file.tell(), snapshot.data_start)
+            self.assertTrue(load_event_queues_until(None))
+            self.assertIs(get_client_descriptor(queue_ids[1]), client)
+            for queue_id in queue_ids:
+                self.assertIsNotNone(get_client_descriptor(queue_id))
+        do_gc_event_queues(set(queue_ids), {1}, {999})
+
 class TestEventsRegisterAllPublicStreamsDefaults(TestCase):
     def setUp(self):
         # type: () -> None
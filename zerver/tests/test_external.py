@@ -9,8 +9,13 @@ from zerver.forms import not_mit_mailing_list
 
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    api_calls_left,
+    block_user,
+    check_and_incr_ratelimit,
     clear_user_history,
     remove_ratelimit_rule,
+    token_leases,
+    unblock_user,
 )
 
 from zerver.lib.actions import compute_mit_user_fullname
@@ -127,6 +132,32 @@ class RateLimitTests(AuthedTestCase):
 
         self.assert_json_success(result)
 
+    def test_manual_block(self):
+        # type: () -> None
+        user = get_user_profile_by_email("hamlet@zulip.com")
+        clear_user_history(user)
+        block_user(user, 30)
+        ratelimited, time_till_free, _ = check_and_incr_ratelimit(user)
+        unblock_user(user)
+        self.assertTrue(ratelimited)
+        self.assertTrue(0 < time_till_free <= 30)
+        self.assertEqual(api_calls_left(user)[0], 100)
+
+    def test_local_tokens(self):
+        # type: () -> None
+        user = get_user_profile_by_email("hamlet@zulip.com")
+        clear_user_history(user)
+        token_leases.clear()
+        with self.settings(RATE_LIMITING_LOCAL_TOKENS=4):
+            results = [check_and_incr_ratelimit(user) for i in range(6)]
+        token_leases.clear()
+
+        # One call, then (once the user is busy) two, then as many of
+        # four as the 5 calls a second rule still allows.
+        self.assertEqual([result[0] for result in results], [False] * 5 + [True])
+        self.assertEqual([result[2] for result in results[:5]], [99, 98, 97, 96, 95])
+        self.assertEqual(api_calls_left(user)[0], 95)
+
 class APNSTokenTests(AuthedTestCase):
     def test_add_token(self):
         # type: () -> None
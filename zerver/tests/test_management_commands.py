@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+import tempfile
 from mock import patch
 from django.test import TestCase
 from django.conf import settings
 from django.core.management import call_command
-from zerver.models import get_realm
+from zerver.models import Message, Recipient, UserMessage, get_realm
 from confirmation.models import RealmCreationKey, generate_realm_creation_url
 from datetime import timedelta
 from zerver.lib.test_helpers import AuthedTestCase
@@ -110,3 +112,27 @@ class TestGenerateRealmCreationLink(AuthedTestCase):
             result = self.client.get(generated_link)
             self.assertEquals(result.status_code, 200)
             self.assert_in_response("The organization creation link has been expired or is not valid.", result)
+
+class TestRealmMessagesExport(AuthedTestCase):
+    def test_export_and_import(self):
+        # type: () -> None
+        realm = get_realm("zulip.com")
+        self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, u"exported \u2603\tmessage\\", "export")
+        message_count = Message.objects.filter(sender__realm=realm).count()
+        usermessage_count = UserMessage.objects.filter(user_profile__realm=realm).count()
+
+        output_dir = os.path.join(tempfile.mkdtemp(), "export")
+        try:
+            call_command("export_realm_messages", "zulip.com", output_dir, processes=1)
+            # Importing into the realm we exported duplicates its messages.
+            call_command("import_realm_messages", "zulip.com", output_dir)
+        finally:
+            shutil.rmtree(os.path.dirname(output_dir))
+
+        self.assertEqual(Message.objects.filter(sender__realm=realm).count(), 2 * message_count)
+        self.assertEqual(UserMessage.objects.filter(user_profile__realm=realm).count(),
+                         2 * usermessage_count)
+        message = Message.objects.filter(sender__realm=realm).order_by("-id")[0]
+        self.assertEqual(message.content, u"exported \u2603\tmessage\\")
+        self.assertEqual(message.subject, "export")
+        self.assertEqual(message.sender.email, "hamlet@zulip.com")
@@ -18,14 +18,16 @@ from zerver.lib.test_helpers import (
 
 from zerver.models import (
     MAX_MESSAGE_LENGTH, MAX_SUBJECT_LENGTH,
-    Client, Message, Realm, Recipient, Stream, UserMessage, UserProfile, Attachment,
+    Client, Message, Realm, Recipient, Stream, Subscription, UserMessage, UserProfile,
+    Attachment,
     get_realm, get_stream, get_user_profile_by_email,
 )
 
 from zerver.lib.actions import (
     check_message, check_send_message,
     create_stream_if_needed,
-    do_add_subscription, do_create_user,
+    do_add_subscription, do_create_user, do_send_messages,
+    internal_prep_message,
 )
 
 from zerver.lib.upload import create_attachment
@@ -319,6 +321,35 @@ class StreamMessagesTest(AuthedTestCase):
 
         self.assert_length(queries, 7)
 
+    def test_send_message_batch(self):
+        for email in ['iago@zulip.com', 'cordelia@zulip.com']:
+            self.subscribe_to_stream(email, "Denmark")
+        self.subscribe_to_stream('othello@zulip.com', "Scotland")
+
+        messages = [
+            internal_prep_message('hamlet@zulip.com', 'stream', 'Denmark', 'batch', 'one'),
+            internal_prep_message('hamlet@zulip.com', 'private', 'othello@zulip.com', '', 'two'),
+            internal_prep_message('hamlet@zulip.com', 'stream', 'Scotland', 'batch', 'three'),
+            internal_prep_message('hamlet@zulip.com', 'stream', 'Denmark', 'batch', 'four'),
+        ]
+        message_ids = do_send_messages(messages)
+
+        def recipient_emails(message_id):
+            return set(UserMessage.objects.filter(message_id=message_id).values_list(
+                'user_profile__email', flat=True))
+
+        denmark_emails = set(sub.user_profile.email for sub in Subscription.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id=get_stream('Denmark', get_realm('zulip.com')).id,
+            active=True, user_profile__is_active=True))
+        self.assertIn('cordelia@zulip.com', denmark_emails)
+        self.assertEqual(recipient_emails(message_ids[0]), denmark_emails)
+        self.assertEqual(recipient_emails(message_ids[1]),
+                         set(['hamlet@zulip.com', 'othello@zulip.com']))
+        self.assertIn('othello@zulip.com', recipient_emails(message_ids[2]))
+        self.assertNotIn('cordelia@zulip.com', recipient_emails(message_ids[2]))
+        self.assertEqual(recipient_emails(message_ids[3]), denmark_emails)
+
     def test_message_mentions(self):
         user_profile = get_user_profile_by_email("iago@zulip.com")
         self.subscribe_to_stream(user_profile.email, "Denmark")
@@ -23,6 +23,7 @@ from zerver.models import (
 )
 
 from zerver.lib.actions import (
+    bulk_add_subscriptions, bulk_remove_subscriptions,
     create_stream_if_needed, do_add_default_stream, do_add_subscription, do_change_is_admin,
     do_create_realm, do_remove_default_stream, do_set_realm_create_stream_by_admins_only,
     gather_subscriptions, get_default_streams_for_realm, get_realm, get_stream,
@@ -1088,6 +1089,38 @@ class SubscriptionAPITest(AuthedTestCase):
         self.assertEqual(add_peer_event['event']['user_email'], email3)
 
 
+    def test_bulk_peer_events(self):
+        # type: () -> None
+        realm = get_realm("zulip.com")
+        stream, _ = create_stream_if_needed(realm, "bulk_peer_stream")
+        do_add_subscription(get_user_profile_by_email(self.test_email), stream)
+        users = [get_user_profile_by_email(email) for email in
+                 ['cordelia@zulip.com', 'iago@zulip.com']]
+
+        events = [] # type: List[Dict[str, Any]]
+        with tornado_redirected_to_list(events):
+            bulk_add_subscriptions([stream], users)
+
+        # One add event per new subscriber, and one peer_add for both.
+        peer_events = [event for event in events if event['event'].get('op') == 'peer_add']
+        self.assert_length(peer_events, 1, exact=True)
+        self.assertEqual(peer_events[0]['users'], [get_user_profile_by_email(self.test_email).id])
+        self.assertEqual(peer_events[0]['event']['subscriptions'], [stream.name])
+        self.assertEqual(peer_events[0]['event']['user_emails'],
+                         ['cordelia@zulip.com', 'iago@zulip.com'])
+        self.assertEqual(len([event for event in events if event['event'].get('op') == 'add']), 2)
+
+        events = []
+        with tornado_redirected_to_list(events):
+            bulk_remove_subscriptions(users, [stream])
+
+        peer_events = [event for event in events if event['event'].get('op') == 'peer_remove']
+        self.assert_length(peer_events, 1, exact=True)
+        self.assertEqual(peer_events[0]['users'], [get_user_profile_by_email(self.test_email).id])
+        self.assertEqual(peer_events[0]['event']['user_emails'],
+                         ['cordelia@zulip.com', 'iago@zulip.com'])
+        self.assertEqual(stream.num_subscribers(), 1)
+
     def test_bulk_subscribe_MIT(self):
         # type: () -> None
         realm = get_realm("mit.edu")
@@ -2,7 +2,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from typing import Any, Callable, Dict, Iterable, List, Tuple, TypeVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
 from mock import patch, MagicMock
 
 from django.http import HttpResponse
@@ -15,12 +15,16 @@ from zerver.lib.test_helpers import (
 )
 
 from zerver.models import UserProfile, Recipient, \
-    Realm, Client, UserActivity, \
+    Realm, Client, UserActivity, UserActivityInterval, UserPresence, \
     get_user_profile_by_email, split_email_to_domain, get_realm, \
-    get_client, get_stream, Message, get_unique_open_realm, \
-    completely_open
+    get_client, get_stream, Message, get_unique_open_realm, get_user_profile_by_id, \
+    extract_message_dict, stringify_message_dict, get_client_cache_key, \
+    completely_open, PushDeviceToken
 
 from zerver.lib.avatar import get_avatar_url
+from zerver.lib.cache import LocalCache, cache_delete_many, cache_get, \
+    generic_bulk_cached_fetch, local_cache, remote_cache_set, user_profile_by_id_cache_key
+from zerver.lib.cache_helpers import fill_remote_cache, fill_remote_cache_checkpoint_key
 from zerver.lib.initial_password import initial_password
 from zerver.lib.email_mirror import create_missed_message_address
 from zerver.lib.actions import \
@@ -31,7 +35,10 @@ from zerver.lib.actions import \
 from zerver.lib.alert_words import alert_words_in_realm, user_alert_words, \
     add_user_alert_words, remove_user_alert_words
 from zerver.lib.notifications import handle_missedmessage_emails
+from zerver.lib.push_notifications import PUSH_NOTIFICATION_MAX_RETRIES, \
+    PUSH_NOTIFICATION_RETRY_DELAY
 from zerver.lib.session_user import get_session_dict_user
+from zerver.lib.timestamp import datetime_to_timestamp, timestamp_to_datetime
 from zerver.middleware import is_slow_query
 
 from zerver.worker import queue_processors
@@ -47,6 +54,7 @@ import sys
 import time
 import ujson
 import random
+import zlib
 
 def bail(msg):
     # type: (str) -> None
@@ -324,6 +332,8 @@ class WorkerTest(TestCase):
             # type: () -> None
             self.consumers = {} # type: Dict[str, Callable]
             self.queue = [] # type: List[Tuple[str, Dict[str, Any]]]
+            self.delivery_tag = 0
+            self.unacked = [] # type: List[int]
 
         def register_json_consumer(self, queue_name, callback):
             # type: (str, Callable) -> None
@@ -335,6 +345,25 @@ class WorkerTest(TestCase):
                 callback = self.consumers[queue_name]
                 callback(data)
 
+        def drain_queue(self, queue_name, json):
+            # type: (str, bool) -> List[Dict[str, Any]]
+            events = [data for (name, data) in self.queue if name == queue_name]
+            self.queue = [(name, data) for (name, data) in self.queue if name != queue_name]
+            return events
+
+        def json_consume(self, queue_name, prefetch_count, inactivity_timeout):
+            # type: (str, int, float) -> Iterator[Optional[Tuple[int, Any]]]
+            # Delivers what's on the queue, then times out once.
+            for data in self.drain_queue(queue_name, json=True):
+                self.delivery_tag += 1
+                self.unacked.append(self.delivery_tag)
+                yield (self.delivery_tag, data)
+            yield None
+
+        def ack(self, delivery_tag, multiple=False):
+            # type: (int, bool) -> None
+            self.unacked = [tag for tag in self.unacked
+                            if tag > delivery_tag or (tag < delivery_tag and not multiple)]
 
     def test_UserActivityWorker(self):
         # type: () -> None
@@ -353,17 +382,62 @@ class WorkerTest(TestCase):
                 query = 'send_message'
         )
         fake_client.queue.append(('user_activity', data))
+        fake_client.queue.append(('user_activity', dict(data, time=data['time'] + 10)))
+        fake_client.queue.append(('user_activity', dict(data, query='get_events_backend')))
 
         with simulated_queue_client(lambda: fake_client):
             worker = queue_processors.UserActivityWorker()
             worker.setup()
             worker.start()
+            self.assertEqual(fake_client.unacked, [])
             activity_records = UserActivity.objects.filter(
                     user_profile = user.id,
                     client = get_client('ios')
-            )
-            self.assertTrue(len(activity_records), 1)
-            self.assertTrue(activity_records[0].count, 1)
+            ).order_by('query')
+            self.assertEqual([(record.query, record.count) for record in activity_records],
+                             [('get_events_backend', 1), ('send_message', 2)])
+            self.assertEqual(datetime_to_timestamp(activity_records[1].last_visit),
+                             int(data['time'] + 10))
+
+        # A second batch adds to the existing rows.
+        fake_client.queue.append(('user_activity', data))
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            worker.start()
+        self.assertEqual(UserActivity.objects.get(user_profile=user.id, client=get_client('ios'),
+                                                  query='send_message').count, 3)
+
+    def test_UserPresenceWorker(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserPresence.objects.filter(user_profile=user).delete()
+        now = time.time()
+        for (offset, status) in [(0, UserPresence.ACTIVE), (20, UserPresence.IDLE)]:
+            fake_client.queue.append(('user_presence', dict(user_profile_id=user.id, client='website',
+                                                            time=now + offset, status=status)))
+            fake_client.queue.append(('user_activity_interval', dict(user_profile_id=user.id,
+                                                                     time=now + offset)))
+        fake_client.queue.append(('user_activity_interval', dict(user_profile_id=user.id,
+                                                                 time=now + 3600)))
+
+        with simulated_queue_client(lambda: fake_client):
+            for worker in [queue_processors.UserPresenceWorker(),
+                           queue_processors.UserActivityIntervalWorker()]:
+                worker.setup()
+                worker.start()
+
+        # Only the latest update for a user and client counts.
+        presence = UserPresence.objects.get(user_profile=user, client=get_client('website'))
+        self.assertEqual(presence.status, UserPresence.IDLE)
+        self.assertEqual(datetime_to_timestamp(presence.timestamp), int(now + 20))
+        intervals = UserActivityInterval.objects.filter(user_profile=user,
+                                                        start__gte=timestamp_to_datetime(now - 1)).order_by('start')
+        self.assertEqual([(datetime_to_timestamp(interval.start), datetime_to_timestamp(interval.end))
+                          for interval in intervals],
+                         [(int(now), int(now + 20 + 15 * 60)),
+                          (int(now + 3600), int(now + 3600 + 15 * 60))])
 
     def test_error_handling(self):
         # type: () -> None
@@ -403,6 +477,45 @@ class WorkerTest(TestCase):
         event = ujson.loads(line.split('\t')[1])
         self.assertEqual(event, 'unexpected behaviour')
 
+    def test_loop_worker(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        batches = [] # type: List[Tuple[List[int], List[int]]]
+
+        @queue_processors.assign_queue('batched_worker')
+        class BatchedWorker(queue_processors.LoopQueueProcessingWorker):
+            batch_size = 2
+
+            def consume_batch(self, events):
+                # type: (List[int]) -> None
+                batches.append((events, list(fake_client.unacked)))
+                if 3 in events:
+                    raise Exception('Worker task not performing as expected!')
+
+            def _log_problem(self):
+                # type: () -> None
+                pass
+
+        for event in range(1, 6):
+            fake_client.queue.append(('batched_worker', event))
+
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'batched_worker.errors')
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = BatchedWorker()
+            worker.setup()
+            worker.start()
+
+        # Each batch is still unacked while it's being handled, and
+        # acked afterwards, even if handling it failed.
+        self.assertEqual(batches, [([1, 2], [1, 2]), ([3, 4], [3, 4]), ([5], [5])])
+        self.assertEqual(fake_client.unacked, [])
+        self.assertEqual([ujson.loads(line.split('\t')[1]) for line in open(fn)], [3, 4])
+
     def test_worker_noname(self):
         # type: () -> None
         class TestWorker(queue_processors.QueueProcessingWorker):
@@ -427,6 +540,75 @@ class WorkerTest(TestCase):
             worker = TestWorker()
             worker.consume({})
 
+class PushNotificationsWorkerTest(AuthedTestCase):
+    class FakeGCMResponse(object):
+        status_code = 200
+        headers = {} # type: Dict[str, str]
+
+        def __init__(self, registration_ids):
+            # type: (List[text_type]) -> None
+            results = {u'sent': {'message_id': '0:1'},
+                       u'unavailable': {'error': 'Unavailable'},
+                       u'gone': {'error': 'NotRegistered'}}
+            self.results = [results[reg_id] for reg_id in registration_ids]
+
+        def json(self):
+            # type: () -> Dict[str, Any]
+            return {'results': self.results}
+
+    def send_notices(self, notices):
+        # type: (List[Dict[str, Any]]) -> Tuple[MagicMock, MagicMock]
+        fake_client = WorkerTest.FakeClient()
+        for notice in notices:
+            fake_client.queue.append(('missedmessage_mobile_notifications', notice))
+        with simulated_queue_client(lambda: fake_client), \
+                self.settings(ANDROID_GCM_API_KEY='key'), \
+                patch('zerver.lib.push_notifications.post_to_gcm',
+                      side_effect=lambda reg_ids, data: self.FakeGCMResponse(reg_ids)) as post_to_gcm, \
+                patch('zerver.lib.push_notifications.queue_json_publish_delayed') as queue_json_publish_delayed:
+            worker = queue_processors.PushNotificationsWorker()
+            worker.setup()
+            worker.start()
+        return (post_to_gcm, queue_json_publish_delayed)
+
+    def test_retries(self):
+        # type: () -> None
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        for token in ['sent', 'unavailable', 'gone']:
+            PushDeviceToken.objects.create(user=user, kind=PushDeviceToken.GCM, token=token)
+        message_id = self.send_message("othello@zulip.com", "hamlet@zulip.com", Recipient.PERSONAL)
+        other_message_id = self.send_message("othello@zulip.com", "hamlet@zulip.com", Recipient.PERSONAL)
+
+        (post_to_gcm, queue_json_publish_delayed) = self.send_notices(
+            [dict(user_profile_id=user.id, message_id=message_id),
+             dict(user_profile_id=user.id, message_id=other_message_id)])
+        self.assertEqual(sorted((sorted(call[0][0]), call[0][1]['zulip_message_id'])
+                                for call in post_to_gcm.call_args_list),
+                         [(['gone', 'sent', 'unavailable'], message_id),
+                          (['gone', 'sent', 'unavailable'], other_message_id)])
+        self.assertFalse(PushDeviceToken.objects.filter(token='gone').exists())
+        # Each notice is requeued, after a delay, for the device GCM
+        # was unavailable for.
+        retries = sorted((call[0][1:3] for call in queue_json_publish_delayed.call_args_list),
+                         key=lambda retry: retry[0]['message_id'])
+        self.assertEqual([(notice['message_id'], notice['devices'], notice['retries'], delay)
+                          for (notice, delay) in retries],
+                         [(message_id, ['unavailable'], 1, PUSH_NOTIFICATION_RETRY_DELAY),
+                          (other_message_id, ['unavailable'], 1, PUSH_NOTIFICATION_RETRY_DELAY)])
+
+        # The retry only goes to that device, and backs off further.
+        (post_to_gcm, queue_json_publish_delayed) = self.send_notices([retries[0][0]])
+        self.assertEqual([call[0][0] for call in post_to_gcm.call_args_list], [['unavailable']])
+        (notice, delay) = queue_json_publish_delayed.call_args[0][1:3]
+        self.assertEqual((notice['devices'], notice['retries'], delay),
+                         (['unavailable'], 2, 2 * PUSH_NOTIFICATION_RETRY_DELAY))
+
+        # And eventually we give up.
+        (post_to_gcm, queue_json_publish_delayed) = self.send_notices(
+            [dict(retries[0][0], retries=PUSH_NOTIFICATION_MAX_RETRIES)])
+        self.assertEqual(post_to_gcm.call_count, 1)
+        self.assertFalse(queue_json_publish_delayed.called)
+
 class ActivityTest(AuthedTestCase):
     def test_activity(self):
         # type: () -> None
@@ -457,6 +639,102 @@ class UserProfileTest(TestCase):
         self.assertEqual(dct[hamlet.id], 'hamlet@zulip.com')
         self.assertEqual(dct[othello.id], 'othello@zulip.com')
 
+class FillRemoteCacheTest(TestCase):
+    def test_resume(self):
+        # type: () -> None
+        clients = list(Client.objects.order_by('id'))
+        self.assertTrue(len(clients) >= 2)
+        keys = [get_client_cache_key(client.name) for client in clients]
+        cache_delete_many(keys)
+        remote_cache_set(fill_remote_cache_checkpoint_key('client'), clients[-2].id)
+
+        # Only the clients after the checkpoint are filled in.
+        fill_remote_cache('client', resume=True)
+        self.assertEqual(cache_get(keys[-1])[0].id, clients[-1].id)
+        self.assertIsNone(cache_get(keys[-2]))
+        self.assertIsNone(cache_get(fill_remote_cache_checkpoint_key('client')))
+
+        fill_remote_cache('client')
+        self.assertEqual(cache_get(keys[0])[0].id, clients[0].id)
+
+class LocalCacheTest(TestCase):
+    def test_lru_and_stats(self):
+        # type: () -> None
+        local_cache = LocalCache()
+        with self.settings(LOCAL_CACHE_SIZE=2, LOCAL_CACHE_TTL=60):
+            local_cache.set(u'get_recipient:1:1', 'get_recipient', 'one')
+            local_cache.set(u'get_recipient:1:2', 'get_recipient', 'two')
+            self.assertEqual(local_cache.get(u'get_recipient:1:1', 'get_recipient'), ('one',))
+            local_cache.set(u'get_recipient:1:3', 'get_recipient', 'three')
+            # get_recipient:1:2 was the least recently used entry
+            self.assertIsNone(local_cache.get(u'get_recipient:1:2', 'get_recipient'))
+            self.assertEqual(local_cache.get(u'get_recipient:1:3', 'get_recipient'), ('three',))
+        self.assertEqual(local_cache.stats['get_recipient'],
+                         dict(hit=2, miss=1, eviction=1))
+
+        with self.settings(LOCAL_CACHE_SIZE=2, LOCAL_CACHE_TTL=-1):
+            local_cache.set(u'get_recipient:1:4', 'get_recipient', 'four')
+            self.assertIsNone(local_cache.get(u'get_recipient:1:4', 'get_recipient'))
+
+    def test_invalidation(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        other_process_cache = LocalCache()
+        with self.settings(LOCAL_CACHE_SIZE=100):
+            other_process_cache.sync()
+            hits = local_cache.stats['user_profile_by_id']['hit']
+            self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, hamlet.full_name)
+            self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, hamlet.full_name)
+            self.assertEqual(local_cache.stats['user_profile_by_id']['hit'], hits + 1)
+            key = user_profile_by_id_cache_key(hamlet.id)
+            other_process_cache.set(key, 'user_profile_by_id', hamlet)
+
+            # Saving the user invalidates this process's copy directly,
+            # and the other process's copy once it syncs.
+            hamlet.full_name = 'Prince Hamlet'
+            hamlet.save(update_fields=['full_name'])
+            self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, 'Prince Hamlet')
+            other_process_cache.sync()
+            self.assertIsNone(other_process_cache.get(key, 'user_profile_by_id'))
+        local_cache.clear()
+
+class GenericBulkCachedFetchTest(TestCase):
+    def test_chunks_and_negative_cache(self):
+        # type: () -> None
+        queried = [] # type: List[List[int]]
+        def query_function(ids):
+            # type: (List[int]) -> List[Dict[str, int]]
+            queried.append(ids)
+            return [dict(id=object_id) for object_id in ids if object_id % 2 == 0]
+
+        def fetch(ids):
+            # type: (List[int]) -> Dict[int, Any]
+            return generic_bulk_cached_fetch(lambda object_id: u'bulk_fetch_test:%d' % (object_id,),
+                                             query_function, ids,
+                                             id_fetcher=lambda obj: obj['id'],
+                                             chunk_size=2,
+                                             negative_cache_timeout=60)
+
+        self.assertEqual(fetch([1, 2, 3, 4, 5]), {2: dict(id=2), 4: dict(id=4)})
+        self.assertEqual(queried, [[1, 2], [3, 4], [5]])
+
+        # The even ids are cached, and the odd ones are known to be missing.
+        queried = []
+        self.assertEqual(fetch([1, 2, 3, 4, 5, 6]), {2: dict(id=2), 4: dict(id=4), 6: dict(id=6)})
+        self.assertEqual(queried, [[6]])
+
+    def test_message_dict_compression(self):
+        # type: () -> None
+        small = dict(id=1, content='short')
+        large = dict(id=2, content='long ' * 1000)
+        self.assertEqual(stringify_message_dict(small)[:1], b'{')
+        self.assertNotEqual(stringify_message_dict(large)[:1], b'{')
+        self.assertEqual(extract_message_dict(stringify_message_dict(small)), small)
+        self.assertEqual(extract_message_dict(stringify_message_dict(large)), large)
+        # Entries cached before small dicts were stored uncompressed
+        self.assertEqual(extract_message_dict(zlib.compress(ujson.dumps(small).encode('utf-8'))),
+                         small)
+
 class UserChangesTest(AuthedTestCase):
     def test_update_api_key(self):
         # type: () -> None
@@ -1511,6 +1789,36 @@ class UserPresenceTests(AuthedTestCase):
         self.assertEqual(json['presences'][email][client]['status'], 'active')
         self.assertEqual(json['presences']['hamlet@zulip.com'][client]['status'], 'idle')
 
+    def test_presences_since(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        self.client.post("/json/users/me/presence", {'status': 'active'})
+        result = self.client.post("/json/users/me/presence", {'status': 'active'})
+        self.assert_json_success(result)
+        json = ujson.loads(result.content)
+        self.assertNotIn('presences_since', json)
+        since = json['server_timestamp']
+
+        self.login("othello@zulip.com")
+        self.client.post("/json/users/me/presence", {'status': 'idle'})
+
+        self.login("hamlet@zulip.com")
+        result = self.client.post("/json/users/me/presence", {'status': 'active',
+                                                               'presences_since': repr(since)})
+        self.assert_json_success(result)
+        json = ujson.loads(result.content)
+        self.assertEqual(json['presences_since'], since)
+        self.assertEqual(json['presences']['othello@zulip.com']['website']['status'], 'idle')
+
+        # Deactivated users are sent with no clients, so that clients drop them.
+        do_deactivate_user(get_user_profile_by_email("othello@zulip.com"))
+        result = self.client.post("/json/users/me/presence", {'status': 'active',
+                                                               'presences_since': repr(json['server_timestamp'])})
+        json = ujson.loads(result.content)
+        self.assertEqual(json['presences']['othello@zulip.com'], {})
+        result = self.client.post("/json/users/me/presence", {'status': 'active'})
+        self.assertNotIn('othello@zulip.com', ujson.loads(result.content)['presences'])
+
     def test_no_mit(self):
         # type: () -> None
         """MIT never gets a list of users"""
@@ -1861,6 +2169,52 @@ class TestMissedMessages(AuthedTestCase):
 
         self.assertIn(body, self.normalize_string(msg.body))
 
+    def test_batching_window(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        iago = get_user_profile_by_email('iago@zulip.com')
+        first_id = self.send_message("othello@zulip.com", "hamlet@zulip.com", Recipient.PERSONAL,
+                                     'First personal message!')
+        second_id = self.send_message("othello@zulip.com", "hamlet@zulip.com", Recipient.PERSONAL,
+                                      'Second personal message!')
+        iago_id = self.send_message("othello@zulip.com", "iago@zulip.com", Recipient.PERSONAL,
+                                    'Message for Iago!')
+
+        fake_client = WorkerTest.FakeClient()
+        now = time.time()
+
+        def process_queue(now):
+            # type: (float) -> None
+            for delivery in fake_client.json_consume('missedmessage_emails', 0, 0):
+                worker.process_delivery(delivery, now)
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.MissedMessageWorker()
+            worker.setup()
+            fake_client.queue.append(('missedmessage_emails', dict(user_profile_id=hamlet.id,
+                                                                   message_id=first_id, timestamp=now)))
+            process_queue(now)
+            # A later message joins Hamlet's window; Iago's starts his own.
+            fake_client.queue.append(('missedmessage_emails', dict(user_profile_id=hamlet.id,
+                                                                   message_id=second_id, timestamp=now + 60)))
+            fake_client.queue.append(('missedmessage_emails', dict(user_profile_id=iago.id,
+                                                                   message_id=iago_id, timestamp=now + 60)))
+            process_queue(now + 60)
+            self.assertEqual(len(mail.outbox), 0)
+            # Nothing is acked until its email is sent.
+            self.assertEqual(fake_client.unacked, [1, 2, 3])
+
+            process_queue(now + queue_processors.MissedMessageWorker.BATCHING_WINDOW)
+            self.assertEqual([msg.to for msg in mail.outbox], [['hamlet@zulip.com']])
+            body = self.normalize_string(mail.outbox[0].body)
+            self.assertIn('First personal message!', body)
+            self.assertIn('Second personal message!', body)
+            self.assertEqual(fake_client.unacked, [3])
+
+            process_queue(now + 60 + queue_processors.MissedMessageWorker.BATCHING_WINDOW)
+            self.assertEqual([msg.to for msg in mail.outbox], [['hamlet@zulip.com'], ['iago@zulip.com']])
+            self.assertEqual(fake_client.unacked, [])
+
 class TestOpenRealms(AuthedTestCase):
     def test_open_realm_logic(self):
         # type: () -> None
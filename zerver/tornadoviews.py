@@ -14,7 +14,7 @@ from zerver.decorator import asynchronous, \
 from zerver.lib.response import json_success, json_error
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.lib.event_queue import get_client_descriptor, \
-    process_notification, fetch_events
+    process_notifications, fetch_events
 from django.core.handlers.base import BaseHandler
 
 from typing import Union, Optional, Iterable, Sequence, List
@@ -24,7 +24,7 @@ import ujson
 @internal_notify_view
 def notify(request):
     # type: (HttpRequest) -> HttpResponse
-    process_notification(ujson.loads(request.POST['data']))
+    process_notifications(ujson.loads(request.POST['data']))
     return json_success()
 
 @has_request_variables
@@ -55,8 +55,9 @@ def get_events_backend(request, user_profile, handler,
                        event_types = REQ(default=None, validator=check_list(check_string)),
                        dont_block = REQ(default=False, validator=check_bool),
                        narrow = REQ(default=[], validator=check_list(None)),
-                       lifespan_secs = REQ(default=0, converter=int)):
-    # type: (HttpRequest, UserProfile, BaseHandler, Optional[Client], Optional[int], Optional[List[text_type]], bool, bool, Optional[text_type], bool, Iterable[Sequence[text_type]], int) -> Union[HttpResponse, _RespondAsynchronously]
+                       lifespan_secs = REQ(default=0, converter=int),
+                       multi_user_peer_events = REQ(default=False, validator=check_bool)):
+    # type: (HttpRequest, UserProfile, BaseHandler, Optional[Client], Optional[int], Optional[List[text_type]], bool, bool, Optional[text_type], bool, Iterable[Sequence[text_type]], int, bool) -> Union[HttpResponse, _RespondAsynchronously]
     if user_client is None:
         user_client = request.client
 
@@ -84,7 +85,8 @@ def get_events_backend(request, user_profile, handler,
             all_public_streams = all_public_streams,
             queue_timeout = lifespan_secs,
             last_connection_time = time.time(),
-            narrow = narrow)
+            narrow = narrow,
+            multi_user_peer_events = multi_user_peer_events)
 
     result = fetch_events(events_query)
     if "extra_log_data" in result:
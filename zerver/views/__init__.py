@@ -30,7 +30,7 @@ from zerver.models import Message, UserProfile, Stream, Subscription, Huddle, \
 from zerver.lib.actions import do_change_password, do_change_full_name, do_change_is_admin, \
     do_activate_user, do_create_user, do_create_realm, set_default_streams, \
     internal_send_message, update_user_presence, do_events_register, \
-    get_status_dict, do_change_enable_offline_email_notifications, \
+    get_status_dict, get_status_dict_changes, do_change_enable_offline_email_notifications, \
     do_change_enable_digest_emails, do_set_realm_name, do_set_realm_restricted_to_domain, \
     do_set_realm_invite_required, do_set_realm_invite_by_admins_only, \
     do_set_realm_create_stream_by_admins_only, do_set_realm_message_editing, \
@@ -38,6 +38,7 @@ from zerver.lib.actions import do_change_password, do_change_full_name, do_chang
     compute_mit_user_fullname, do_set_muted_topics, clear_followup_emails_queue, \
     do_update_pointer, realm_user_count
 from zerver.lib.push_notifications import num_push_devices_for_user
+from zerver.lib.event_queue import get_sockjs_url
 from zerver.forms import RegistrationForm, HomepageForm, RealmCreationForm, ToSForm, \
     CreateUserForm, is_inactive, OurAuthenticationForm
 from django.views.decorators.csrf import csrf_exempt
@@ -860,7 +861,8 @@ def home(request):
             narrow.append(["topic", narrow_topic])
 
     register_ret = do_events_register(user_profile, request.client,
-                                      apply_markdown=True, narrow=narrow)
+                                      apply_markdown=True, narrow=narrow,
+                                      multi_user_peer_events=True)
     user_has_messages = (register_ret['max_message_id'] != -1)
 
     # Reset our don't-spam-users-with-email counter since the
@@ -977,6 +979,7 @@ def home(request):
 
         enable_digest_emails  = user_profile.enable_digest_emails,
         event_queue_id        = register_ret['queue_id'],
+        sockjs_url            = get_sockjs_url(user_profile.id),
         last_event_id         = register_ret['last_event_id'],
         max_message_id        = register_ret['max_message_id'],
         unread_count          = approximate_unread_count(user_profile),
@@ -1184,15 +1187,25 @@ def api_fetch_google_client_id(request):
         return json_error(_("GOOGLE_CLIENT_ID is not configured"), status=400)
     return json_success({"google_client_id": settings.GOOGLE_CLIENT_ID})
 
-def get_status_list(requesting_user_profile):
-    # type: (UserProfile) -> Dict[str, Any]
+def get_status_list(requesting_user_profile, presences_since=None):
+    # type: (UserProfile, Optional[float]) -> Dict[str, Any]
+    # Taken first, so that the client's next presences_since doesn't
+    # skip changes made while we answer.
+    server_timestamp = time.time()
+    if presences_since is not None:
+        changes = get_status_dict_changes(requesting_user_profile, presences_since)
+        if changes is not None:
+            return {'presences': changes,
+                    'presences_since': presences_since,
+                    'server_timestamp': server_timestamp}
     return {'presences': get_status_dict(requesting_user_profile),
-            'server_timestamp': time.time()}
+            'server_timestamp': server_timestamp}
 
 @has_request_variables
 def update_active_status_backend(request, user_profile, status=REQ(),
-                                 new_user_input=REQ(validator=check_bool, default=False)):
-    # type: (HttpRequest, UserProfile, str, bool) -> HttpResponse
+                                 new_user_input=REQ(validator=check_bool, default=False),
+                                 presences_since=REQ(converter=float, default=None)):
+    # type: (HttpRequest, UserProfile, str, bool, Optional[float]) -> HttpResponse
     status_val = UserPresence.status_from_string(status)
     if status_val is None:
         raise JsonableError(_("Invalid presence status: %s") % (status,))
@@ -1200,7 +1213,7 @@ def update_active_status_backend(request, user_profile, status=REQ(),
         update_user_presence(user_profile, request.client, now(), status_val,
                              new_user_input)
 
-    ret = get_status_list(user_profile)
+    ret = get_status_list(user_profile, presences_since)
     if user_profile.realm.domain == "mit.edu":
         try:
             activity = UserActivity.objects.get(user_profile = user_profile,
@@ -1249,14 +1262,15 @@ def events_register_backend(request, user_profile, apply_markdown=True,
                             all_public_streams=None,
                             event_types=REQ(validator=check_list(check_string), default=None),
                             narrow=REQ(validator=check_list(check_list(check_string, length=2)), default=[]),
-                            queue_lifespan_secs=REQ(converter=int, default=0)):
-    # type: (HttpRequest, UserProfile, bool, Optional[bool], Optional[Iterable[str]], Iterable[Sequence[text_type]], int) -> HttpResponse
+                            queue_lifespan_secs=REQ(converter=int, default=0),
+                            multi_user_peer_events=REQ(validator=check_bool, default=False)):
+    # type: (HttpRequest, UserProfile, bool, Optional[bool], Optional[Iterable[str]], Iterable[Sequence[text_type]], int, bool) -> HttpResponse
     all_public_streams = _default_all_public_streams(user_profile, all_public_streams)
     narrow = _default_narrow(user_profile, narrow)
 
     ret = do_events_register(user_profile, request.client, apply_markdown,
                              event_types, queue_lifespan_secs, all_public_streams,
-                             narrow=narrow)
+                             narrow=narrow, multi_user_peer_events=multi_user_peer_events)
     return json_success(ret)
 
 
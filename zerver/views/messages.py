@@ -9,7 +9,7 @@ from django.db import connection
 from django.db.models import Q
 from django.http import HttpRequest, HttpResponse
 from six import text_type
-from typing import AnyStr, Iterable, Optional, Tuple
+from typing import Any, AnyStr, Dict, Iterable, List, Optional, Tuple
 from zerver.lib.str_utils import force_bytes
 
 from zerver.decorator import authenticated_api_view, authenticated_json_post_view, \
@@ -437,6 +437,25 @@ def exclude_muting_conditions(user_profile, narrow):
 
     return conditions
 
+# Narrow terms that only filter on columns of zerver_usermessage.  A
+# narrow made up only of these terms can be answered from the
+# (user_profile_id, message_id) index on zerver_usermessage (and the
+# partial indexes on its flags) without joining zerver_message.
+USERMESSAGE_ONLY_NARROW_OPERATORS = frozenset(['id', 'near'])
+USERMESSAGE_ONLY_NARROW_TERMS = frozenset([('is', 'starred'), ('is', 'mentioned'),
+                                           ('is', 'alerted'), ('in', 'all')])
+
+def narrow_needs_message_table(narrow):
+    if narrow is None:
+        return False
+    for term in narrow:
+        if term['operator'] in USERMESSAGE_ONLY_NARROW_OPERATORS:
+            continue
+        if (term['operator'], term['operand']) in USERMESSAGE_ONLY_NARROW_TERMS:
+            continue
+        return True
+    return False
+
 @has_request_variables
 def get_old_messages_backend(request, user_profile,
                              anchor = REQ(converter=int),
@@ -448,16 +467,25 @@ def get_old_messages_backend(request, user_profile,
                                                 converter=ujson.loads)):
     include_history = ok_to_include_history(narrow, user_profile.realm)
 
+    muting_conditions = [] # type: List[Any]
+    if use_first_unread_anchor:
+        # We exclude messages on muted topics when finding the first unread
+        # message in this narrow
+        muting_conditions = exclude_muting_conditions(user_profile, narrow)
+
+    # Pick the narrowest plan for the shape of the narrow: public
+    # stream history only needs zerver_message, narrows on flags (or
+    # no narrow at all) only need zerver_usermessage, and everything
+    # else needs both.
     if include_history and not use_first_unread_anchor:
         query = select([column("id").label("message_id")], None, "zerver_message")
         inner_msg_id_col = literal_column("zerver_message.id")
-    elif narrow is None:
+    elif not narrow_needs_message_table(narrow) and not muting_conditions:
         query = select([column("message_id"), column("flags")],
                        column("user_profile_id") == literal(user_profile.id),
                        "zerver_usermessage")
         inner_msg_id_col = column("message_id")
     else:
-        # TODO: Don't do this join if we're not doing a search
         query = select([column("message_id"), column("flags")],
                        column("user_profile_id") == literal(user_profile.id),
                        join("zerver_usermessage", "zerver_message",
@@ -499,10 +527,6 @@ def get_old_messages_backend(request, user_profile,
     sa_conn = get_sqlalchemy_connection()
     if use_first_unread_anchor:
         condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
-
-        # We exclude messages on muted topics when finding the first unread
-        # message in this narrow
-        muting_conditions = exclude_muting_conditions(user_profile, narrow)
         if muting_conditions:
             condition = and_(condition, *muting_conditions)
 
@@ -601,7 +625,12 @@ def get_old_messages_backend(request, user_profile,
         message_list.append(msg_dict)
 
     statsd.incr('loaded_old_messages', len(message_list))
+    # Queries are keyed on message ids rather than offsets, so clients
+    # continue paging from the ids at either end of the returned
+    # messages; the anchor is returned since with
+    # use_first_unread_anchor it is chosen by the server.
     ret = {'messages': message_list,
+           'anchor': anchor,
            "result": "success",
            "msg": ""}
     return json_success(ret)
@@ -1,21 +1,22 @@
 from __future__ import absolute_import
-from typing import Any
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.handlers.base import BaseHandler
-from zerver.models import get_user_profile_by_email, \
+from zerver.models import UserProfile, get_user_profile_by_email, \
     get_user_profile_by_id, get_prereg_user_by_email, get_client
+from zerver.lib.cache import generic_bulk_cached_fetch, user_profile_by_id_cache_key
 from zerver.lib.context_managers import lockfile
 from zerver.lib.queue import SimpleQueueClient, queue_json_publish
 from zerver.lib.timestamp import timestamp_to_datetime
-from zerver.lib.notifications import handle_missedmessage_emails, enqueue_welcome_emails, \
+from zerver.lib.notifications import handle_missedmessage_emails_for_users, enqueue_welcome_emails, \
     clear_followup_emails_queue, send_local_email_template_with_delay
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    do_update_user_activities, do_update_user_activity_intervals, do_update_user_presences, \
     internal_send_message, check_send_message, extract_recipients, \
-    handle_push_notification
-from zerver.lib.digest import handle_digest_email
+    handle_push_notifications, handle_link_previews
+from zerver.lib.digest import handle_digest_emails
 from zerver.lib.email_mirror import process_message as mirror_email
 from zerver.decorator import JsonableError
 from zerver.lib.socket import req_redis_key
@@ -23,6 +24,7 @@ from confirmation.models import Confirmation
 from zerver.lib.db import reset_queries
 from django.core.mail import EmailMessage
 from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
 
 import os
 import sys
@@ -72,17 +74,21 @@ class QueueProcessingWorker(object):
             self.consume(data)
         except Exception:
             self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = u'%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
+            self._save_failed_events([data])
         reset_queries()
 
+    def _save_failed_events(self, events):
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                for data in events:
+                    line = u'%s\t%s\n' % (time.asctime(), ujson.dumps(data))
+                    f.write(line.encode('utf-8'))
+
     def _log_problem(self):
         logging.exception("Problem handling data on queue %s" % (self.queue_name,))
 
@@ -96,6 +102,48 @@ class QueueProcessingWorker(object):
     def stop(self):
         self.q.stop_consuming()
 
+class LoopQueueProcessingWorker(QueueProcessingWorker):
+    """A worker that hands the events on its queue to consume_batch in
+    batches, for queues whose events are cheaper to apply together than
+    one at a time.  A batch's events are acked only once it has been
+    handled, so that if the worker dies, RabbitMQ redelivers them."""
+    # The most events in a batch; RabbitMQ won't send us more than
+    # this before we ack them.
+    batch_size = 500
+    # How long to wait for a batch to fill up.
+    sleep_delay = 1
+
+    def start(self):
+        deliveries = [] # type: List[Tuple[int, Any]]
+        first_received = 0.0
+        for delivery in self.q.json_consume(self.queue_name, self.batch_size, self.sleep_delay):
+            if delivery is not None:
+                if not deliveries:
+                    first_received = time.time()
+                deliveries.append(delivery)
+            if deliveries and (delivery is None or len(deliveries) >= self.batch_size or
+                               time.time() - first_received >= self.sleep_delay):
+                self.process_batch(deliveries)
+                deliveries = []
+
+    def process_batch(self, deliveries):
+        # type: (List[Tuple[int, Any]]) -> None
+        events = [event for (delivery_tag, event) in deliveries]
+        try:
+            self.consume_batch(events)
+        except Exception:
+            self._log_problem()
+            self._save_failed_events(events)
+        reset_queries()
+        # We've acked everything before this batch already.
+        self.q.ack(deliveries[-1][0], multiple=True)
+
+    def consume_batch(self, events):
+        raise WorkerDeclarationException("No batch consumer defined!")
+
+    def consume(self, event):
+        self.consume_batch([event])
+
 if settings.MAILCHIMP_API_KEY:
     from postmonkey import PostMonkey, MailChimpException
 
@@ -149,54 +197,96 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
                                              sender={'email': settings.ZULIP_ADMINISTRATOR, 'name': 'Zulip'})
 
 @assign_queue('user_activity')
-class UserActivityWorker(QueueProcessingWorker):
-    def consume(self, event):
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
+class UserActivityWorker(LoopQueueProcessingWorker):
+    def consume_batch(self, events):
+        do_update_user_activities([(event["user_profile_id"], get_client(event["client"]),
+                                    event["query"], timestamp_to_datetime(event["time"]))
+                                   for event in events])
 
 @assign_queue('user_activity_interval')
-class UserActivityIntervalWorker(QueueProcessingWorker):
-    def consume(self, event):
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
+class UserActivityIntervalWorker(LoopQueueProcessingWorker):
+    def consume_batch(self, events):
+        do_update_user_activity_intervals([(event["user_profile_id"], timestamp_to_datetime(event["time"]))
+                                           for event in events])
 
 @assign_queue('user_presence')
-class UserPresenceWorker(QueueProcessingWorker):
-    def consume(self, event):
-        logging.info("Received event: %s" % (event),)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+class UserPresenceWorker(LoopQueueProcessingWorker):
+    def consume_batch(self, events):
+        logging.info("Received %d events" % (len(events),))
+        # From the same remote cache entries as get_user_profile_by_id.
+        user_profiles = generic_bulk_cached_fetch(
+            user_profile_by_id_cache_key,
+            lambda user_ids: UserProfile.objects.select_related().filter(id__in=user_ids),
+            list(set(event["user_profile_id"] for event in events)))
+        do_update_user_presences([(user_profiles[event["user_profile_id"]], get_client(event["client"]),
+                                   timestamp_to_datetime(event["time"]), event["status"])
+                                  for event in events if event["user_profile_id"] in user_profiles])
 
 @assign_queue('missedmessage_emails')
 class MissedMessageWorker(QueueProcessingWorker):
-    def start(self):
-        while True:
-            missed_events = self.q.drain_queue("missedmessage_emails", json=True)
-            by_recipient = defaultdict(list) # type: Dict[int, List[Dict[str, Any]]]
-
-            for event in missed_events:
-                logging.info("Received event: %s" % (event,))
-                by_recipient[event['user_profile_id']].append(event)
+    # Aggregate each user's missed messages for 2 minutes from the first
+    # one, to let someone finish sending a batch of messages.
+    BATCHING_WINDOW = 2 * 60
+    # How often to check for users whose window is over.
+    sleep_delay = 1
+    # We only ack events once their emails are sent, so that they
+    # survive the worker restarting; RabbitMQ won't send us more than
+    # this many before then.
+    prefetch_count = 10000
 
-            for user_profile_id, events in by_recipient.items():
-                handle_missedmessage_emails(user_profile_id, events)
+    def __init__(self):
+        super(MissedMessageWorker, self).__init__()
+        # (delivery tag, event) for each user's events.
+        self.events_by_user = defaultdict(list) # type: Dict[int, List[Tuple[int, Dict[str, Any]]]]
+        # When to send each user's emails.
+        self.deadlines = {} # type: Dict[int, float]
 
-            reset_queries()
-            # Aggregate all messages received every 2 minutes to let someone finish sending a batch
-            # of messages
-            time.sleep(2 * 60)
+    def start(self):
+        for delivery in self.q.json_consume(self.queue_name, self.prefetch_count, self.sleep_delay):
+            self.process_delivery(delivery)
+
+    def process_delivery(self, delivery, now=None):
+        # type: (Optional[Tuple[int, Dict[str, Any]]], Optional[float]) -> None
+        """Holds on to the event from json_consume, if there is one, and
+        then sends the emails of the users whose window is over."""
+        if now is None:
+            now = time.time()
+        if delivery is not None:
+            event = delivery[1]
+            logging.info("Received event: %s" % (event,))
+            # The window starts when the message was sent, so that a
+            # backlog doesn't hold emails back any longer.
+            sent = event.get('timestamp', now)
+            statsd.timing("missed_message_emails.queue_lag", 1000 * (now - sent))
+            user_profile_id = event['user_profile_id']
+            self.deadlines.setdefault(user_profile_id, sent + self.BATCHING_WINDOW)
+            self.events_by_user[user_profile_id].append(delivery)
+
+        due = dict((user_profile_id, self.events_by_user.pop(user_profile_id))
+                   for (user_profile_id, deadline) in list(self.deadlines.items()) if deadline <= now)
+        if not due:
+            return
+        for user_profile_id in due:
+            del self.deadlines[user_profile_id]
+        events_by_user = dict((user_profile_id, [event for (delivery_tag, event) in deliveries])
+                              for (user_profile_id, deliveries) in due.items())
+        try:
+            handle_missedmessage_emails_for_users(events_by_user)
+        except Exception:
+            self._log_problem()
+            self._save_failed_events([user_event for events in events_by_user.values() for user_event in events])
+        reset_queries()
+        for deliveries in due.values():
+            for (delivery_tag, event) in deliveries:
+                self.q.ack(delivery_tag)
 
 @assign_queue('missedmessage_mobile_notifications')
-class PushNotificationsWorker(QueueProcessingWorker):
-    def consume(self, data):
-        handle_push_notification(data['user_profile_id'], data)
+class PushNotificationsWorker(LoopQueueProcessingWorker):
+    # Retries only reach the queue once they're due; see
+    # retry_push_notification.
+    def consume_batch(self, events):
+        logging.info("Received %d events" % (len(events),))
+        handle_push_notifications(events)
 
 def make_feedback_client():
     sys.path.append(os.path.join(os.path.dirname(__file__), '../../api'))
@@ -327,12 +417,25 @@ class MessageSenderWorker(QueueProcessingWorker):
         queue_json_publish(server_meta['return_queue'], result, lambda e: None)
 
 @assign_queue('digest_emails')
-class DigestWorker(QueueProcessingWorker):
+class DigestWorker(LoopQueueProcessingWorker):
     # Who gets a digest is entirely determined by the enqueue_digest_emails
     # management command, not here.
-    def consume(self, event):
-        logging.info("Received digest event: %s" % (event,))
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+    def consume_batch(self, events):
+        logging.info("Received %d digest events" % (len(events),))
+        # A run of enqueue_digest_emails gives everyone the same
+        # cutoff, so that each realm's digest is computed once.
+        by_cutoff = defaultdict(list) # type: Dict[int, List[int]]
+        for event in events:
+            by_cutoff[int(event["cutoff"])].append(event["user_profile_id"])
+        failed = set() # type: Set[Tuple[int, int]]
+        for (cutoff, user_profile_ids) in by_cutoff.items():
+            failed.update((cutoff, user_profile_id) for user_profile_id in
+                          handle_digest_emails(user_profile_ids, cutoff))
+        # The rest of the batch got their emails, so only these events
+        # need to be looked at again.
+        if failed:
+            self._save_failed_events([event for event in events
+                                      if (int(event["cutoff"]), event["user_profile_id"]) in failed])
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
@@ -342,6 +445,13 @@ class MirrorWorker(QueueProcessingWorker):
         mirror_email(email.message_from_string(event["message"].encode("utf-8")),
                      rcpt_to=event["rcpt_to"], pre_checked=True)
 
+@assign_queue('embed_links')
+class FetchLinksEmbedData(QueueProcessingWorker):
+    # Fetches the data for link previews that bugdown deferred while
+    # rendering a message, and updates the message with them.
+    def consume(self, event):
+        handle_link_previews(event)
+
 @assign_queue('test')
 class TestWorker(QueueProcessingWorker):
     # This worker allows you to test the queue worker infrastructure without
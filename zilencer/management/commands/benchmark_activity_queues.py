@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, List, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from zerver.lib.actions import consolidate_client, do_update_user_activities, \
+    do_update_user_activity_intervals, do_update_user_presences
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import Client, UserActivity, UserActivityInterval, UserPresence, \
+    UserProfile, get_client
+
+import datetime
+import mock
+import random
+import time
+
+# How the user_activity, user_activity_interval and user_presence
+# workers applied each event before they handled them in batches.
+def update_user_activity_one_at_a_time(user_profile, client, query, log_time):
+    # type: (UserProfile, Client, str, datetime.datetime) -> None
+    (activity, created) = UserActivity.objects.get_or_create(
+        user_profile = user_profile,
+        client = client,
+        query = query,
+        defaults={'last_visit': log_time, 'count': 0})
+    activity.count += 1
+    activity.last_visit = log_time
+    activity.save(update_fields=["last_visit", "count"])
+
+def update_user_activity_interval_one_at_a_time(user_profile, log_time):
+    # type: (UserProfile, datetime.datetime) -> None
+    effective_end = log_time + datetime.timedelta(minutes=15)
+    try:
+        last = UserActivityInterval.objects.filter(user_profile=user_profile).order_by("-end")[0]
+        if ((log_time <= last.end and log_time >= last.start) or
+            (effective_end <= last.end and effective_end >= last.start)):
+            last.end = max(last.end, effective_end)
+            last.start = min(last.start, log_time)
+            last.save(update_fields=["start", "end"])
+            return
+    except IndexError:
+        pass
+    UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
+                                        end=effective_end)
+
+def update_user_presence_one_at_a_time(user_profile, client, log_time, status):
+    # type: (UserProfile, Client, datetime.datetime, int) -> None
+    client = consolidate_client(client)
+    (presence, created) = UserPresence.objects.get_or_create(
+        user_profile = user_profile,
+        client = client,
+        defaults = {'timestamp': log_time,
+                    'status': status})
+    stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
+    was_idle = presence.status == UserPresence.IDLE
+    if not created and stale_status or was_idle or status == presence.status:
+        presence.timestamp = log_time
+        update_fields = ["timestamp"]
+        if presence.status != status:
+            presence.status = status
+            update_fields.append("status")
+        presence.save(update_fields=update_fields)
+
+class Command(BaseCommand):
+    help = """Benchmark the user_activity, user_activity_interval and
+user_presence workers on a replay of synthetic events for the users in
+the database, applying the events one at a time (as the workers used
+to) and in batches, and report events per second and database
+statements per event.  Everything is rolled back afterwards."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--events', dest='events', type=int, default=5000,
+                            help='events replayed to each worker')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=500,
+                            help='events per batch when batching')
+
+    def measure(self, name, events, apply_one, apply_batch, batch_size):
+        # type: (str, List[Tuple[Any, ...]], Callable[..., None], Callable[[List[Any]], None], int) -> None
+        results = []
+        for batched in [False, True]:
+            with transaction.atomic():
+                connection.ensure_connection()
+                queries_before = len(connection.connection.queries)
+                start = time.time()
+                if batched:
+                    for i in range(0, len(events), batch_size):
+                        apply_batch(events[i:i + batch_size])
+                else:
+                    for event in events:
+                        apply_one(*event)
+                elapsed = time.time() - start
+                statements = len(connection.connection.queries) - queries_before
+                transaction.set_rollback(True)
+            results.append("%8.1f events/s, %6.3f statements/event"
+                           % (len(events) / elapsed, float(statements) / len(events)))
+        print("%-23s one at a time: %s; batched: %s" % (name, results[0], results[1]))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rand = random.Random(0)
+        user_profiles = list(UserProfile.objects.select_related().filter(is_active=True, is_bot=False))
+        clients = [get_client(name) for name in ['website', 'ZulipAndroid', 'ZulipiOS', 'API']]
+        queries = ['get_events_backend', 'send_message_backend', 'update_pointer_backend',
+                   'get_old_messages_backend']
+        start_time = time.time() - options['events']
+        # Spread over time like real traffic: about one event a second.
+        times = [timestamp_to_datetime(start_time + i) for i in range(options['events'])]
+        picks = [(rand.choice(user_profiles), rand.choice(clients)) for i in range(options['events'])]
+
+        self.measure('user_activity',
+                     [(user_profile, client, rand.choice(queries), log_time)
+                      for ((user_profile, client), log_time) in zip(picks, times)],
+                     update_user_activity_one_at_a_time,
+                     lambda batch: do_update_user_activities(
+                         [(user_profile.id, client, query, log_time)
+                          for (user_profile, client, query, log_time) in batch]),
+                     options['batch_size'])
+        self.measure('user_activity_interval',
+                     [(user_profile, log_time) for ((user_profile, client), log_time) in zip(picks, times)],
+                     update_user_activity_interval_one_at_a_time,
+                     lambda batch: do_update_user_activity_intervals(
+                         [(user_profile.id, log_time) for (user_profile, log_time) in batch]),
+                     options['batch_size'])
+        # Presence changes would be sent to Tornado; leave them out of both.
+        with mock.patch('zerver.lib.actions.send_presence_changed'):
+            self.measure('user_presence',
+                         [(user_profile, client, log_time, rand.choice([UserPresence.ACTIVE, UserPresence.IDLE]))
+                          for ((user_profile, client), log_time) in zip(picks, times)],
+                         update_user_presence_one_at_a_time,
+                         do_update_user_presences,
+                         options['batch_size'])
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Set
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from six import text_type
+
+from zerver.lib.alert_words import AlertWordMatcher
+
+import random
+import re
+import time
+
+# The per-word regular expressions the alert word preprocessor used
+# before AlertWordMatcher, for comparison.
+ALLOWED_BEFORE_PUNCTUATION = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+ALLOWED_AFTER_PUNCTUATION = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+
+def find_user_ids_with_regexes(realm_words, content):
+    # type: (Dict[int, List[text_type]], text_type) -> Set[int]
+    content = content.lower()
+    user_ids = set() # type: Set[int]
+    for user_id, words in realm_words.items():
+        for word in words:
+            match_re = re.compile(u'(?:%s)%s(?:%s)' % (ALLOWED_BEFORE_PUNCTUATION,
+                                                       re.escape(word.lower()),
+                                                       ALLOWED_AFTER_PUNCTUATION))
+            if re.search(match_re, content):
+                user_ids.add(user_id)
+    return user_ids
+
+def random_word(rand):
+    # type: (random.Random) -> text_type
+    return u''.join(rand.choice(u'abcdefghijklmnopqrstuvwxyz')
+                    for i in range(rand.randint(3, 10)))
+
+class Command(BaseCommand):
+    help = """Benchmark finding the users whose alert words occur in a
+message, with AlertWordMatcher and with one regular expression per
+alert word (the previous implementation).  Uses synthetic words, so it
+does not need a database."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--words', dest='words', type=int, nargs='+',
+                            default=[100, 1000, 10000],
+                            help='total alert word counts to benchmark')
+        parser.add_argument('--words-per-user', dest='words_per_user', type=int, default=5,
+                            help='alert words set by each user')
+        parser.add_argument('--message-words', dest='message_words', type=int, default=100,
+                            help='words in each message')
+        parser.add_argument('--messages', dest='messages', type=int, default=20,
+                            help='messages scanned for each word count')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rand = random.Random(0)
+        for num_words in options['words']:
+            realm_words = {} # type: Dict[int, List[text_type]]
+            for i in range(num_words):
+                realm_words.setdefault(i // options['words_per_user'], []).append(random_word(rand))
+            all_words = [word for words in realm_words.values() for word in words]
+            messages = []
+            for i in range(options['messages']):
+                # Mostly random text, with a few of the alert words in it.
+                message_words = [random_word(rand) for j in range(options['message_words'])]
+                for j in range(3):
+                    message_words[rand.randrange(len(message_words))] = rand.choice(all_words)
+                messages.append(u' '.join(message_words) + u'.')
+
+            start = time.time()
+            matcher = AlertWordMatcher(realm_words)
+            build_time = time.time() - start
+
+            start = time.time()
+            for content in messages:
+                matcher.find_user_ids(content)
+            matcher_time = (time.time() - start) / len(messages)
+
+            start = time.time()
+            for content in messages:
+                find_user_ids_with_regexes(realm_words, content)
+            regex_time = (time.time() - start) / len(messages)
+
+            print("%6d words: matcher built in %8.2fms, %8.3fms per message; regexes %8.3fms per message"
+                  % (num_words, 1000 * build_time, 1000 * matcher_time, 1000 * regex_time))
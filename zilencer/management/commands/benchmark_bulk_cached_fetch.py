@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, List, Optional
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib.cache import cache_delete_many, generic_bulk_cached_fetch
+from zerver.models import Message, extract_message_dict, stringify_message_dict, \
+    to_dict_cache_key_id
+
+import time
+import ujson
+import zlib
+
+class Command(BaseCommand):
+    help = """Benchmark fetching a window of message dicts through
+generic_bulk_cached_fetch, with a cold and a warm cache, and report how
+many bytes the window takes in the cache.
+
+This flushes the cached dicts of the messages it fetches, so only run
+it against a development server.  Run it on trees before and after a
+change to compare."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--window', dest='window', type=int, default=1000,
+                            help='number of most recent messages fetched')
+        parser.add_argument('--chunk-sizes', dest='chunk_sizes', type=int, nargs='+',
+                            default=[0, 250],
+                            help='database query chunk sizes to benchmark (0 for unchunked)')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=5,
+                            help='fetches timed for each configuration')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        message_ids = list(Message.objects.order_by('-id')
+                           .values_list('id', flat=True)[:options['window']])
+        cache_keys = [to_dict_cache_key_id(message_id, True) for message_id in message_ids]
+
+        for chunk_size in options['chunk_sizes']:
+            cold = 0.0
+            warm = 0.0
+            for round_num in range(options['rounds']):
+                cache_delete_many(cache_keys)
+                start = time.time()
+                self.fetch(message_ids, chunk_size or None)
+                cold += time.time() - start
+                start = time.time()
+                self.fetch(message_ids, chunk_size or None)
+                warm += time.time() - start
+            print("chunk size %4d: %8.2fms cold, %8.2fms warm per window"
+                  % (chunk_size, 1000 * cold / options['rounds'],
+                     1000 * warm / options['rounds']))
+
+        stored = 0
+        always_compressed = 0
+        for message_dict in self.fetch(message_ids, None).values():
+            stored += len(stringify_message_dict(message_dict))
+            always_compressed += len(zlib.compress(ujson.dumps(message_dict).encode('utf-8')))
+        print("%d messages: %d bytes stored, %d bytes if every dict were compressed"
+              % (len(message_ids), stored, always_compressed))
+
+    def fetch(self, message_ids, chunk_size):
+        # type: (List[int], Optional[int]) -> Any
+        return generic_bulk_cached_fetch(
+            lambda message_id: to_dict_cache_key_id(message_id, True),
+            Message.get_raw_db_rows,
+            message_ids,
+            id_fetcher=lambda row: row['id'],
+            cache_transformer=lambda row: Message.build_dict_from_raw_db_row(row, True),
+            extractor=extract_message_dict,
+            setter=stringify_message_dict,
+            chunk_size=chunk_size)
@@ -0,0 +1,200 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Set, Tuple
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q, QuerySet
+from django.template import loader
+from django.utils import timezone
+from six import text_type
+
+from zerver.lib.create_user import create_user_profile
+from zerver.lib.digest import gather_new_streams, gather_new_users, handle_digest_emails
+from zerver.lib.notifications import build_message_list
+from zerver.models import Message, Realm, Recipient, Stream, Subscription, UserMessage, \
+    UserProfile, get_client
+
+import datetime
+import mock
+import random
+import time
+
+# How handle_digest_email gathered each user's digest before digests
+# were computed per realm: from all of the user's messages since the
+# cutoff, and a query per hot conversation.
+def gather_hot_conversations_from_messages(user_profile, stream_messages):
+    # type: (UserProfile, QuerySet) -> List[Dict[str, Any]]
+    conversation_length = defaultdict(int) # type: Dict[Tuple[int, text_type], int]
+    conversation_diversity = defaultdict(set) # type: Dict[Tuple[int, text_type], Set[text_type]]
+    for user_message in stream_messages:
+        if not user_message.message.sent_by_human():
+            continue
+        key = (user_message.message.recipient.type_id,
+               user_message.message.subject)
+        conversation_diversity[key].add(
+            user_message.message.sender.full_name)
+        conversation_length[key] += 1
+
+    diversity_list = list(conversation_diversity.items())
+    diversity_list.sort(key=lambda entry: len(entry[1]), reverse=True)
+    length_list = list(conversation_length.items())
+    length_list.sort(key=lambda entry: entry[1], reverse=True)
+
+    hot_conversations = [elt[0] for elt in diversity_list[:2]]
+    for candidate, _ in length_list:
+        if candidate not in hot_conversations:
+            hot_conversations.append(candidate)
+        if len(hot_conversations) >= 4:
+            break
+
+    hot_conversation_render_payloads = []
+    for (stream_id, subject) in hot_conversations:
+        first_few_messages = [user_message.message for user_message in
+                              stream_messages.filter(message__recipient__type_id=stream_id,
+                                                     message__subject=subject)[:2]]
+        hot_conversation_render_payloads.append({
+            "participants": list(conversation_diversity[(stream_id, subject)]),
+            "count": conversation_length[(stream_id, subject)] - len(first_few_messages),
+            "first_few_messages": build_message_list(user_profile, first_few_messages)})
+    return hot_conversation_render_payloads
+
+def render_digest_one_user_at_a_time(user_profile_id, cutoff):
+    # type: (int, int) -> None
+    user_profile = UserProfile.objects.get(id=user_profile_id)
+    cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
+    all_messages = UserMessage.objects.filter(
+        user_profile=user_profile,
+        message__pub_date__gt=cutoff_date).order_by("message__pub_date")
+    template_payload = {'name': user_profile.full_name,
+                        'external_host': 'zulip.example.com',
+                        'unsubscribe_link': ''} # type: Dict[str, Any]
+    pms = all_messages.filter(~Q(message__recipient__type=Recipient.STREAM) &
+                              ~Q(message__sender=user_profile))
+    template_payload['unread_pms'] = build_message_list(user_profile, [pm.message for pm in pms[:4]])
+    template_payload['remaining_unread_pms_count'] = max(0, len(pms) - 4)
+    home_view_recipients = [sub.recipient for sub in Subscription.objects.filter(
+        user_profile=user_profile, active=True, in_home_view=True)]
+    stream_messages = all_messages.filter(message__recipient__type=Recipient.STREAM,
+                                          message__recipient__in=home_view_recipients)
+    template_payload["hot_conversations"] = gather_hot_conversations_from_messages(
+        user_profile, stream_messages)
+    (template_payload["new_streams_count"], template_payload["new_streams"]) = gather_new_streams(
+        user_profile.realm, cutoff_date)
+    template_payload["new_users"] = gather_new_users(user_profile.realm, cutoff_date)[1]
+    loader.render_to_string('zerver/emails/digest/digest_email.txt', template_payload)
+    loader.render_to_string('zerver/emails/digest/digest_email_html.txt', template_payload)
+
+class Command(BaseCommand):
+    help = """Benchmark computing digest emails for a synthetic realm:
+one user at a time (as handle_digest_email used to) for a sample of
+its users, and for all of them at once with handle_digest_emails.
+The emails are rendered but not sent, and the realm is rolled back
+afterwards."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, default=5000,
+                            help='users in the realm')
+        parser.add_argument('--streams', dest='streams', type=int, default=50,
+                            help='streams in the realm')
+        parser.add_argument('--subscriptions', dest='subscriptions', type=int, default=3,
+                            help='streams each user is subscribed to')
+        parser.add_argument('--messages', dest='messages', type=int, default=2000,
+                            help='stream messages sent since the cutoff')
+        parser.add_argument('--private-messages', dest='private_messages', type=int, default=2000,
+                            help='private messages sent since the cutoff')
+        parser.add_argument('--sample', dest='sample', type=int, default=50,
+                            help='users whose digests are computed one at a time')
+
+    def make_realm(self, rand, options):
+        # type: (random.Random, Dict[str, Any]) -> List[UserProfile]
+        realm = Realm.objects.create(domain=u'digest-benchmark.example.com', name=u'Digest benchmark')
+        UserProfile.objects.bulk_create([
+            create_user_profile(realm, u'user%d@digest-benchmark.example.com' % (i,), None, True, None,
+                                u'User %d' % (i,), u'user%d' % (i,), None, False)
+            for i in range(options['users'])])
+        user_profiles = list(UserProfile.objects.filter(realm=realm))
+        Stream.objects.bulk_create([Stream(realm=realm, name=u'stream %d' % (i,))
+                                    for i in range(options['streams'])])
+        Recipient.objects.bulk_create(
+            [Recipient(type=Recipient.PERSONAL, type_id=user_profile.id) for user_profile in user_profiles] +
+            [Recipient(type=Recipient.STREAM, type_id=stream.id)
+             for stream in Stream.objects.filter(realm=realm)])
+        personal_recipients = dict((recipient.type_id, recipient) for recipient in Recipient.objects.filter(
+            type=Recipient.PERSONAL, type_id__in=[user_profile.id for user_profile in user_profiles]))
+        stream_recipients = list(Recipient.objects.filter(
+            type=Recipient.STREAM, type_id__in=Stream.objects.filter(realm=realm).values('id')))
+
+        subscribers = defaultdict(list) # type: Dict[int, List[UserProfile]]
+        subscriptions = [] # type: List[Subscription]
+        for user_profile in user_profiles:
+            for recipient in rand.sample(stream_recipients, options['subscriptions']):
+                subscribers[recipient.id].append(user_profile)
+                subscriptions.append(Subscription(user_profile=user_profile, recipient=recipient))
+        Subscription.objects.bulk_create(subscriptions, batch_size=10000)
+
+        # Most conversations are short, but a few have many messages.
+        now = timezone.now()
+        clients = [get_client(u'website'), get_client(u'ZulipAndroid'), get_client(u'API')]
+        messages = [] # type: List[Message]
+        for i in range(options['messages'] + options['private_messages']):
+            if i < options['messages']:
+                recipient = rand.choice(stream_recipients)
+                sender = rand.choice(subscribers[recipient.id] or user_profiles)
+                subject = u'topic %d' % (int(rand.paretovariate(1)),)
+            else:
+                sender = rand.choice(user_profiles)
+                recipient = personal_recipients[rand.choice(user_profiles).id]
+                subject = u''
+            messages.append(Message(sender=sender, recipient=recipient, subject=subject,
+                                    content=u'message %d' % (i,),
+                                    rendered_content=u'<p>message %d</p>' % (i,),
+                                    rendered_content_version=1, sending_client=rand.choice(clients),
+                                    pub_date=now - datetime.timedelta(seconds=rand.randint(0, 20 * 3600))))
+        Message.objects.bulk_create(messages, batch_size=10000)
+
+        user_messages = [] # type: List[UserMessage]
+        for message in Message.objects.filter(sender__realm=realm).select_related('recipient'):
+            if message.recipient.type == Recipient.STREAM:
+                receivers = [user_profile.id for user_profile in subscribers[message.recipient_id]]
+            else:
+                receivers = list(set([message.sender_id, message.recipient.type_id]))
+            user_messages.extend(UserMessage(user_profile_id=user_profile_id, message=message)
+                                 for user_profile_id in receivers)
+        UserMessage.objects.bulk_create(user_messages, batch_size=10000)
+        return user_profiles
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rand = random.Random(0)
+        with transaction.atomic():
+            user_profiles = self.make_realm(rand, options)
+            cutoff = int(time.time()) - 24 * 3600
+            sample = rand.sample(user_profiles, min(options['sample'], len(user_profiles)))
+            connection.ensure_connection()
+
+            with mock.patch('zerver.lib.digest.send_digest_email'):
+                queries_before = len(connection.connection.queries)
+                start = time.time()
+                for user_profile in sample:
+                    render_digest_one_user_at_a_time(user_profile.id, cutoff)
+                one_at_a_time_time = time.time() - start
+                one_at_a_time_statements = len(connection.connection.queries) - queries_before
+
+                queries_before = len(connection.connection.queries)
+                start = time.time()
+                handle_digest_emails([user_profile.id for user_profile in user_profiles], cutoff)
+                realm_time = time.time() - start
+                realm_statements = len(connection.connection.queries) - queries_before
+            transaction.set_rollback(True)
+
+        print("%d users: one at a time %8.2fms and %6.1f statements per user (over %d users); "
+              "per realm %8.2fms and %6.2f statements per user, %8.2fs in all"
+              % (len(user_profiles), 1000 * one_at_a_time_time / len(sample),
+                 float(one_at_a_time_statements) / len(sample), len(sample),
+                 1000 * realm_time / len(user_profiles),
+                 float(realm_statements) / len(user_profiles), realm_time))
@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib.event_journal import EventQueueSnapshot, write_snapshot
+from zerver.lib.event_queue import ClientDescriptor, EventQueue, \
+    EVENT_QUEUE_LOAD_CHUNK_SIZE
+
+import os
+import shutil
+import tempfile
+import time
+import ujson
+
+def build_clients(num_queues, events_per_queue):
+    # type: (int, int) -> List[Tuple[str, Dict[str, Any]]]
+    message = dict(id=1, sender_id=1, type='stream', client='website',
+                   display_recipient='Verona', subject='benchmark',
+                   content='<p>' + 'benchmark ' * 20 + '</p>')
+    clients = []
+    for i in range(num_queues):
+        queue = EventQueue('1:%d' % (i,))
+        for j in range(events_per_queue):
+            queue.push(dict(type='message', message=message, flags=[]))
+        client = ClientDescriptor(i, 'user%d@zulip.com' % (i,), 1, queue, None,
+                                  'website', lifespan_secs=600)
+        clients.append((queue.id, client.to_dict()))
+    return clients
+
+class Command(BaseCommand):
+    help = """Benchmark Tornado restart time: persisting and restoring the
+event queues with the streaming snapshot format, compared to the old
+single JSON document."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--queues', dest='queues', type=int, default=100000,
+                            help='number of event queues')
+        parser.add_argument('--events', dest='events', type=int, default=10,
+                            help='events in each queue')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        clients = build_clients(options['queues'], options['events'])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'event_queues.json')
+
+            start = time.time()
+            with open(filename, 'w') as stored_queues:
+                ujson.dump(clients, stored_queues)
+            legacy_dump = time.time() - start
+            start = time.time()
+            with open(filename, 'r') as stored_queues:
+                restored = dict((qid, ClientDescriptor.from_dict(client))
+                                for (qid, client) in ujson.loads(stored_queues.read()))
+            legacy_load = time.time() - start
+            del restored
+
+            start = time.time()
+            write_snapshot(filename, 1, iter(clients))
+            snapshot_dump = time.time() - start
+            start = time.time()
+            restored = {}
+            first_chunk = None
+            for (qid, client) in EventQueueSnapshot(filename).clients():
+                restored[qid] = ClientDescriptor.from_dict(client)
+                if first_chunk is None and len(restored) == EVENT_QUEUE_LOAD_CHUNK_SIZE:
+                    first_chunk = time.time() - start
+            snapshot_load = time.time() - start
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        print("%d queues with %d events each" % (options['queues'], options['events']))
+        print("Single JSON document: dump %.3fs, load %.3fs (serving after %.3fs)"
+              % (legacy_dump, legacy_load, legacy_load))
+        print("Streaming snapshot:   dump %.3fs, load %.3fs (serving after %.3fs)"
+              % (snapshot_dump, snapshot_load, first_chunk or snapshot_load))
@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from zerver.lib.test_helpers import POSTRequestMock
+from zerver.models import Message, Recipient, Subscription, UserProfile, \
+    get_display_recipient, get_user_profile_by_email
+from zerver.views.messages import get_old_messages_backend
+
+import time
+import ujson
+
+class Command(BaseCommand):
+    help = """Benchmark get_old_messages for a range of narrow shapes.
+
+With --synthetic-rows, first generates that many messages (copies of
+the user's latest stream message) with UserMessage rows for the user,
+a share of them starred or mentioned, to benchmark against a large
+zerver_usermessage table.  Only run this against a development
+database.  Run it on trees before and after a change to compare."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--email', dest='email', type=str, default='hamlet@zulip.com',
+                            help='user whose messages are fetched')
+        parser.add_argument('--synthetic-rows', dest='synthetic_rows', type=int, default=0,
+                            help='synthetic messages to generate first (e.g. 10000000)')
+        parser.add_argument('--num', dest='num', type=int, default=200,
+                            help='messages fetched before and after the anchor')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=10,
+                            help='requests timed for each narrow')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        user_profile = get_user_profile_by_email(options['email'])
+        if options['synthetic_rows']:
+            self.generate_rows(user_profile, options['synthetic_rows'])
+
+        stream_sub = Subscription.objects.filter(user_profile=user_profile, active=True,
+                                                 recipient__type=Recipient.STREAM).first()
+        narrows = [
+            ('none', None),
+            ('empty', []),
+            ('is:starred', [['is', 'starred']]),
+            ('is:mentioned', [['is', 'mentioned']]),
+            ('is:private', [['is', 'private']]),
+            ('pm-with', [['pm-with', 'othello@zulip.com']]),
+        ] # type: List[Any]
+        if stream_sub is not None:
+            stream_name = get_display_recipient(stream_sub.recipient)
+            narrows.append(('stream', [['stream', stream_name]]))
+            narrows.append(('stream+topic', [['stream', stream_name], ['topic', 'benchmark']]))
+
+        last_message = Message.objects.filter(usermessage__user_profile=user_profile) \
+                                      .order_by('-id').first()
+        anchor = last_message.id if last_message is not None else 0
+        for (name, narrow) in narrows:
+            params = dict(anchor=anchor,
+                          num_before=options['num'],
+                          num_after=options['num']) # type: Dict[str, Any]
+            if narrow is not None:
+                params['narrow'] = ujson.dumps(narrow)
+            elapsed = 0.0
+            for round_num in range(options['rounds']):
+                request = POSTRequestMock(params, user_profile)
+                start = time.time()
+                get_old_messages_backend(request, user_profile)
+                elapsed += time.time() - start
+            print("%-14s %8.2fms per request" % (name, 1000 * elapsed / options['rounds']))
+
+    def generate_rows(self, user_profile, num_rows):
+        # type: (UserProfile, int) -> None
+        template = Message.objects.filter(usermessage__user_profile=user_profile,
+                                          recipient__type=Recipient.STREAM).order_by('-id').first()
+        if template is None:
+            print("%s has no stream messages to copy" % (user_profile.email,))
+            return
+        start = time.time()
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("SELECT max(id) FROM zerver_message")
+            max_id = cursor.fetchone()[0]
+            cursor.execute("""
+                INSERT INTO zerver_message (sender_id, recipient_id, subject, content,
+                    rendered_content, rendered_content_version, pub_date, sending_client_id,
+                    has_attachment, has_image, has_link)
+                SELECT sender_id, recipient_id, subject, content, rendered_content,
+                    rendered_content_version, pub_date, sending_client_id,
+                    has_attachment, has_image, has_link
+                FROM zerver_message, generate_series(1, %s)
+                WHERE zerver_message.id = %s""", [num_rows, template.id])
+            # Star 1% and mention 2% of the messages; the rest are read.
+            cursor.execute("""
+                INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+                SELECT %s, id,
+                    CASE WHEN id %% 100 = 0 THEN 3 WHEN id %% 50 = 1 THEN 9 ELSE 1 END
+                FROM zerver_message WHERE id > %s""", [user_profile.id, max_id])
+            cursor.execute("ANALYZE zerver_message")
+            cursor.execute("ANALYZE zerver_usermessage")
+        print("Generated %d messages in %.1fs" % (num_rows, time.time() - start))
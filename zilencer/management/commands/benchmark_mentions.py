@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from six import text_type
+
+from zerver.lib import bugdown, mention
+from zerver.lib.create_user import create_user_profile
+from zerver.lib.mention import MentionIndex
+from zerver.models import Message, Realm, UserProfile, get_client
+
+import binascii
+import os
+import random
+import time
+
+def find_user_with_dicts(realm_users, name):
+    # type: (List[Dict[str, Any]], text_type) -> Optional[Dict[str, Any]]
+    """What bugdown did for each message before MentionIndex: build
+    the name dicts from the realm's user dicts, then look the name up."""
+    full_names = dict((user['full_name'].lower(), user) for user in realm_users)
+    short_names = dict((user['short_name'].lower(), user) for user in realm_users)
+    user = full_names.get(name.lower(), None)
+    if user is None:
+        user = short_names.get(name.lower(), None)
+    return user
+
+def random_name(rand):
+    # type: (random.Random) -> text_type
+    return u''.join(rand.choice(u'abcdefghijklmnopqrstuvwxyz')
+                    for i in range(rand.randint(3, 10)))
+
+class Command(BaseCommand):
+    help = """Benchmark resolving the @-mentions in a message against
+realms of different sizes, with a MentionIndex and by building name
+dicts for each message (the previous implementation), using synthetic
+users; then time bugdown.convert on messages with and without an
+@-mention in a synthetic realm of each size, which is rolled back
+afterwards."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, nargs='+',
+                            default=[100, 1000, 10000, 50000],
+                            help='realm sizes to benchmark')
+        parser.add_argument('--mentions', dest='mentions', type=int, default=200,
+                            help='mentions resolved for each realm size')
+        parser.add_argument('--renders', dest='renders', type=int, default=100,
+                            help='messages rendered with and without a mention for each realm size')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rand = random.Random(0)
+        for num_users in options['users']:
+            realm_users = [dict(id=i,
+                                full_name=u'%s %s' % (random_name(rand), random_name(rand)),
+                                short_name=random_name(rand),
+                                email=u'user%d@example.com' % (i,))
+                           for i in range(num_users)] # type: List[Dict[str, Any]]
+            names = [rand.choice(realm_users)[rand.choice(['full_name', 'short_name'])]
+                     for i in range(options['mentions'])] # type: List[text_type]
+
+            start = time.time()
+            index = MentionIndex(realm_users)
+            build_time = time.time() - start
+
+            start = time.time()
+            for name in names:
+                index.find_user(name)
+            index_time = (time.time() - start) / len(names)
+
+            start = time.time()
+            for user in realm_users[:options['mentions']]:
+                index.add_user(dict(user, full_name=u'renamed %s' % (user['full_name'],)))
+            update_time = (time.time() - start) / options['mentions']
+
+            # The old way is slow enough that a few rounds tell the story.
+            rounds = min(len(names), 20)
+            start = time.time()
+            for name in names[:rounds]:
+                find_user_with_dicts(realm_users, name)
+            dict_time = (time.time() - start) / rounds
+
+            print("%6d users: index built in %8.2fms, %8.4fms per mention, %8.4fms per rename; "
+                  "per-message dicts %8.3fms per mention"
+                  % (num_users, 1000 * build_time, 1000 * index_time, 1000 * update_time,
+                     1000 * dict_time))
+
+            plain_time, first_mention_time, mention_time = self.time_renders(
+                realm_users, options['renders'], rand)
+            print("%6d users: bugdown.convert %8.3fms per message without @, %8.3fms with an "
+                  "@-mention; %8.2fms for the first @-mention (building the index)"
+                  % (num_users, 1000 * plain_time, 1000 * mention_time, 1000 * first_mention_time))
+
+    def time_renders(self, realm_users, renders, rand):
+        # type: (List[Dict[str, Any]], int, random.Random) -> Tuple[float, float, float]
+        """Times bugdown.convert on messages sent in a realm with
+        realm_users, returning the seconds taken per message without a
+        mention, for the first mention, and per mention after that."""
+        # Messages unique to this run, so that the render cache misses.
+        nonce = binascii.hexlify(os.urandom(8)).decode('ascii')
+        with transaction.atomic():
+            realm = Realm.objects.create(domain=u'mentions-benchmark.example.com',
+                                         name=u'Mentions benchmark')
+            UserProfile.objects.bulk_create([
+                create_user_profile(realm, user['email'].replace(u'example.com', realm.domain),
+                                    None, True, None, user['full_name'], user['short_name'],
+                                    None, False)
+                for user in realm_users], batch_size=10000)
+            sender = UserProfile.objects.filter(realm=realm).first()
+            client = get_client(u'benchmark')
+
+            def time_render(contents):
+                # type: (List[text_type]) -> float
+                start = time.time()
+                for content in contents:
+                    message = Message(sender=sender, sending_client=client, content=content)
+                    bugdown.convert(content, message.prepare_to_render(None), message)
+                return (time.time() - start) / len(contents)
+
+            # Load the realm's filters, emoji and alert words.
+            time_render([u'Warming up %s' % (nonce,)])
+            plain_time = time_render([u'Message %d of %s, with **some** markdown.' % (i, nonce)
+                                      for i in range(renders)])
+            mentions = [u'@**%s** message %d of %s, with **some** markdown.'
+                        % (rand.choice(realm_users)['full_name'], i, nonce)
+                        for i in range(renders + 1)]
+            first_mention_time = time_render(mentions[:1])
+            mention_time = time_render(mentions[1:])
+
+            mention.realm_mention_indexes.pop(realm.id, None)
+            transaction.set_rollback(True)
+        return (plain_time, first_mention_time, mention_time)
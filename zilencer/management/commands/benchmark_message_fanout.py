@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+
+from zerver.lib.event_queue import allocate_client_descriptor, clients, \
+    do_gc_event_queues, process_message_event
+
+import time
+
+def build_message_event(message_id, num_recipients, mentioned_every):
+    # type: (int, int, int) -> Dict[str, Any]
+    message_dict = dict(id=message_id, sender_id=1, sender_email='user1@zulip.com',
+                        type='stream', client='website', display_recipient='Verona',
+                        subject='benchmark', content='<p>benchmark</p>')
+    users = []
+    for user_id in range(1, num_recipients + 1):
+        flags = [] # type: List[str]
+        if mentioned_every and user_id % mentioned_every == 0:
+            flags = ['mentioned']
+        users.append(dict(id=user_id, flags=flags, always_push_notify=False))
+    return dict(event=dict(type='message',
+                           message_dict_markdown=message_dict,
+                           message_dict_no_markdown=message_dict,
+                           stream_name='Verona',
+                           invite_only=False,
+                           realm_id=1,
+                           presences={}),
+                users=users)
+
+class Command(BaseCommand):
+    help = """Benchmark the Tornado fan-out of a stream message
+(process_message_event) to the event queues of its recipients.
+
+Run it on trees before and after a change to compare."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--recipients', dest='recipients', type=int, nargs='+',
+                            default=[1000, 10000, 50000],
+                            help='recipient counts to benchmark')
+        parser.add_argument('--queues-per-user', dest='queues_per_user', type=int, default=1,
+                            help='event queues registered by each recipient')
+        parser.add_argument('--narrowed-queues', dest='narrowed_queues', type=int, default=100,
+                            help='extra narrowed queues in the realm that do not match')
+        parser.add_argument('--messages', dest='messages', type=int, default=20,
+                            help='messages sent for each recipient count')
+        parser.add_argument('--mentioned-every', dest='mentioned_every', type=int, default=0,
+                            help='mention every Nth recipient (0 for no mentions); note that '
+                                 'mentions of idle users queue missed-message notifications')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        for num_recipients in options['recipients']:
+            queue_ids = []
+            for user_id in range(1, num_recipients + 1):
+                for i in range(options['queues_per_user']):
+                    queue_ids.append(self.allocate_queue(user_id, []))
+            for i in range(options['narrowed_queues']):
+                queue_ids.append(self.allocate_queue(num_recipients + 1 + i,
+                                                     [['stream', 'Denmark']]))
+
+            elapsed = 0.0
+            for message_id in range(options['messages']):
+                notice = build_message_event(message_id, num_recipients,
+                                             options['mentioned_every'])
+                start = time.time()
+                process_message_event(notice['event'], notice['users'])
+                elapsed += time.time() - start
+                for queue_id in queue_ids:
+                    clients[queue_id].event_queue.prune(message_id)
+
+            print("%6d recipients: %8.2fms per message"
+                  % (num_recipients, 1000 * elapsed / options['messages']))
+
+            do_gc_event_queues(set(queue_ids),
+                               set(clients[queue_id].user_profile_id for queue_id in queue_ids),
+                               set([1]))
+
+    def allocate_queue(self, user_id, narrow):
+        # type: (int, List[List[str]]) -> str
+        client = allocate_client_descriptor(dict(user_profile_id=user_id,
+                                                 user_profile_email='user%d@zulip.com' % (user_id,),
+                                                 realm_id=1,
+                                                 event_types=None,
+                                                 client_type_name='website',
+                                                 apply_markdown=True,
+                                                 all_public_streams=False,
+                                                 queue_timeout=600,
+                                                 last_connection_time=time.time(),
+                                                 narrow=narrow))
+        return client.event_queue.id
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from six import text_type
+
+from zerver.lib.presence import PresenceSnapshot
+
+import random
+import time
+
+def status_dict_from_rows(rows, mobile_user_ids):
+    # type: (List[Dict[str, Any]], List[int]) -> Dict[text_type, Dict[text_type, Dict[str, Any]]]
+    """The loop UserPresence.get_status_dict_by_realm ran over the
+    realm's rows on each ping, with the push device owners in a list."""
+    user_statuses = {} # type: Dict[text_type, Dict[text_type, Dict[str, Any]]]
+    for row in rows:
+        info = dict(client=row['client__name'],
+                    status=row['status'],
+                    timestamp=row['timestamp'],
+                    pushable=(row['user_profile__enable_offline_push_notifications'] and
+                              row['user_profile__id'] in mobile_user_ids))
+        user_statuses.setdefault(row['user_profile__email'], {})[row['client__name']] = info
+    return user_statuses
+
+class Command(BaseCommand):
+    help = """Benchmark answering presence pings for realms of different
+sizes: building the realm's status dict from its presence rows (the
+previous implementation, without the database query itself), against
+a PresenceSnapshot applying a ping's worth of changes and answering
+with a full copy or a delta.  Uses synthetic presence data, so it does
+not need a database."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, nargs='+',
+                            default=[1000, 10000, 50000],
+                            help='realm sizes to benchmark')
+        parser.add_argument('--pings', dest='pings', type=int, default=50,
+                            help='pings answered for each realm size')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rand = random.Random(0)
+        for num_users in options['users']:
+            now = int(time.time())
+            rows = [{'client__name': u'website',
+                     'status': 'active',
+                     'timestamp': now - rand.randint(0, 3600),
+                     'user_profile__email': u'user%d@example.com' % (i,),
+                     'user_profile__id': i,
+                     'user_profile__enable_offline_push_notifications': True,
+                     'user_profile__is_mirror_dummy': False} for i in range(num_users)]
+            mobile_user_ids = [i for i in range(num_users) if rand.random() < 0.2]
+
+            # The old way is slow enough that a few pings tell the story.
+            rounds = min(options['pings'], 5)
+            start = time.time()
+            for i in range(rounds):
+                status_dict_from_rows(rows, mobile_user_ids)
+            rows_time = (time.time() - start) / rounds
+
+            snapshot = PresenceSnapshot(status_dict_from_rows(rows, mobile_user_ids))
+            # Everyone pings every 50 seconds, so between two pings
+            # served by one of (say) 8 processes, about this many users
+            # change, over this many seconds of (simulated) time.
+            num_processes = 8
+            changes_per_ping = max(1, num_users // 50 // num_processes)
+            clock = snapshot.built_at
+            apply_time = 0.0
+            full_time = 0.0
+            delta_time = 0.0
+            for i in range(options['pings']):
+                since = clock
+                start = time.time()
+                for j in range(changes_per_ping):
+                    clock += 50.0 / num_processes / changes_per_ping
+                    user = rand.randrange(num_users)
+                    snapshot.update_client(u'user%d@example.com' % (user,),
+                                           dict(client=u'website', status='active',
+                                                timestamp=int(clock), pushable=None),
+                                           clock)
+                apply_time += time.time() - start
+
+                start = time.time()
+                dict(snapshot.presences)
+                full_time += time.time() - start
+
+                start = time.time()
+                snapshot.get_changes_since(since)
+                delta_time += time.time() - start
+
+            pings = options['pings']
+            print("%6d users: rows %8.3fms per ping; snapshot: applying %d changes %8.4fms, "
+                  "full %8.3fms, delta %8.4fms per ping"
+                  % (num_users, 1000 * rows_time, changes_per_ping, 1000 * apply_time / pings,
+                     1000 * full_time / pings, 1000 * delta_time / pings))
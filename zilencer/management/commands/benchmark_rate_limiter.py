@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from zerver.lib.rate_limiter import api_calls_left, check_and_incr_ratelimit, \
+    clear_user_history, client, is_ratelimited, max_api_calls, max_api_window, \
+    redis_key, token_leases
+from zerver.models import UserProfile
+
+import redis
+import threading
+import time
+
+# How rate_limit_user checked and recorded an API call before it was
+# one script: a pipeline to check, a WATCH/MULTI transaction (retried
+# when another call got in between) to record, and a pipeline for the
+# headers.  Returns how many times the transaction was retried.
+def check_and_incr_in_transaction(user, domain):
+    # type: (UserProfile, str) -> int
+    ratelimited, time_till_free = is_ratelimited(user, domain)
+    if ratelimited:
+        return 0
+    list_key, set_key, blocking_key = redis_key(user, domain)
+    now = time.time()
+    retries = 0
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(list_key)
+                last_val = pipe.lindex(list_key, max_api_calls(user) - 1)
+                pipe.multi()
+                pipe.lpush(list_key, now)
+                pipe.ltrim(list_key, 0, max_api_calls(user) - 1)
+                pipe.zadd(set_key, now, now)
+                if last_val is not None:
+                    pipe.zrem(set_key, last_val)
+                pipe.expire(list_key, max_api_window(user))
+                pipe.expire(set_key, max_api_window(user))
+                pipe.execute()
+                break
+            except redis.WatchError:
+                if retries > 10:
+                    break
+                retries += 1
+    api_calls_left(user, domain)
+    return retries
+
+class Command(BaseCommand):
+    help = """Benchmark rate limiting many concurrent API calls by one
+user: as rate_limit_user used to (a WATCH/MULTI transaction), with
+check_and_incr_ratelimit's script, and with the script and
+RATE_LIMITING_LOCAL_TOKENS.  Uses the first active user, under a
+separate domain (whose keys are deleted afterwards), with limits high
+enough that no call is rate limited."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--threads', dest='threads', type=int, default=32,
+                            help='concurrent workers sharing the user')
+        parser.add_argument('--calls', dest='calls', type=int, default=500,
+                            help='API calls made by each worker')
+        parser.add_argument('--local-tokens', dest='local_tokens', type=int, default=16,
+                            help='RATE_LIMITING_LOCAL_TOKENS for the last run')
+
+    def run(self, name, user, call, options):
+        # type: (str, UserProfile, Callable[[], int], Dict[str, Any]) -> None
+        domain = 'rate-limiter-benchmark'
+        clear_user_history(user, domain)
+        retries = [] # type: List[int]
+
+        def worker():
+            # type: () -> None
+            for i in range(options['calls']):
+                retries.append(call())
+
+        threads = [threading.Thread(target=worker) for i in range(options['threads'])]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        recorded = client.zcard(redis_key(user, domain)[1])
+        clear_user_history(user, domain)
+
+        calls = options['threads'] * options['calls']
+        print("%-22s %9.1f calls/s, %6.3fms per call, %d recorded, %d transaction retries"
+              % (name, calls / elapsed, 1000 * elapsed / calls, recorded, sum(retries)))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        user = UserProfile.objects.filter(is_active=True)[0]
+        # Not saved; just high enough that every call goes through.
+        calls = options['threads'] * options['calls']
+        user.rate_limits = "1:%d,3600:%d" % (calls, calls)
+        domain = 'rate-limiter-benchmark'
+
+        def check_and_incr_in_script():
+            # type: () -> int
+            check_and_incr_ratelimit(user, domain)
+            return 0
+
+        self.run('WATCH/MULTI', user, lambda: check_and_incr_in_transaction(user, domain), options)
+        self.run('script', user, check_and_incr_in_script, options)
+        token_leases.clear()
+        with override_settings(RATE_LIMITING_LOCAL_TOKENS=options['local_tokens']):
+            self.run('script, local tokens', user, check_and_incr_in_script, options)
+        token_leases.clear()
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Optional
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from zerver.lib.actions import do_send_messages, internal_prep_message
+
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark sending batches of messages with do_send_messages,
+compared to sending the same messages one do_send_messages call at a
+time.
+
+This sends real messages, so only run it against a development
+database.  Run it on trees before and after a change to compare."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--sender', dest='sender', type=str,
+                            default='othello@zulip.com',
+                            help='email address of the sender')
+        parser.add_argument('--streams', dest='streams', type=str,
+                            default='Verona,Denmark,Scotland',
+                            help='comma-separated streams to send to, round-robin')
+        parser.add_argument('--pm-recipient', dest='pm_recipient', type=str,
+                            default='hamlet@zulip.com',
+                            help='recipient of the private messages mixed into each batch')
+        parser.add_argument('--batch-sizes', dest='batch_sizes', type=int, nargs='+',
+                            default=[1, 10, 100],
+                            help='batch sizes to benchmark')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=5,
+                            help='batches sent for each batch size')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        streams = [stream.strip() for stream in options['streams'].split(',')]
+        for batch_size in options['batch_sizes']:
+            for batched in [False, True]:
+                elapsed = 0.0
+                num_queries = 0
+                for round_num in range(options['rounds']):
+                    messages = self.prep_messages(options, streams, batch_size)
+                    with CaptureQueriesContext(connection) as queries:
+                        start = time.time()
+                        if batched:
+                            do_send_messages(messages)
+                        else:
+                            for message in messages:
+                                do_send_messages([message])
+                        elapsed += time.time() - start
+                    num_queries += len(queries)
+
+                num_messages = batch_size * options['rounds']
+                print("batch size %4d, %-9s: %7.2fms and %5.1f queries per message"
+                      % (batch_size, "batched" if batched else "unbatched",
+                         1000 * elapsed / num_messages, float(num_queries) / num_messages))
+
+    def prep_messages(self, options, streams, batch_size):
+        # type: (Dict[str, Any], List[str], int) -> List[Optional[Dict[str, Any]]]
+        messages = [] # type: List[Optional[Dict[str, Any]]]
+        for i in range(batch_size):
+            # Every fifth message is a private message, so that the
+            # batch mixes recipient types like the mirror does.
+            if i % 5 == 4:
+                messages.append(internal_prep_message(
+                    options['sender'], 'private', options['pm_recipient'], '',
+                    'benchmark message %d' % (i,)))
+            else:
+                messages.append(internal_prep_message(
+                    options['sender'], 'stream', streams[i % len(streams)], 'benchmark',
+                    'benchmark message %d' % (i,)))
+        return messages
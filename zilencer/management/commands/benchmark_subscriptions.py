@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from zerver.lib.actions import bulk_add_subscriptions, bulk_remove_subscriptions, \
+    create_stream_if_needed, do_add_subscription
+from zerver.lib.create_user import create_user_profile
+from zerver.models import Realm, UserProfile
+
+import mock
+import random
+import time
+
+class Command(BaseCommand):
+    help = """Benchmark subscribing all of a synthetic realm's users to
+a set of streams with bulk_add_subscriptions, and unsubscribing them
+with bulk_remove_subscriptions, reporting the time, database statements
+and events each took; and, for comparison, do_add_subscription one
+user and stream at a time for a sample of them.  Events are counted
+rather than sent, and the realm is rolled back afterwards."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--users', dest='users', type=int, default=10000,
+                            help='users in the realm')
+        parser.add_argument('--streams', dest='streams', type=int, default=50,
+                            help='streams to subscribe them to')
+        parser.add_argument('--subscribed', dest='subscribed', type=int, default=10,
+                            help='percentage of the users already subscribed to each stream')
+        parser.add_argument('--sample', dest='sample', type=int, default=200,
+                            help='subscriptions made one at a time')
+
+    def measure(self, events, action):
+        # type: (List[Dict[str, Any]], Callable[[], Any]) -> str
+        events_before = len(events)
+        queries_before = len(connection.connection.queries)
+        start = time.time()
+        action()
+        elapsed = time.time() - start
+        statements = len(connection.connection.queries) - queries_before
+        return "%8.2fs, %5d statements, %6d events" % (elapsed, statements, len(events) - events_before)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rand = random.Random(0)
+        events = [] # type: List[Dict[str, Any]]
+        with transaction.atomic(), mock.patch('zerver.lib.actions.send_event',
+                                              side_effect=lambda event, users: events.append(event)):
+            realm = Realm.objects.create(domain=u'subs-benchmark.example.com', name=u'Subscriptions benchmark')
+            UserProfile.objects.bulk_create([
+                create_user_profile(realm, u'user%d@subs-benchmark.example.com' % (i,), None, True, None,
+                                    u'User %d' % (i,), u'user%d' % (i,), None, False)
+                for i in range(options['users'])])
+            user_profiles = list(UserProfile.objects.filter(realm=realm))
+            streams = [create_stream_if_needed(realm, u'stream %d' % (i,))[0]
+                       for i in range(options['streams'])]
+            sample_stream = create_stream_if_needed(realm, u'sample stream')[0]
+            connection.ensure_connection()
+
+            # Some users are already on each stream, so that there are
+            # peers to tell about the new subscribers.
+            for stream in streams:
+                bulk_add_subscriptions([stream], rand.sample(
+                    user_profiles, len(user_profiles) * options['subscribed'] // 100))
+
+            add = self.measure(events, lambda: bulk_add_subscriptions(streams, user_profiles))
+            remove = self.measure(events, lambda: bulk_remove_subscriptions(user_profiles, streams))
+            sample = rand.sample(user_profiles, min(options['sample'], len(user_profiles)))
+            one_at_a_time = self.measure(events, lambda: [do_add_subscription(user_profile, sample_stream)
+                                                          for user_profile in sample])
+            transaction.set_rollback(True)
+
+        print("%d users to %d streams: bulk_add_subscriptions %s; bulk_remove_subscriptions %s"
+              % (len(user_profiles), len(streams), add, remove))
+        print("%d users to 1 stream with do_add_subscription: %s" % (len(sample), one_at_a_time))
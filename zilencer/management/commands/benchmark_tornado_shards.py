@@ -0,0 +1,110 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from argparse import ArgumentParser
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from zerver.lib.event_queue import allocate_client_descriptor, \
+    get_notification_shards, is_local_user, process_notification
+
+import multiprocessing
+import random
+import time
+
+def build_message_events(num_events, num_users, recipients_per_event):
+    # type: (int, int, int) -> List[Dict[str, Any]]
+    rng = random.Random(42)
+    events = []
+    for message_id in range(num_events):
+        message_dict = dict(id=message_id, sender_id=1, type='stream', client='website',
+                            display_recipient='Verona', subject='benchmark',
+                            content='<p>benchmark</p>')
+        recipients = rng.sample(range(1, num_users + 1), recipients_per_event)
+        events.append(dict(event=dict(type='message',
+                                      message_dict_markdown=message_dict,
+                                      message_dict_no_markdown=message_dict,
+                                      stream_name='Verona',
+                                      invite_only=True,
+                                      realm_id=1,
+                                      presences={}),
+                           users=[dict(id=user_id, flags=[]) for user_id in recipients]))
+    return events
+
+def run_shard(shard, num_shards, num_users, queues_per_user, events, results):
+    # type: (int, int, int, int, List[Dict[str, Any]], Any) -> None
+    settings.TORNADO_PROCESSES = num_shards
+    settings.TORNADO_SHARD = shard
+
+    for user_id in range(1, num_users + 1):
+        if not is_local_user(user_id):
+            continue
+        for i in range(queues_per_user):
+            allocate_client_descriptor(dict(user_profile_id=user_id,
+                                            user_profile_email='user%d@zulip.com' % (user_id,),
+                                            realm_id=1,
+                                            event_types=None,
+                                            client_type_name='website',
+                                            apply_markdown=True,
+                                            all_public_streams=False,
+                                            queue_timeout=600,
+                                            last_connection_time=time.time(),
+                                            narrow=[]))
+
+    # The routing happens in Django, so it is not part of the shard's time.
+    notices = []
+    for notice in events:
+        shard_users = get_notification_shards(notice['event'], notice['users']).get(shard)
+        if shard_users is not None:
+            notices.append(dict(event=notice['event'], users=shard_users))
+
+    start = time.time()
+    for notice in notices:
+        process_notification(notice)
+    results.put((shard, time.time() - start))
+
+class Command(BaseCommand):
+    help = """Benchmark event queue delivery throughput with the users
+partitioned across a varying number of Tornado shards.
+
+Each shard runs in its own process and delivers its partition of a
+fixed stream of message events to its local event queues; transport
+between Django and Tornado is not included."""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--shards', dest='shards', type=int, nargs='+', default=[1, 2, 4],
+                            help='shard counts to benchmark')
+        parser.add_argument('--users', dest='users', type=int, default=10000,
+                            help='number of users with event queues')
+        parser.add_argument('--queues-per-user', dest='queues_per_user', type=int, default=2,
+                            help='event queues registered by each user')
+        parser.add_argument('--events', dest='events', type=int, default=1000,
+                            help='number of message events to deliver')
+        parser.add_argument('--recipients', dest='recipients', type=int, default=1000,
+                            help='recipients of each message event')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        events = build_message_events(options['events'], options['users'], options['recipients'])
+        deliveries = options['events'] * options['recipients'] * options['queues_per_user']
+        baseline = None
+        for num_shards in options['shards']:
+            results = multiprocessing.Queue() # type: Any
+            workers = [multiprocessing.Process(target=run_shard,
+                                               args=(shard, num_shards, options['users'],
+                                                     options['queues_per_user'], events, results))
+                       for shard in range(num_shards)]
+            for worker in workers:
+                worker.start()
+            elapsed = max(results.get()[1] for worker in workers)
+            for worker in workers:
+                worker.join()
+
+            throughput = deliveries / elapsed
+            if baseline is None:
+                baseline = throughput
+            print("%2d shard(s): %8.3fs  %12.0f queue deliveries/s  (%.2fx)"
+                  % (num_shards, elapsed, throughput, throughput / baseline))
@@ -21,8 +21,7 @@ Usage: python manage.py render_old_messages"""
             messages = Message.objects.filter(rendered_content_version=None)[0:100]
             if len(messages) == 0:
                 break
-            for message in messages:
-                message.maybe_render_content(None, save=True)
+            Message.maybe_render_content_many(messages, None, save=True)
             total_rendered += len(messages)
             print(datetime.datetime.now(), total_rendered)
             # Put in some sleep so this can run safely on low resource machines
@@ -120,6 +120,11 @@ ERROR_REPORTING = True
 # a link to an image is referenced in a message.
 INLINE_IMAGE_PREVIEW = True
 
+# The pages of previewed links (for their OpenGraph metadata) are
+# fetched directly by default; set this to fetch them through an HTTP
+# proxy instead.
+#OPEN_GRAPH_FETCH_PROXY = 'http://proxy.example.com:3128'
+
 # By default, files uploaded by users and user avatars are stored
 # directly on the Zulip server.  If file storage in Amazon S3 is
 # desired, you can configure that as follows:
@@ -183,6 +188,10 @@ ENABLE_GRAVATAR = True
 # 3. Click on the application you created and click "create my access token".
 # 4. Fill in the values for twitter_consumer_key, twitter_consumer_secret, twitter_access_token_key,
 #    and twitter_access_token_secret in /etc/zulip/zulip-secrets.conf.
+#
+# Tweets are fetched from TWITTER_API_URL, which you can point at a
+# compatible endpoint of your own.
+#TWITTER_API_URL = 'https://api.twitter.com/1.1'
 
 ### EMAIL GATEWAY INTEGRATION
 
@@ -327,6 +336,17 @@ CAMO_URI = '/external_content/'
 # Format HOST:PORT
 # MEMCACHED_LOCATION = 127.0.0.1:11211
 
+# Number of hot objects (user profiles, streams, recipients, clients)
+# each server process keeps in an in-process cache in front of
+# memcached, and how many seconds they are kept for.  0 disables it.
+# LOCAL_CACHE_SIZE = 5000
+# LOCAL_CACHE_TTL = 60
+
+# How many worker processes each server process starts to render
+# markdown in, in parallel and with renders that time out killed
+# rather than left running.  0 renders in the server process itself.
+# BUGDOWN_RENDER_PROCESSES = 2
+
 # Redis configuration
 #
 # By default, Zulip connects to redis running locally on the machine,
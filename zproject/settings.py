@@ -96,6 +96,7 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'TWITTER_CONSUMER_SECRET': '',
                     'TWITTER_ACCESS_TOKEN_KEY': '',
                     'TWITTER_ACCESS_TOKEN_SECRET': '',
+                    'TWITTER_API_URL': 'https://api.twitter.com/1.1',
                     'EMAIL_GATEWAY_PATTERN': '',
                     'EMAIL_GATEWAY_EXAMPLE': '',
                     'EMAIL_GATEWAY_BOT': None,
@@ -120,6 +121,9 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'RABBITMQ_USERNAME': 'zulip',
                     'MEMCACHED_LOCATION': '127.0.0.1:11211',
                     'RATE_LIMITING': True,
+                    # Most API calls each process reserves at once for a
+                    # busy user, to skip Redis on the calls after; 0 for off
+                    'RATE_LIMITING_LOCAL_TOKENS': 0,
                     'REDIS_HOST': '127.0.0.1',
                     'REDIS_PORT': 6379,
                     # The following bots only exist in non-VOYAGER installs
@@ -130,11 +134,15 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'APNS_CERT_FILE': None,
                     'APNS_KEY_FILE': None,
                     'ANDROID_GCM_API_KEY': None,
+                    'ANDROID_GCM_URL': 'https://android.googleapis.com/gcm/send',
+                    # (host, port) to send APNs notifications to instead of Apple's
+                    'APNS_GATEWAY': None,
                     'INITIAL_PASSWORD_SALT': None,
                     'FEEDBACK_BOT': 'feedback@zulip.com',
                     'FEEDBACK_BOT_NAME': 'Zulip Feedback Bot',
                     'ADMINS': '',
                     'INLINE_IMAGE_PREVIEW': True,
+                    'OPEN_GRAPH_FETCH_PROXY': None,
                     'CAMO_URI': '',
                     'ENABLE_FEEDBACK': PRODUCTION,
                     'FEEDBACK_EMAIL': None,
@@ -154,6 +162,14 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'EXTRA_INSTALLED_APPS': [],
                     'DEFAULT_NEW_REALM_STREAMS': ["social", "general", "zulip"],
                     'REALM_CREATION_LINK_VALIDITY_DAYS': 7,
+                    # Puppet starts and routes to as many Tornado
+                    # processes as zulip.conf asks for.
+                    'TORNADO_PROCESSES': (config_file.getint('application_server', 'tornado_processes')
+                                          if config_file.has_option('application_server', 'tornado_processes')
+                                          else 1),
+                    'LOCAL_CACHE_SIZE': 0,
+                    'LOCAL_CACHE_TTL': 60,
+                    'BUGDOWN_RENDER_PROCESSES': 0,
                     }
 
 for setting_name, setting_val in six.iteritems(DEFAULT_SETTINGS):
@@ -281,6 +297,7 @@ MIDDLEWARE_CLASSES = (
     'zerver.middleware.JsonErrorHandler',
     'zerver.middleware.RateLimitMiddleware',
     'zerver.middleware.FlushDisplayRecipientCache',
+    'zerver.middleware.SyncLocalCache',
     'django.middleware.common.CommonMiddleware',
     'zerver.middleware.SessionHostDomainMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -318,6 +335,13 @@ INSTALLED_APPS = [
 # We override the port number when running frontend tests.
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
+# Which partition of the event queues this Tornado process owns when
+# TORNADO_PROCESSES > 1; set by `manage.py runtornado --shard`.  In
+# production, set tornado_processes in the [application_server]
+# section of /etc/zulip/zulip.conf rather than TORNADO_PROCESSES, so
+# that puppet configures supervisor and nginx for the same number of
+# shards (see docs/architecture-overview.md).
+TORNADO_SHARD = 0
 
 ########################################################################
 # DATABASE CONFIGURATION